@@ -0,0 +1,425 @@
+"""
+Benchmarks for the speed of the E-step, the M-step and the Hessian on synthetic data.
+The data is simulated with SurvivalModelSimulator for every combination of sequence length,
+number of mutations per sequence, motif lengths, per-target model and number of E-step samples.
+The time to import the entry points in a new interpreter is measured too.
+The timings are compared against a stored baseline, and the script fails if any benchmark is slower
+than the baseline by more than the regression threshold. Every timing is divided by the time of a fixed
+reference workload from the same run, so the comparison is not thrown off by a faster or slower machine,
+and it is skipped if the baseline was made with different versions of python or numpy, or on a different
+architecture or number of CPUs.
+"""
+
+import sys
+import os
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import tempfile
+import shutil
+import time
+import multiprocessing
+
+SAMM_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(SAMM_PATH)
+
+import numpy as np
+import scipy.sparse
+
+from models import ObservedSequenceMutations
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from survival_model_simulator import SurvivalModelSimulatorSingleColumn, SurvivalModelSimulatorMultiColumn
+from mutation_order_gibbs import MutationOrderGibbsSampler
+from survival_problem_grad_descent_workers import PrecalcDataWorker, GradientWorker, LogLikelihoodWorker, HessianWorker
+from sampling_utils import set_random_seed
+from common import NUM_NUCLEOTIDES, NUCLEOTIDES
+
+REFERENCE_BENCHMARK = "reference"
+# The parts of the environment that must match the baseline for the timings to be compared
+ENVIRONMENT_KEYS = ["python", "numpy", "machine", "num_cpus"]
+
+def parse_args():
+    ''' parse command line arguments '''
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--seed',
+        type=int,
+        help='Random number generator seed for replicability',
+        default=1)
+    parser.add_argument('--seq-lens',
+        type=str,
+        help='Comma-separated list of sequence lengths',
+        default='100,300')
+    parser.add_argument('--num-mutations',
+        type=str,
+        help='Comma-separated list of the number of mutations per sequence',
+        default='5,20')
+    parser.add_argument('--motif-lens',
+        type=str,
+        help='Colon-separated list of comma-separated motif lengths; each one is a (hierarchical) model where the center position mutates',
+        default='3:5:3,5,7')
+    parser.add_argument('--per-target-models',
+        type=str,
+        help='Comma-separated list of whether to benchmark a per-target model (0 or 1)',
+        default='0,1')
+    parser.add_argument('--num-e-samples',
+        type=str,
+        help='Comma-separated list of the number of mutation orders to sample per sequence',
+        default='4')
+    parser.add_argument('--num-seqs',
+        type=int,
+        help='Number of sequences in each synthetic dataset',
+        default=5)
+    parser.add_argument('--num-reps',
+        type=int,
+        help='Number of times to repeat each benchmark; the fastest time is kept',
+        default=3)
+    parser.add_argument('--max-hessian-dim',
+        type=int,
+        help='Skip the Hessian benchmark if the Hessian has more rows than this',
+        default=400)
+    parser.add_argument('--num-hessian-samples',
+        type=int,
+        help='Number of mutation orders to calculate the Hessian for',
+        default=20)
+    parser.add_argument('--skip-fit',
+        action='store_true',
+        help='Do not benchmark a full fit_samm run')
+    parser.add_argument('--fit-em-iters',
+        type=int,
+        help='Number of EM iterations for the fit_samm benchmark',
+        default=2)
+    parser.add_argument('--import-modules',
+        type=str,
+        help='Comma-separated list of modules to time importing in a new interpreter',
+        default='fit_samm,run_worker,simulate_shm_star_tree,generate_theta,read_data')
+    parser.add_argument('--baseline-file',
+        type=str,
+        help='JSON file with the baseline timings',
+        default=os.path.join(SAMM_PATH, 'benchmarks', 'baseline.json'))
+    parser.add_argument('--regression-threshold',
+        type=float,
+        help='A benchmark regressed if it is this many times slower than the baseline',
+        default=1.5)
+    parser.add_argument('--min-compare-time',
+        type=float,
+        help='Only compare benchmarks that took at least this many seconds in the baseline, since shorter ones are too noisy',
+        default=0.5)
+    parser.add_argument('--ignore-environment',
+        action='store_true',
+        help='Compare against the baseline even if it was made in a different environment')
+    parser.add_argument('--write-baseline',
+        action='store_true',
+        help='Write the timings to --baseline-file instead of comparing against it')
+    parser.add_argument('--output-file',
+        type=str,
+        help='JSON file to write the timings to',
+        default='_output/benchmarks.json')
+
+    args = parser.parse_args()
+    args.seq_lens = [int(l) for l in args.seq_lens.split(",")]
+    args.num_mutations = [int(m) for m in args.num_mutations.split(",")]
+    args.motif_lens = [[int(m) for m in motif_lens.split(",")] for motif_lens in args.motif_lens.split(":")]
+    args.per_target_models = [bool(int(p)) for p in args.per_target_models.split(",")]
+    args.num_e_samples = [int(n) for n in args.num_e_samples.split(",")]
+    args.import_modules = args.import_modules.split(",") if args.import_modules else []
+    return args
+
+def get_feat_generator(motif_lens):
+    """
+    @return HierarchicalMotifFeatureGenerator for these motif lengths, with the center positions mutating
+    """
+    return HierarchicalMotifFeatureGenerator(
+        motif_lens=motif_lens,
+        left_motif_flank_len_list=[[motif_len/2] for motif_len in motif_lens],
+    )
+
+def simulate_dataset(feat_generator, per_target_model, seq_len, num_mutations, num_seqs):
+    """
+    Simulate sequences with a random theta
+
+    @return theta, list of ObservedSequenceMutations with the base features added
+    """
+    theta_num_col = NUM_NUCLEOTIDES + 1 if per_target_model else 1
+    theta = np.random.randn(feat_generator.feature_vec_len, theta_num_col) * 0.5
+    if per_target_model:
+        theta_mask = feat_generator.get_possible_motifs_to_targets(theta.shape)
+        theta[~theta_mask] = -np.inf
+        simulator = SurvivalModelSimulatorMultiColumn(theta[:, 0:1] + theta[:, 1:], feat_generator, lambda0=0.1)
+    else:
+        probability_matrix = np.ones((feat_generator.feature_vec_len, NUM_NUCLEOTIDES))/3.0
+        possible_motif_mask = feat_generator.get_possible_motifs_to_targets(probability_matrix.shape)
+        probability_matrix[~possible_motif_mask] = 0
+        simulator = SurvivalModelSimulatorSingleColumn(theta, probability_matrix, feat_generator, lambda0=0.1)
+
+    flank_len = max(feat_generator.max_left_motif_flank_len, feat_generator.max_right_motif_flank_len)
+    obs_data = []
+    for _ in range(num_seqs):
+        start_seq = "".join(np.random.choice(list(NUCLEOTIDES), size=seq_len + 2 * flank_len))
+        full_seq_mutation = simulator.simulate(start_seq, percent_mutated=float(num_mutations)/seq_len)
+        obs_seq_mutation = ObservedSequenceMutations(
+            full_seq_mutation.left_flank + full_seq_mutation.start_seq + full_seq_mutation.right_flank,
+            full_seq_mutation.left_flank + full_seq_mutation.end_seq + full_seq_mutation.right_flank,
+            motif_len=max(feat_generator.motif_lens),
+            left_flank_len=feat_generator.max_left_motif_flank_len,
+            right_flank_len=feat_generator.max_right_motif_flank_len,
+        )
+        feat_generator.add_base_features(obs_seq_mutation)
+        obs_data.append(obs_seq_mutation)
+    return theta, obs_data
+
+def time_func(func, num_reps):
+    """
+    @return the fastest time over the repetitions and the result of the last one
+    """
+    times = []
+    for _ in range(num_reps):
+        st_time = time.time()
+        result = func()
+        times.append(time.time() - st_time)
+    return min(times), result
+
+def run_case(args, motif_lens, per_target_model, seq_len, num_mutations, num_e_samples):
+    """
+    Run the benchmarks for one synthetic dataset
+
+    @return dictionary mapping benchmark names to the times in seconds
+    """
+    set_random_seed(args.seed)
+    feat_generator = get_feat_generator(motif_lens)
+    theta, obs_data = simulate_dataset(feat_generator, per_target_model, seq_len, num_mutations, args.num_seqs)
+
+    def _run_gibbs():
+        set_random_seed(args.seed)
+        samples = []
+        for obs_seq_mutation in obs_data:
+            sampler = MutationOrderGibbsSampler(theta, feat_generator, obs_seq_mutation)
+            sampler_res = sampler.run(obs_seq_mutation.mutation_pos_dict.keys(), 0, num_e_samples)
+            samples += sampler_res.samples
+        return samples
+    gibbs_time, samples = time_func(_run_gibbs, args.num_reps)
+
+    def _run_precalc():
+        return [
+            PrecalcDataWorker(
+                sample,
+                feat_generator.create_for_mutation_steps(sample),
+                feat_generator.feature_vec_len,
+                per_target_model,
+            ).run_worker(None)
+            for sample in samples
+        ]
+    precalc_time, precalc_data = time_func(_run_precalc, args.num_reps)
+
+    timings = {
+        "gibbs_sweeps": gibbs_time,
+        "precalc": precalc_time,
+        "gradient": time_func(lambda: GradientWorker(precalc_data, per_target_model).run_worker(theta), args.num_reps)[0],
+        "log_likelihood": time_func(
+            lambda: [LogLikelihoodWorker(sample_data, per_target_model).run_worker(theta) for sample_data in precalc_data],
+            args.num_reps,
+        )[0],
+    }
+    if theta.size <= args.max_hessian_dim:
+        # Only one repetition on a subset of the samples since it is the slowest
+        hessian_worker = HessianWorker(precalc_data[:args.num_hessian_samples], per_target_model)
+        timings["hessian"] = time_func(lambda: hessian_worker.run_worker(theta), 1)[0]
+
+    case_name = "len%d_mut%d_motif%s_%s_samples%d" % (
+        seq_len,
+        num_mutations,
+        "-".join(map(str, motif_lens)),
+        "pertarget" if per_target_model else "single",
+        num_e_samples,
+    )
+    return {"%s/%s" % (name, case_name): t for name, t in timings.iteritems()}
+
+def run_fit(args):
+    """
+    Time a small fit_samm run on a synthetic dataset with the first settings of each benchmark parameter
+
+    @return dictionary mapping the benchmark name to the time in seconds
+    """
+    set_random_seed(args.seed)
+    motif_lens = args.motif_lens[0]
+    feat_generator = get_feat_generator(motif_lens)
+    _, obs_data = simulate_dataset(feat_generator, False, args.seq_lens[0], args.num_mutations[0], args.num_seqs)
+
+    scratch_dir = tempfile.mkdtemp()
+    gene_file = os.path.join(scratch_dir, "genes.csv")
+    seq_file = os.path.join(scratch_dir, "seqs.csv")
+    with open(gene_file, "w") as f:
+        f.write("germline_name,germline_sequence\n")
+        for i, obs_seq_mutation in enumerate(obs_data):
+            f.write("gene%d,%s\n" % (i, obs_seq_mutation.left_flank + obs_seq_mutation.start_seq + obs_seq_mutation.right_flank))
+    with open(seq_file, "w") as f:
+        f.write("germline_name,sequence_name,species,sequence\n")
+        for i, obs_seq_mutation in enumerate(obs_data):
+            f.write("gene%d,seq%d,human,%s\n" % (i, i, obs_seq_mutation.left_flank + obs_seq_mutation.end_seq + obs_seq_mutation.right_flank))
+
+    cmd = [
+        sys.executable,
+        os.path.join(SAMM_PATH, "fit_samm.py"),
+        "--seed", str(args.seed),
+        "--input-naive", gene_file,
+        "--input-mutated", seq_file,
+        "--motif-lens", ",".join(map(str, motif_lens)),
+        "--positions-mutating", ":".join([str(motif_len/2) for motif_len in motif_lens]),
+        "--penalty-params", "0.01",
+        "--em-max-iters", str(args.fit_em_iters),
+        "--unpenalized-em-max-iters", str(args.fit_em_iters),
+        "--num-e-samples", "4",
+        "--burn-in", "2",
+        "--tuning-sample-ratio", "0.2",
+        "--omit-hessian",
+        "--scratch-directory", scratch_dir,
+        "--log-file", os.path.join(scratch_dir, "fit_log.txt"),
+        "--out-file", os.path.join(scratch_dir, "fitted.pkl"),
+    ]
+    st_time = time.time()
+    subprocess.check_call(cmd, cwd=SAMM_PATH)
+    fit_time = time.time() - st_time
+    shutil.rmtree(scratch_dir)
+    return {"fit_samm/motif%s" % "-".join(map(str, motif_lens)): fit_time}
+
+def run_reference(args):
+    """
+    Time a fixed workload of python loops and sparse matrix products, like the ones in the E-step and M-step.
+    The other timings are divided by this one before comparing them to the baseline.
+
+    @return dictionary mapping the benchmark name to the fastest time in seconds
+    """
+    rand_state = np.random.RandomState(0)
+    X = scipy.sparse.random(20000, 500, density=0.01, format="csr", random_state=rand_state)
+    theta = rand_state.randn(500)
+    def _run_reference():
+        total = 0.
+        for i in range(100):
+            total += np.sum(np.exp(X.dot(theta)))
+            counts = {}
+            for j in range(20000):
+                counts[j % 7] = counts.get(j % 7, 0) + j
+        return total
+    return {REFERENCE_BENCHMARK: time_func(_run_reference, args.num_reps)[0]}
+
+def get_environment():
+    """
+    @return dictionary describing where the benchmarks are run
+    """
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "num_cpus": multiprocessing.cpu_count(),
+    }
+
+def get_environment_mismatches(environment, baseline_environment):
+    """
+    @return list of lines describing the differences between the environments that matter for the timings;
+            the exact platform (e.g. kernel version) is not compared
+    """
+    return [
+        "%s: baseline %s, now %s" % (key, baseline_environment.get(key), environment[key])
+        for key in ENVIRONMENT_KEYS
+        if baseline_environment.get(key) != environment[key]
+    ]
+
+def run_imports(args):
+    """
+    Time importing each module in a new interpreter, which is what every batch job and script pays before doing any work
+
+    @return dictionary mapping the benchmark names to the fastest time in seconds
+    """
+    timings = {}
+    for module_name in args.import_modules:
+        code = "import time; st_time = time.time(); import %s; print time.time() - st_time" % module_name
+        import_times = [
+            float(subprocess.check_output([sys.executable, "-c", code], cwd=SAMM_PATH).split()[-1])
+            for _ in range(args.num_reps)
+        ]
+        timings["import/%s" % module_name] = min(import_times)
+    return timings
+
+def compare_to_baseline(timings, baseline_timings, regression_threshold, min_compare_time):
+    """
+    @param timings: dictionary mapping benchmark names to times, including the reference benchmark
+    @param baseline_timings: dictionary mapping benchmark names to times in the baseline, including the reference benchmark
+
+    @return list of lines comparing the timings, list of names of the benchmarks that regressed;
+            the ratios are of the timings relative to the reference benchmark of the same run
+    """
+    reference_ratio = timings[REFERENCE_BENCHMARK]/baseline_timings[REFERENCE_BENCHMARK]
+    lines = [
+        "The reference benchmark took %.2f times as long as in the baseline" % reference_ratio,
+        "%-60s %10s %10s %8s" % ("benchmark", "baseline", "time", "ratio"),
+    ]
+    regressions = []
+    for name in sorted(timings.keys()):
+        if name == REFERENCE_BENCHMARK:
+            continue
+        if name not in baseline_timings:
+            lines.append("%-60s %10s %10.4f" % (name, "-", timings[name]))
+            continue
+        ratio = timings[name]/baseline_timings[name]/reference_ratio
+        flag = ""
+        if baseline_timings[name] >= min_compare_time and ratio > regression_threshold:
+            regressions.append(name)
+            flag = " REGRESSION"
+        lines.append("%-60s %10.4f %10.4f %8.2f%s" % (name, baseline_timings[name], timings[name], ratio, flag))
+    return lines, regressions
+
+def main(args=sys.argv[1:]):
+    args = parse_args()
+
+    timings = run_reference(args)
+    for motif_lens, per_target_model, seq_len, num_mutations, num_e_samples in itertools.product(
+            args.motif_lens,
+            args.per_target_models,
+            args.seq_lens,
+            args.num_mutations,
+            args.num_e_samples):
+        timings.update(run_case(args, motif_lens, per_target_model, seq_len, num_mutations, num_e_samples))
+    if not args.skip_fit:
+        timings.update(run_fit(args))
+    timings.update(run_imports(args))
+
+    results = {
+        "environment": get_environment(),
+        "settings": {
+            "seed": args.seed,
+            "num_seqs": args.num_seqs,
+            "num_reps": args.num_reps,
+        },
+        "timings": timings,
+    }
+    output_dir = os.path.dirname(args.output_file)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output_file, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.write_baseline:
+        with open(args.baseline_file, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print "Wrote baseline to %s" % args.baseline_file
+        return
+
+    with open(args.baseline_file, "r") as f:
+        baseline = json.load(f)
+    mismatches = get_environment_mismatches(results["environment"], baseline["environment"])
+    if mismatches and not args.ignore_environment:
+        print "Not comparing to the baseline since it was made in a different environment:"
+        print "\n".join(mismatches)
+        return
+    lines, regressions = compare_to_baseline(timings, baseline["timings"], args.regression_threshold, args.min_compare_time)
+    print "\n".join(lines)
+    if regressions:
+        print "%d benchmarks are more than %.2f times slower than the baseline" % (len(regressions), args.regression_threshold)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
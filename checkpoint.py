@@ -0,0 +1,135 @@
+"""
+Checkpoints for long model fits, so a fit that was killed can resume where it stopped and
+finish with exactly the same results as a fit that was never interrupted.
+
+All the files are written atomically: they are written to a temporary file first and then renamed,
+so a fit that is killed while writing a checkpoint still has the previous checkpoint.
+"""
+import os
+import glob
+import shutil
+import cPickle
+import numpy as np
+
+from sampling_utils import get_random_state, set_random_state
+
+EM_STATE_FILE = "state.npz"
+EM_TRACES_FILE_PATTERN = "traces_%06d.pkl"
+
+def write_atomic(file_name, write_func):
+    """
+    Write to a temporary file first, so a partially written file is never read
+
+    @param file_name: the file to write
+    @param write_func: function that takes an open file and writes to it
+    """
+    tmp_file_name = "%s.tmp%d" % (file_name, os.getpid())
+    with open(tmp_file_name, "wb") as f:
+        write_func(f)
+    os.rename(tmp_file_name, file_name)
+
+def save_pickle_checkpoint(file_name, obj):
+    """
+    Pickle an object atomically
+    """
+    write_atomic(file_name, lambda f: cPickle.dump(obj, f, protocol=cPickle.HIGHEST_PROTOCOL))
+
+def load_pickle_checkpoint(file_name):
+    """
+    @return the pickled object, None if there is no checkpoint
+    """
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, "rb") as f:
+        return cPickle.load(f)
+
+class EMCheckpoint:
+    """
+    Checkpoint of MCMC_EM.run, saved at the start of every EM iteration. It is a directory with:
+        state.npz: the EM iteration, theta, the mutation orders that initialize the samplers and the
+                state of the random number generator. The samplers of each observation are seeded
+                from this random number generator, so this is enough to reproduce their samples.
+        traces_<n>.pkl: the sampler traces since the previous checkpoint, starting from the n-th E-step.
+                Each one is only written once, so the checkpoints stay cheap as the traces grow.
+    """
+    def __init__(self, checkpoint_dir):
+        """
+        @param checkpoint_dir: directory for this checkpoint
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.num_saved_traces = 0
+
+    def clear(self):
+        if os.path.exists(self.checkpoint_dir):
+            shutil.rmtree(self.checkpoint_dir)
+        self.num_saved_traces = 0
+
+    def save(self, em_iter, theta, init_orders, all_traces):
+        """
+        @param em_iter: the EM iteration that is about to start
+        @param theta: theta at the start of the EM iteration
+        @param init_orders: list of mutation orders to initialize the samplers with, one per observation
+        @param all_traces: list of the traces from every E-step so far
+        """
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        if len(all_traces) > self.num_saved_traces:
+            save_pickle_checkpoint(
+                os.path.join(self.checkpoint_dir, EM_TRACES_FILE_PATTERN % self.num_saved_traces),
+                all_traces[self.num_saved_traces:],
+            )
+            self.num_saved_traces = len(all_traces)
+
+        (rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian), buffer_state = get_random_state()
+        arrays = dict(
+            em_iter=em_iter,
+            theta=theta,
+            order_lens=np.array([len(order) for order in init_orders], dtype=int),
+            orders=np.array([pos for order in init_orders for pos in order], dtype=int),
+            num_traces=len(all_traces),
+            rng_name=rng_name,
+            rng_keys=rng_keys,
+            rng_pos=rng_pos,
+            rng_has_gauss=rng_has_gauss,
+            rng_cached_gaussian=rng_cached_gaussian,
+            buffer_state=buffer_state,
+        )
+        write_atomic(os.path.join(self.checkpoint_dir, EM_STATE_FILE), lambda f: np.savez(f, **arrays))
+
+    def load(self):
+        """
+        Restores the state of the random number generator from the checkpoint
+
+        @return None if there is no checkpoint, otherwise a tuple with the EM iteration to start from,
+                theta, the list of mutation orders to initialize the samplers with, the list of traces so far
+        """
+        state_file = os.path.join(self.checkpoint_dir, EM_STATE_FILE)
+        if not os.path.exists(state_file):
+            return None
+
+        state = np.load(state_file)
+        orders = state["orders"].tolist()
+        order_starts = np.concatenate([[0], np.cumsum(state["order_lens"])])
+        init_orders = [orders[start:end] for start, end in zip(order_starts[:-1], order_starts[1:])]
+
+        # Only read the traces that were saved before this state
+        num_traces = int(state["num_traces"])
+        all_traces = []
+        for traces_file in sorted(glob.glob(os.path.join(self.checkpoint_dir, EM_TRACES_FILE_PATTERN.replace("%06d", "*")))):
+            if len(all_traces) >= num_traces:
+                break
+            all_traces += load_pickle_checkpoint(traces_file)
+        assert(len(all_traces) == num_traces)
+        self.num_saved_traces = num_traces
+
+        set_random_state((
+            (
+                str(state["rng_name"]),
+                state["rng_keys"],
+                int(state["rng_pos"]),
+                int(state["rng_has_gauss"]),
+                float(state["rng_cached_gaussian"]),
+            ),
+            state["buffer_state"],
+        ))
+        return int(state["em_iter"]), state["theta"], init_orders, all_traces
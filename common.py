@@ -3,6 +3,8 @@ import re
 import random
 import warnings
 
+from sampling_utils import sample_index, sample_indices
+
 DEBUG = False
 
 NUM_NUCLEOTIDES = 4
@@ -183,19 +185,15 @@ def sample_multinomial(pvals):
     Sample 1 item from multinomial and get the index of this sample
     will renormalize pvals if needed
     """
-    norm_pvals = np.array(pvals)/np.sum(pvals)
-    assert(np.sum(norm_pvals) > 1 - 1e-10)
-    sample = np.random.multinomial(1, norm_pvals)
-    return np.where(sample == 1)[0][0]
+    assert(np.sum(pvals) > 0)
+    return sample_index(pvals)
 
 def get_random_dna_seq(seq_length, nucleotide_probs=[0.25, 0.25, 0.25, 0.25]):
     """
     Generate a random dna sequence
     """
-    random_nucleotides = [
-        NUCLEOTIDES[sample_multinomial(nucleotide_probs)] for i in range(seq_length)
-    ]
-    return "".join(random_nucleotides)
+    random_nucleotides = sample_indices(nucleotide_probs, seq_length)
+    return "".join([NUCLEOTIDES[i] for i in random_nucleotides])
 
 def get_standard_error_ci_corrected(values, zscore, pen_val_diff):
     """
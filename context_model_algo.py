@@ -3,7 +3,6 @@ import time
 import copy
 import logging as log
 import numpy as np
-import scipy.stats
 
 from mcmc_em import MCMC_EM
 from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
@@ -12,6 +11,7 @@ from model_truncation import ModelTruncation
 from common import *
 from sampler_collection import SamplerCollection
 from mutation_order_gibbs import MutationOrderGibbsSampler
+from perf_registry import PerfRegistry, perf_start_record, perf_timer
 
 class ContextModelAlgo:
     """
@@ -47,12 +47,14 @@ class ContextModelAlgo:
             scratch_dir=scratch_dir,
             per_target_model=args.per_target_model,
             sampling_rate=args.sampling_rate,
+            job_backend=args.job_backend,
         )
         self.em_max_iters = args.em_max_iters
 
         self.true_theta = true_theta
         self.num_e_samples = args.num_e_samples
         self.num_jobs = args.num_jobs
+        self.job_backend = args.job_backend
         self.scratch_dir = scratch_dir
         self.intermediate_out_dir = args.intermediate_out_dir
         self.burn_in = args.burn_in
@@ -68,6 +70,7 @@ class ContextModelAlgo:
         if self.true_theta is not None and self.true_theta.shape == theta.shape:
             theta_err = np.linalg.norm(self.true_theta[theta_mask] - theta[theta_mask])
             if np.var(theta[theta_mask]) > 0:
+                import scipy.stats
                 pearson_r, _ = scipy.stats.pearsonr(self.true_theta[theta_mask], theta[theta_mask])
                 spearman_r, _ = scipy.stats.spearmanr(self.true_theta[theta_mask], theta[theta_mask])
                 log.info("Difference between true and fitted theta %f, pear %f, spear %f" % (theta_err, pearson_r, spearman_r))
@@ -85,36 +88,43 @@ class ContextModelAlgo:
 
         return ll_ratio_lower_bound, log_lik_ratio
 
-    def fit_penalized(self, train_set, penalty_params, max_em_iters, val_set_evaluator=None, init_theta=None, reference_pen_param=None, pool=None):
+    def fit_penalized(self, train_set, penalty_params, max_em_iters, val_set_evaluator=None, init_theta=None, reference_pen_param=None, pool=None, checkpoint=None):
         """
         @param penalty_params: penalty parameter for fitting penalized model
         @param val_set_evaluator: LikelihoodComparer with a given reference model
         @param reference_pen_param: the penalty parameters for the reference model
+        @param checkpoint: EMCheckpoint for MCMC-EM
 
         @return the fitted model after the 2-step procedure
         """
         if init_theta is None:
             init_theta = initialize_theta(self.theta_shape, self.possible_theta_mask, self.zero_theta_mask)
 
-        penalized_theta, _, _, _ = self.em_algo.run(
-            train_set,
-            self.feat_generator,
-            theta=init_theta,
-            possible_theta_mask=self.possible_theta_mask,
-            zero_theta_mask=self.zero_theta_mask,
-            burn_in=self.burn_in,
-            penalty_params=penalty_params,
-            max_em_iters=max_em_iters,
-            max_e_samples=self.num_e_samples * 4,
-            pool=pool,
-        )
-        curr_model_results = MethodResults(penalty_params)
+        perf_registry = PerfRegistry()
+        with perf_registry.activate():
+            penalized_theta, _, _, _ = self.em_algo.run(
+                train_set,
+                self.feat_generator,
+                theta=init_theta,
+                possible_theta_mask=self.possible_theta_mask,
+                zero_theta_mask=self.zero_theta_mask,
+                burn_in=self.burn_in,
+                penalty_params=penalty_params,
+                max_em_iters=max_em_iters,
+                max_e_samples=self.num_e_samples * 4,
+                pool=pool,
+                checkpoint=checkpoint,
+            )
 
-        #### Calculate validation log likelihood (EM surrogate), use to determine if model is any good.
-        log_lik_ratio_lower_bound, log_lik_ratio = self._do_validation_set_checks(
-            penalized_theta,
-            val_set_evaluator,
-        )
+            #### Calculate validation log likelihood (EM surrogate), use to determine if model is any good.
+            perf_start_record(phase="validation")
+            with perf_timer("validation_time"):
+                log_lik_ratio_lower_bound, log_lik_ratio = self._do_validation_set_checks(
+                    penalized_theta,
+                    val_set_evaluator,
+                )
+        curr_model_results = MethodResults(penalty_params)
+        curr_model_results.set_perf_records("penalized", perf_registry.records)
         curr_model_results.set_penalized_theta(
             penalized_theta,
             log_lik_ratio_lower_bound,
@@ -127,10 +137,12 @@ class ContextModelAlgo:
         log.info(get_nonzero_theta_print_lines(penalized_theta, self.feat_generator))
         return curr_model_results
 
-    def refit_unpenalized(self, obs_data, model_result, max_em_iters, hessian_check_iter=None, get_hessian=True, pool=None):
+    def refit_unpenalized(self, obs_data, model_result, max_em_iters, hessian_check_iter=None, get_hessian=True, pool=None, checkpoint=None):
         """
         Refit the model
         Modifies model_result
+
+        @param checkpoint: EMCheckpoint for MCMC-EM
         """
         model_masks = model_result.model_masks
 
@@ -153,20 +165,24 @@ class ContextModelAlgo:
         # Refit over the support from the penalized problem
         init_theta = model_result.penalized_theta[~model_masks.feats_to_remove_mask,:]
         init_theta[model_masks.zero_theta_mask_refit] = 0
-        refit_theta, variance_est, sample_obs_info, _ = self.em_algo.run(
-            obs_data_stage2,
-            feat_generator_stage2,
-            theta=init_theta, # initialize from the lasso version
-            possible_theta_mask=possible_theta_mask_refit,
-            zero_theta_mask=model_masks.zero_theta_mask_refit,
-            burn_in=self.burn_in,
-            penalty_params=(0,0), # now fit with no penalty
-            max_em_iters=max_em_iters,
-            hessian_check_iter=hessian_check_iter,
-            max_e_samples=self.num_e_samples * 4,
-            get_hessian=get_hessian,
-            pool=pool
-        )
+        perf_registry = PerfRegistry()
+        with perf_registry.activate():
+            refit_theta, variance_est, sample_obs_info, _ = self.em_algo.run(
+                obs_data_stage2,
+                feat_generator_stage2,
+                theta=init_theta, # initialize from the lasso version
+                possible_theta_mask=possible_theta_mask_refit,
+                zero_theta_mask=model_masks.zero_theta_mask_refit,
+                burn_in=self.burn_in,
+                penalty_params=(0,0), # now fit with no penalty
+                max_em_iters=max_em_iters,
+                hessian_check_iter=hessian_check_iter,
+                max_e_samples=self.num_e_samples * 4,
+                get_hessian=get_hessian,
+                pool=pool,
+                checkpoint=checkpoint,
+            )
+        model_result.set_perf_records("refit", perf_registry.records)
 
         log.info("==== Refit theta, %s====" % model_result)
         log.info(get_nonzero_theta_print_lines(refit_theta, feat_generator_stage2))
@@ -207,6 +223,7 @@ class ContextModelAlgo:
             self.num_jobs,
             self.scratch_dir,
             get_residuals=True,
+            job_backend=self.job_backend,
         )
         init_orders = [
             np.random.permutation(obs_seq.mutation_pos_dict.keys()).tolist()
@@ -218,6 +235,7 @@ class ContextModelAlgo:
             self.burn_in,
             sampling_rate=self.sampling_rate,
         )
+        sampler_collection.close()
         model_result.set_sampler_results(sampler_results)
 
     def calculate_confidence_intervals(self, model_result, z=1.96):
@@ -0,0 +1,313 @@
+"""
+On-disk cache of processed observations and their base feature matrices.
+
+Each cache entry is a directory named after a hash of the input files and the processing settings.
+The sequences, mutated positions and sparse base feature matrices of all the observations are stored
+as concatenated numpy arrays (.npy), so they can be memory-mapped when loading. The remaining
+per-observation information (collapse lists, metadata) is pickled. Both are written one chunk of
+observations at a time, so the observations can be cached as they are read.
+"""
+import os
+import hashlib
+import cPickle
+import shutil
+import numpy as np
+import scipy.sparse
+
+from models import ObservedSequenceMutations
+
+CACHE_VERSION = 2
+METADATA_FILE = "metadata.pkl"
+# The motif lengths, collapse lists and metadata of the observations, pickled one chunk after another
+OBS_INFO_FILE = "obs_info.pkl"
+ARRAY_NAMES = [
+    "start_seqs",
+    "end_seqs",
+    "seq_offsets",
+    "skipped",
+    "mutation_pos",
+    "mutation_offsets",
+    "feat_indices",
+    "feat_offsets",
+    "feat_indptrs",
+    "feat_indptr_offsets",
+]
+ARRAY_DTYPES = {
+    "start_seqs": np.uint8,
+    "end_seqs": np.uint8,
+    "seq_offsets": np.int64,
+    "skipped": np.int64,
+    "mutation_pos": np.int32,
+    "mutation_offsets": np.int64,
+    "feat_indices": np.int32,
+    "feat_offsets": np.int64,
+    "feat_indptrs": np.int32,
+    "feat_indptr_offsets": np.int64,
+}
+# Shape of each entry of the arrays that are not flat
+ARRAY_SHAPES = {"skipped": (2,)}
+# Arrays with the start of each observation in another array; they have one more entry than there are observations
+OFFSET_ARRAY_NAMES = ["seq_offsets", "mutation_offsets", "feat_offsets", "feat_indptr_offsets"]
+
+def get_feature_generator_settings(feat_generator):
+    """
+    @param feat_generator: FeatureGenerator, can be None
+
+    @return the settings of the feature generator that determine the base feature matrices
+    """
+    if feat_generator is None:
+        return None
+    return (feat_generator.__class__.__name__, feat_generator.feature_vec_len, feat_generator.feature_info_list)
+
+def get_cache_key(file_names, settings):
+    """
+    @param file_names: list of input files
+    @param settings: anything that changes how the input files are processed; must have a stable repr
+
+    @return hex string that identifies the processed data
+    """
+    hasher = hashlib.sha1()
+    hasher.update(str(CACHE_VERSION))
+    for file_name in file_names:
+        with open(file_name, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+    hasher.update(repr(settings))
+    return hasher.hexdigest()
+
+def get_cache_path(cache_dir, file_names, settings):
+    """
+    @return the directory for this cache entry
+    """
+    return os.path.join(cache_dir, get_cache_key(file_names, settings))
+
+class ObsDataCacheWriter:
+    """
+    Writes the observations to a cache directory one chunk at a time, so the processed observations
+    never have to be in memory all at once.
+    The arrays are appended to raw files in a temporary directory and turned into .npy files at the end,
+    and the per-observation information is pickled one chunk after another.
+    The temporary directory is only renamed to the cache directory once everything is written,
+    so a partially written cache is never loaded.
+    """
+    def __init__(self, cache_path, left_flank_len, right_flank_len, feat_generator=None):
+        """
+        @param cache_path: directory for this cache entry
+        @param left_flank_len: the left flank length used to process the observations
+        @param right_flank_len: the right flank length used to process the observations
+        @param feat_generator: if not None, the base feature matrices of the observations are also stored
+        """
+        self.cache_path = cache_path
+        self.left_flank_len = left_flank_len
+        self.right_flank_len = right_flank_len
+        self.feat_generator = feat_generator
+        self.array_names = [name for name in ARRAY_NAMES if feat_generator is not None or not name.startswith("feat_")]
+
+        self.tmp_path = cache_path + ".tmp%d" % os.getpid()
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.raw_files = {
+            name: open(os.path.join(self.tmp_path, "%s.raw" % name), "wb")
+            for name in self.array_names
+        }
+        self.obs_info_file = open(os.path.join(self.tmp_path, OBS_INFO_FILE), "wb")
+        self.num_obs = 0
+        self.array_lens = {name: 0 for name in self.array_names}
+        # The last value of each offset array, which the offsets of the next chunk start from
+        self.last_offsets = {name: 0 for name in OFFSET_ARRAY_NAMES}
+        for name in OFFSET_ARRAY_NAMES:
+            if name in self.raw_files:
+                self._write_array(name, np.zeros(1))
+
+    def _write_array(self, name, arr):
+        arr = np.asarray(arr, dtype=ARRAY_DTYPES[name])
+        arr.tofile(self.raw_files[name])
+        self.array_lens[name] += arr.shape[0]
+
+    def _write_offsets(self, name, lens):
+        offsets = self.last_offsets[name] + np.cumsum(lens, dtype=ARRAY_DTYPES[name])
+        if offsets.size:
+            self.last_offsets[name] = offsets[-1]
+        self._write_array(name, offsets)
+
+    def append(self, obs_data, metadata):
+        """
+        @param obs_data: list of ObservedSequenceMutations
+        @param metadata: list of metadata for each observation
+        """
+        mutation_pos_list = [sorted(obs.mutation_pos_dict.keys()) for obs in obs_data]
+        self._write_array("start_seqs", np.frombuffer("".join([obs.start_seq_with_flanks for obs in obs_data]), dtype=np.uint8))
+        self._write_array("end_seqs", np.frombuffer("".join([obs.end_seq_with_flanks for obs in obs_data]), dtype=np.uint8))
+        self._write_offsets("seq_offsets", [len(obs.start_seq_with_flanks) for obs in obs_data])
+        self._write_array("skipped", np.array([
+            [obs.left_position_offset - self.left_flank_len, obs.right_position_offset - self.right_flank_len]
+            for obs in obs_data
+        ]).reshape((-1, 2)))
+        self._write_array("mutation_pos", sum(mutation_pos_list, []))
+        self._write_offsets("mutation_offsets", [len(m) for m in mutation_pos_list])
+        if self.feat_generator is not None:
+            self._write_array("feat_indices", np.concatenate(
+                [np.zeros(0)] + [obs.feat_matrix_start.indices for obs in obs_data]
+            ))
+            self._write_offsets("feat_offsets", [obs.feat_matrix_start.nnz for obs in obs_data])
+            self._write_array("feat_indptrs", np.concatenate(
+                [np.zeros(0)] + [obs.feat_matrix_start.indptr for obs in obs_data]
+            ))
+            self._write_offsets("feat_indptr_offsets", [obs.feat_matrix_start.indptr.size for obs in obs_data])
+
+        cPickle.dump({
+            "motif_lens": [obs.motif_len for obs in obs_data],
+            "collapse_lists": [obs.collapse_list for obs in obs_data],
+            "metadata": metadata,
+        }, self.obs_info_file, protocol=cPickle.HIGHEST_PROTOCOL)
+        self.num_obs += len(obs_data)
+        for f in self.raw_files.values() + [self.obs_info_file]:
+            f.flush()
+
+    def close(self):
+        """
+        Turns the raw files into .npy files and moves the temporary directory to the cache directory
+        """
+        self.obs_info_file.close()
+        for name in self.array_names:
+            self.raw_files[name].close()
+            raw_file_name = os.path.join(self.tmp_path, "%s.raw" % name)
+            with open(raw_file_name, "rb") as raw_file, open(os.path.join(self.tmp_path, "%s.npy" % name), "wb") as f:
+                np.lib.format.write_array_header_1_0(f, {
+                    "descr": np.lib.format.dtype_to_descr(np.dtype(ARRAY_DTYPES[name])),
+                    "fortran_order": False,
+                    "shape": (self.array_lens[name],) + ARRAY_SHAPES.get(name, ()),
+                })
+                shutil.copyfileobj(raw_file, f)
+            os.remove(raw_file_name)
+        with open(os.path.join(self.tmp_path, METADATA_FILE), "wb") as f:
+            cPickle.dump({
+                "num_obs": self.num_obs,
+                "left_flank_len": self.left_flank_len,
+                "right_flank_len": self.right_flank_len,
+                "feature_vec_len": self.feat_generator.feature_vec_len if self.feat_generator is not None else None,
+            }, f, protocol=cPickle.HIGHEST_PROTOCOL)
+        if os.path.exists(self.cache_path):
+            shutil.rmtree(self.cache_path)
+        os.rename(self.tmp_path, self.cache_path)
+
+    def remove(self):
+        """
+        Removes the temporary directory without writing the cache entry
+        """
+        for f in self.raw_files.values() + [self.obs_info_file]:
+            f.close()
+        shutil.rmtree(self.tmp_path)
+
+def load_obs_data(cache_path, mmap_mode="r"):
+    """
+    @param cache_path: directory for this cache entry
+    @param mmap_mode: passed to np.load; the feature matrices of the observations will point into the memory-mapped arrays
+
+    @return list of ObservedSequenceMutations (with base features if they were stored), list of metadata
+    """
+    with open(os.path.join(cache_path, METADATA_FILE), "rb") as f:
+        cache_meta = cPickle.load(f)
+    for key in ["motif_lens", "collapse_lists", "metadata"]:
+        cache_meta[key] = []
+    with open(os.path.join(cache_path, OBS_INFO_FILE), "rb") as f:
+        while True:
+            try:
+                obs_info = cPickle.load(f)
+            except EOFError:
+                break
+            for key, values in obs_info.iteritems():
+                cache_meta[key] += values
+    arrays = {}
+    for name in ARRAY_NAMES:
+        file_name = os.path.join(cache_path, "%s.npy" % name)
+        if os.path.exists(file_name):
+            # plain ndarray views of the memory-mapped files are faster to slice than memmap objects
+            arrays[name] = np.asarray(np.load(file_name, mmap_mode=mmap_mode))
+
+    seq_offsets = np.array(arrays["seq_offsets"]).tolist()
+    mutation_offsets = np.array(arrays["mutation_offsets"]).tolist()
+    skipped = np.array(arrays["skipped"]).tolist()
+    mutation_pos = np.array(arrays["mutation_pos"]).tolist()
+    has_feats = cache_meta["feature_vec_len"] is not None
+    if has_feats:
+        feat_offsets = np.array(arrays["feat_offsets"]).tolist()
+        feat_indptr_offsets = np.array(arrays["feat_indptr_offsets"]).tolist()
+
+    obs_data = []
+    for i in range(cache_meta["num_obs"]):
+        start_seq = arrays["start_seqs"][seq_offsets[i]:seq_offsets[i + 1]].tostring()
+        end_seq = arrays["end_seqs"][seq_offsets[i]:seq_offsets[i + 1]].tostring()
+        skipped_left, skipped_right = skipped[i]
+        # Pad the sequences so that the skipped regions get the same offsets as before;
+        # the flank indices are given so the padding is never read
+        obs_seq_mutation = ObservedSequenceMutations(
+            start_seq="n" * skipped_left + start_seq + "n" * skipped_right,
+            end_seq="n" * skipped_left + end_seq + "n" * skipped_right,
+            motif_len=cache_meta["motif_lens"][i],
+            left_flank_len=cache_meta["left_flank_len"],
+            right_flank_len=cache_meta["right_flank_len"],
+            collapse_list=cache_meta["collapse_lists"][i],
+            flank_idxs=(skipped_left, skipped_left + len(start_seq)),
+            mutation_pos=mutation_pos[mutation_offsets[i]:mutation_offsets[i + 1]],
+        )
+        if has_feats:
+            feat_indices = arrays["feat_indices"][feat_offsets[i]:feat_offsets[i + 1]]
+            feat_indptr = arrays["feat_indptrs"][feat_indptr_offsets[i]:feat_indptr_offsets[i + 1]]
+            obs_seq_mutation.set_start_feats(scipy.sparse.csr_matrix(
+                (np.ones(feat_indices.size, dtype=bool), feat_indices, feat_indptr),
+                shape=(obs_seq_mutation.seq_len, cache_meta["feature_vec_len"]),
+            ))
+        obs_data.append(obs_seq_mutation)
+    return obs_data, cache_meta["metadata"]
+
+def read_obs_data_cached(cache_dir, file_names, read_func, settings, left_flank_len, right_flank_len, feat_generator=None):
+    """
+    Loads the processed observations from the cache if they are there.
+    Otherwise reads them with `read_func`, adds base features, and stores them in the cache.
+    Each chunk of observations is written to the cache as soon as `read_func` produces it, and the observations
+    are then loaded back from the cache.
+
+    @param cache_dir: directory with all the cache entries; if None, nothing is cached
+    @param file_names: list of input files that `read_func` reads
+    @param read_func: function with no arguments that returns an iterable of chunks of observations,
+                    where each chunk is a tuple with a list of observations and a list of their metadata
+    @param settings: the settings passed to `read_func`
+    @param left_flank_len: the left flank length used to process the observations
+    @param right_flank_len: the right flank length used to process the observations
+    @param feat_generator: if not None, base features are added to the observations
+
+    @return list of ObservedSequenceMutations, list of metadata
+    """
+    if cache_dir is None:
+        obs_data = []
+        metadata = []
+        for chunk_obs_data, chunk_metadata in read_func():
+            if feat_generator is not None:
+                feat_generator.add_base_features_for_list(chunk_obs_data)
+            obs_data += chunk_obs_data
+            metadata += chunk_metadata
+        return obs_data, metadata
+
+    cache_path = get_cache_path(
+        cache_dir,
+        file_names,
+        (settings, left_flank_len, right_flank_len, get_feature_generator_settings(feat_generator)),
+    )
+    if os.path.exists(os.path.join(cache_path, METADATA_FILE)):
+        return load_obs_data(cache_path)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    writer = ObsDataCacheWriter(cache_path, left_flank_len, right_flank_len, feat_generator)
+    try:
+        for chunk_obs_data, chunk_metadata in read_func():
+            if feat_generator is not None:
+                feat_generator.add_base_features_for_list(chunk_obs_data)
+            writer.append(chunk_obs_data, chunk_metadata)
+    except:
+        writer.remove()
+        raise
+    writer.close()
+    return load_obs_data(cache_path)
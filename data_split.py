@@ -1,9 +1,6 @@
 import numpy as np
 import logging as log
 
-from sklearn.model_selection import KFold
-from sklearn.model_selection import GroupKFold
-
 def split(num_obs, metadata, tuning_sample_ratio, number_folds=1, validation_column=None, val_column_idx=None):
     """
     @param num_obs: number of observations
@@ -29,6 +26,10 @@ def split_kfolds(num_obs, meta_data, n_splits, validation_column=None):
     Split into k folds, by group if validation_column is specified
     @return list of tuples, each tuple is train indices and test indices for that fold
     """
+    # sklearn is slow to import and is only needed for k-fold CV
+    from sklearn.model_selection import KFold
+    from sklearn.model_selection import GroupKFold
+
     if validation_column is None:
         # For no validation column just sample data randomly
         return [(train_idx, test_idx) for train_idx, test_idx in KFold(n_splits).split(np.arange(num_obs))]
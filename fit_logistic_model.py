@@ -7,18 +7,25 @@ import argparse
 import os
 import os.path
 import logging as log
+import time
+from multiprocessing import Pool
 import scipy.sparse
 import numpy as np
 
 import data_split
 from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
-from logistic_problem_cvxpy import LogisticRegressionMotif
+from logistic_problem_prox import LogisticRegressionMotifProximal, LogisticSufficientStats
+from logistic_problem_workers import LogisticFoldWorker
+from parallel_worker import MultiprocessingManager
 from fit_model_common import process_motif_length_args
 from model_truncation import ModelTruncation
 from common import *
 from read_data import *
+from data_cache import read_obs_data_cached
+from sampling_utils import set_random_seed
 
 MAX_CVXPY_ITERS = 1000
+MAX_PROX_ITERS = 5000
 
 class LogisticModel:
     def __init__(self, theta):
@@ -33,6 +40,10 @@ def parse_args():
         type=int,
         help='Random number generator seed for replicability',
         default=1)
+    parser.add_argument('--cache-dir',
+        type=str,
+        help='Directory for caching the processed data and base features; the data is processed from scratch if not given',
+        default=None)
     parser.add_argument('--input-naive',
         type=str,
         help='Input CSV file with naive sequences',
@@ -73,6 +84,15 @@ def parse_args():
     parser.add_argument('--per-target-model',
         action='store_true',
         help='Fit a model that allows for different hazard rates for different target nucleotides')
+    parser.add_argument('--solver',
+        type=str,
+        choices=('prox', 'cvxpy'),
+        help='prox = proximal gradient descent on the sparse design matrix, cvxpy = cvxpy on the dense design matrix',
+        default='prox')
+    parser.add_argument('--num-cpu-threads',
+        type=int,
+        help='Number of processes for fitting the folds in parallel',
+        default=1)
     parser.add_argument('--log-file',
         type=str,
         help='Log file',
@@ -96,8 +116,35 @@ def parse_args():
 
     return args
 
-def get_X_y_matrices(obs_data, per_target_model):
+def get_max_iters(solver):
+    return MAX_CVXPY_ITERS if solver == "cvxpy" else MAX_PROX_ITERS
+
+def get_logistic_problem(solver, theta_shape, data, per_target_model):
+    """
+    @param solver: "prox" or "cvxpy"; cvxpy is only imported if it is used
+    @param theta_shape: shape of theta
+    @param data: tuple with the dense X matrix, y and y_orig for the cvxpy solver (see get_X_y_matrices),
+                or with the sparse X matrix, y, y_orig and the row counts for the prox solver (see get_logistic_counts)
+    @param per_target_model: whether the substitution probabilities are modeled too
+
+    @return the logistic regression problem
+    """
+    if solver == "cvxpy":
+        from logistic_problem_cvxpy import LogisticRegressionMotif
+        return LogisticRegressionMotif(theta_shape, *data, per_target_model=per_target_model)
+    X, y, y_orig, counts = data
+    return LogisticRegressionMotifProximal(theta_shape, X, y, y_orig, per_target_model=per_target_model, counts=counts)
+
+def get_logistic_counts(obs_data, per_target_model):
     """
+    @return LogisticSufficientStats with the number of positions with each combination of features and outcome
+    """
+    return LogisticSufficientStats.from_X_y(*get_X_y_matrices(obs_data, per_target_model, dense=False))
+
+def get_X_y_matrices(obs_data, per_target_model, dense=True):
+    """
+    @param dense: whether to return X as a dense matrix instead of a sparse one
+
     @return X matrix for each position of each sequence
             y matrix with the indicator of mutation or the target nucleotide (depends on if per-target specified)
             y matrix of the original nucleotide
@@ -118,30 +165,44 @@ def get_X_y_matrices(obs_data, per_target_model):
         ys.append(y_vec)
         y_origs.append(y_orig)
 
-    stacked_X = scipy.sparse.vstack(X).todense()
+    stacked_X = scipy.sparse.vstack(X, format="csr")
+    if dense:
+        stacked_X = stacked_X.todense()
     stacked_y = np.concatenate(ys)
     stacked_y_origs = np.concatenate(y_origs)
     return stacked_X, stacked_y, stacked_y_origs
 
-def get_best_penalty_param(penalty_params, data_folds, max_iters=MAX_CVXPY_ITERS):
+def get_best_penalty_param(penalty_params, data_folds, max_iters=MAX_CVXPY_ITERS, pool=None):
     """
-    Use Cross validation/training validation split to get the best penalty parameter
+    Use Cross validation/training validation split to get the best penalty parameter.
+    Each fold fits the penalty parameters in the given order, and each fit starts from the previous solution
+    if the solver supports warm starts.
+    @param pool: multiprocessing pool for fitting the folds in parallel
     @return best penalty parameter
     """
     if len(penalty_params) == 1:
         return penalty_params[0]
 
     # Fit the models for each penalty parameter
+    worker_list = [
+        LogisticFoldWorker(fold_idx, fold_idx, logistic_reg, val_data, penalty_params, max_iters)
+        for fold_idx, (val_data, logistic_reg) in enumerate(data_folds)
+    ]
+    if pool is not None and len(worker_list) > 1:
+        manager = MultiprocessingManager(pool, worker_list, num_approx_batches=len(worker_list), pool_chunksize=1)
+        fold_results = manager.run()
+    else:
+        fold_results = [worker.run_worker(None) for worker in worker_list]
+    if len(fold_results) != len(worker_list) or any([res is None for res in fold_results]):
+        raise ValueError("Failed to fit the logistic regression for all the folds")
+
     tot_validation_values = []
-    for penalty_param in penalty_params:
+    for param_idx, penalty_param in enumerate(penalty_params):
         tot_validation_value = 0
-        for fold_idx, (val_X, val_y, val_y_orig, logistic_reg) in enumerate(data_folds):
-            theta_raw, theta_part_agg, train_value = logistic_reg.solve(
-                    lam_val=penalty_param,
-                    max_iters=max_iters,
-                    verbose=False)
-            tot_validation_value += logistic_reg.score(val_X, val_y, val_y_orig)
-            log.info("theta support %d", np.sum(np.abs(theta_raw) > 1e-5))
+        for fold_idx, fold_res in enumerate(fold_results):
+            res = fold_res[param_idx]
+            tot_validation_value += res.validation_value
+            log.info("fold %d, penalty_param %f: theta support %d, time %f", fold_idx, penalty_param, np.sum(np.abs(res.theta) > 1e-5), res.fit_time)
         tot_validation_values.append([penalty_param, tot_validation_value])
         log.info("penalty_param %f, tot_val %f", penalty_param, tot_validation_value)
 
@@ -149,26 +210,24 @@ def get_best_penalty_param(penalty_params, data_folds, max_iters=MAX_CVXPY_ITERS
     best_pen_param = tot_validation_values[np.argmax(tot_validation_values[:,1]),0]
     return best_pen_param
 
-def fit_to_data(obs_data, pen_param, theta_shape, per_target_model, max_iters=MAX_CVXPY_ITERS):
+def fit_to_data(data, pen_param, theta_shape, per_target_model, solver="prox"):
     """
+    @param data: the data for get_logistic_problem
+
     @return the fitted theta (includes the intercept) for this dataset
     """
-    obs_X, obs_y, obs_y_orig = get_X_y_matrices(obs_data, per_target_model)
-    logistic_reg = LogisticRegressionMotif(
-            theta_shape,
-            obs_X,
-            obs_y,
-            obs_y_orig,
-            per_target_model=per_target_model)
+    logistic_reg = get_logistic_problem(solver, theta_shape, data, per_target_model)
+    st_time = time.time()
     _, theta, _ = logistic_reg.solve(pen_param,
-            max_iters=max_iters,
+            max_iters=get_max_iters(solver),
             verbose=False)
+    log.info("refit time %f", time.time() - st_time)
     return theta
 
 def main(args=sys.argv[1:]):
     args = parse_args()
     log.basicConfig(format="%(message)s", filename=args.log_file, level=log.DEBUG)
-    np.random.seed(args.seed)
+    set_random_seed(args.seed)
 
     feat_generator = HierarchicalMotifFeatureGenerator(
         motif_lens=args.motif_lens,
@@ -177,17 +236,23 @@ def main(args=sys.argv[1:]):
     theta_shape = (feat_generator.feature_vec_len, NUM_NUCLEOTIDES + 1 if args.per_target_model else 1)
 
     log.info("Reading data")
-    obs_data, metadata = read_gene_seq_csv_data(
-        args.input_naive,
-        args.input_mutated,
-        motif_len=args.max_motif_len,
-        left_flank_len=args.max_left_flank,
-        right_flank_len=args.max_right_flank,
+    obs_data, metadata = read_obs_data_cached(
+        args.cache_dir,
+        [args.input_naive, args.input_mutated],
+        lambda: [read_gene_seq_csv_data_bulk(
+            args.input_naive,
+            args.input_mutated,
+            motif_len=args.max_motif_len,
+            left_flank_len=args.max_left_flank,
+            right_flank_len=args.max_right_flank,
+        )],
+        args.max_motif_len,
+        args.max_left_flank,
+        args.max_right_flank,
+        feat_generator=feat_generator,
     )
     log.info("num observations %d", len(obs_data))
 
-    feat_generator.add_base_features_for_list(obs_data)
-
     # Process data
     fold_indices = data_split.split(
         len(obs_data),
@@ -196,30 +261,42 @@ def main(args=sys.argv[1:]):
         args.k_folds,
         validation_column=args.validation_col,
     )
+    if args.solver == "prox":
+        # Collapse the positions into counts of the distinct rows of the data.
+        # The training counts of each fold are the total counts minus its validation counts.
+        all_counts = get_logistic_counts(obs_data, args.per_target_model)
+        all_data = all_counts.get_X_y_counts()
+        log.info("collapsed %d positions into %d rows", np.sum(all_data[3]), all_data[0].shape[0])
+    else:
+        all_data = get_X_y_matrices(obs_data, args.per_target_model)
     data_folds = []
     for train_idx, val_idx in fold_indices:
-        train_set = [obs_data[i] for i in train_idx]
         val_set = [obs_data[i] for i in val_idx]
-        train_X, train_y, train_y_orig = get_X_y_matrices(train_set, args.per_target_model)
-        val_X, val_y, val_y_orig = get_X_y_matrices(val_set, args.per_target_model)
-        logistic_reg = LogisticRegressionMotif(
-                theta_shape,
-                train_X,
-                train_y,
-                train_y_orig,
-                per_target_model=args.per_target_model)
-        data_folds.append((val_X, val_y, val_y_orig, logistic_reg))
+        if args.solver == "prox":
+            val_counts = get_logistic_counts(val_set, args.per_target_model)
+            train_data = all_counts.subtract(val_counts).get_X_y_counts()
+            val_data = val_counts.get_X_y_counts()
+        else:
+            train_set = [obs_data[i] for i in train_idx]
+            train_data = get_X_y_matrices(train_set, args.per_target_model)
+            val_data = get_X_y_matrices(val_set, args.per_target_model)
+        logistic_reg = get_logistic_problem(args.solver, theta_shape, train_data, args.per_target_model)
+        data_folds.append((val_data, logistic_reg))
 
     # Fit the models for each penalty parameter
-    best_pen_param = get_best_penalty_param(args.penalty_params, data_folds)
+    pool = Pool(args.num_cpu_threads) if args.num_cpu_threads > 1 else None
+    best_pen_param = get_best_penalty_param(args.penalty_params, data_folds, max_iters=get_max_iters(args.solver), pool=pool)
+    if pool is not None:
+        pool.close()
     log.info("best penalty param %f", best_pen_param)
 
     # Refit penalized with all the data
     penalized_theta = fit_to_data(
-            obs_data,
+            all_data,
             best_pen_param,
             theta_shape,
-            args.per_target_model)
+            args.per_target_model,
+            solver=args.solver)
     lines = get_nonzero_theta_print_lines(penalized_theta, feat_generator)
     log.info("========penalized==========")
     log.info(lines)
@@ -6,7 +6,7 @@ import sys
 import argparse
 import os
 import os.path
-import pickle
+import shutil
 import logging as log
 import time
 from multiprocessing import Pool
@@ -15,14 +15,22 @@ import numpy as np
 
 from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from mutation_order_gibbs import MutationOrderGibbsSampler
+from mutation_order_smc import MutationOrderSMCSampler
 from survival_problem_lasso import SurvivalProblemLasso
 from samm_worker import SammWorker
-from parallel_worker import MultiprocessingManager
+from fold_penalty_scheduler import FoldPenaltyScheduler
 from context_model_algo import ContextModelAlgo
 import data_split
 from fit_model_common import process_motif_length_args
 from common import *
 from read_data import *
+from data_cache import read_obs_data_cached
+from result_store import ResultStore
+from checkpoint import EMCheckpoint, save_pickle_checkpoint, load_pickle_checkpoint
+from perf_registry import write_perf_json
+from sampling_utils import set_random_seed
+
+FIT_CHECKPOINT_FILE = "fit_state.pkl"
 
 def parse_args():
     ''' parse command line arguments '''
@@ -33,6 +41,10 @@ def parse_args():
         type=int,
         help='Random number generator seed for replicability',
         default=1)
+    parser.add_argument('--cache-dir',
+        type=str,
+        help='Directory for caching the processed data and base features; the data is processed from scratch if not given',
+        default=None)
     parser.add_argument('--input-naive',
         type=str,
         help='Input CSV file with naive sequences',
@@ -41,6 +53,44 @@ def parse_args():
         type=str,
         help='Input CSV file with naive sequences',
         default='_output/mutated.csv')
+    parser.add_argument('--path-to-annotations',
+        type=str,
+        help='Path to partis annotations; if given, the data is read from the annotations instead of --input-naive/--input-mutated',
+        default=None)
+    parser.add_argument('--metadata-path',
+        type=str,
+        help='Metadata with subject/species/locus information for the partis annotations',
+        default=None)
+    parser.add_argument("--locus",
+        type=str,
+        choices=('','igh','igk','igl'),
+        help="locus for use in partis annotations (igh, igk or igl; default selects all loci)",
+        default='')
+    parser.add_argument("--species",
+        type=str,
+        choices=('','mouse','human'),
+        help="species for use in partis annotations (mouse or human; default selects all species in data)",
+        default='')
+    parser.add_argument('--group',
+        type=str,
+        help="a group that's in the metadata file to filter by (defaults to no filter)",
+        default='')
+    parser.add_argument('--region',
+        type=str,
+        choices=('v','d','j','vdj'),
+        help="region of BCR to return",
+        default='v')
+    parser.add_argument('--germline-family',
+        type=str,
+        choices=('v','d','j'),
+        help="germline family to use for validation splits",
+        default='v')
+    parser.add_argument('--use-out-of-frame-seqs',
+        action='store_true',
+        help='use out-of-frame seqs?')
+    parser.add_argument('--filter-indels',
+        action='store_true',
+        help='ignore sequences that had indels?')
     parser.add_argument('--sample-regime',
         type=int,
         default=1,
@@ -58,6 +108,11 @@ def parse_args():
         type=int,
         help='Number of jobs to submit to a Slurm cluster during E-step. (If using only 1 job, it does not submit to a cluster.)',
         default=1)
+    parser.add_argument('--job-backend',
+        type=str,
+        choices=('slurm', 'local'),
+        help='Where to run the jobs when --num-jobs is more than 1: on a Slurm cluster, or on that many long-lived worker processes on this host',
+        default='slurm')
     parser.add_argument('--motif-lens',
         type=str,
         help='Comma-separated list of motif lengths for the motif model we are fitting',
@@ -100,14 +155,30 @@ def parse_args():
         type=int,
         help='Number of gibbs sweep to perform to get one sample',
         default=1)
+    parser.add_argument('--e-step-sampler',
+        type=str,
+        choices=('gibbs', 'smc'),
+        help='Sampler for the E-step: gibbs sampler or sequential Monte Carlo (weighted samples, number of particles is --num-e-samples)',
+        default='gibbs')
     parser.add_argument('--log-file',
         type=str,
         help='Log file',
         default='_output/context_log.txt')
     parser.add_argument('--out-file',
         type=str,
-        help='Output file with pickled context model',
-        default='_output/context_model.pkl')
+        help='Output directory with the fitted context models (see result_store)',
+        default='_output/context_model')
+    parser.add_argument('--checkpoint-dir',
+        type=str,
+        help='Directory for the checkpoints of the fit; --out-file with a "_checkpoints" suffix by default',
+        default=None)
+    parser.add_argument('--perf-file',
+        type=str,
+        help='JSON file for the timings and counters of each fit; --out-file with a "_perf.json" suffix by default',
+        default=None)
+    parser.add_argument('--resume',
+        action='store_true',
+        help='Resume from the last checkpoint of a fit with the same settings that was interrupted')
     parser.add_argument("--penalty-params",
         type=str,
         help="Comma-separated list of penalty parameters",
@@ -149,7 +220,10 @@ def parse_args():
     args.problem_solver_cls = SurvivalProblemLasso
 
     # Determine sampler
-    args.sampler_cls = MutationOrderGibbsSampler
+    if args.e_step_sampler == 'smc':
+        args.sampler_cls = MutationOrderSMCSampler
+    else:
+        args.sampler_cls = MutationOrderGibbsSampler
     if args.per_target_model:
         # First column is the median theta value and the remaining columns are the offset for that target nucleotide
         args.theta_num_col = NUM_NUCLEOTIDES + 1
@@ -159,6 +233,10 @@ def parse_args():
     process_motif_length_args(args)
 
     args.intermediate_out_dir = os.path.dirname(args.out_file)
+    if args.checkpoint_dir is None:
+        args.checkpoint_dir = "%s_checkpoints" % args.out_file.rstrip("/")
+    if args.perf_file is None:
+        args.perf_file = "%s_perf.json" % os.path.splitext(args.out_file.rstrip("/"))[0]
 
     # sort penalty params from largest to smallest
     args.penalty_params = [float(p) for p in args.penalty_params.split(",")]
@@ -185,10 +263,10 @@ def _check_same_support(model_results):
 def main(args=sys.argv[1:]):
     args = parse_args()
     log.basicConfig(format="%(message)s", filename=args.log_file, level=log.DEBUG)
-    np.random.seed(args.seed)
+    set_random_seed(args.seed)
 
-    if max(args.k_folds, args.num_cpu_threads) > 1:
-        all_runs_pool = Pool(max(args.k_folds, args.num_cpu_threads))
+    if args.num_cpu_threads > 1:
+        all_runs_pool = Pool(args.num_cpu_threads)
     else:
         all_runs_pool = None
 
@@ -198,15 +276,52 @@ def main(args=sys.argv[1:]):
     )
 
     log.info("Reading data")
-    obs_data, metadata = read_gene_seq_csv_data(
-        args.input_naive,
-        args.input_mutated,
-        motif_len=args.max_motif_len,
-        left_flank_len=args.max_left_flank,
-        right_flank_len=args.max_right_flank,
+    if args.path_to_annotations is not None:
+        seq_filters = {}
+        if args.filter_indels:
+            seq_filters['indel_reversed_seqs'] = ['']
+        if args.use_out_of_frame_seqs:
+            seq_filters['in_frames'] = [False]
+        filters = {
+            'group': [args.group],
+            'locus': [args.locus],
+            'species': [args.species],
+        }
+        input_files = get_partis_annotation_files(args.path_to_annotations, args.metadata_path)
+        read_settings = (args.max_motif_len, filters, seq_filters, args.region, args.germline_family)
+        read_func = lambda: read_partis_data_chunks_from_annotations(
+            args.path_to_annotations,
+            args.metadata_path,
+            motif_len=args.max_motif_len,
+            left_flank_len=args.max_left_flank,
+            right_flank_len=args.max_right_flank,
+            filters=filters,
+            seq_filters=seq_filters,
+            region=args.region,
+            germline_family=args.germline_family,
+            pool=all_runs_pool,
+            num_threads=args.num_cpu_threads,
+        )
+    else:
+        input_files = [args.input_naive, args.input_mutated]
+        read_settings = args.max_motif_len
+        read_func = lambda: [read_gene_seq_csv_data_bulk(
+            args.input_naive,
+            args.input_mutated,
+            motif_len=args.max_motif_len,
+            left_flank_len=args.max_left_flank,
+            right_flank_len=args.max_right_flank,
+        )]
+    obs_data, metadata = read_obs_data_cached(
+        args.cache_dir,
+        input_files,
+        read_func,
+        read_settings,
+        args.max_left_flank,
+        args.max_right_flank,
+        feat_generator=feat_generator,
     )
 
-    feat_generator.add_base_features_for_list(obs_data)
     fold_indices = data_split.split(
         len(obs_data),
         metadata,
@@ -227,74 +342,133 @@ def main(args=sys.argv[1:]):
     log.info("Settings %s" % args)
     log.info("Running EM")
 
+    if all_runs_pool is not None:
+        # Each fit below runs in its own process with its own pool
+        all_runs_pool.close()
+        all_runs_pool.join()
+
     # Run EM on the lasso parameters from largest to smallest
-    results_list = []
-    val_set_evaluators = [None for _ in fold_indices]
+    # Each (fold, penalty parameter) fit is a task: the folds are fit concurrently, and each fit warm-starts
+    # from the fit of the previous penalty parameter in the same fold
+    num_folds = len(data_folds)
+    num_params = len(args.penalty_params)
+    results_list = [[None for _ in data_folds] for _ in args.penalty_params]
+    result_store = ResultStore(args.out_file)
     cmodel_algos = [ContextModelAlgo(feat_generator, args) for _ in fold_indices]
-    prev_pen_theta = None
-    best_model_idx = 0
-    for param_i, penalty_param in enumerate(args.penalty_params):
-        param_results = []
-        penalty_params_prev = None if param_i == 0 else args.penalty_params[param_i - 1]
+    # The fit is checkpointed after each task, and MCMC-EM is checkpointed at every iteration
+    fit_checkpoint_file = os.path.join(args.checkpoint_dir, FIT_CHECKPOINT_FILE)
+    fit_state = load_pickle_checkpoint(fit_checkpoint_file) if args.resume else None
+    if fit_state is not None:
+        for fold_idx, num_params_done in enumerate(fit_state["fold_num_params_done"]):
+            for param_i in range(num_params_done):
+                results_list[param_i][fold_idx] = result_store.load_result(param_i, fold_idx)
+        log.info("Resuming after %s penalty parameters in each fold" % fit_state["fold_num_params_done"])
+    else:
+        fit_state = dict(
+            # Number of penalty parameters that each fold has fit
+            fold_num_params_done=[0 for _ in data_folds],
+            val_set_evaluators=[None for _ in data_folds],
+            # Number of penalty parameters that all the folds have fit and that the stopping rule has checked
+            num_params_checked=0,
+            best_model_idx=0,
+            stop_fitting=False,
+        )
+        result_store.clear()
+        if not args.resume and os.path.exists(args.checkpoint_dir):
+            shutil.rmtree(args.checkpoint_dir)
+    if not os.path.exists(args.checkpoint_dir):
+        os.makedirs(args.checkpoint_dir)
+
+    def _make_samm_worker(param_i, fold_idx):
+        train_set, val_set = data_folds[fold_idx]
+        penalty_param = args.penalty_params[param_i]
         target_penalty_param = penalty_param if args.per_target_model else 0
-        penalty_params = (penalty_param, target_penalty_param)
-        log.info("==== Penalty parameters %f, %f ====" % penalty_params)
-        workers = []
-        for fold_idx, (train_set, val_set) in enumerate(data_folds):
-            log.info("========= Fold %d ==============" % fold_idx)
-            prev_pen_theta = results_list[param_i - 1][fold_idx].penalized_theta if param_i else None
-            val_set_evaluator = val_set_evaluators[fold_idx]
-            # Use the same number of order samples as previous validation set if possible
-            prev_num_val_samples = val_set_evaluator.num_samples if val_set_evaluator is not None else args.num_val_samples
-            samm_worker = SammWorker(
-                fold_idx,
-                cmodel_algos[fold_idx],
-                train_set,
-                penalty_params,
-                args.em_max_iters,
-                val_set_evaluator,
-                prev_pen_theta,
-                penalty_params_prev,
-                val_set,
-                prev_num_val_samples,
-                args)
-            workers.append(samm_worker)
-        if args.k_folds > 1:
-            # We will be using the MultiprocessingManager handle fitting theta for each fold (so python's multiprocessing lib)
-            manager = MultiprocessingManager(all_runs_pool, workers, num_approx_batches=len(workers))
-            results = manager.run()
-        else:
-            # We will be using the MultiprocessingManager parallelize computations within the M-step
-            results = [w.run(all_runs_pool) for w in workers]
-
-        param_results = [r[0] for r in results]
-        results_list.append(param_results)
-        val_set_evaluators = [r[1] for r in results]
-
-        with open(args.out_file, "w") as f:
-            pickle.dump(results_list, f)
-
-        nonzeros = np.array([res.penalized_num_nonzero for res in param_results])
-        log_lik_ratios = np.array([r.log_lik_ratio for r in param_results])
-        log.info("Log lik ratios %s" % log_lik_ratios)
-        if any(nonzeros) and param_i > 0:
-            cv_interval = get_interval(log_lik_ratios, zscore=1)
-            log.info("log lik interval %s", cv_interval)
-            if cv_interval[0] < -ZERO_THRES:
-                # Make sure that the penalty isnt so big that theta is empty
-                # One std error below the mean for the log lik ratios surrogate is negative
-                # Time to stop shrinking penalty param
-                # This model is not better than the previous model. Stop trying penalty parameters.
-                # Time to refit the model
-                log.info("EM surrogate function is decreasing. Stop trying penalty parameters. ll_ratios %s" % log_lik_ratios)
+        log.info("==== Penalty parameters %f, %f, fold %d ====" % (penalty_param, target_penalty_param, fold_idx))
+        val_set_evaluator = fit_state["val_set_evaluators"][fold_idx]
+        # Use the same number of order samples as previous validation set if possible
+        prev_num_val_samples = val_set_evaluator.num_samples if val_set_evaluator is not None else args.num_val_samples
+        return SammWorker(
+            fold_idx,
+            cmodel_algos[fold_idx],
+            train_set,
+            (penalty_param, target_penalty_param),
+            args.em_max_iters,
+            val_set_evaluator,
+            results_list[param_i - 1][fold_idx].penalized_theta if param_i else None,
+            None if param_i == 0 else args.penalty_params[param_i - 1],
+            val_set,
+            prev_num_val_samples,
+            args,
+            checkpoint=EMCheckpoint(os.path.join(args.checkpoint_dir, "em_param%d_fold%d" % (param_i, fold_idx))))
+
+    scheduler = FoldPenaltyScheduler(num_folds, num_params, args.num_cpu_threads, args.checkpoint_dir)
+    if fit_state["stop_fitting"]:
+        scheduler.prune(fit_state["num_params_checked"] - 1)
+    for param_i, fold_idx, (method_res, val_set_evaluator) in scheduler.run(_make_samm_worker, fit_state["fold_num_params_done"]):
+        if fit_state["stop_fitting"] and param_i >= fit_state["num_params_checked"]:
+            # This task was already running when the fits stopped improving
+            val_set_evaluator.close()
+            continue
+        results_list[param_i][fold_idx] = method_res
+        result_store.save(param_i, fold_idx, method_res)
+        # The evaluator for the previous penalty parameter of this fold is not used anymore
+        if fit_state["val_set_evaluators"][fold_idx] is not None:
+            fit_state["val_set_evaluators"][fold_idx].close()
+        fit_state["val_set_evaluators"][fold_idx] = val_set_evaluator
+        fit_state["fold_num_params_done"][fold_idx] = param_i + 1
+
+        # Check the penalty parameters that all the folds have fit, from largest to smallest
+        while not fit_state["stop_fitting"] and fit_state["num_params_checked"] < num_params:
+            check_param_i = fit_state["num_params_checked"]
+            param_results = results_list[check_param_i]
+            if None in param_results:
                 break
-
-        best_model_idx = param_i
-
-        if np.mean(nonzeros) == feat_generator.feature_vec_len:
-            # Model is saturated so stop fitting new parameters
-            log.info("Model is saturated with %d parameters. Stop fitting." % np.mean(nonzeros))
-            break
+            fit_state["num_params_checked"] += 1
+
+            nonzeros = np.array([res.penalized_num_nonzero for res in param_results])
+            log_lik_ratios = np.array([r.log_lik_ratio for r in param_results])
+            log.info("Penalty param %d: Log lik ratios %s" % (check_param_i, log_lik_ratios))
+            if any(nonzeros) and check_param_i > 0:
+                cv_interval = get_interval(log_lik_ratios, zscore=1)
+                log.info("log lik interval %s", cv_interval)
+                if cv_interval[0] < -ZERO_THRES:
+                    # Make sure that the penalty isnt so big that theta is empty
+                    # One std error below the mean for the log lik ratios surrogate is negative
+                    # Time to stop shrinking penalty param
+                    # This model is not better than the previous model. Stop trying penalty parameters.
+                    # Time to refit the model
+                    log.info("EM surrogate function is decreasing. Stop trying penalty parameters. ll_ratios %s" % log_lik_ratios)
+                    fit_state["stop_fitting"] = True
+
+            if not fit_state["stop_fitting"]:
+                fit_state["best_model_idx"] = check_param_i
+
+                if np.mean(nonzeros) == feat_generator.feature_vec_len:
+                    # Model is saturated so stop fitting new parameters
+                    log.info("Model is saturated with %d parameters. Stop fitting." % np.mean(nonzeros))
+                    fit_state["stop_fitting"] = True
+
+        if fit_state["stop_fitting"]:
+            # Do not start the fits for the smaller penalty parameters, and drop the ones that already finished
+            scheduler.prune(fit_state["num_params_checked"] - 1)
+            for drop_param_i in range(fit_state["num_params_checked"], num_params):
+                for drop_fold_idx in range(num_folds):
+                    results_list[drop_param_i][drop_fold_idx] = None
+                    result_store.remove(drop_param_i, drop_fold_idx)
+            fit_state["fold_num_params_done"] = [
+                min(num_params_done, fit_state["num_params_checked"]) for num_params_done in fit_state["fold_num_params_done"]
+            ]
+
+        save_pickle_checkpoint(fit_checkpoint_file, fit_state)
+
+    for val_set_evaluator in fit_state["val_set_evaluators"]:
+        if val_set_evaluator is not None:
+            val_set_evaluator.close()
+    results_list = results_list[:fit_state["num_params_checked"]]
+    best_model_idx = fit_state["best_model_idx"]
+
+    if args.num_cpu_threads > 1:
+        all_runs_pool = Pool(args.num_cpu_threads)
 
     # Pick out the best model
     # Make sure we have hte same support. Otherwise we need to refit
@@ -313,12 +487,11 @@ def main(args=sys.argv[1:]):
             max_em_iters=args.em_max_iters,
             init_theta=prev_pen_theta,
             pool=all_runs_pool,
+            checkpoint=EMCheckpoint(os.path.join(args.checkpoint_dir, "em_refit_penalized")),
         )
         results_list[best_model_idx].append(method_res)
 
     # Finally ready to refit as unpenalized model
-    if args.num_cpu_threads > 1 and all_runs_pool is None:
-        all_runs_pool = Pool(args.num_cpu_threads)
     cmodel_algos[0].refit_unpenalized(
         obs_data,
         model_result=method_res,
@@ -326,11 +499,32 @@ def main(args=sys.argv[1:]):
         hessian_check_iter=args.hessian_check_iter,
         get_hessian=not args.omit_hessian,
         pool=all_runs_pool,
+        checkpoint=EMCheckpoint(os.path.join(args.checkpoint_dir, "em_refit_unpenalized")),
     )
 
-    # Pickle the refitted theta
-    with open(args.out_file, "w") as f:
-        pickle.dump(results_list, f)
+    # Store the refitted theta
+    result_store.save(best_model_idx, results_list[best_model_idx].index(method_res), method_res)
+
+    perf_entries = []
+    for param_i, param_results in enumerate(results_list):
+        for model_idx, res in enumerate(param_results):
+            for stage, records in getattr(res, "perf_records", {}).iteritems():
+                perf_entries.append(dict(
+                    penalty_params=res.penalty_params,
+                    param_idx=param_i,
+                    # The model index is the fold, or the number of folds for a fit on all the data
+                    model_idx=model_idx,
+                    stage=stage,
+                    records=records,
+                ))
+    write_perf_json(args.perf_file, perf_entries, info=dict(
+        num_cpu_threads=args.num_cpu_threads,
+        num_jobs=args.num_jobs,
+        job_backend=args.job_backend,
+        k_folds=args.k_folds,
+        num_obs=len(obs_data),
+        total_time=time.time() - st_time,
+    ))
 
     if not args.omit_hessian:
         full_feat_generator = HierarchicalMotifFeatureGenerator(
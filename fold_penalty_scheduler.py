@@ -0,0 +1,217 @@
+"""
+Scheduler for fitting a path of penalty parameters on several folds at once
+"""
+import os
+import logging as log
+from multiprocessing import Pool, Process, Queue
+from Queue import Empty
+
+from checkpoint import save_pickle_checkpoint, load_pickle_checkpoint
+
+TASK_RESULT_FILE_PATTERN = "task_param%d_fold%d.pkl"
+
+def run_task(worker, num_threads):
+    """
+    Runs one task, with a multiprocessing pool for its inner parallelism
+
+    @param worker: ParallelWorker whose shared object is the multiprocessing pool
+    @param num_threads: number of cores for this task
+
+    @return the result of the worker, None if it failed
+    """
+    pool = Pool(num_threads) if num_threads > 1 else None
+    result = worker.run(pool)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return result
+
+def run_scheduled_task(worker, num_threads, result_file, done_queue, task_key):
+    """
+    Runs one task in its own process.
+    The result is written to a file, since it can be too large to send back through the queue.
+    Note: this must be a global function
+
+    @param worker: ParallelWorker whose shared object is the multiprocessing pool
+    @param num_threads: number of cores for this task
+    @param result_file: file to write the result of the worker to
+    @param done_queue: queue to put the task key and whether the task succeeded when the task is done
+    @param task_key: tuple with the index of the penalty parameter and the fold
+    """
+    result = run_task(worker, num_threads)
+    if result is not None:
+        save_pickle_checkpoint(result_file, result)
+    done_queue.put((task_key, result is not None))
+
+class FoldPenaltyScheduler:
+    """
+    Runs the fits of a path of penalty parameters on several folds.
+    Each (fold, penalty parameter) fit is a task. The tasks of a fold run in the order of the penalty parameters,
+    since each one warm-starts from the previous one, but different folds are independent and run concurrently.
+    Each running task is a separate process with its own multiprocessing pool, so it can parallelize its E-steps
+    and M-steps over its share of the cores.
+    Tasks for smaller penalty parameters can be pruned before they start, e.g. once the fits stop improving.
+    Every fold gets a process even if there are fewer cores than folds.
+    If there is only one fold, the tasks run in this process instead.
+    """
+    def __init__(self, num_folds, num_params, num_threads, result_dir, poll_interval=1.):
+        """
+        @param num_folds: number of folds
+        @param num_params: number of penalty parameters
+        @param num_threads: total number of cores for all the running tasks; at least one per fold
+        @param result_dir: directory for passing the results of the tasks back
+        @param poll_interval: how many seconds to wait for a task to finish before checking whether
+                        the processes of the running tasks are still alive
+        """
+        self.num_folds = num_folds
+        self.num_params = num_params
+        # Like the pool of one process per fold that was used before, the folds always run concurrently
+        self.num_threads = max(num_threads, num_folds)
+        self.result_dir = result_dir
+        self.poll_interval = poll_interval
+        self.max_param_idx = num_params - 1
+
+    def prune(self, max_param_idx):
+        """
+        Do not start any more tasks for penalty parameters after max_param_idx.
+        Tasks that are already running finish and are still returned.
+        """
+        self.max_param_idx = min(self.max_param_idx, max_param_idx)
+
+    def _get_task_threads(self, free_threads, num_ready):
+        """
+        @return list with the number of cores for each of the ready tasks that can start now
+        """
+        num_tasks = min(num_ready, free_threads)
+        task_threads = []
+        for i in range(num_tasks):
+            num_threads = free_threads / (num_tasks - i)
+            task_threads.append(num_threads)
+            free_threads -= num_threads
+        return task_threads
+
+    def run(self, make_worker, start_param_idxs=None):
+        """
+        A generator of the results of the tasks, in the order that they finish.
+        The next task of a fold is only made after the result of its previous task is returned.
+
+        @param make_worker: function that takes the index of the penalty parameter and of the fold
+                        and returns the ParallelWorker of the task; the worker is given a multiprocessing pool
+                        (or None if it only has one core)
+        @param start_param_idxs: the index of the first penalty parameter to fit for each fold;
+                        all of them by default
+
+        @return tuples with the index of the penalty parameter, the index of the fold and the result of the task
+        """
+        next_param_idxs = list(start_param_idxs) if start_param_idxs is not None else [0] * self.num_folds
+        if min(self.num_folds, self.num_threads) == 1:
+            for task_result in self._run_in_process(make_worker, next_param_idxs):
+                yield task_result
+            return
+
+        if not os.path.exists(self.result_dir):
+            os.makedirs(self.result_dir)
+        done_queue = Queue()
+        # Maps fold index to the running process, the penalty parameter index and the number of cores
+        running = {}
+        failed_tasks = []
+        free_threads = self.num_threads
+        while True:
+            if not failed_tasks:
+                ready_folds = [
+                    fold_idx for fold_idx in range(self.num_folds)
+                    if fold_idx not in running and next_param_idxs[fold_idx] <= self.max_param_idx
+                ]
+                # Start the tasks with the larger penalty parameters first, since the pruning depends on them
+                ready_folds = sorted(ready_folds, key=lambda fold_idx: (next_param_idxs[fold_idx], fold_idx))
+                for fold_idx, num_threads in zip(ready_folds, self._get_task_threads(free_threads, len(ready_folds))):
+                    param_idx = next_param_idxs[fold_idx]
+                    log.info("Starting penalty param %d, fold %d with %d threads" % (param_idx, fold_idx, num_threads))
+                    proc = Process(
+                        target=run_scheduled_task,
+                        args=(
+                            make_worker(param_idx, fold_idx),
+                            num_threads,
+                            os.path.join(self.result_dir, TASK_RESULT_FILE_PATTERN % (param_idx, fold_idx)),
+                            done_queue,
+                            (param_idx, fold_idx),
+                        ),
+                    )
+                    proc.start()
+                    running[fold_idx] = (proc, param_idx, num_threads)
+                    free_threads -= num_threads
+
+            if not running:
+                break
+
+            param_idx, fold_idx, success = self._wait_for_task(done_queue, running)
+            proc, _, num_threads = running.pop(fold_idx)
+            proc.join()
+            free_threads += num_threads
+            if not success:
+                # Let the running tasks finish, so their own pools are shut down properly
+                log.info("Fit of penalty param %d, fold %d failed" % (param_idx, fold_idx))
+                failed_tasks.append((param_idx, fold_idx))
+                continue
+
+            result_file = os.path.join(self.result_dir, TASK_RESULT_FILE_PATTERN % (param_idx, fold_idx))
+            result = load_pickle_checkpoint(result_file)
+            os.remove(result_file)
+            next_param_idxs[fold_idx] = param_idx + 1
+            if not failed_tasks:
+                yield param_idx, fold_idx, result
+
+        if failed_tasks:
+            raise ValueError("Fits failed for (penalty param, fold) %s" % failed_tasks)
+
+    def _run_in_process(self, make_worker, next_param_idxs):
+        """
+        Runs the tasks one at a time in this process, in the same order as run would with one core
+
+        @param make_worker: see run
+        @param next_param_idxs: the index of the first penalty parameter to fit for each fold
+
+        @return tuples with the index of the penalty parameter, the index of the fold and the result of the task
+        """
+        while True:
+            ready_folds = [
+                fold_idx for fold_idx in range(self.num_folds)
+                if next_param_idxs[fold_idx] <= self.max_param_idx
+            ]
+            if not ready_folds:
+                break
+            fold_idx = min(ready_folds, key=lambda fold_idx: (next_param_idxs[fold_idx], fold_idx))
+            param_idx = next_param_idxs[fold_idx]
+            log.info("Starting penalty param %d, fold %d with %d threads" % (param_idx, fold_idx, self.num_threads))
+            result = run_task(make_worker(param_idx, fold_idx), self.num_threads)
+            if result is None:
+                raise ValueError("Fits failed for (penalty param, fold) %s" % [(param_idx, fold_idx)])
+            next_param_idxs[fold_idx] = param_idx + 1
+            yield param_idx, fold_idx, result
+
+    def _wait_for_task(self, done_queue, running):
+        """
+        Waits until one of the running tasks is done.
+        A task whose process exits without reporting back (e.g. it was killed or ran out of memory) has failed.
+
+        @param done_queue: queue that the tasks report to
+        @param running: dictionary that maps fold index to the running process, the penalty parameter index
+                        and the number of cores
+
+        @return tuple with the index of the penalty parameter, the index of the fold and whether the task succeeded
+        """
+        while True:
+            try:
+                (param_idx, fold_idx), success = done_queue.get(timeout=self.poll_interval)
+                return param_idx, fold_idx, success
+            except Empty:
+                pass
+            for fold_idx, (proc, param_idx, _) in running.iteritems():
+                if proc.exitcode is not None:
+                    # The process may have reported back right before it exited
+                    try:
+                        (done_param_idx, done_fold_idx), success = done_queue.get(timeout=self.poll_interval)
+                        return done_param_idx, done_fold_idx, success
+                    except Empty:
+                        log.info("Process of penalty param %d, fold %d exited with code %d without reporting back" % (param_idx, fold_idx, proc.exitcode))
+                        return param_idx, fold_idx, False
@@ -15,6 +15,7 @@ import re
 from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from model_truncation import ModelTruncation
 from common import *
+from sampling_utils import set_random_seed
 
 def parse_args():
     ''' parse command line arguments '''
@@ -190,7 +191,7 @@ def main(args=sys.argv[1:]):
     args = parse_args()
 
     # Randomly generate number of mutations or use default
-    np.random.seed(args.seed)
+    set_random_seed(args.seed)
 
     hier_feat_generator = HierarchicalMotifFeatureGenerator(
         motif_lens=args.motif_lens,
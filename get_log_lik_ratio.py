@@ -7,22 +7,23 @@ import sys
 import argparse
 import os
 import os.path
-import pickle
 import time
 import numpy as np
-import itertools
 
 SCRATCH_DIR = '/fh/fast/matsen_e/dshaw/_tmp/samm/'
 
 #SAMM_PATH = '/home/jfeng2//mobeef'
 #sys.path.insert(1, SAMM_PATH)
 
-from read_data import read_gene_seq_csv_data, load_logistic_model
+from read_data import read_gene_seq_csv_data_bulk, load_logistic_model
+from data_cache import read_obs_data_cached
+from result_store import load_method_results
 from fit_logistic_model import LogisticModel
 from common import pick_best_model, NUM_NUCLEOTIDES
 from likelihood_evaluator import LikelihoodComparer
 from compare_simulated_shazam_vs_samm import ShazamModel
 from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from sampling_utils import set_random_seed
 
 FOLDER_SEED = 12
 
@@ -34,6 +35,10 @@ def parse_args():
     parser.add_argument('--seed',
         type=int,
         default=444)
+    parser.add_argument('--cache-dir',
+        type=str,
+        help='Directory for caching the processed data and base features; the data is processed from scratch if not given',
+        default=None)
     parser.add_argument('--input-naive',
         type=str,
         help='Input CSV file with naive sequences',
@@ -63,10 +68,19 @@ def parse_args():
         type=int,
         help='Number of mutation order samples drawn per observation when estimating likelihood of validation data',
         default=16)
+    parser.add_argument('--min-ess-ratio',
+        type=float,
+        help='The samples drawn for one reference model are importance-reweighted for the next reference model, unless the average effective sample size is less than this fraction of the number of samples (set to 1 to always draw new samples)',
+        default=0.5)
     parser.add_argument('--num-jobs',
         type=int,
         help='Number of jobs to submit to a Slurm cluster during E-step. (If using only 1 job, it does not submit to a cluster.)',
         default=10)
+    parser.add_argument('--job-backend',
+        type=str,
+        choices=('slurm', 'local'),
+        help='Where to run the jobs: on a Slurm cluster, or on that many long-lived worker processes on this host',
+        default='slurm')
 
     parser.set_defaults(per_target_model=False, motif_len=5, left_flank=2, right_flank=2)
     args = parser.parse_args()
@@ -80,32 +94,38 @@ def parse_args():
 def main(args=sys.argv[1:]):
     args = parse_args()
     print(args)
-    np.random.seed(args.seed)
+    set_random_seed(args.seed)
 
     thetas = []
     labels = []
-    # get data
-    obs_data, metadata = read_gene_seq_csv_data(
-        args.input_naive,
-        args.input_mutated,
-        motif_len=args.motif_len,
-        left_flank_len=args.left_flank,
-        right_flank_len=args.right_flank,
-    )
-
     ## get samm theta
-    with open(args.input_samm, "r") as f:
-        method_results = pickle.load(f)
-        method_res = pick_best_model(method_results)
-        feat_generator = method_res.refit_feature_generator
-        per_target_model = method_res.refit_theta.shape[1] == NUM_NUCLEOTIDES + 1
+    method_results = load_method_results(args.input_samm)
+    method_res = pick_best_model(method_results)
+    feat_generator = method_res.refit_feature_generator
+    per_target_model = method_res.refit_theta.shape[1] == NUM_NUCLEOTIDES + 1
 
     max_motif_len = args.motif_len
     full_feat_generator = HierarchicalMotifFeatureGenerator(
         motif_lens=[max_motif_len],
         left_motif_flank_len_list=[[args.left_flank]],
     )
-    full_feat_generator.add_base_features_for_list(obs_data)
+
+    # get data
+    obs_data, metadata = read_obs_data_cached(
+        args.cache_dir,
+        [args.input_naive, args.input_mutated],
+        lambda: [read_gene_seq_csv_data_bulk(
+            args.input_naive,
+            args.input_mutated,
+            motif_len=args.motif_len,
+            left_flank_len=args.left_flank,
+            right_flank_len=args.right_flank,
+        )],
+        args.motif_len,
+        args.left_flank,
+        args.right_flank,
+        feat_generator=full_feat_generator,
+    )
 
     samm_theta = feat_generator.create_aggregate_theta(method_res.refit_theta, keep_col0=False)
     agg_possible_motif_mask = full_feat_generator.get_possible_motifs_to_targets(samm_theta.shape)
@@ -127,24 +147,28 @@ def main(args=sys.argv[1:]):
     thetas += [logistic_theta]
     labels += ['logistic']
 
-    # do all comparisons
-    cur_ref_idx = -1
-    for idx in itertools.permutations(range(len(thetas)), 2):
-        if idx[0] != cur_ref_idx:
-            # need to update val_set_evaluator
-            cur_ref_idx = idx[0]
-            val_set_evaluator = LikelihoodComparer(
-                obs_data,
-                full_feat_generator,
-                theta_ref=thetas[idx[0]],
-                num_samples=args.num_val_samples,
-                burn_in=args.num_val_burnin,
-                num_jobs=args.num_jobs,
-                scratch_dir=args.scratch_dir,
-            )
-        log_lik_ratio, lower_bound, upper_bound = val_set_evaluator.get_log_likelihood_ratio(thetas[idx[1]])
-        print "{} with {} reference:".format(labels[idx[1]], labels[idx[0]])
-        print "(lower, ratio, upper) = (%.4f, %.4f, %.4f)" % (lower_bound, log_lik_ratio, upper_bound)
+    # do all comparisons, evaluating all the other models against each reference at once
+    val_set_evaluator = LikelihoodComparer(
+        obs_data,
+        full_feat_generator,
+        theta_ref=thetas[0],
+        num_samples=args.num_val_samples,
+        burn_in=args.num_val_burnin,
+        num_jobs=args.num_jobs,
+        scratch_dir=args.scratch_dir,
+        min_ess_ratio=args.min_ess_ratio,
+        job_backend=args.job_backend,
+    )
+    for ref_idx in range(len(thetas)):
+        if ref_idx > 0:
+            # reuse the samples if they can be reweighted for this reference
+            val_set_evaluator.set_reference(thetas[ref_idx])
+        other_idxs = [i for i in range(len(thetas)) if i != ref_idx]
+        log_lik_ratios = val_set_evaluator.get_log_likelihood_ratios([thetas[i] for i in other_idxs])
+        for i, (log_lik_ratio, lower_bound, upper_bound) in zip(other_idxs, log_lik_ratios):
+            print "{} with {} reference:".format(labels[i], labels[ref_idx])
+            print "(lower, ratio, upper) = (%.4f, %.4f, %.4f)" % (lower_bound, log_lik_ratio, upper_bound)
+    val_set_evaluator.close()
 
 if __name__ == "__main__":
     main(sys.argv[1:])
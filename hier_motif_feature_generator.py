@@ -1,11 +1,10 @@
-import itertools
 import numpy as np
 
 from common import NUCLEOTIDE_SET, get_max_mut_pos, get_zero_theta_mask, create_theta_idx_mask, ZSCORE_95, NUM_NUCLEOTIDES, NUCLEOTIDE_DICT
 from combined_feature_generator import CombinedFeatureGenerator
 from feature_generator import MultiFeatureMutationStep
 from motif_feature_generator import MotifFeatureGenerator
-from scipy.sparse import hstack
+from scipy.sparse import hstack, csr_matrix
 from common import NUCLEOTIDES, mutate_string
 from models import ObservedSequenceMutations
 
@@ -87,6 +86,13 @@ class HierarchicalMotifFeatureGenerator(CombinedFeatureGenerator):
         for f in self.feat_gens:
             self.motif_list += f.motif_list
             self.mutating_pos_list += [-f.distance_to_start_of_motif] * len(f.motif_list)
+        self.motif_agg_matrix = None
+
+    def __getstate__(self):
+        # The aggregation matrix is large and is rebuilt when it is needed, so it is not pickled
+        state = self.__dict__.copy()
+        state["motif_agg_matrix"] = None
+        return state
 
     def get_possible_motifs_to_targets(self, mask_shape):
         """
@@ -104,93 +110,85 @@ class HierarchicalMotifFeatureGenerator(CombinedFeatureGenerator):
                 theta_mask[i, center_nucleotide_idx] = False
         return theta_mask
 
-    def combine_thetas_and_get_conf_int(self, theta, variance_est=None, col_idx=0, zstat=ZSCORE_95, add_targets=True):
-        """
-        Combine hierarchical and offset theta values
+    def _get_motif_agg_matrix(self):
         """
-        full_feat_generator = MotifFeatureGenerator(
-            motif_len=self.motif_len,
-            distance_to_start_of_motif=-self.max_left_motif_flank_len,
-        )
-        full_theta_size = full_feat_generator.feature_vec_len
-        zero_theta_mask = self.model_truncation.zero_theta_mask_refit if self.model_truncation is not None else np.ones(theta.shape, dtype=bool)
-        assert theta.shape[0] == self.feature_vec_len
-        possible_theta_mask = self.get_possible_motifs_to_targets(zero_theta_mask.shape)
-        theta_idx_counter = create_theta_idx_mask(zero_theta_mask, possible_theta_mask)
-        # stores which hierarchical theta values were used to construct the full theta
-        # important for calculating covariance
-        theta_index_matches = {i:[] for i in range(full_theta_size)}
-
-        full_theta = np.zeros(full_theta_size)
-        theta_lower = np.zeros(full_theta_size)
-        theta_upper = np.zeros(full_theta_size)
-
-        for i, feat_gen in enumerate(self.feat_gens):
-            for m_idx, m in enumerate(feat_gen.motif_list):
-                raw_theta_idx = self.feat_offsets[i] + m_idx
-
-                if col_idx != 0 and add_targets:
-                    m_theta = theta[raw_theta_idx, 0] + theta[raw_theta_idx, col_idx]
-                else:
-                    m_theta = theta[raw_theta_idx, col_idx]
+        The aggregation matrix is made the first time it is needed and is kept until the features change.
+        Feature generators pickled before the matrix was kept do not have it.
 
+        @return sparse matrix with a row for each full motif and a column for each hierarchical theta index,
+                with a one if the hierarchical motif is a sub-motif of the full motif
+        """
+        if getattr(self, "motif_agg_matrix", None) is None:
+            full_feat_generator = MotifFeatureGenerator(
+                motif_len=self.motif_len,
+                distance_to_start_of_motif=-self.max_left_motif_flank_len,
+            )
+            agg_rows = []
+            agg_cols = []
+            for offset, feat_gen in zip(self.feat_offsets, self.feat_gens):
                 if feat_gen.motif_len == full_feat_generator.motif_len:
                     assert(full_feat_generator.distance_to_start_of_motif == feat_gen.distance_to_start_of_motif)
                     assert(self.max_left_motif_flank_len == -feat_gen.distance_to_start_of_motif)
-                    # Already at maximum motif length, so nothing to combine
-                    full_m_idx = full_feat_generator.motif_dict[m]
-                    full_theta[full_m_idx] += m_theta
-
-                    if theta_idx_counter[raw_theta_idx, 0] != -1:
-                        theta_index_matches[full_m_idx].append(theta_idx_counter[raw_theta_idx, 0])
-                    if col_idx != 0 and theta_idx_counter[raw_theta_idx, col_idx] != -1:
-                        theta_index_matches[full_m_idx].append(theta_idx_counter[raw_theta_idx, col_idx])
-                else:
-                    # Combine hierarchical feat_gens for given left_motif_len
-                    flanks = itertools.product(NUCLEOTIDE_SET, repeat=full_feat_generator.motif_len - feat_gen.motif_len)
-                    for f in flanks:
-                        full_m = "".join(f[:feat_gen.flank_len_offset]) + m + "".join(f[feat_gen.flank_len_offset:])
-                        full_m_idx = full_feat_generator.motif_dict[full_m]
-                        full_theta[full_m_idx] += m_theta
-
-                        if theta_idx_counter[raw_theta_idx, 0] != -1:
-                            theta_index_matches[full_m_idx].append(theta_idx_counter[raw_theta_idx, 0])
-                        if col_idx != 0 and theta_idx_counter[raw_theta_idx, col_idx] != -1:
-                            theta_index_matches[full_m_idx].append(theta_idx_counter[raw_theta_idx, col_idx])
+                for full_m_idx, full_m in enumerate(full_feat_generator.motif_list):
+                    m_idx = feat_gen.motif_dict[full_m[feat_gen.flank_len_offset:feat_gen.flank_len_offset + feat_gen.motif_len]]
+                    if m_idx is not None:
+                        agg_rows.append(full_m_idx)
+                        agg_cols.append(offset + m_idx)
+            self.motif_agg_matrix = csr_matrix(
+                (np.ones(len(agg_rows)), (agg_rows, agg_cols)),
+                shape=(full_feat_generator.feature_vec_len, self.feature_vec_len),
+            )
+        return self.motif_agg_matrix
+
+    def combine_thetas_and_get_conf_int(self, theta, variance_est=None, col_idx=0, zstat=ZSCORE_95, add_targets=True):
+        """
+        Combine hierarchical and offset theta values
+        """
+        assert theta.shape[0] == self.feature_vec_len
+        agg_matrix = self._get_motif_agg_matrix()
+        if col_idx != 0 and add_targets:
+            full_theta = agg_matrix.dot(theta[:, 0] + theta[:, col_idx])
+        else:
+            full_theta = agg_matrix.dot(theta[:, col_idx])
+        theta_lower = np.zeros(full_theta.size)
+        theta_upper = np.zeros(full_theta.size)
 
         if variance_est is not None:
-            # Make the aggregation matrix
-            agg_matrix = np.zeros((full_theta.size, np.max(theta_idx_counter) + 1))
-            for full_theta_idx, matches in theta_index_matches.iteritems():
-                agg_matrix[full_theta_idx, matches] = 1
-
-            # Try two estimates of the obsersed information matrix
-            cov_mat_full = np.dot(np.dot(agg_matrix, variance_est), agg_matrix.T)
-            if np.any(np.diag(cov_mat_full) < 0):
+            zero_theta_mask = self.model_truncation.zero_theta_mask_refit if self.model_truncation is not None else np.ones(theta.shape, dtype=bool)
+            possible_theta_mask = self.get_possible_motifs_to_targets(zero_theta_mask.shape)
+            theta_idx_counter = create_theta_idx_mask(zero_theta_mask, possible_theta_mask)
+            # Map the hierarchical theta values used to construct the full theta to their index in the covariance
+            idx_cols = [0] if col_idx == 0 else [0, col_idx]
+            idx_rows = [np.where(theta_idx_counter[:, c] != -1)[0] for c in idx_cols]
+            theta_idx_matrix = csr_matrix(
+                (
+                    np.ones(sum([rows.size for rows in idx_rows])),
+                    (np.concatenate(idx_rows), np.concatenate([theta_idx_counter[rows, c] for rows, c in zip(idx_rows, idx_cols)])),
+                ),
+                shape=(self.feature_vec_len, np.max(theta_idx_counter) + 1),
+            )
+            cov_agg_matrix = agg_matrix.dot(theta_idx_matrix)
+
+            # Only the diagonal of the covariance of the full theta is needed
+            full_var = np.asarray(cov_agg_matrix.multiply(cov_agg_matrix.dot(variance_est)).sum(axis=1)).ravel()
+            if np.any(full_var < 0):
                 raise ValueError(
                         "Some variance estimates were negative: %d neg var, %s" % (
-                            np.sum(np.diag(cov_mat_full) < 0),
-                            np.diag(cov_mat_full)))
+                            np.sum(full_var < 0),
+                            full_var))
 
-            full_std_err = np.sqrt(np.diag(cov_mat_full))
+            full_std_err = np.sqrt(full_var)
             theta_lower = full_theta - zstat * full_std_err
             theta_upper = full_theta + zstat * full_std_err
 
         return full_theta, theta_lower, theta_upper
 
     def create_aggregate_theta(self, theta, keep_col0=True, add_targets=True):
-        def _combine_thetas(col_idx):
-            theta_col, _, _ = self.combine_thetas_and_get_conf_int(
-                theta,
-                col_idx=col_idx,
-                add_targets=add_targets,
-            )
-            return theta_col.reshape((theta_col.size, 1))
-
+        assert theta.shape[0] == self.feature_vec_len
+        agg_theta = self._get_motif_agg_matrix().dot(theta)
         if theta.shape[1] == 1:
-            theta_cols = [_combine_thetas(col_idx) for col_idx in range(1)]
-        else:
-            start_idx = 0 if keep_col0 else 1
-            theta_cols = [_combine_thetas(col_idx) for col_idx in range(start_idx, theta.shape[1])]
-        agg_theta = np.hstack(theta_cols)
-        return agg_theta
+            return agg_theta
+        if add_targets:
+            agg_theta[:, 1:] += agg_theta[:, :1]
+        start_idx = 0 if keep_col0 else 1
+        return agg_theta[:, start_idx:]
@@ -1,9 +1,11 @@
 import time
 import numpy as np
 from combined_feature_generator import CombinedFeatureGenerator
-from sampler_collection import SamplerCollection
+from sampler_collection import SamplerCollection, ObservedDataDump
 from mutation_order_gibbs import MutationOrderGibbsSampler
-from mutation_order_chibs import MutationOrderChibsSampler
+from mutation_order_chibs import MutationOrderChibsSampler, MutationOrderChibsReferenceSampler
+from mutation_order_chibs import ChibsStageWorker, ChibsStageWorkerShared
+from mutation_order_smc import MutationOrderSMCSampler
 from survival_problem_lasso import SurvivalProblemLasso
 import logging as log
 from common import *
@@ -27,33 +29,46 @@ class GreedyLikelihoodComparer:
         sorted_models = sorted(models, key=sort_func)
         best_model = sorted_models[0]
         best_model_idx = 0
-        val_set_evaluator = LikelihoodComparer(
-            val_set,
-            feat_generator,
-            theta_ref=best_model.penalized_theta,
-            num_samples=num_samples,
-            burn_in=burn_in,
-            num_jobs=num_jobs,
-            scratch_dir=scratch_dir,
-        )
-        for model_idx, model in enumerate(sorted_models[1:]):
-            log_lik_ratio, lower_bound, upper_bound = val_set_evaluator.get_log_likelihood_ratio(model.penalized_theta)
+        val_set_evaluator = None
+        # The log likelihood ratios of the remaining models against the current reference model,
+        # which are evaluated together
+        pending_ratios = []
+        for model_idx in range(1, len(sorted_models)):
+            model = sorted_models[model_idx]
+            if val_set_evaluator is None:
+                val_set_evaluator = LikelihoodComparer(
+                    val_set,
+                    feat_generator,
+                    theta_ref=best_model.penalized_theta,
+                    num_samples=num_samples,
+                    burn_in=burn_in,
+                    num_jobs=num_jobs,
+                    scratch_dir=scratch_dir,
+                )
+            if not pending_ratios:
+                pending_ratios = val_set_evaluator.get_log_likelihood_ratios(
+                    [m.penalized_theta for m in sorted_models[model_idx:]],
+                    max_iters=1,
+                )
+            log_lik_ratio, lower_bound, upper_bound = pending_ratios.pop(0)
+            if lower_bound < 0 and upper_bound > 0:
+                # Not sure about this model, so draw more samples for it.
+                # The ratios of the other models need to be recalculated if there are more samples now.
+                prev_num_samples = val_set_evaluator.num_samples
+                log_lik_ratio, lower_bound, upper_bound = val_set_evaluator.get_log_likelihood_ratio(model.penalized_theta)
+                if val_set_evaluator.num_samples != prev_num_samples:
+                    pending_ratios = []
             log.info("  Greedy search: ratio %f (%f, %f), model %s" % (log_lik_ratio, lower_bound, upper_bound, model))
             if log_lik_ratio >= 0:
                 best_model = model
-                best_model_idx = model_idx + 1
-                if model_idx != len(sorted_models) - 2:
-                    val_set_evaluator = LikelihoodComparer(
-                        val_set,
-                        feat_generator,
-                        theta_ref=best_model.penalized_theta,
-                        num_samples=num_samples,
-                        burn_in=burn_in,
-                        num_jobs=num_jobs,
-                        scratch_dir=scratch_dir,
-                    )
+                best_model_idx = model_idx
+                val_set_evaluator.close()
+                val_set_evaluator = None
+                pending_ratios = []
             else:
                 break
+        if val_set_evaluator is not None:
+            val_set_evaluator.close()
         return best_model, best_model_idx
 
 class LikelihoodComparer:
@@ -67,10 +82,13 @@ class LikelihoodComparer:
     where Q = E[log lik(theta | data)]
 
     Therefore we can compare theta parameters using the Q function
+
+    The reference theta can be changed with set_reference. The samples are then importance-reweighted
+    to be from the new reference theta, unless the weights are degenerate.
     """
     MAX_TOT_SAMPLES = 50000
 
-    def __init__(self, obs_data, feat_generator, theta_ref, num_samples=10, burn_in=0, num_jobs=1, scratch_dir=""):
+    def __init__(self, obs_data, feat_generator, theta_ref, num_samples=10, burn_in=0, num_jobs=1, scratch_dir="", min_ess_ratio=0.5, job_backend="slurm"):
         """
         @param obs_data: list of ObservedSequenceMutations
         @param feat_generator: CombinedFeatureGenerator
@@ -79,51 +97,132 @@ class LikelihoodComparer:
         @param burn_in: number of burn in samples
         @param num_jobs: number of jobs to submit
         @param scratch_dir: tmp dir for batch submission manager
+        @param min_ess_ratio: when changing the reference theta, draw new samples if the average effective sample size
+                            of the importance weights is less than this fraction of the number of samples
+        @param job_backend: "slurm" to submit the jobs to slurm, "local" to run them on local worker processes
         """
+        self.obs_data = obs_data
         self.theta_ref = theta_ref
-        self.num_samples = num_samples
+        self.base_num_samples = num_samples
+        self.burn_in = burn_in
+        self.num_jobs = num_jobs
+        self.job_backend = job_backend
+        self.scratch_dir = scratch_dir
+        self.min_ess_ratio = min_ess_ratio
+        # The sampler collections for each reference theta share one copy of the observed data in the scratch dir
+        self.observed_data_dump = ObservedDataDump(obs_data, num_jobs, scratch_dir)
 
         assert(isinstance(feat_generator, CombinedFeatureGenerator))
         self.feat_generator = feat_generator
         self.per_target_model = theta_ref.shape[1] == NUM_NUCLEOTIDES + 1
 
         log.info("Creating likelihood comparer")
-        st_time = time.time()
-        self.sampler_collection = SamplerCollection(
-            obs_data,
-            self.theta_ref,
-            MutationOrderGibbsSampler,
-            feat_generator,
-            num_jobs=num_jobs,
-            scratch_dir=scratch_dir,
-        )
-
-        # Get samples drawn from the distribution P(order | start, end, theta reference)
         self.num_tot_obs = len(obs_data)
         self.init_orders = [
             np.random.permutation(obs_seq.mutation_pos_dict.keys()).tolist()
             for obs_seq in obs_data
         ]
+        self._draw_samples()
+
+    def _draw_samples(self):
+        """
+        Get samples drawn from the distribution P(order | start, end, theta reference)
+        """
+        st_time = time.time()
+        self.sampling_theta = self.theta_ref
+        self.num_samples = self.base_num_samples
+        self.sampler_collection = SamplerCollection(
+            self.obs_data,
+            self.sampling_theta,
+            MutationOrderGibbsSampler,
+            self.feat_generator,
+            num_jobs=self.num_jobs,
+            scratch_dir=self.scratch_dir,
+            job_backend=self.job_backend,
+            observed_data_dump=self.observed_data_dump,
+        )
         sampler_results = self.sampler_collection.get_samples(
             self.init_orders,
             self.num_samples,
-            burn_in,
+            self.burn_in,
         )
         log.info("Finished getting samples, time %s" % (time.time() - st_time))
         sampled_orders_list = [res.samples for res in sampler_results]
         self.init_orders = [sampled_orders[-1].mutation_order for sampled_orders in sampled_orders_list]
         self.samples = [o for orders in sampled_orders_list for o in orders]
         self.sample_labels = [i for i, orders in enumerate(sampled_orders_list) for o in orders]
-        # Setup a problem so that we can extract the log likelihood ratio
         st_time = time.time()
+        self._setup_problem()
+        log.info("Finished calculating sample info, time %s" % (time.time() - st_time))
+
+    def _setup_problem(self):
+        """
+        Setup a problem so that we can extract the log likelihood ratio
+        """
         self.prob = SurvivalProblemLasso(
-            feat_generator,
+            self.feat_generator,
             self.samples,
             sample_labels=self.sample_labels,
             penalty_params=[0],
             per_target_model=self.per_target_model,
         )
-        log.info("Finished calculating sample info, time %s" % (time.time() - st_time))
+        self._update_weights()
+
+    def _update_weights(self):
+        """
+        Calculate the importance weights of the samples for the reference theta and their effective sample size.
+        The log likelihoods of the reference theta are the same for every comparison, so they are calculated once here.
+        """
+        if self.sampling_theta is self.theta_ref:
+            self.ref_log_lik_vec = self.prob.get_log_lik_vec(self.theta_ref)
+            self.prob.set_sample_weights(None)
+            self.ess_ratio = 1
+            return
+
+        # The weight of an order is P(order | start, end, theta ref)/P(order | start, end, sampling theta),
+        # up to a constant for each observation
+        self.ref_log_lik_vec, sampling_log_lik_vec = self.prob.get_log_lik_vecs([self.theta_ref, self.sampling_theta])
+        log_weights = self.ref_log_lik_vec - sampling_log_lik_vec
+        sample_labels = np.array(self.sample_labels)
+        sample_weights = np.zeros(log_weights.size)
+        ess_ratios = []
+        for label in range(self.num_tot_obs):
+            label_idxs = np.where(sample_labels == label)[0]
+            weights = np.exp(log_weights[label_idxs] - np.max(log_weights[label_idxs]))
+            ess_ratios.append(np.power(weights.sum(), 2)/np.power(weights, 2).sum()/label_idxs.size)
+            # Same normalization as the weights of the E-step samples: they sum to the number of samples
+            sample_weights[label_idxs] = weights * label_idxs.size/weights.sum()
+        self.prob.set_sample_weights(sample_weights)
+        self.ess_ratio = np.mean(ess_ratios)
+        log.info("Likelihood comparer importance weights: mean effective sample size ratio %f" % self.ess_ratio)
+
+    def set_reference(self, theta_ref):
+        """
+        Change the reference theta. The samples are importance-reweighted to be from P(order | start, end, theta_ref)
+        instead of drawing new ones, unless the effective sample size of the weights is too small.
+
+        @param theta_ref: the new reference theta, with the same shape as the current one
+        @return True if the samples were reweighted, False if new samples were drawn
+        """
+        self.theta_ref = theta_ref
+        self._update_weights()
+        if self.ess_ratio < self.min_ess_ratio:
+            log.info("Likelihood comparer importance weights are degenerate, drawing new samples")
+            self._draw_samples()
+            return False
+        return True
+
+    def _get_ratio_summaries(self, thetas):
+        """
+        @return list with the mean log likelihood ratio and its confidence interval for each theta
+        """
+        ratio_summaries = []
+        for ll_ratio_vec in self.prob.calculate_log_lik_ratio_vecs(thetas, self.ref_log_lik_vec, group_by_sample=True):
+            mean_ll_ratio = np.mean(ll_ratio_vec)
+            ase, lower_bound, upper_bound, ess = get_standard_error_ci_corrected(ll_ratio_vec, ZSCORE_95, mean_ll_ratio)
+            log.info("Likelihood comparer (lower,mean,upper, ess)=(%f,%f,%f,%f)" % (lower_bound, mean_ll_ratio, upper_bound, ess))
+            ratio_summaries.append((mean_ll_ratio, lower_bound, upper_bound))
+        return ratio_summaries
 
     def get_log_likelihood_ratio(self, theta, max_iters=3):
         """
@@ -131,15 +230,24 @@ class LikelihoodComparer:
         @param theta: the model parameter to compare against
         @return Q(theta | theta ref) - Q(theta ref | theta ref)
         """
-        ll_ratio_vec = self.prob.calculate_log_lik_ratio_vec(theta, self.theta_ref, group_by_sample=True)
-        mean_ll_ratio = np.mean(ll_ratio_vec)
-        ase, lower_bound, upper_bound, ess = get_standard_error_ci_corrected(ll_ratio_vec, ZSCORE_95, mean_ll_ratio)
-        log.info("Likelihood comparer (lower,mean,upper, ess)=(%f,%f,%f,%f)" % (lower_bound, mean_ll_ratio, upper_bound, ess))
+        return self.get_log_likelihood_ratios([theta], max_iters=max_iters)[0]
+
+    def get_log_likelihood_ratios(self, thetas, max_iters=3):
+        """
+        Get the log likelihood ratios between each theta and a reference theta.
+        The thetas are evaluated together, so comparing many models (e.g. a whole penalty path)
+        costs about the same as comparing one.
+        More samples are drawn while we are unsure of the sign of any of the ratios.
+
+        @param thetas: list of model parameters to compare against, all with the same shape as the reference theta
+        @return list of tuples with Q(theta | theta ref) - Q(theta ref | theta ref) and its confidence interval
+        """
+        ratio_summaries = self._get_ratio_summaries(thetas)
 
         curr_iter = 1
-        while lower_bound < 0 and upper_bound > 0 and self.num_samples * (1 + curr_iter) * self.num_tot_obs < LikelihoodComparer.MAX_TOT_SAMPLES and curr_iter < max_iters:
+        while any([lower_bound < 0 and upper_bound > 0 for _, lower_bound, upper_bound in ratio_summaries]) and self.num_samples * (1 + curr_iter) * self.num_tot_obs < LikelihoodComparer.MAX_TOT_SAMPLES and curr_iter < max_iters:
             # If we aren't sure if the mean log likelihood ratio is negative or positive, grab more samples
-            log.info("Get more samples likelihood comparer (lower,mean,upper,ess)=(%f,%f,%f,%f)" % (lower_bound, mean_ll_ratio, upper_bound, ess))
+            log.info("Get more samples likelihood comparer")
             st_time = time.time()
             sampler_results = self.sampler_collection.get_samples(
                 self.init_orders,
@@ -152,20 +260,18 @@ class LikelihoodComparer:
             self.samples += [s for res in sampler_results for s in res.samples]
             self.sample_labels += [i for i, orders in enumerate(sampled_orders_list) for o in orders]
             self.num_samples += self.num_samples
-            # Setup a problem so that we can extract the log likelihood ratio
-            self.prob = SurvivalProblemLasso(
-                self.feat_generator,
-                self.samples,
-                sample_labels=self.sample_labels,
-                penalty_params=[0],
-                per_target_model=self.per_target_model,
-            )
-            ll_ratio_vec = self.prob.calculate_log_lik_ratio_vec(theta, self.theta_ref, group_by_sample=True)
-            mean_ll_ratio = np.mean(ll_ratio_vec)
-            ase, lower_bound, upper_bound, ess = get_standard_error_ci_corrected(ll_ratio_vec, ZSCORE_95, mean_ll_ratio)
+            self._setup_problem()
+            ratio_summaries = self._get_ratio_summaries(thetas)
             curr_iter += 1
 
-        return mean_ll_ratio, lower_bound, upper_bound
+        return ratio_summaries
+
+    def close(self):
+        """
+        Remove the observed data that the samplers wrote to the scratch dir.
+        It is written again if more samples are drawn later.
+        """
+        self.observed_data_dump.remove()
 
 class LogLikelihoodEvaluator:
     """
@@ -173,12 +279,13 @@ class LogLikelihoodEvaluator:
     Uses Chibs
     """
 
-    def __init__(self, obs_data, feat_generator, num_jobs=1, scratch_dir=""):
+    def __init__(self, obs_data, feat_generator, num_jobs=1, scratch_dir="", pool=None):
         """
         @param obs_data: list of ObservedSequenceMutations
         @param feat_generator: CombinedFeatureGenerator
         @param num_jobs: number of jobs to submit
         @param scratch_dir: tmp dir for batch submission manager
+        @param pool: multiprocessing pool
         """
         self.obs_data = obs_data
         self.init_orders = [obs_seq.mutation_pos_dict.keys() for obs_seq in obs_data]
@@ -187,22 +294,26 @@ class LogLikelihoodEvaluator:
         self.feat_generator = feat_generator
         self.num_jobs = num_jobs
         self.scratch_dir = scratch_dir
+        self.pool = pool
 
-    def get_log_lik(self, theta, num_samples=1000, burn_in=0, num_tries=5):
+    def get_log_lik(self, theta, num_samples=1000, burn_in=0, num_tries=5, parallel_stages=False):
         """
         Get the log likelihood of the data
         @param theta: the model parameter to evaluate this for
         @param num_samples: number of gibbs samples
         @param burn_in: number of burn in iterations for gibbs
         @param num_tries: number of tries for Chibs sampler
+        @param parallel_stages: if True, run the conditional gibbs samplers of all the observations in parallel
+                                rather than running each Chibs sampler sequentially
         """
         sampler_collection = SamplerCollection(
             self.obs_data,
             theta,
-            MutationOrderChibsSampler,
+            MutationOrderChibsReferenceSampler if parallel_stages else MutationOrderChibsSampler,
             self.feat_generator,
             num_jobs=self.num_jobs,
             scratch_dir=self.scratch_dir,
+            pool=self.pool,
             num_tries=num_tries,
         )
 
@@ -215,9 +326,83 @@ class LogLikelihoodEvaluator:
             burn_in,
             sampling_rate=0,
         )
+        if parallel_stages:
+            self._run_conditional_stages(sampler_collection, sampler_results, num_samples, num_tries)
+        sampler_collection.close()
+
         # Store the sampled orders for faster runs next time
         self.init_orders = [res.gibbs_samples[-1].mutation_order for res in sampler_results]
 
         data_set_log_lik = [res.log_prob_order - res.log_prob_estimate for res in sampler_results]
         total_log_lik = np.sum(data_set_log_lik)
         return total_log_lik
+
+    def get_log_lik_smc(self, theta, num_particles=1000):
+        """
+        Get the log likelihood of the data using the marginal likelihood estimates from the SMC sampler
+        @param theta: the model parameter to evaluate this for
+        @param num_particles: number of particles for each observation
+        """
+        sampler_collection = SamplerCollection(
+            self.obs_data,
+            theta,
+            MutationOrderSMCSampler,
+            self.feat_generator,
+            num_jobs=self.num_jobs,
+            scratch_dir=self.scratch_dir,
+            pool=self.pool,
+        )
+        sampler_results = sampler_collection.get_samples(
+            self.init_orders,
+            num_particles,
+        )
+        sampler_collection.close()
+        return np.sum([res.log_marginal_estimate for res in sampler_results])
+
+    def _run_conditional_stages(self, sampler_collection, sampler_results, num_samples, num_tries):
+        """
+        Run the pending conditional stages of Chibs method for all the observations at once.
+        The log probability terms of the stages are added to the log_prob_estimate of sampler_results.
+        Only the stages without enough samples are rerun, each time with 10 times the number of samples.
+
+        @param sampler_collection: the SamplerCollection that ran MutationOrderChibsReferenceSampler
+        @param sampler_results: list of ChibsSamplerResult with pending conditional stages
+        """
+        pending = [
+            (obs_idx, stage_idx)
+            for obs_idx, res in enumerate(sampler_results)
+            for stage_idx in res.pending_stages
+        ]
+        shared_obj = ChibsStageWorkerShared(sampler_collection.theta, self.feat_generator)
+        for _ in range(num_tries):
+            if len(pending) == 0:
+                break
+
+            st_time = time.time()
+            rand_seed = get_randint()
+            worker_list = [
+                ChibsStageWorker(
+                    rand_seed + i,
+                    obs_idx,
+                    self.obs_data[obs_idx],
+                    sampler_results[obs_idx].reference_order,
+                    stage_idx,
+                    num_samples,
+                )
+                for i, (obs_idx, stage_idx) in enumerate(pending)
+            ]
+            stage_results = sampler_collection.run_workers(worker_list, shared_obj, worker_folder_name="chibs_stage_workers")
+
+            finished = set()
+            for stage_res in stage_results:
+                if stage_res.log_prob_stage is not None:
+                    sampler_results[stage_res.obs_idx].log_prob_estimate += stage_res.log_prob_stage
+                    finished.add((stage_res.obs_idx, stage_res.stage_idx))
+            pending = [p for p in pending if p not in finished]
+            log.info("Chibs: ran %d conditional stages, %d need more samples, time %f" % (len(worker_list), len(pending), time.time() - st_time))
+            num_samples *= 10
+
+        for obs_idx, res in enumerate(sampler_results):
+            res.pending_stages = []
+        if len(pending):
+            raise ValueError("Chibs: not enough samples to estimate %d conditional stages" % len(pending))
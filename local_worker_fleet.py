@@ -0,0 +1,178 @@
+"""
+A fleet of long-lived worker processes on this host, so the E-step can be split into jobs without a job scheduler.
+The workers are started once and are sent the batches of ParallelWorkers through pipes, so the jobs do not pay
+for starting the interpreter, importing the modules and reading and writing files.
+"""
+import os
+import atexit
+import select
+import traceback
+import cPickle
+from multiprocessing import Process, Pipe
+
+from perf_registry import perf_count
+
+_LOCAL_WORKER_FLEET = None
+
+def run_fleet_worker(conn):
+    """
+    Loop of a worker process of LocalWorkerFleet. Receives messages until it is told to stop:
+        ("shared", pickled shared object): the shared object for the next batches
+        ("batch", pickled list of ParallelWorkers): run the workers and send back the pickled list of results
+        ("stop", None): exit
+    Note: this must be a global function
+    """
+    shared_obj = None
+    while True:
+        msg_type, payload = conn.recv()
+        if msg_type == "shared":
+            shared_obj = cPickle.loads(payload)
+        elif msg_type == "batch":
+            results = [worker.run(shared_obj) for worker in cPickle.loads(payload)]
+            conn.send_bytes(cPickle.dumps(results, protocol=cPickle.HIGHEST_PROTOCOL))
+        else:
+            break
+    conn.close()
+
+class LocalWorkerFleet:
+    """
+    Runs batches of ParallelWorkers on long-lived worker processes.
+    Each round, the shared object is sent once to each worker and the batches are streamed to the workers
+    as they become free. A batch whose worker dies is retried on a new worker.
+    """
+    def __init__(self, num_workers):
+        """
+        @param num_workers: number of worker processes
+        """
+        self.num_workers = num_workers
+        self.procs = [None] * num_workers
+        self.conns = [None] * num_workers
+        # The round whose shared object each worker has
+        self.worker_rounds = [None] * num_workers
+        self.round_idx = 0
+        for worker_idx in range(num_workers):
+            self._start_worker(worker_idx)
+
+    def _start_worker(self, worker_idx):
+        parent_conn, child_conn = Pipe()
+        proc = Process(target=run_fleet_worker, args=(child_conn,))
+        proc.daemon = True
+        proc.start()
+        child_conn.close()
+        self.procs[worker_idx] = proc
+        self.conns[worker_idx] = parent_conn
+        self.worker_rounds[worker_idx] = None
+
+    def _restart_worker(self, worker_idx):
+        self.conns[worker_idx].close()
+        if self.procs[worker_idx].is_alive():
+            self.procs[worker_idx].terminate()
+        self.procs[worker_idx].join()
+        self._start_worker(worker_idx)
+
+    def _send(self, worker_idx, msg_type, payload):
+        perf_count("num_job_bytes_sent", len(payload))
+        self.conns[worker_idx].send((msg_type, payload))
+
+    def run(self, batched_workers_list, shared_obj, max_num_tries=2):
+        """
+        @param batched_workers_list: list of lists of ParallelWorkers
+        @param shared_obj: object shared across the ParallelWorkers
+        @param max_num_tries: number of times to retry a batch whose worker died, as in custom_utils.finish_process
+
+        @return list with the list of results for each batch, None if the batch failed on every try
+        """
+        self.round_idx += 1
+        pickled_shared_obj = cPickle.dumps(shared_obj, protocol=cPickle.HIGHEST_PROTOCOL)
+        pending = range(len(batched_workers_list))
+        n_tries = [0] * len(batched_workers_list)
+        batch_results = [None] * len(batched_workers_list)
+        # Maps worker index to the index of the batch it is running
+        running = {}
+        while pending or running:
+            for worker_idx in range(self.num_workers):
+                if worker_idx in running or not pending:
+                    continue
+                batch_idx = pending.pop(0)
+                n_tries[batch_idx] += 1
+                try:
+                    if self.worker_rounds[worker_idx] != self.round_idx:
+                        self._send(worker_idx, "shared", pickled_shared_obj)
+                        self.worker_rounds[worker_idx] = self.round_idx
+                    self._send(
+                        worker_idx,
+                        "batch",
+                        cPickle.dumps(batched_workers_list[batch_idx], protocol=cPickle.HIGHEST_PROTOCOL),
+                    )
+                    running[worker_idx] = batch_idx
+                except (IOError, OSError):
+                    traceback.print_exc()
+                    self._handle_failure(worker_idx, batch_idx, n_tries, max_num_tries, pending)
+
+            if not running:
+                continue
+            readable_conns, _, _ = select.select([self.conns[worker_idx] for worker_idx in running], [], [])
+            for worker_idx, batch_idx in running.items():
+                if self.conns[worker_idx] not in readable_conns:
+                    continue
+                del running[worker_idx]
+                try:
+                    pickled_results = self.conns[worker_idx].recv_bytes()
+                    perf_count("num_job_bytes_received", len(pickled_results))
+                    batch_results[batch_idx] = cPickle.loads(pickled_results)
+                except (EOFError, IOError, OSError):
+                    traceback.print_exc()
+                    self._handle_failure(worker_idx, batch_idx, n_tries, max_num_tries, pending)
+        return batch_results
+
+    def _handle_failure(self, worker_idx, batch_idx, n_tries, max_num_tries, pending):
+        """
+        Restart the worker and retry the batch, unless it has been tried too many times
+        """
+        self._restart_worker(worker_idx)
+        if n_tries[batch_idx] > max_num_tries:
+            print "exceeded max number of tries for batch %d on the local workers" % batch_idx
+        else:
+            print "    batch %d try %d failed, restarting" % (batch_idx, n_tries[batch_idx])
+            pending.insert(0, batch_idx)
+
+    def shutdown(self):
+        for worker_idx in range(self.num_workers):
+            try:
+                self.conns[worker_idx].send(("stop", None))
+            except (IOError, OSError):
+                pass
+            self.conns[worker_idx].close()
+            self.procs[worker_idx].join()
+
+def get_local_worker_fleet(num_workers):
+    """
+    The fleet is started the first time it is needed in a process and is reused afterwards.
+    Processes forked from a process with a fleet start their own.
+
+    @param num_workers: number of worker processes
+    @return the LocalWorkerFleet of this process
+    """
+    global _LOCAL_WORKER_FLEET
+    if _LOCAL_WORKER_FLEET is not None:
+        fleet_pid, fleet = _LOCAL_WORKER_FLEET
+        if fleet_pid == os.getpid() and fleet.num_workers == num_workers:
+            return fleet
+        if fleet_pid == os.getpid():
+            fleet.shutdown()
+    fleet = LocalWorkerFleet(num_workers)
+    _LOCAL_WORKER_FLEET = (os.getpid(), fleet)
+    return fleet
+
+def shutdown_local_worker_fleet():
+    """
+    Stop the worker processes of the fleet of this process, if it has one
+    """
+    global _LOCAL_WORKER_FLEET
+    if _LOCAL_WORKER_FLEET is not None:
+        fleet_pid, fleet = _LOCAL_WORKER_FLEET
+        if fleet_pid == os.getpid():
+            fleet.shutdown()
+        _LOCAL_WORKER_FLEET = None
+
+atexit.register(shutdown_local_worker_fleet)
@@ -0,0 +1,256 @@
+import time
+import logging as log
+import numpy as np
+import scipy.sparse
+
+from common import NUM_NUCLEOTIDES
+
+def _log_logistic(z):
+    """
+    @return log(1/(1 + exp(-z))), computed without overflow
+    """
+    return -np.logaddexp(0, -z)
+
+def _sigmoid(z):
+    return np.exp(_log_logistic(z))
+
+class LogisticSufficientStats:
+    """
+    The positions of a logistic dataset collapsed into the number of positions with each combination of
+    features, outcome and original nucleotide. Positions with the same combination contribute the same term
+    to the log likelihood, so a motif model only needs a table with a row per motif and outcome.
+    """
+    def __init__(self, row_counts, num_feats):
+        """
+        @param row_counts: dictionary mapping a tuple of the feature indices, y and y_orig to the number of positions
+        @param num_feats: number of features
+        """
+        self.row_counts = row_counts
+        self.num_feats = num_feats
+
+    @staticmethod
+    def from_X_y(X, y, y_orig):
+        """
+        @param X, y, y_orig: see LogisticData
+
+        @return LogisticSufficientStats with the counts of the rows of the dataset
+        """
+        X = scipy.sparse.csr_matrix(X)
+        X.sort_indices()
+        row_nnz = np.diff(X.indptr)
+        row_counts = {}
+        # Rows with the same number of features can be stacked into one array and collapsed together
+        for nnz in np.unique(row_nnz):
+            row_idxs = np.where(row_nnz == nnz)[0]
+            feat_idxs = X.indices[X.indptr[row_idxs][:, None] + np.arange(nnz)[None, :]]
+            keys = np.hstack([feat_idxs, y[row_idxs, None], y_orig[row_idxs, None]]).astype(int)
+            unique_keys, key_counts = np.unique(keys, axis=0, return_counts=True)
+            for key, key_count in zip(unique_keys, key_counts):
+                row_counts[tuple(key)] = key_count
+        return LogisticSufficientStats(row_counts, X.shape[1])
+
+    def subtract(self, other):
+        """
+        @param other: LogisticSufficientStats of a subset of the positions of this dataset
+
+        @return LogisticSufficientStats of the rest of the positions
+        """
+        row_counts = {}
+        for key, count in self.row_counts.iteritems():
+            remaining_count = count - other.row_counts.get(key, 0)
+            assert(remaining_count >= 0)
+            if remaining_count > 0:
+                row_counts[key] = remaining_count
+        return LogisticSufficientStats(row_counts, self.num_feats)
+
+    def get_X_y_counts(self):
+        """
+        @return sparse X matrix with a row per distinct position, y, y_orig and the number of positions of each row
+        """
+        keys = sorted(self.row_counts.keys())
+        feat_idxs = [key[:-2] for key in keys]
+        X = scipy.sparse.csr_matrix(
+            (
+                np.ones(sum([len(f) for f in feat_idxs])),
+                np.concatenate([[]] + [list(f) for f in feat_idxs]).astype(int),
+                np.cumsum([0] + [len(f) for f in feat_idxs]),
+            ),
+            shape=(len(keys), self.num_feats),
+        )
+        y = np.array([key[-2] for key in keys], dtype=float)
+        y_orig = np.array([key[-1] for key in keys], dtype=float)
+        counts = np.array([self.row_counts[key] for key in keys], dtype=float)
+        return X, y, y_orig, counts
+
+class LogisticData:
+    """
+    A dataset for LogisticRegressionMotifProximal, with X kept sparse.
+    Every position has only a handful of nonzero features (one motif per motif length), so the terms that
+    are linear in theta are summarized by the feature counts over the positions with each outcome,
+    and only the logistic and softmax denominators need the full X.
+    The intercept is added to every feature, like in logistic_problem_cvxpy, so it enters the logit of a position
+    once for each of its features.
+    """
+    def __init__(self, X, y, y_orig, per_target_model, counts=None):
+        """
+        @param X: sparse matrix with a row for each position
+        @param y: indicator of mutation, or the target nucleotide index + 1 for a per-target model
+        @param y_orig: the original nucleotide index + 1 of the mutated positions
+        @param per_target_model: whether the substitution probabilities are modeled too
+        @param counts: number of positions that each row stands for (see LogisticSufficientStats); one each if None
+        """
+        self.X = scipy.sparse.csr_matrix(X)
+        self.counts = np.ones(self.X.shape[0]) if counts is None else counts
+        # Number of features of each position, which multiplies the intercept in its logit
+        self.row_sums = np.asarray(self.X.sum(axis=1)).ravel()
+        no_mutate = y == 0
+        # Feature counts of the positions that did not mutate: their log likelihood has an extra -X * theta
+        self.no_mutate_feat_counts = self.X[no_mutate, :].T.dot(self.counts[no_mutate])
+        self.no_mutate_row_sum = np.sum(self.no_mutate_feat_counts)
+        self.per_target_model = per_target_model
+        if per_target_model:
+            mutated = ~no_mutate
+            self.mutate_X = self.X[mutated, :]
+            self.mutate_counts = self.counts[mutated]
+            targets = y[mutated].astype(int) - 1
+            # Mask of the targets that each mutated position could have mutated to
+            self.possible_targets = np.ones((targets.size, NUM_NUCLEOTIDES), dtype=bool)
+            self.possible_targets[np.arange(targets.size), y_orig[mutated].astype(int) - 1] = False
+            target_indicators = scipy.sparse.csr_matrix(
+                (self.mutate_counts, (np.arange(targets.size), targets)),
+                shape=(targets.size, NUM_NUCLEOTIDES),
+            )
+            # Feature counts of the positions that mutated to each target: the numerators of the softmax
+            self.target_feat_counts = np.asarray((self.mutate_X.T * target_indicators).todense())
+
+class LogisticRegressionMotifProximal:
+    """
+    Fit logistic regression with L1 penalty on the theta matrix via accelerated proximal gradient descent.
+    Solves the same problem as LogisticRegressionMotif in logistic_problem_cvxpy but never makes X dense.
+
+    The probability of mutating follows usual logistic regression parameterization
+    The probability of substituting particular nucleotides follows a softmax parameterization
+    """
+    def __init__(self, theta_shape, X, y, y_orig, init_lam=1, per_target_model=False, counts=None):
+        """
+        @param theta_shape: shape of theta; one column, or NUM_NUCLEOTIDES + 1 columns for a per-target model
+        @param X, y, y_orig, counts: see LogisticData
+        @param init_lam: penalty parameter
+        @param per_target_model: whether the substitution probabilities are modeled too
+        """
+        self.data = LogisticData(X, y, y_orig, per_target_model, counts)
+        self.per_target_model = per_target_model
+        self.lam = init_lam
+        # The solution of the last call to solve, used as the starting point of the next call
+        self.theta = np.zeros(theta_shape)
+        self.theta_intercept = 0.
+        self.step_size = 1.
+
+    def _get_log_lik(self, data, theta, theta_intercept, get_grad=False):
+        """
+        @return log likelihood of the data,
+                its gradient with respect to theta and theta_intercept if get_grad
+        """
+        # z = X * (theta + theta_intercept)
+        z = data.X.dot(theta[:, 0]) + data.row_sums * theta_intercept
+        log_lik = data.counts.dot(_log_logistic(z)) - data.no_mutate_feat_counts.dot(theta[:, 0]) - data.no_mutate_row_sum * theta_intercept
+        if get_grad:
+            # derivative of the log logistic is 1 - sigmoid
+            z_grad = data.counts * _sigmoid(-z)
+            grad = np.zeros(theta.shape)
+            grad[:, 0] = data.X.T.dot(z_grad) - data.no_mutate_feat_counts
+            grad_intercept = data.row_sums.dot(z_grad) - data.no_mutate_row_sum
+
+        if self.per_target_model and data.mutate_X.shape[0]:
+            # The intercept cancels in the softmax
+            target_logits = np.where(data.possible_targets, -data.mutate_X.dot(theta[:, 1:]), -np.inf)
+            log_denoms = np.logaddexp.reduce(target_logits, axis=1)
+            log_lik += -np.sum(data.target_feat_counts * theta[:, 1:]) - data.mutate_counts.dot(log_denoms)
+            if get_grad:
+                target_probs = data.mutate_counts[:, None] * np.exp(target_logits - log_denoms[:, None])
+                grad[:, 1:] = -data.target_feat_counts + data.mutate_X.T.dot(target_probs)
+
+        if get_grad:
+            return log_lik, grad, grad_intercept
+        return log_lik
+
+    def _get_penalized_value(self, theta, theta_intercept):
+        return self._get_log_lik(self.data, theta, theta_intercept) - self.lam * np.sum(np.abs(theta))
+
+    def solve(self, lam_val, max_iters=2000, verbose=False, init_theta=None, step_size_shrink=0.5, diff_thres=1e-8):
+        """
+        Runs FISTA with backtracking and restarts whenever the objective increases.
+        By default, starts from the solution of the previous call so a path of penalty parameters is fast to fit.
+
+        @param lam_val: penalty parameter
+        @param max_iters: maximum number of iterations
+        @param verbose: whether to log the status at each iteration
+        @param init_theta: tuple of theta and the intercept to start from, instead of the previous solution
+        @param step_size_shrink: how much to shrink the step size during backtracking
+        @param diff_thres: stop when the relative change in the objective is less than this
+
+        @return theta, theta with the intercept added, penalized log likelihood
+        """
+        st_time = time.time()
+        self.lam = lam_val
+        if init_theta is not None:
+            self.theta, self.theta_intercept = np.array(init_theta[0], dtype=float), float(init_theta[1])
+
+        theta, theta_intercept = self.theta, self.theta_intercept
+        current_value = self._get_penalized_value(theta, theta_intercept)
+        # the extrapolated point
+        y_theta, y_intercept = theta, theta_intercept
+        t = 1.
+        for i in range(max_iters):
+            y_log_lik, grad, grad_intercept = self._get_log_lik(self.data, y_theta, y_intercept, get_grad=True)
+            # We maximize, so step along the gradient and backtrack until the quadratic lower bound holds
+            while True:
+                potential_theta = y_theta + self.step_size * grad
+                potential_theta = np.sign(potential_theta) * np.maximum(np.abs(potential_theta) - self.step_size * lam_val, 0)
+                potential_intercept = y_intercept + self.step_size * grad_intercept
+                diff_theta = potential_theta - y_theta
+                diff_intercept = potential_intercept - y_intercept
+                potential_log_lik = self._get_log_lik(self.data, potential_theta, potential_intercept)
+                lower_bound = (
+                    y_log_lik
+                    + np.sum(grad * diff_theta) + grad_intercept * diff_intercept
+                    - (np.sum(diff_theta ** 2) + diff_intercept ** 2) / (2 * self.step_size)
+                )
+                if potential_log_lik >= lower_bound or self.step_size < 1e-20:
+                    break
+                self.step_size *= step_size_shrink
+
+            potential_value = potential_log_lik - lam_val * np.sum(np.abs(potential_theta))
+            if potential_value < current_value:
+                # Restart the momentum
+                t = 1.
+                y_theta, y_intercept = theta, theta_intercept
+                if np.abs(potential_value - current_value) < diff_thres * max(1., np.abs(current_value)):
+                    break
+                continue
+
+            t_new = (1 + np.sqrt(1 + 4 * t ** 2)) / 2
+            momentum = (t - 1) / t_new
+            y_theta = potential_theta + momentum * (potential_theta - theta)
+            y_intercept = potential_intercept + momentum * (potential_intercept - theta_intercept)
+            t = t_new
+
+            diff = potential_value - current_value
+            theta, theta_intercept, current_value = potential_theta, potential_intercept, potential_value
+            if verbose:
+                log.info("PROX logistic iter %d, val %f, step size %g" % (i, current_value, self.step_size))
+            if diff < diff_thres * max(1., np.abs(current_value)):
+                break
+            # Let the step size grow again in case the backtracking was too cautious
+            self.step_size /= step_size_shrink ** 0.5
+
+        log.info("PROX logistic lam %f: iters %d, val %f, time %f" % (lam_val, i + 1, current_value, time.time() - st_time))
+        self.theta, self.theta_intercept = theta, theta_intercept
+        return theta, theta + theta_intercept, current_value
+
+    def score(self, new_X, new_y, new_y_orig, new_counts=None):
+        """
+        @return log likelihood on this new dataset
+        """
+        new_data = LogisticData(new_X, new_y, new_y_orig, self.per_target_model, new_counts)
+        return self._get_log_lik(new_data, self.theta, self.theta_intercept)
@@ -0,0 +1,68 @@
+import time
+import numpy as np
+
+from parallel_worker import ParallelWorker
+
+class LogisticFoldWorker(ParallelWorker):
+    """
+    Fits the logistic regression problem of one fold for a path of penalty parameters.
+    The penalty parameters are fit in order, each one starting from the solution of the previous one
+    if the solver supports warm starts.
+    """
+    def __init__(self, seed, fold_idx, logistic_reg, val_data, penalty_params, max_iters):
+        """
+        @param seed: not used by the fit
+        @param fold_idx: index of the fold
+        @param logistic_reg: logistic regression problem with the training data of the fold
+        @param val_data: tuple with the arguments to logistic_reg.score for the validation data of the fold
+        @param penalty_params: list of penalty parameters
+        @param max_iters: maximum number of iterations for each fit
+        """
+        self.seed = seed
+        self.fold_idx = fold_idx
+        self.logistic_reg = logistic_reg
+        self.val_data = val_data
+        self.penalty_params = penalty_params
+        self.max_iters = max_iters
+
+    def run_worker(self, shared_obj=None):
+        """
+        @return list with a LogisticFoldResult for each penalty parameter
+        """
+        results = []
+        for penalty_param in self.penalty_params:
+            st_time = time.time()
+            theta_raw, theta_part_agg, train_value = self.logistic_reg.solve(
+                    lam_val=penalty_param,
+                    max_iters=self.max_iters,
+                    verbose=False)
+            fit_time = time.time() - st_time
+            results.append(LogisticFoldResult(
+                penalty_param,
+                np.array(theta_raw),
+                np.array(theta_part_agg),
+                self.logistic_reg.score(*self.val_data),
+                fit_time,
+            ))
+        return results
+
+    def __str__(self):
+        return "LogisticFoldWorker %d" % self.fold_idx
+
+class LogisticFoldResult:
+    """
+    The fit of one fold for one penalty parameter
+    """
+    def __init__(self, penalty_param, theta, theta_part_agg, validation_value, fit_time):
+        """
+        @param penalty_param: the penalty parameter
+        @param theta: fitted theta
+        @param theta_part_agg: fitted theta with the intercept added
+        @param validation_value: log likelihood of the validation data
+        @param fit_time: seconds spent fitting
+        """
+        self.penalty_param = penalty_param
+        self.theta = theta
+        self.theta_part_agg = theta_part_agg
+        self.validation_value = validation_value
+        self.fit_time = fit_time
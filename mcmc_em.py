@@ -7,9 +7,10 @@ from common import *
 from sampler_collection import SamplerCollection
 from profile_support import profile
 from confidence_interval_maker import ConfidenceIntervalMaker
+from perf_registry import perf_start_record, perf_timer, perf_count
 
 class MCMC_EM:
-    def __init__(self, sampler_cls, problem_solver_cls, base_num_e_samples=10, max_m_iters=200, num_jobs=1, scratch_dir='_output', per_target_model=False, sampling_rate=1):
+    def __init__(self, sampler_cls, problem_solver_cls, base_num_e_samples=10, max_m_iters=200, num_jobs=1, scratch_dir='_output', per_target_model=False, sampling_rate=1, job_backend="slurm"):
         """
         @param train_data, val_data: lists of ObservedSequenceMutationsFeatures (start and end sequences, plus base feature info)
         @param sampler_cls: a Sampler class
@@ -17,17 +18,19 @@ class MCMC_EM:
         @param base_num_e_samples: number of E-step samples to draw initially
         @param max_m_iters: maximum number of iterations for the M-step
         @param num_jobs: number of jobs to submit for E-step
+        @param job_backend: "slurm" to submit the E-step jobs to slurm, "local" to run them on local worker processes
         """
         self.base_num_e_samples = base_num_e_samples
         self.max_m_iters = max_m_iters
         self.sampler_cls = sampler_cls
         self.problem_solver_cls = problem_solver_cls
         self.num_jobs = num_jobs
+        self.job_backend = job_backend
         self.scratch_dir = scratch_dir
         self.per_target_model = per_target_model
         self.sampling_rate = sampling_rate
 
-    def run(self, observed_data, feat_generator, theta, penalty_params=[1], possible_theta_mask=None, zero_theta_mask=None, max_em_iters=10, burn_in=1, diff_thres=1e-6, max_e_samples=10, get_hessian=False, pool=None, hessian_check_iter=None):
+    def run(self, observed_data, feat_generator, theta, penalty_params=[1], possible_theta_mask=None, zero_theta_mask=None, max_em_iters=10, burn_in=1, diff_thres=1e-6, max_e_samples=10, get_hessian=False, pool=None, hessian_check_iter=None, checkpoint=None):
         """
         @param theta: initial value for theta in MCMC-EM
         @param feat_generator: an instance of a FeatureGenerator
@@ -37,6 +40,8 @@ class MCMC_EM:
         @param diff_thres: if the change in the objective function changes no more than `diff_thres`, stop MCMC-EM
         @param max_e_samples: maximum number of e-samples to grab per observed sequence
         @param train_and_val: whether to train on both train and validation data
+        @param checkpoint: EMCheckpoint that is saved at the start of every EM iteration. If it already has a
+                        checkpoint (from a run that was interrupted), continue from there.
         """
         st = time.time()
         num_data = len(observed_data)
@@ -48,38 +53,58 @@ class MCMC_EM:
         all_traces = []
         sample_obs_info = None
         variance_est = None
+        start_run = 0
+        if checkpoint is not None:
+            checkpoint_state = checkpoint.load()
+            if checkpoint_state is not None:
+                start_run, theta, init_orders, all_traces = checkpoint_state
+                log.info("Resuming MCMC-EM from iteration %d" % start_run)
+        # One sampler collection for the whole run, so the observed data is only written once for the jobs
+        sampler_collection = SamplerCollection(
+            observed_data,
+            theta,
+            self.sampler_cls,
+            feat_generator,
+            self.num_jobs,
+            self.scratch_dir,
+            pool=pool,
+            job_backend=self.job_backend,
+        )
         # burn in only at the very beginning
-        for run in range(max_em_iters):
+        for run in range(start_run, max_em_iters):
+            perf_start_record(em_iter=run)
+            if checkpoint is not None:
+                checkpoint.save(run, theta, init_orders, all_traces)
             prev_theta = theta
             num_e_samples = self.base_num_e_samples
-
-            sampler_collection = SamplerCollection(
-                observed_data,
-                prev_theta,
-                self.sampler_cls,
-                feat_generator,
-                self.num_jobs,
-                self.scratch_dir,
-            )
+            sampler_collection.theta = prev_theta
 
             e_step_samples = []
             e_step_labels = []
+            e_step_weights = []
             lower_bound_is_negative = True
             while len(e_step_samples)/num_data < max_e_samples and lower_bound_is_negative:
                 ## Keep grabbing samples until it is highly likely we have increased the penalized log likelihood
 
                 # do E-step
                 log.info("E STEP, iter %d, num samples %d, time %f" % (run, len(e_step_samples)/num_data + num_e_samples, time.time() - st))
-                sampler_results = sampler_collection.get_samples(
-                    init_orders,
-                    num_e_samples,
-                    burn_in,
-                    sampling_rate=self.sampling_rate,
-                )
+                with perf_timer("e_step_time"):
+                    sampler_results = sampler_collection.get_samples(
+                        init_orders,
+                        num_e_samples,
+                        burn_in,
+                        sampling_rate=self.sampling_rate,
+                    )
+                perf_count("num_samples_drawn", sum([len(res.samples) for res in sampler_results]))
                 # Don't use burn-in from now on
                 # burn_in = 0
                 all_traces.append([res.trace for res in sampler_results])
-                sampled_orders_list = [res.samples for res in sampler_results]
+                if get_hessian:
+                    # Calculating the hessian requires unweighted samples
+                    sampled_orders_list = [self._get_unweighted_samples(res) for res in sampler_results]
+                else:
+                    sampled_orders_list = [res.samples for res in sampler_results]
+                    e_step_weights += self._get_sample_weights(sampler_results)
 
                 # the last sampled mutation order from each list
                 # use this iteration's sampled mutation orders as initialization for the gibbs samplers next cycle
@@ -91,21 +116,23 @@ class MCMC_EM:
                 # Do M-step
                 log.info("M STEP, iter %d, time %f" % (run, time.time() - st))
 
-                problem = self.problem_solver_cls(
-                    feat_generator,
-                    e_step_samples,
-                    e_step_labels,
-                    penalty_params,
-                    self.per_target_model,
-                    possible_theta_mask=possible_theta_mask,
-                    zero_theta_mask=zero_theta_mask,
-                    pool=pool,
-                )
+                with perf_timer("m_step_time"):
+                    problem = self.problem_solver_cls(
+                        feat_generator,
+                        e_step_samples,
+                        e_step_labels,
+                        penalty_params,
+                        self.per_target_model,
+                        possible_theta_mask=possible_theta_mask,
+                        zero_theta_mask=zero_theta_mask,
+                        pool=pool,
+                        sample_weights=e_step_weights if len(e_step_weights) else None,
+                    )
 
-                theta, pen_exp_log_lik, lower_bound = problem.solve(
-                    init_theta=prev_theta,
-                    max_iters=self.max_m_iters,
-                )
+                    theta, pen_exp_log_lik, lower_bound = problem.solve(
+                        init_theta=prev_theta,
+                        max_iters=self.max_m_iters,
+                    )
 
                 num_nonzero = get_num_nonzero(theta)
                 num_unique = get_num_unique_theta(theta)
@@ -135,4 +162,30 @@ class MCMC_EM:
                     log.info("found negative variance estimates.. EM iteration %d", run)
                 else:
                     break
+        sampler_collection.close()
         return theta, variance_est, sample_obs_info, all_traces
+
+    def _get_sample_weights(self, sampler_results):
+        """
+        @param sampler_results: list of results from the sampler, one per observation
+        @return list of importance weights for the samples, rescaled so that the weights for each observation
+                sum to the number of samples for that observation. Empty if the samples are unweighted.
+        """
+        sample_weights = []
+        for res in sampler_results:
+            if getattr(res, "sample_weights", None) is None:
+                return []
+            sample_weights += (res.sample_weights * len(res.samples)/np.sum(res.sample_weights)).tolist()
+        return sample_weights
+
+    def _get_unweighted_samples(self, sampler_res):
+        """
+        @param sampler_res: a result from the sampler
+        @return the samples, resampled according to their importance weights if the samples are weighted
+        """
+        if getattr(sampler_res, "sample_weights", None) is None:
+            return sampler_res.samples
+        num_samples = len(sampler_res.samples)
+        sample_weights = sampler_res.sample_weights/np.sum(sampler_res.sample_weights)
+        resampled_idxs = np.random.choice(num_samples, size=num_samples, p=sample_weights)
+        return [sampler_res.samples[i] for i in resampled_idxs]
@@ -13,6 +13,8 @@ class MethodResults:
         self.num_not_crossing_zero = 0
         self.percent_not_crossing_zero = 1
         self.num_p = 0
+        # Timers and counters of each stage of the fit (see perf_registry)
+        self.perf_records = {}
 
     def set_penalized_theta(self, penalized_theta, log_lik_ratio_lower_bound, log_lik_ratio, model_masks, reference_penalty_param=None):
         """
@@ -47,6 +49,13 @@ class MethodResults:
         self.refit_possible_theta_mask = possible_theta_mask
         self.num_p = np.sum(self.refit_possible_theta_mask & ~self.model_masks.zero_theta_mask_refit)
 
+    def set_perf_records(self, stage, records):
+        """
+        @param stage: name of the stage of the fit, e.g. "penalized" or "refit"
+        @param records: list of records from a PerfRegistry, e.g. one per EM iteration
+        """
+        self.perf_records[stage] = records
+
     def set_sampler_results(self, sampler_results):
         """
         Store the residuals
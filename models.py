@@ -2,7 +2,7 @@ from common import mutate_string, DEGENERATE_NUCLEOTIDE
 import numpy as np
 
 class ObservedSequenceMutations:
-    def __init__(self, start_seq, end_seq, motif_len=3, left_flank_len=None, right_flank_len=None, collapse_list=[]):
+    def __init__(self, start_seq, end_seq, motif_len=3, left_flank_len=None, right_flank_len=None, collapse_list=[], flank_idxs=None, mutation_pos=None):
         """
         @param start_seq: start sequence
         @param end_seq: ending sequence with mutations
@@ -10,6 +10,9 @@ class ObservedSequenceMutations:
         @param left_flank_len: maximum left flank length for this motif length
         @param right_flank_len: maximum right flank length for this motif length
         @param collapse_list: list of tuples of (index offset, start index of run of "n"s, end index of run of "n"s) for bookkeeping later
+        @param flank_idxs: optional tuple with the precomputed start and end indices of the conserved region
+                            (i.e. start_idx and end_idx below), to skip scanning for the flanks
+        @param mutation_pos: optional list of precomputed mutated positions in the trimmed sequence, to skip comparing the sequences
 
         This class goes through half the sequence forward and finds the position where
         there are left_flank_len conserved nucleotides, and does the same in reverse with right_flank_len nucleotides.
@@ -31,28 +34,31 @@ class ObservedSequenceMutations:
         if right_flank_len is None:
             right_flank_len = motif_len/2
 
-        start_idx = 0
-        end_idx = len(start_seq)
-
-        # Go through half the sequence forward to find beginning conserved nucleotides
-        # Also skip ns
-        for flank_start_idx in range(len(start_seq)/2):
-            if start_idx + left_flank_len == flank_start_idx:
-                break
-            elif start_seq[flank_start_idx] != end_seq[flank_start_idx] or \
-                 start_seq[flank_start_idx] == DEGENERATE_NUCLEOTIDE or \
-                 end_seq[flank_start_idx] == DEGENERATE_NUCLEOTIDE:
-                start_idx = flank_start_idx + 1
-
-        # Go through remaining half the sequence backward to find ending conserved nucleotides
-        # Also skip ns
-        for flank_end_idx in reversed(range(len(start_seq)/2, len(start_seq))):
-            if end_idx - right_flank_len - 1 == flank_end_idx:
-                break
-            elif start_seq[flank_end_idx] != end_seq[flank_end_idx] or \
-                 start_seq[flank_end_idx] == DEGENERATE_NUCLEOTIDE or \
-                 end_seq[flank_end_idx] == DEGENERATE_NUCLEOTIDE:
-                end_idx = flank_end_idx
+        if flank_idxs is not None:
+            start_idx, end_idx = flank_idxs
+        else:
+            start_idx = 0
+            end_idx = len(start_seq)
+
+            # Go through half the sequence forward to find beginning conserved nucleotides
+            # Also skip ns
+            for flank_start_idx in range(len(start_seq)/2):
+                if start_idx + left_flank_len == flank_start_idx:
+                    break
+                elif start_seq[flank_start_idx] != end_seq[flank_start_idx] or \
+                     start_seq[flank_start_idx] == DEGENERATE_NUCLEOTIDE or \
+                     end_seq[flank_start_idx] == DEGENERATE_NUCLEOTIDE:
+                    start_idx = flank_start_idx + 1
+
+            # Go through remaining half the sequence backward to find ending conserved nucleotides
+            # Also skip ns
+            for flank_end_idx in reversed(range(len(start_seq)/2, len(start_seq))):
+                if end_idx - right_flank_len - 1 == flank_end_idx:
+                    break
+                elif start_seq[flank_end_idx] != end_seq[flank_end_idx] or \
+                     start_seq[flank_end_idx] == DEGENERATE_NUCLEOTIDE or \
+                     end_seq[flank_end_idx] == DEGENERATE_NUCLEOTIDE:
+                    end_idx = flank_end_idx
 
         skipped_left = start_idx
         skipped_right = len(start_seq) - end_idx
@@ -63,12 +69,12 @@ class ObservedSequenceMutations:
         start_seq = start_seq[start_idx + left_flank_len:end_idx - right_flank_len]
         end_seq = end_seq[start_idx + left_flank_len:end_idx - right_flank_len]
 
-        self.mutation_pos_dict = dict()
+        if mutation_pos is None:
+            mutation_pos = [i for i in range(len(start_seq)) if start_seq[i] != end_seq[i]]
+        self.mutation_pos_dict = {i: end_seq[i] for i in mutation_pos}
         self.mutated_indicator = [0.] * len(start_seq)
-        for i in range(len(start_seq)):
-            if start_seq[i] != end_seq[i]:
-                self.mutation_pos_dict[i] = end_seq[i]
-                self.mutated_indicator[i] = 1.
+        for i in mutation_pos:
+            self.mutated_indicator[i] = 1.
 
         self.num_mutations = len(self.mutation_pos_dict.keys())
         self.left_flank_len = len(self.left_flank)
@@ -87,15 +93,18 @@ class ObservedSequenceMutations:
         # so that position information is lost---raw_pos keeps the "raw position," i.e.,
         # if we had collapsed two "n"s in the middle of a sequence, all subsequent positions
         # will have a raw_pos 2 greater than the pos value.
-        self.raw_pos = {}
-        for pos in range(self.seq_len):
-            raw_pos = pos + self.left_position_offset
-            for half_motif_len, string_start, string_end in sorted(self.collapse_list, key=lambda val: val[1]):
-                if raw_pos <= self.left_position_offset + string_start - half_motif_len:
-                    break
-                else:
-                    raw_pos += string_end - string_start - half_motif_len
-            self.raw_pos[pos] = raw_pos
+        if len(self.collapse_list) == 0:
+            self.raw_pos = {pos: pos + self.left_position_offset for pos in range(self.seq_len)}
+        else:
+            self.raw_pos = {}
+            for pos in range(self.seq_len):
+                raw_pos = pos + self.left_position_offset
+                for half_motif_len, string_start, string_end in sorted(self.collapse_list, key=lambda val: val[1]):
+                    if raw_pos <= self.left_position_offset + string_start - half_motif_len:
+                        break
+                    else:
+                        raw_pos += string_end - string_start - half_motif_len
+                self.raw_pos[pos] = raw_pos
 
         assert(self.seq_len > 0)
 
@@ -0,0 +1,249 @@
+"""
+Scores the mutability of every position in many sequences with a fitted motif model.
+
+The aggregate theta of the fitted model (see HierarchicalMotifFeatureGenerator.create_aggregate_theta)
+is compiled into a dense table indexed by motif codes: the motif is read as a base-4 number
+(in the order of NUCLEOTIDES, first nucleotide is the most significant digit). Scoring a batch of sequences
+then only needs array operations: encode the nucleotides, compute the motif code at every position
+and look up the table.
+"""
+import csv
+import os
+import itertools
+import numpy as np
+
+from common import NUCLEOTIDES, NUM_NUCLEOTIDES, NUCLEOTIDE_DICT
+from motif_feature_generator import MotifFeatureGenerator
+from parallel_worker import ParallelWorker, BatchParallelWorkers, run_multiprocessing_worker
+
+INDEX_FILE = "sequences.csv"
+RATES_FILE = "rates.bin"
+TARGET_PROBS_FILE = "target_probs.bin"
+SCORE_DTYPE = np.float32
+
+class MutabilityScorer:
+    """
+    Computes the relative mutation rate, exp(theta * psi), of every position in a sequence,
+    and the probability of mutating to each target nucleotide if the model is a per-target model
+    """
+    def __init__(self, agg_theta, motif_len, left_flank_len):
+        """
+        @param agg_theta: aggregate theta with one row per motif of length motif_len (in the order of
+                        MotifFeatureGenerator.motif_list). One column for the rate of the motif mutating,
+                        or one column per target nucleotide.
+        @param motif_len: length of the motifs
+        @param left_flank_len: the position in the motif that mutates
+        """
+        self.motif_len = motif_len
+        self.left_flank_len = left_flank_len
+        self.right_flank_len = motif_len - left_flank_len - 1
+        self.per_target_model = agg_theta.shape[1] == NUM_NUCLEOTIDES
+
+        full_feat_generator = MotifFeatureGenerator(
+            motif_len=motif_len,
+            distance_to_start_of_motif=-left_flank_len,
+        )
+        assert(agg_theta.shape[0] == full_feat_generator.feature_vec_len)
+        # hazards of each motif code mutating to each target nucleotide (or mutating at all)
+        self.hazard_table = np.zeros((NUM_NUCLEOTIDES ** motif_len, agg_theta.shape[1]))
+        for motif_idx, motif in enumerate(full_feat_generator.motif_list):
+            self.hazard_table[self._get_motif_code(motif)] = np.exp(agg_theta[motif_idx])
+            if self.per_target_model:
+                # a motif cannot mutate to its own center nucleotide
+                self.hazard_table[self._get_motif_code(motif), NUCLEOTIDE_DICT[motif[left_flank_len]]] = 0
+        self.rate_table = self.hazard_table.sum(axis=1)
+
+        # maps characters to nucleotide indices, with -1 for anything that is not a nucleotide
+        self.nucleotide_codes = -np.ones(256, dtype=int)
+        for i, nucleotide in enumerate(NUCLEOTIDES):
+            self.nucleotide_codes[ord(nucleotide)] = i
+            self.nucleotide_codes[ord(nucleotide.upper())] = i
+
+    @staticmethod
+    def from_method_results(method_res):
+        """
+        @param method_res: MethodResults with a refit theta
+
+        @return MutabilityScorer for the refit theta
+        """
+        feat_generator = method_res.refit_feature_generator
+        agg_theta = feat_generator.create_aggregate_theta(
+            method_res.refit_theta,
+            keep_col0=False,
+            add_targets=True,
+        )
+        return MutabilityScorer(agg_theta, feat_generator.motif_len, feat_generator.max_left_motif_flank_len)
+
+    def _get_motif_code(self, motif):
+        code = 0
+        for nucleotide in motif:
+            code = code * NUM_NUCLEOTIDES + NUCLEOTIDE_DICT[nucleotide]
+        return code
+
+    def score(self, seqs):
+        """
+        Positions without a full motif around them (at the ends of the sequence or next to a
+        character that is not a nucleotide) get NaN scores.
+
+        @param seqs: list of sequences
+        @return numpy array with the relative mutation rate of every position of every sequence,
+                numpy array with the target nucleotide probabilities of every position (None if not a per-target model),
+                numpy array with the start of each sequence in the score arrays (plus the total length at the end)
+        """
+        seq_lens = np.array([len(seq) for seq in seqs], dtype=int)
+        offsets = np.concatenate([[0], np.cumsum(seq_lens)])
+        # Pad every sequence so motif windows never span two sequences
+        pad = "n" * (self.motif_len - 1)
+        padded = pad + pad.join(seqs) + pad
+        codes = self.nucleotide_codes[np.frombuffer(padded, dtype=np.uint8)]
+
+        num_windows = codes.size - self.motif_len + 1
+        motif_codes = np.zeros(num_windows, dtype=int)
+        is_valid = np.ones(num_windows, dtype=bool)
+        for k in range(self.motif_len):
+            window_codes = codes[k:k + num_windows]
+            motif_codes = motif_codes * NUM_NUCLEOTIDES + np.maximum(window_codes, 0)
+            is_valid &= window_codes >= 0
+
+        # The window for the position at index p of the padded string starts at p - left_flank_len.
+        # Sequence i starts at index offsets[i] + (i + 1) * len(pad) of the padded string.
+        seq_idxs = np.repeat(np.arange(len(seqs)), seq_lens)
+        window_starts = np.arange(offsets[-1]) + (seq_idxs + 1) * len(pad) - self.left_flank_len
+        position_codes = motif_codes[window_starts]
+        position_is_valid = is_valid[window_starts]
+
+        rates = np.where(position_is_valid, self.rate_table[position_codes], np.nan).astype(SCORE_DTYPE)
+        target_probs = None
+        if self.per_target_model:
+            target_hazards = self.hazard_table[position_codes]
+            target_probs = target_hazards / self.rate_table[position_codes][:, None]
+            target_probs[~position_is_valid] = np.nan
+            target_probs = target_probs.astype(SCORE_DTYPE)
+        return rates, target_probs, offsets
+
+class ScoringWorker(ParallelWorker):
+    """
+    Scores a chunk of sequences
+    """
+    def __init__(self, seed, chunk_idx, seqs):
+        """
+        @param seed: not used for scoring
+        @param chunk_idx: index of the chunk
+        @param seqs: list of sequences
+        """
+        self.seed = seed
+        self.chunk_idx = chunk_idx
+        self.seqs = seqs
+
+    def run_worker(self, scorer):
+        """
+        @param scorer: MutabilityScorer
+        @return the output of MutabilityScorer.score
+        """
+        return scorer.score(self.seqs)
+
+    def __str__(self):
+        return "ScoringWorker %d: %d sequences" % (self.chunk_idx, len(self.seqs))
+
+def score_sequence_chunks(scorer, chunks, pool=None, num_threads=1):
+    """
+    Scores chunks of sequences, a few chunks per process at a time so the input can be streamed
+
+    @param scorer: MutabilityScorer
+    @param chunks: iterable of tuples with a list of sequence names and a list of sequences
+    @param pool: multiprocessing pool; if None, the chunks are scored serially
+
+    @return generator with the sequence names and the output of MutabilityScorer.score for each chunk,
+            in the same order as the chunks
+    """
+    num_chunks_per_round = 2 * num_threads if pool is not None else 1
+    chunk_iter = iter(chunks)
+    chunk_idx = 0
+    while True:
+        round_chunks = list(itertools.islice(chunk_iter, num_chunks_per_round))
+        if not round_chunks:
+            break
+        batched_workers = [
+            BatchParallelWorkers([ScoringWorker(None, chunk_idx + i, seqs)], scorer)
+            for i, (_, seqs) in enumerate(round_chunks)
+        ]
+        chunk_idx += len(round_chunks)
+        if pool is not None:
+            results = pool.imap(run_multiprocessing_worker, batched_workers)
+        else:
+            results = ([batched_worker.workers[0].run_worker(scorer)] for batched_worker in batched_workers)
+        for (names, _), batched_worker, (result,) in itertools.izip(round_chunks, batched_workers, results):
+            if result is None:
+                raise ValueError("Failed to score sequences: %s" % batched_worker.workers[0])
+            yield names, result
+
+class ScoreWriter:
+    """
+    Writes the scores to a directory:
+        sequences.csv: name, start and length of each sequence in the score files
+        rates.bin: float32 relative mutation rates of all the positions
+        target_probs.bin: float32 target nucleotide probabilities of all the positions, four per position
+                        (in the order of NUCLEOTIDES); only for per-target models
+    The .bin files can be read with read_scores
+    """
+    def __init__(self, output_dir):
+        """
+        @param output_dir: the output directory
+        """
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        self.output_dir = output_dir
+        self.index_file = open(os.path.join(output_dir, INDEX_FILE), "w")
+        self.index_writer = csv.writer(self.index_file)
+        self.index_writer.writerow(["sequence_name", "start", "length"])
+        self.rates_file = open(os.path.join(output_dir, RATES_FILE), "wb")
+        self.target_probs_file = None
+        self.num_positions = 0
+
+    def write(self, names, rates, target_probs, offsets):
+        """
+        @param names: names of the sequences
+        @param rates, target_probs, offsets: output of MutabilityScorer.score for these sequences
+        """
+        self.index_writer.writerows([
+            (name, self.num_positions + start, end - start)
+            for name, start, end in zip(names, offsets[:-1].tolist(), offsets[1:].tolist())
+        ])
+        rates.tofile(self.rates_file)
+        if target_probs is not None:
+            if self.target_probs_file is None:
+                self.target_probs_file = open(os.path.join(self.output_dir, TARGET_PROBS_FILE), "wb")
+            target_probs.tofile(self.target_probs_file)
+        self.num_positions += rates.size
+
+    def close(self):
+        self.index_file.close()
+        self.rates_file.close()
+        if self.target_probs_file is not None:
+            self.target_probs_file.close()
+
+def read_scores(output_dir):
+    """
+    @param output_dir: directory written by ScoreWriter
+
+    @return list of (sequence name, start, length),
+            memory-mapped relative mutation rates,
+            memory-mapped target nucleotide probabilities (None if not a per-target model)
+    """
+    with open(os.path.join(output_dir, INDEX_FILE), "r") as f:
+        reader = csv.reader(f)
+        next(reader)
+        index = [(name, int(start), int(length)) for name, start, length in reader]
+    num_positions = sum([length for _, _, length in index])
+
+    def _read_bin(file_name, shape):
+        if num_positions == 0:
+            return np.zeros(shape, dtype=SCORE_DTYPE)
+        return np.memmap(file_name, dtype=SCORE_DTYPE, mode="r", shape=shape)
+
+    rates = _read_bin(os.path.join(output_dir, RATES_FILE), (num_positions,))
+    target_probs_file_name = os.path.join(output_dir, TARGET_PROBS_FILE)
+    target_probs = None
+    if os.path.exists(target_probs_file_name):
+        target_probs = _read_bin(target_probs_file_name, (num_positions, NUM_NUCLEOTIDES))
+    return index, rates, target_probs
@@ -6,16 +6,26 @@ from models import ImputedSequenceMutations
 from common import *
 
 from sampler_collection import Sampler
+from parallel_worker import ParallelWorker
 from profile_support import profile
 from collections import Counter
 from mutation_order_gibbs import MutationOrderGibbsSampler
 
 class ChibsSamplerResult:
-    def __init__(self, reference_order, log_prob_estimate, log_prob_order, gibbs_samples):
+    def __init__(self, reference_order, log_prob_estimate, log_prob_order, gibbs_samples, pending_stages=None):
+        """
+        @param reference_order: the mutation order the marginal likelihood estimate is based on
+        @param log_prob_estimate: estimate of log p(reference order | end, start, theta)
+        @param log_prob_order: log p(reference order | start, theta)
+        @param gibbs_samples: samples from the unconditional gibbs sampler
+        @param pending_stages: conditional stages whose log probability terms are not yet
+                            included in log_prob_estimate (see MutationOrderChibsReferenceSampler)
+        """
         self.reference_order = reference_order
         self.log_prob_estimate = log_prob_estimate
         self.log_prob_order = log_prob_order
         self.gibbs_samples = gibbs_samples
+        self.pending_stages = pending_stages if pending_stages is not None else []
 
 class MutationOrderChibsSampler(Sampler):
     """
@@ -34,6 +44,9 @@ class MutationOrderChibsSampler(Sampler):
                                                 + log p(partial order of n positions | end, start, partial order of n-1 positions, theta)
     Each of these log probability terms is estimated using the empirical distribution of a (conditional) gibbs sampler.
     Note that the last term can be calculated analytically.
+
+    The conditional gibbs samplers only depend on the reference order, so each of these stages can be run
+    (and retried) independently of the others.
     """
     def run(self, init_order, burn_in, num_samples, sampling_rate=0):
         """
@@ -45,99 +58,163 @@ class MutationOrderChibsSampler(Sampler):
         @param burn_in: number of iterations for burn in for the first gibbs sampler
         @param num_samples: number of samples to collect for each gibbs sampler
         """
+        gibbs_sampler = MutationOrderGibbsSampler(self.theta, self.feature_generator, self.obs_seq_mutation)
+        reference_res = self._run_reference_stage(gibbs_sampler, init_order, burn_in, num_samples, sampling_rate)
+
+        # Get estimate of probability of order given starting sequence
+        # Only the conditional stage that did not have enough samples is rerun
+        log_prob_order_terms = [reference_res.log_prob_estimate]
+        for stage_idx in reference_res.pending_stages:
+            log_prob_stage = self.estimate_stage_with_retries(gibbs_sampler, reference_res.reference_order, stage_idx, num_samples)
+            if log_prob_stage is None:
+                return None
+            log_prob_order_terms.append(log_prob_stage)
+
+        return ChibsSamplerResult(
+            reference_order=reference_res.reference_order,
+            log_prob_estimate=np.sum(log_prob_order_terms),
+            log_prob_order=reference_res.log_prob_order,
+            gibbs_samples=reference_res.gibbs_samples,
+        )
+
+    def estimate_stage_with_retries(self, gibbs_sampler, reference_order, stage_idx, num_samples):
+        """
+        Estimate a conditional stage, increasing the number of samples by a factor of 10 each time
+        the conditional gibbs sampler never agrees with the reference partial order
+
+        @return the log probability term for this stage, None if we ran out of tries
+        """
         for _ in range(self.num_tries):
-            # Sample gibbs again but not conditional on any partial ordering
-            gibbs_sampler = MutationOrderGibbsSampler(self.theta, self.feature_generator, self.obs_seq_mutation)
-            first_sampler_res = gibbs_sampler.run(
-                init_order,
-                burn_in,
-                num_samples,
-                sampling_rate=sampling_rate,
-            )
+            log_prob_stage = self.estimate_stage(gibbs_sampler, reference_order, stage_idx, num_samples)
+            if log_prob_stage is not None:
+                return log_prob_stage
+            num_samples *= 10
+            log.info("Chibs: not enough samples to estimate stage %d -- trying again with %d samples" % (stage_idx, num_samples))
+        return None
 
-            # Choose reference order to be the most commonly seen mutation order
-            samples = first_sampler_res.samples
-            ctr = Counter([".".join(map(str, s.mutation_order)) for s in samples])
-            most_common_order = ctr.most_common(1)[0]
-            num_appears = most_common_order[1]
-            reference_order = [int(p) for p in most_common_order[0].split(".")]
+    def _run_reference_stage(self, gibbs_sampler, init_order, burn_in, num_samples, sampling_rate):
+        """
+        Run the unconditional gibbs sampler, choose the reference order, and calculate all the log probability
+        terms that do not require a conditional gibbs sampler.
 
-            # Get estimate of probability of order given starting sequence
-            log_prob_order_terms = self._estimate_order_probability(gibbs_sampler, reference_order, samples, num_samples)
-            if log_prob_order_terms is None:
-                num_samples *= 10
-                log.info("Chibs: not enough samples to estimate validation log likelihood -- trying again with %d samples" % num_samples)
-                continue
+        @return ChibsSamplerResult where log_prob_estimate is missing the terms for the pending conditional stages
+        """
+        # Sample gibbs but not conditional on any partial ordering
+        first_sampler_res = gibbs_sampler.run(
+            init_order,
+            burn_in,
+            num_samples,
+            sampling_rate=sampling_rate,
+        )
+        samples = first_sampler_res.samples
 
-            # Get log probability of reference order (not conditional on ending sequence)
-            log_prob_ref_order = gibbs_sampler.get_log_probs(reference_order)
+        # Choose reference order to be the most commonly seen mutation order
+        ctr = Counter([tuple(s.mutation_order) for s in samples])
+        reference_order = list(ctr.most_common(1)[0][0])
 
-            return ChibsSamplerResult(
-                reference_order=reference_order,
-                log_prob_estimate=np.sum(log_prob_order_terms),
-                log_prob_order=log_prob_ref_order,
-                gibbs_samples=first_sampler_res.samples,
+        log_prob_order_terms = []
+        if self.num_mutations > 2:
+            # The probability of seeing a partial ordering of two positions is estimated from the unconditional gibbs sampler
+            # Since the reference order is one of the samples, this proportion is always positive
+            ranks, positions = MutationOrderChibsSampler._get_order_ranks(samples)
+            num_agrees_normalized = MutationOrderChibsSampler._get_proportion_agrees_from_ranks(
+                ranks,
+                positions,
+                reference_order[-2:],
             )
+            log_prob_order_terms.append(np.log(num_agrees_normalized))
 
-    def _estimate_order_probability(self, gibbs_sampler, reference_order, first_samples, num_samples):
-        """
-        Get estimate of log p(reference order | end, start, theta)
-        @param gibbs_sampler: the gibbs sampler for this particular start and ending mutation sequence
-        @param reference_order: the mutation order of interest
-        @param first_samples: samples drawn from the unconditional gibbs sampler
-        @param num_samples: number of samples to draw from each conditional gibbs sampler
+        if self.num_mutations > 1:
+            log_prob_order_terms.append(self._get_last_stage_log_prob(gibbs_sampler, reference_order))
+
+        return ChibsSamplerResult(
+            reference_order=reference_order,
+            log_prob_estimate=np.sum(log_prob_order_terms),
+            # Get log probability of reference order (not conditional on ending sequence)
+            log_prob_order=gibbs_sampler.get_log_probs(reference_order),
+            gibbs_samples=samples,
+            pending_stages=self.get_conditional_stages(),
+        )
 
+    def get_conditional_stages(self):
+        """
         When we split log p(reference order | end, start, theta), we are going to split it from back to front.
         So if the reference order is [10, 3, 8, 2], we estimate the conditional probabilities for
-            1. partial ordering [8, 2]
-            2. partial ordering [3, 8, 2]
-            3. mutation ordering [10, 3, 8, 2]
+            1. partial ordering [8, 2] (from the unconditional gibbs sampler)
+            2. partial ordering [3, 8, 2] (stage 3: conditional gibbs sampler given partial ordering [8, 2])
+            3. mutation ordering [10, 3, 8, 2] (calculated analytically)
+
+        @return list of stage indices i that require a gibbs sampler conditional on the partial order of i - 1 positions
         """
+        return range(3, self.num_mutations)
 
-        if self.num_mutations <= 1:
-            # If there are one or fewer mutations the Chibs step is trivial, so output logprob of zero
-            return 0.
+    def estimate_stage(self, gibbs_sampler, reference_order, stage_idx, num_samples):
+        """
+        Estimate log p(partial order of i positions | end, start, partial order of i - 1 positions, theta)
 
-        log_prob_order_terms = []
+        @param gibbs_sampler: the gibbs sampler for this particular start and ending mutation sequence
+        @param reference_order: the mutation order of interest
+        @param stage_idx: the number of positions i in the partial order
+        @param num_samples: number of samples to draw from the conditional gibbs sampler
 
-        ref_partial_order = reference_order[-1:]
-        if self.num_mutations > 2:
-            ref_partial_order = reference_order[-2:]
-            # The probability of seeing a partial ordering of two positions is estimated from the unconditional gibbs sampler
-            num_agrees_normalized = MutationOrderChibsSampler._get_proportion_agrees(first_samples, ref_partial_order)
-            if num_agrees_normalized == 0:
-                return None
+        @return the log probability term, None if none of the samples agreed with the partial order
+        """
+        # Sample gibbs again but with conditional partial order
+        sampler_res = gibbs_sampler.run(
+            reference_order,
+            burn_in=0,
+            num_samples=num_samples,
+            sampling_rate=0,
+            conditional_partial_order=reference_order[-(stage_idx - 1):],
+        )
 
-            log_prob_order_terms.append(np.log(num_agrees_normalized))
+        # Now estimate the probability of seeing the partial ordering of i positions from this conditional gibbs sampler
+        ranks, positions = MutationOrderChibsSampler._get_order_ranks(sampler_res.samples)
+        num_agrees_normalized = MutationOrderChibsSampler._get_proportion_agrees_from_ranks(
+            ranks,
+            positions,
+            reference_order[-stage_idx:][:2],
+        )
+        if num_agrees_normalized == 0:
+            return None
+        return np.log(num_agrees_normalized)
 
-            for i in range(3, self.num_mutations):
-                # Sample gibbs again but with conditional partial order
-                sampler_res = gibbs_sampler.run(
-                    reference_order,
-                    burn_in=0,
-                    num_samples=num_samples,
-                    sampling_rate=0,
-                    conditional_partial_order=ref_partial_order,
-                )
-
-                ref_partial_order = reference_order[-i:]
-                # Now estimate the probability of seeing the partial ordering of i positions from this conditional gibbs sampler
-                num_agrees_normalized = MutationOrderChibsSampler._get_proportion_agrees(sampler_res.samples, ref_partial_order[:2])
-                if num_agrees_normalized == 0:
-                    return None
-                log_prob_order_terms.append(np.log(num_agrees_normalized))
-
-        # Calculate the probability of seeing the full mutation order given a partial ordering of all the other positions
-        # This is done analytically. No need for a gibbs sampler.
+    def _get_last_stage_log_prob(self, gibbs_sampler, reference_order):
+        """
+        Calculate the probability of seeing the full mutation order given a partial ordering of all the other positions
+        This is done analytically. No need for a gibbs sampler.
+        """
         # First get the probability of all the mutation orders consistent with this partial ordering.
-        _, _, all_log_probs = gibbs_sampler._do_gibbs_step(ref_partial_order, reference_order[0])
+        _, _, all_log_probs = gibbs_sampler._do_gibbs_step(reference_order[1:], reference_order[0])
         # Normalize across the probability of all consistent mutation orders to get the probability of the full mutation order
         # given the n-1 partial ordering
-        log_conditional_prob = all_log_probs[-1] - scipy.misc.logsumexp(all_log_probs)
-        log_prob_order_terms.append(log_conditional_prob)
+        return all_log_probs[-1] - scipy.misc.logsumexp(all_log_probs)
+
+    @staticmethod
+    def _get_order_ranks(samples):
+        """
+        @param samples: list of ImputedSequenceMutations
+
+        @return tuple with
+            1. matrix where entry (i, j) is the step at which positions[j] mutates in the i-th sample
+            2. sorted array of the mutated positions
+        """
+        orders = np.array([s.mutation_order for s in samples], dtype=int)
+        positions = np.sort(orders[0])
+        ranks = np.empty(orders.shape, dtype=int)
+        ranks[np.arange(orders.shape[0])[:, None], np.searchsorted(positions, orders)] = np.arange(orders.shape[1])
+        return ranks, positions
 
-        # The final estimate of the log probability is the sum of all the log conditional probabilities
-        return np.sum(log_prob_order_terms)
+    @staticmethod
+    def _get_proportion_agrees_from_ranks(ranks, positions, ref_partial_order):
+        """
+        @param ranks: rank matrix from _get_order_ranks
+        @param positions: the mutated positions from _get_order_ranks
+        @param ref_partial_order: list of two positions in partial mutation order
+        """
+        assert(len(ref_partial_order) == 2)
+        first_col, second_col = np.searchsorted(positions, ref_partial_order)
+        return np.mean(ranks[:, first_col] < ranks[:, second_col])
 
     @staticmethod
     def _get_proportion_agrees(samples, ref_partial_order):
@@ -146,14 +223,56 @@ class MutationOrderChibsSampler(Sampler):
 
         @param ref_partial_order: list of two positions in partial mutation order
         """
-        assert(len(ref_partial_order) == 2)
-        num_agrees = 0
-        for s in samples:
-            for p in s.mutation_order:
-                if p == ref_partial_order[0]:
-                    # agrees with partial order
-                    num_agrees += 1
-                elif p == ref_partial_order[1]:
-                    # doesn't agree
-                    break
-        return float(num_agrees)/len(samples)
+        ranks, positions = MutationOrderChibsSampler._get_order_ranks(samples)
+        return MutationOrderChibsSampler._get_proportion_agrees_from_ranks(ranks, positions, ref_partial_order)
+
+class MutationOrderChibsReferenceSampler(MutationOrderChibsSampler):
+    """
+    Only runs the unconditional gibbs sampler of Chibs method.
+    The conditional stages listed in the pending_stages of the result are left to be run by ChibsStageWorkers,
+    so that the conditional stages for all the observations can be run in parallel.
+    """
+    def run(self, init_order, burn_in, num_samples, sampling_rate=0):
+        gibbs_sampler = MutationOrderGibbsSampler(self.theta, self.feature_generator, self.obs_seq_mutation)
+        return self._run_reference_stage(gibbs_sampler, init_order, burn_in, num_samples, sampling_rate)
+
+class ChibsStageWorkerShared:
+    def __init__(self, theta, feat_generator):
+        self.theta = theta
+        self.feat_generator = feat_generator
+
+class ChibsStageResult:
+    def __init__(self, obs_idx, stage_idx, log_prob_stage):
+        """
+        @param obs_idx: index of the observation
+        @param stage_idx: the conditional stage (see MutationOrderChibsSampler.get_conditional_stages)
+        @param log_prob_stage: the estimated log probability term, None if not enough samples
+        """
+        self.obs_idx = obs_idx
+        self.stage_idx = stage_idx
+        self.log_prob_stage = log_prob_stage
+
+class ChibsStageWorker(ParallelWorker):
+    """
+    Runs a single conditional gibbs sampler for Chibs method
+    """
+    def __init__(self, seed, obs_idx, obs_seq, reference_order, stage_idx, num_samples):
+        self.seed = seed
+        self.obs_idx = obs_idx
+        self.obs_seq = obs_seq
+        self.reference_order = reference_order
+        self.stage_idx = stage_idx
+        self.num_samples = num_samples
+
+    def run_worker(self, shared_obj):
+        """
+        @param shared_obj: ChibsStageWorkerShared
+        @return ChibsStageResult
+        """
+        chibs_sampler = MutationOrderChibsSampler(shared_obj.theta, shared_obj.feat_generator, self.obs_seq)
+        gibbs_sampler = MutationOrderGibbsSampler(shared_obj.theta, shared_obj.feat_generator, self.obs_seq)
+        log_prob_stage = chibs_sampler.estimate_stage(gibbs_sampler, self.reference_order, self.stage_idx, self.num_samples)
+        return ChibsStageResult(self.obs_idx, self.stage_idx, log_prob_stage)
+
+    def __str__(self):
+        return "ChibsStageWorker %d, stage %d" % (self.obs_idx, self.stage_idx)
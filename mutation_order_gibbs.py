@@ -1,11 +1,11 @@
 import numpy as np
-import scipy.misc
 import logging as log
 
 from models import ImputedSequenceMutations
 from common import *
 
 from sampler_collection import Sampler
+from sampling_utils import sample_index_from_log_probs
 from profile_support import profile
 
 class GibbsSamplerResult:
@@ -260,9 +260,7 @@ class MutationOrderGibbsSampler(Sampler):
         @return tuple of GibbsStepInfo and log likelihood of the sampled mutation order
         """
 
-        # for tiny probabilities shift by subtracting negative
-        all_probs = np.exp(all_log_probs - min(all_log_probs))
-        sampled_idx = sample_multinomial(all_probs)
+        sampled_idx = sample_index_from_log_probs(all_log_probs)
 
         # Now reconstruct our decision
         idx = self.num_mutations - sampled_idx - 1
@@ -0,0 +1,158 @@
+import numpy as np
+import scipy.misc
+import logging as log
+
+from models import ImputedSequenceMutations
+from common import *
+
+from sampler_collection import Sampler
+from sampling_utils import UNIFORM_BUFFER
+
+class SMCSamplerResult:
+    def __init__(self, samples, trace, sample_weights, log_marginal_estimate):
+        """
+        class returned by MutationOrderSMCSampler after a run
+
+        @param samples: list of ImputedSequenceMutations, one per particle
+        @param trace: list of effective sample sizes at each mutation step (for trace diagnostics)
+        @param sample_weights: numpy array of the normalized importance weights of the samples
+        @param log_marginal_estimate: estimate of log p(end | start, theta)
+        """
+        self.samples = samples
+        self.trace = trace
+        self.sample_weights = sample_weights
+        self.log_marginal_estimate = log_marginal_estimate
+
+class MutationOrderSMCSampler(Sampler):
+    """
+    Sequential Monte Carlo sampler for the mutation order.
+
+    Each particle builds a mutation order forward in time, one mutation step at a time.
+    At every step, the next mutating position is proposed from the observed mutated positions that have
+    not mutated yet, with probability proportional to their hazards:
+        q(j | order so far) = exp(theta * psi_j) / sum_{i remaining} exp(theta * psi_i)
+    The probability of the mutation step is
+        p(j | order so far) = exp(theta * psi_j) / sum_{i in risk group} exp(theta * psi_i)
+    so the incremental importance weight p/q is the same for all the proposed positions:
+        sum_{i remaining} exp(theta * psi_i) / sum_{i in risk group} exp(theta * psi_i)
+    The weighted particles approximate p(order | end, start, theta) and the product of the
+    average incremental weights is an unbiased estimate of p(end | start, theta).
+    Particles are resampled whenever the effective sample size drops below `resample_thres`.
+    """
+    resample_thres = 0.5
+
+    def run(self, init_order, burn_in, num_samples, sampling_rate=0):
+        """
+        @param init_order: ignored, particles are built from scratch
+        @param burn_in: ignored, no burn in for SMC
+        @param num_samples: number of particles
+        @param sampling_rate: ignored
+
+        @return SMCSamplerResult
+        """
+        mutated_positions = np.array(self.mutated_positions, dtype=int)
+        if self.per_target_model:
+            target_cols = np.array([get_target_col(self.obs_seq_mutation, p) - 1 for p in mutated_positions], dtype=int)
+            merged_thetas = self.theta[:,0,None] + self.theta[:,1:]
+        else:
+            target_cols = np.zeros(self.num_mutations, dtype=int)
+            merged_thetas = self.theta[:,0,None]
+
+        # risks[i, pos, col] is the hazard of position `pos` mutating to target `col` for particle i
+        start_risks = np.exp(self.obs_seq_mutation.feat_matrix_start * merged_thetas)
+        risks = np.tile(start_risks, (num_samples, 1, 1))
+        seqs = [self.obs_seq_mutation.start_seq] * num_samples
+        orders = np.zeros((num_samples, self.num_mutations), dtype=int)
+        is_remaining = np.ones((num_samples, self.num_mutations), dtype=bool)
+
+        log_weights = np.zeros(num_samples) - np.log(num_samples)
+        log_marginal_estimate = 0
+        trace = []
+        particle_idxs = np.arange(num_samples)
+        for step in range(self.num_mutations):
+            remaining_risks = risks[:, mutated_positions, target_cols] * is_remaining
+            remaining_risk_sums = remaining_risks.sum(axis=1)
+            denominators = risks.sum(axis=(1, 2))
+            # A particle whose remaining positions all have zero hazard cannot reach the ending sequence
+            can_finish = remaining_risk_sums > 0
+            log_incr_weights = np.zeros(num_samples) - np.inf
+            log_incr_weights[can_finish] = np.log(remaining_risk_sums[can_finish]) - np.log(denominators[can_finish])
+
+            log_weights += log_incr_weights
+            log_weight_sum = scipy.misc.logsumexp(log_weights)
+            log_marginal_estimate += log_weight_sum
+            if log_weight_sum == -np.inf:
+                # No particle can reach the ending sequence, so the estimate of p(end | start, theta) is zero.
+                # Keep the weights uniform so they stay well defined.
+                log_weights = np.zeros(num_samples) - np.log(num_samples)
+            else:
+                log_weights -= log_weight_sum
+
+            # Propose the next mutating position for each particle
+            # The particles that cannot finish propose uniformly from the remaining positions
+            proposal_risks = np.where(can_finish[:, None], remaining_risks, is_remaining)
+            cum_risks = np.cumsum(proposal_risks, axis=1)
+            unifs = UNIFORM_BUFFER.draw_many(num_samples) * cum_risks[:, -1]
+            sampled_cols = np.minimum((cum_risks <= unifs[:, None]).sum(axis=1), self.num_mutations - 1)
+            orders[:, step] = mutated_positions[sampled_cols]
+            is_remaining[particle_idxs, sampled_cols] = False
+            self._update_particles(risks, seqs, orders[:, step], is_remaining, mutated_positions, merged_thetas)
+
+            ess = 1.0/np.exp(scipy.misc.logsumexp(2 * log_weights))
+            trace.append(ess)
+            if step < self.num_mutations - 1 and ess < self.resample_thres * num_samples:
+                resampled_idxs = np.random.choice(num_samples, size=num_samples, p=np.exp(log_weights))
+                risks = risks[resampled_idxs]
+                seqs = [seqs[i] for i in resampled_idxs]
+                orders = orders[resampled_idxs]
+                is_remaining = is_remaining[resampled_idxs]
+                log_weights = np.zeros(num_samples) - np.log(num_samples)
+
+        return SMCSamplerResult(
+            [ImputedSequenceMutations(self.obs_seq_mutation, order.tolist()) for order in orders],
+            trace,
+            np.exp(log_weights),
+            log_marginal_estimate,
+        )
+
+    def _update_particles(self, risks, seqs, step_positions, is_remaining, mutated_positions, merged_thetas):
+        """
+        Mutate the sequences of the particles and update the hazards of the positions near the mutations.
+        Particles that have mutated the same positions and have just mutated the same position have the same
+        sequence and hazards, so the features are made once for each group of these particles.
+
+        @param risks: number of particles x seq_len x number of target columns array of hazards, modified in place
+        @param seqs: list of the current sequences of the particles (without flanks), modified in place
+        @param step_positions: numpy array with the position that each particle just mutated
+        @param is_remaining: number of particles x number of mutations boolean array of the mutated positions
+                            that have not mutated yet, after this step
+        @param mutated_positions: numpy array of the mutated positions
+        @param merged_thetas: theta with the first column added to the target columns
+        """
+        particle_groups = {}
+        for i, (step_pos, particle_is_remaining) in enumerate(zip(step_positions, is_remaining)):
+            particle_groups.setdefault((step_pos, particle_is_remaining.tobytes()), []).append(i)
+
+        for (step_pos, _), group_idxs in particle_groups.iteritems():
+            seq = mutate_string(seqs[group_idxs[0]], step_pos, self.obs_seq_mutation.end_seq[step_pos])
+            for i in group_idxs:
+                seqs[i] = seq
+            risks[group_idxs, step_pos] = 0
+
+            already_mutated_pos = set(mutated_positions[~is_remaining[group_idxs[0]]])
+            neighbor_pos = [
+                p for p in range(
+                    max(step_pos - self.feature_generator.left_update_region, 0),
+                    min(step_pos + self.feature_generator.right_update_region + 1, self.seq_len),
+                ) if p not in already_mutated_pos
+            ]
+            if len(neighbor_pos):
+                feat_dict = self.feature_generator.create_for_sequence(
+                    seq,
+                    self.obs_seq_mutation.left_flank,
+                    self.obs_seq_mutation.right_flank,
+                    do_feat_vec_pos=neighbor_pos,
+                    obs_seq_mutation=self.obs_seq_mutation,
+                )
+                neighbor_risks = np.array([np.exp(merged_thetas[feat_dict[p]].sum(axis=0)) for p in neighbor_pos])
+                risks[np.ix_(group_idxs, neighbor_pos)] = neighbor_risks
@@ -7,12 +7,87 @@ from custom_utils import CustomCommand
 import numpy as np
 
 from common import DEBUG
+from sampling_utils import set_random_seed, UNIFORM_BUFFER
+from perf_registry import perf_count
+from local_worker_fleet import get_local_worker_fleet
+
+# Objects loaded from pickle files by PickledObjectRef, keyed by file name
+_LOADED_PICKLES = {}
+
+class PickledObjectRef:
+    """
+    Reference to an object in a pickle file, so that the object can be written once and used by many jobs.
+    Each file is loaded at most once per process.
+    """
+    def __init__(self, file_name, key=None):
+        """
+        @param file_name: pickle file written by write_pickled_object
+        @param key: if not None, the object is this item of the object in the file
+        """
+        self.file_name = file_name
+        self.key = key
+
+    def get(self):
+        if self.file_name not in _LOADED_PICKLES:
+            with open(self.file_name, "r") as f:
+                _LOADED_PICKLES[self.file_name] = cPickle.load(f)
+        obj = _LOADED_PICKLES[self.file_name]
+        return obj if self.key is None else obj[self.key]
+
+    def __str__(self):
+        return "PickledObjectRef %s %s" % (self.file_name, self.key)
+
+def evict_pickled_objects(file_names):
+    """
+    Remove the objects loaded from these files from the cache of PickledObjectRef
+    """
+    for file_name in file_names:
+        _LOADED_PICKLES.pop(file_name, None)
+
+def write_pickled_object(file_name, obj):
+    """
+    Write an object for PickledObjectRef
+    """
+    _LOADED_PICKLES.pop(file_name, None)
+    with open(file_name, "w") as f:
+        cPickle.dump(obj, f, protocol=cPickle.HIGHEST_PROTOCOL)
+
+def split_into_batches(item_list, num_approx_batches):
+    """
+    @return list of lists of consecutive items, about num_approx_batches of them
+    """
+    num_items = len(item_list)
+    num_per_batch = int(max(np.ceil(float(num_items)/num_approx_batches), 1))
+    return [item_list[start_idx:start_idx + num_per_batch] for start_idx in range(0, num_items, num_per_batch)]
 
 class BatchParallelWorkers:
     def __init__(self, workers, shared_obj):
+        """
+        @param workers: list of ParallelWorkers
+        @param shared_obj: object shared among the workers, or a PickledObjectRef to it
+        """
         self.workers = workers
         self.shared_obj = shared_obj
 
+    def get_shared_obj(self):
+        if isinstance(self.shared_obj, PickledObjectRef):
+            return self.shared_obj.get()
+        return self.shared_obj
+
+    def run(self):
+        """
+        Runs the workers of the batch.
+        The objects that were loaded by PickledObjectRefs while running the batch are evicted from the cache
+        afterwards, so a process that runs many batches does not keep all of their data in memory.
+
+        @return list of results from the workers
+        """
+        loaded_before = set(_LOADED_PICKLES.keys())
+        shared_obj = self.get_shared_obj()
+        results = [worker.run(shared_obj) for worker in self.workers]
+        evict_pickled_objects([file_name for file_name in _LOADED_PICKLES.keys() if file_name not in loaded_before])
+        return results
+
 class ParallelWorker:
     """
     Stores the information for running something in parallel
@@ -30,7 +105,9 @@ class ParallelWorker:
 
         Do not implement this function!
         """
-        np.random.seed(self.seed)
+        # The seed is always set here, so the worker can use the uniform buffer.
+        # It is turned off afterwards so that code outside the workers can be seeded with np.random.seed.
+        set_random_seed(self.seed, buffer_uniforms=True)
 
         result = None
         try:
@@ -38,6 +115,8 @@ class ParallelWorker:
         except Exception as e:
             print "Exception caught in parallel worker: %s" % e
             traceback.print_exc()
+        finally:
+            UNIFORM_BUFFER.disable()
         return result
 
     def run_worker(self, shared_obj):
@@ -68,13 +147,16 @@ class MultiprocessingManager(ParallelWorkerManager):
     We have written our own custom function for batching jobs together
     So runs ParallelWorkers using multiple CPUs on the same machine
     """
-    def __init__(self, pool, worker_list, shared_obj=None, num_approx_batches=1):
+    def __init__(self, pool, worker_list, shared_obj=None, num_approx_batches=1, pool_chunksize=None):
         """
         @param worker_list: List of ParallelWorkers
         @param shared_obj: shared object between workers - useful to minimize disk space usage
         @param num_approx_batches: number of batches to split across processes (might be a bit more)
+        @param pool_chunksize: number of batches sent to a process at a time; by default the pool decides.
+                            Use 1 if the batches take very different amounts of time.
         """
         self.pool = pool
+        self.pool_chunksize = pool_chunksize
 
         # Batch commands together
         num_workers = len(worker_list)
@@ -88,7 +170,15 @@ class MultiprocessingManager(ParallelWorkerManager):
 
     def run(self):
         try:
-            results_raw = self.pool.map(run_multiprocessing_worker, self.batched_workers_list)
+            # Pickle the batches here instead of in the pool, so the number of bytes sent is known
+            pickled_batches = [
+                cPickle.dumps(batched_workers, protocol=cPickle.HIGHEST_PROTOCOL)
+                for batched_workers in self.batched_workers_list
+            ]
+            perf_count("num_pool_bytes_sent", sum([len(b) for b in pickled_batches]))
+            pickled_results = self.pool.map(run_pickled_multiprocessing_worker, pickled_batches, chunksize=self.pool_chunksize)
+            perf_count("num_pool_bytes_received", sum([len(r) for r in pickled_results]))
+            results_raw = [cPickle.loads(r) for r in pickled_results]
         except Exception as e:
             print "Error occured when trying to process workers in parallel %s" % e
             # Just do it all one at a time instead
@@ -108,28 +198,47 @@ def run_multiprocessing_worker(batched_workers):
     Function called on each worker process, used by MultiprocessingManager
     Note: this must be a global function
     """
-    results = []
-    for worker in batched_workers.workers:
-        results.append(worker.run(batched_workers.shared_obj))
-    return results
+    return batched_workers.run()
+
+def run_pickled_multiprocessing_worker(pickled_batched_workers):
+    """
+    @param pickled_batched_workers: pickled BatchParallelWorkers
+    Same as run_multiprocessing_worker, but the batch and the results are pickled
+    Note: this must be a global function
+    """
+    results = run_multiprocessing_worker(cPickle.loads(pickled_batched_workers))
+    return cPickle.dumps(results, protocol=cPickle.HIGHEST_PROTOCOL)
 
 class BatchSubmissionManager(ParallelWorkerManager):
     """
-    Handles submitting jobs to a job submission system (e.g. slurm)
+    Handles submitting jobs to a job submission system (e.g. slurm),
+    or to long-lived worker processes on this host (see LocalWorkerFleet)
     """
-    def __init__(self, worker_list, shared_obj, num_approx_batches, worker_folder):
+    def __init__(self, worker_list, shared_obj, num_approx_batches, worker_folder, backend="slurm"):
         """
         @param worker_list: List of ParallelWorkers
         @param shared_obj: object shared across parallel workers - useful to minimize disk space usage
         @param num_approx_batches: number of batches to make approximately (might be a bit more)
         @param worker_folder: the folder to make all the results from the workers
+        @param backend: "slurm" to submit the jobs to slurm, "local" to run them on the local worker processes
+                        (there are num_approx_batches of them)
         """
+        self.backend = backend
+        self.num_approx_batches = num_approx_batches
         self.batch_worker_cmds = []
         self.batched_workers = [] # Tracks the batched workers if something fails
         self.output_files = []
-        self.create_batch_worker_cmds(worker_list, shared_obj, num_approx_batches, worker_folder)
+        if backend == "local":
+            self.shared_obj = shared_obj
+            self.batched_workers = split_into_batches(worker_list, num_approx_batches)
+        else:
+            self.create_batch_worker_cmds(worker_list, shared_obj, num_approx_batches, worker_folder)
 
     def run(self):
+        if self.backend == "local":
+            fleet = get_local_worker_fleet(self.num_approx_batches)
+            return self._get_worker_results(fleet.run(self.batched_workers, self.shared_obj))
+
         self.clean_outputs()
         custom_utils.run_cmds(self.batch_worker_cmds)
         res = self.read_batch_worker_results()
@@ -139,15 +248,16 @@ class BatchSubmissionManager(ParallelWorkerManager):
     def create_batch_worker_cmds(self, worker_list, shared_obj, num_approx_batches, worker_folder):
         """
         Create commands for submitting to a batch manager
-        Pickles the workers as input files to the jobs
+        Pickles the workers as input files to the jobs, and the shared object once for all the jobs
         The commands specify the output file names for each job - read these output files
         to retrieve the results from the jobs
         """
         self.shared_obj = shared_obj
-        num_workers = len(worker_list)
-        num_per_batch = int(max(np.ceil(float(num_workers)/num_approx_batches), 1))
-        for batch_idx, start_idx in enumerate(range(0, num_workers, num_per_batch)):
-            batched_workers = worker_list[start_idx:start_idx + num_per_batch]
+        if not os.path.exists(worker_folder):
+            os.makedirs(worker_folder)
+        shared_obj_file_name = "%s/shared.pkl" % worker_folder
+        write_pickled_object(shared_obj_file_name, shared_obj)
+        for batch_idx, batched_workers in enumerate(split_into_batches(worker_list, num_approx_batches)):
             self.batched_workers.append(batched_workers)
 
             # Create the folder for the output from this batch worker
@@ -162,7 +272,7 @@ class BatchSubmissionManager(ParallelWorkerManager):
             with open(input_file_name, "w") as cmd_input_file:
                 # Pickle the worker as input to the job
                 cPickle.dump(
-                    BatchParallelWorkers(batched_workers, shared_obj),
+                    BatchParallelWorkers(batched_workers, PickledObjectRef(shared_obj_file_name)),
                     cmd_input_file,
                     protocol=cPickle.HIGHEST_PROTOCOL,
                 )
@@ -179,17 +289,29 @@ class BatchSubmissionManager(ParallelWorkerManager):
         """
         Read the output (pickle) files from the batched workers
         """
-        worker_results = []
-        for i, f in enumerate(self.output_files):
+        batch_results = []
+        for f in self.output_files:
             try:
                 with open(f, "r") as output_f:
-                    res = cPickle.load(output_f)
+                    batch_results.append(cPickle.load(output_f))
             except Exception as e:
                 # Probably the file doesn't exist and the job failed?
                 traceback.print_exc()
-                print "Rerunning locally -- could not load pickle files %s" % f
+                print "Could not load pickle files %s" % f
+                batch_results.append(None)
+        return self._get_worker_results(batch_results)
+
+    def _get_worker_results(self, batch_results):
+        """
+        @param batch_results: list with the list of results of each batch, None if the job of the batch failed
+        @return list of results from the workers (failed workers are dropped)
+        """
+        worker_results = []
+        for i, res in enumerate(batch_results):
+            if res is None:
+                print "Rerunning locally -- batch %d failed" % i
                 # Now let's try to recover by running the worker
-                res = [w.run(self.shared_obj) for w in self.batched_workers[i]]
+                res = BatchParallelWorkers(self.batched_workers[i], self.shared_obj).run()
 
             for j, r in enumerate(res):
                 if r is None:
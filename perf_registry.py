@@ -0,0 +1,124 @@
+"""
+Timers and counters for the phases of a model fit, e.g. the E-step time, the number of M-step iterations
+and the number of bytes sent to the multiprocessing pool in each EM iteration.
+
+The code that is being measured calls perf_timer and perf_count, which record into the active PerfRegistry.
+They do nothing if no registry is active, so they are cheap enough to leave in the fitting code.
+By convention, the names of timers end with "_time" and the names of counters start with "num_".
+Registries are per process: work done by the workers of a multiprocessing pool is measured by the process
+that submits it.
+"""
+import time
+import json
+from functools import wraps
+from contextlib import contextmanager
+
+_ACTIVE_REGISTRY = None
+
+class PerfRegistry:
+    """
+    A list of records, each one a dictionary of labels (e.g. the EM iteration), times in seconds and counts.
+    Timers and counters are added to the last record.
+    """
+    def __init__(self):
+        self.records = []
+
+    def start_record(self, **labels):
+        """
+        Start a new record, e.g. for a new EM iteration
+
+        @param labels: labels that identify the record
+        """
+        self.records.append(dict(labels))
+
+    def add(self, name, value):
+        """
+        Add the value to the timer or counter with this name in the last record
+        """
+        if not self.records:
+            self.start_record()
+        record = self.records[-1]
+        record[name] = record.get(name, 0) + value
+
+    @contextmanager
+    def activate(self):
+        """
+        Use this registry for perf_timer and perf_count while in this context
+        """
+        global _ACTIVE_REGISTRY
+        prev_registry = _ACTIVE_REGISTRY
+        _ACTIVE_REGISTRY = self
+        try:
+            yield self
+        finally:
+            _ACTIVE_REGISTRY = prev_registry
+
+def get_active_registry():
+    """
+    @return the active PerfRegistry, None if there is none
+    """
+    return _ACTIVE_REGISTRY
+
+def perf_start_record(**labels):
+    """
+    Start a new record in the active registry
+    """
+    if _ACTIVE_REGISTRY is not None:
+        _ACTIVE_REGISTRY.start_record(**labels)
+
+def perf_count(name, count=1):
+    """
+    Add to a counter of the active registry
+    """
+    if _ACTIVE_REGISTRY is not None:
+        _ACTIVE_REGISTRY.add(name, count)
+
+@contextmanager
+def perf_timer(name):
+    """
+    Add the time spent in this context to a timer of the active registry
+    """
+    st_time = time.time()
+    try:
+        yield
+    finally:
+        if _ACTIVE_REGISTRY is not None:
+            _ACTIVE_REGISTRY.add(name, time.time() - st_time)
+
+def perf_timed(name):
+    """
+    Decorator that adds the time spent in the function to a timer of the active registry
+    """
+    def decorator(func):
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            with perf_timer(name):
+                return func(*args, **kwargs)
+        return timed_func
+    return decorator
+
+def get_perf_totals(records):
+    """
+    @param records: list of records from PerfRegistry
+    @return dictionary with the sum of each timer and counter over the records
+    """
+    totals = {}
+    for record in records:
+        for name, value in record.iteritems():
+            if name.endswith("_time") or name.startswith("num_"):
+                totals[name] = totals.get(name, 0) + value
+    return totals
+
+def write_perf_json(file_name, perf_entries, info={}):
+    """
+    @param file_name: JSON file to write
+    @param perf_entries: list of dictionaries, each with labels for a fit (e.g. its penalty parameters and fold)
+                        and its list of records under "records"
+    @param info: dictionary with other things to write, e.g. the settings and the total time
+    """
+    for entry in perf_entries:
+        entry["totals"] = get_perf_totals(entry["records"])
+    perf_dict = dict(info)
+    perf_dict["fits"] = perf_entries
+    with open(file_name, "w") as f:
+        json.dump(perf_dict, f, indent=2, sort_keys=True)
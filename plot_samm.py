@@ -1,15 +1,15 @@
 """
-Given a pickled output file with theta values, plot bar charts
+Given an output file with fitted theta values, plot bar charts
 """
 import numpy as np
 import subprocess
 import sys
 import argparse
-import pickle
 import csv
 
 from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from common import *
+from result_store import load_method_results
 
 def parse_args():
     ''' parse command line arguments '''
@@ -18,8 +18,8 @@ def parse_args():
 
     parser.add_argument('--input-pkl',
         type=str,
-        help='Pickle file with model parameters (theta values)',
-        default='_output/context_model.pkl')
+        help='Fitted model from fit_samm (a result store directory, or a pickle file from an older fit)',
+        default='_output/context_model')
     parser.add_argument('--output-csv',
         type=str,
         help='place to output temporary CSV file',
@@ -104,10 +104,9 @@ def main(args=sys.argv[1:]):
     args = parse_args()
 
     # Load fitted theta file
-    with open(args.input_pkl, "r") as f:
-        method_results = pickle.load(f)
-        method_res = pick_best_model(method_results)
-        per_target_model = method_res.refit_theta.shape[1] == NUM_NUCLEOTIDES + 1
+    method_results = load_method_results(args.input_pkl)
+    method_res = pick_best_model(method_results)
+    per_target_model = method_res.refit_theta.shape[1] == NUM_NUCLEOTIDES + 1
 
     feat_generator = method_res.refit_feature_generator
 
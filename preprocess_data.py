@@ -14,6 +14,8 @@ from common import get_randint
 from read_data import write_partis_data_from_annotations, write_data_after_imputing, write_data_after_sampling
 from data_split import split_train_val
 from shutil import copyfile
+from multiprocessing import Pool
+from sampling_utils import set_random_seed
 
 def parse_args():
     ''' parse command line arguments '''
@@ -96,6 +98,10 @@ def parse_args():
         type=str,
         help='where to write dnapars files, if necessary',
         default='_output')
+    parser.add_argument('--num-cpu-threads',
+        type=int,
+        help='number of processes for running dnapars on clonal families in parallel',
+        default=1)
     parser.add_argument('--metadata-path',
         type=str,
         help='metadata with subject/species/locus information',
@@ -143,7 +149,7 @@ def main(args=sys.argv[1:]):
     args = parse_args()
     log.basicConfig(format="%(message)s", filename=args.log_file, level=log.DEBUG)
     random.seed(args.seed)
-    np.random.seed(args.seed)
+    set_random_seed(args.seed)
     scratch_dir = os.path.join(args.scratch_directory, str(time.time() + get_randint()))
     if not os.path.exists(scratch_dir):
         os.makedirs(scratch_dir)
@@ -180,6 +186,7 @@ def main(args=sys.argv[1:]):
             sample_highest_mutated=args.sample_highest_mutated,
         )
     elif args.impute_ancestors:
+        pool = Pool(args.num_cpu_threads) if args.num_cpu_threads > 1 else None
         write_data_after_imputing(
             args.output_genes,
             args.output_seqs,
@@ -187,8 +194,11 @@ def main(args=sys.argv[1:]):
             args.input_seqs,
             motif_len=args.motif_len,
             verbose=False,
-            scratch_dir=scratch_dir
+            scratch_dir=scratch_dir,
+            pool=pool,
         )
+        if pool is not None:
+            pool.close()
     elif args.path_to_annotations is None:
         copyfile(args.input_genes, args.output_genes)
         copyfile(args.input_seqs, args.output_seqs)
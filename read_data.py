@@ -4,9 +4,10 @@ import csv
 import subprocess
 import os.path
 import pickle
-import pandas as pd
 import glob
 import copy
+import itertools
+import shutil
 
 from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from motif_feature_generator import MotifFeatureGenerator
@@ -17,10 +18,8 @@ csv.field_size_limit(sys.maxsize)
 
 from common import *
 from models import ObservedSequenceMutations
-from Bio.Seq import Seq
-from Bio.SeqIO import SeqRecord
-from Bio.AlignIO import MultipleSeqAlignment
-from ete3 import Tree
+from result_store import load_method_results
+from parallel_worker import ParallelWorker, BatchParallelWorkers, run_multiprocessing_worker, MultiprocessingManager
 from itertools import izip
 
 GERMLINE_PARAM_FILE = 'partis/data/germlines/human/igh/ighv.fasta'
@@ -141,18 +140,8 @@ def write_partis_data_from_annotations(
     @write genes to output_genes and seqs to output_seqs
     """
 
-    families = ['v', 'd', 'j']
-    if germline_family not in families:
-        raise ValueError("Invalid germline_family: %s. Must be one of %s" % (germline_family, families))
-
-    regions = ['v', 'd', 'j', 'vdj']
-    if region not in regions:
-        raise ValueError("Invalid region: %s. Must be one of %s" % (region, regions))
-
-    PARTIS_PATH = os.path.dirname(os.path.realpath(__file__)) + '/partis'
-    sys.path.insert(1, PARTIS_PATH + '/python')
-    from utils import add_implicit_info, process_input_line
-    import glutils
+    _check_partis_region(region, germline_family)
+    process_input_line, add_implicit_info, glutils = _import_partis_utils()
 
     partition_info = get_partition_info(
         path_to_annotations,
@@ -191,30 +180,18 @@ def write_partis_data_from_annotations(
                     # add goodies from partis
                     process_input_line(line)
                     add_implicit_info(glfo, line)
-                    n_seqs = len(line['input_seqs'])
-                    if n_seqs < min_clonal_family_size:
-                        # don't take small clonal families---for data quality purposes
-                        continue
-
-                    if region == 'vdj':
-                        gl_seq = line['naive_seq'].lower()
-                        all_seqs = [seq.lower() for seq in line['seqs']]
-                    else:
-                        gl_seq = line['v_gl_seq'].lower()
-                        all_seqs = [seq.lower() for seq in line['v_qr_seqs']]
-
-                    idx_list = []
-                    # frequency filter
-                    idx_list.append(set([i for i, val in enumerate(line['mut_freqs']) if val < max_mut_pct and val >= min_mut_pct]))
-                    # sequence length filter
-                    idx_list.append(set([i for i, val in enumerate(all_seqs) if len(val.translate(None, 'n')) > min_seq_len]))
-                    for key, values in seq_filters.iteritems():
-                        idx_list.append(set([i for i, val in enumerate(line[key]) if val in values]))
-
-                    good_seq_idx = set.intersection(*idx_list)
-                    if not good_seq_idx:
-                        # no sequences after filtering... skip
+                    family = _filter_partis_family(
+                        line,
+                        seq_filters,
+                        min_clonal_family_size,
+                        min_seq_len,
+                        max_mut_pct,
+                        min_mut_pct,
+                        region,
+                    )
+                    if family is None:
                         continue
+                    gl_seq, all_seqs, good_seq_idx = family
 
                     gl_name = 'clone{}-{}-{}'.format(*[data_idx, idx, clone_str])
                     gene_writer.writerow({
@@ -223,19 +200,316 @@ def write_partis_data_from_annotations(
                     })
 
                     for good_idx in good_seq_idx:
-                        base_dict = {
-                            'germline_name': gl_name,
-                            'sequence_name': '-'.join([gl_name, line['unique_ids'][good_idx]]),
-                            'sequence': all_seqs[good_idx].lower(),
-                            'germline_family': line['{}_gene'.format(germline_family)][:5],
-                            'v_gene': line['v_gene'],
-                            'region': region,
-                        }
+                        seq_writer.writerow(
+                            _get_partis_seq_info(line, gl_name, good_idx, all_seqs, data_info, region, germline_family)
+                        )
+
+def _check_partis_region(region, germline_family):
+    """
+    @param region: B-cell receptor region ('v', 'd', 'j', or 'vdj')
+    @param germline_family: for performing cross validation ('v', 'd', or 'j')
+    """
+    families = ['v', 'd', 'j']
+    if germline_family not in families:
+        raise ValueError("Invalid germline_family: %s. Must be one of %s" % (germline_family, families))
+
+    regions = ['v', 'd', 'j', 'vdj']
+    if region not in regions:
+        raise ValueError("Invalid region: %s. Must be one of %s" % (region, regions))
+
+def _import_partis_utils():
+    """
+    @return the partis functions for processing annotations: process_input_line, add_implicit_info and the glutils module
+    """
+    PARTIS_PATH = os.path.dirname(os.path.realpath(__file__)) + '/partis'
+    if PARTIS_PATH + '/python' not in sys.path:
+        sys.path.insert(1, PARTIS_PATH + '/python')
+    from utils import add_implicit_info, process_input_line
+    import glutils
+    return process_input_line, add_implicit_info, glutils
+
+def _filter_partis_family(
+    line,
+    seq_filters={},
+    min_clonal_family_size=0,
+    min_seq_len=0,
+    max_mut_pct=1.,
+    min_mut_pct=0.,
+    region='v',
+):
+    """
+    Applies the filters to a clonal family from a partis annotation file
+    (see write_partis_data_from_annotations for the parameters)
+
+    @param line: a line from a partis annotation file, after it was processed by partis
+
+    @return tuple with the germline sequence, all the sequences in the family and the set of indices
+        of the sequences that pass the filters; None if the whole family is filtered out
+    """
+    n_seqs = len(line['input_seqs'])
+    if n_seqs < min_clonal_family_size:
+        # don't take small clonal families---for data quality purposes
+        return None
+
+    if region == 'vdj':
+        gl_seq = line['naive_seq'].lower()
+        all_seqs = [seq.lower() for seq in line['seqs']]
+    else:
+        gl_seq = line['v_gl_seq'].lower()
+        all_seqs = [seq.lower() for seq in line['v_qr_seqs']]
+
+    idx_list = []
+    # frequency filter
+    idx_list.append(set([i for i, val in enumerate(line['mut_freqs']) if val < max_mut_pct and val >= min_mut_pct]))
+    # sequence length filter
+    idx_list.append(set([i for i, val in enumerate(all_seqs) if len(val.translate(None, 'n')) > min_seq_len]))
+    for key, values in seq_filters.iteritems():
+        idx_list.append(set([i for i, val in enumerate(line[key]) if val in values]))
+
+    good_seq_idx = set.intersection(*idx_list)
+    if not good_seq_idx:
+        # no sequences after filtering... skip
+        return None
+    return gl_seq, all_seqs, good_seq_idx
+
+def _get_partis_seq_info(line, gl_name, seq_idx, all_seqs, data_info, region, germline_family):
+    """
+    @return dictionary with the information about one sequence in a clonal family;
+        these are the columns written to the sequence file by write_partis_data_from_annotations
+    """
+    base_dict = {
+        'germline_name': gl_name,
+        'sequence_name': '-'.join([gl_name, line['unique_ids'][seq_idx]]),
+        'sequence': all_seqs[seq_idx].lower(),
+        'germline_family': line['{}_gene'.format(germline_family)][:5],
+        'v_gene': line['v_gene'],
+        'region': region,
+    }
+
+    for key, value in data_info.iteritems():
+        base_dict[key] = value
+    return base_dict
+
+def get_partis_annotation_files(path_to_annotations, metadata):
+    """
+    @param path_to_annotations: path to annotations files
+    @param metadata: csv file of metadata
+
+    @return list with the metadata file and all the annotation files it refers to;
+        useful for checking whether processed partis data is stale (see data_cache)
+    """
+    return [metadata] + [
+        data_info['annotations_file'] for data_info in get_partition_info(path_to_annotations, metadata)
+    ]
+
+def _get_partis_annotation_chunks(partition_info, filters={}, chunk_size=500):
+    """
+    Reads the partis annotation files lazily, a chunk of clonal families at a time
+
+    @param partition_info: list of dictionaries from get_partition_info
+    @param filters: same as in write_partis_data_from_annotations
+    @param chunk_size: number of clonal families per chunk
+
+    @return generator of tuples: dataset index, dataset info, indices of the lines in the annotation file, the lines
+    """
+    for data_idx, data_info in enumerate(partition_info):
+        if any([data_info[key] not in values for key, values in filters.iteritems()]):
+            continue
+        with open(data_info['annotations_file'], "r") as csvfile:
+            reader = csv.DictReader(csvfile)
+            line_idxs = []
+            lines = []
+            for idx, line in enumerate(reader):
+                if line['v_gene'] == '':
+                    # failed annotations
+                    continue
+                line_idxs.append(idx)
+                lines.append(line)
+                if len(lines) == chunk_size:
+                    yield data_idx, data_info, line_idxs, lines
+                    line_idxs = []
+                    lines = []
+            if lines:
+                yield data_idx, data_info, line_idxs, lines
+
+# The germline info of each dataset, read once per process by PartisChunkWorker
+_PARTIS_GLFOS = {}
+
+class PartisChunkWorker(ParallelWorker):
+    """
+    Processes a chunk of clonal families from a partis annotation file into ObservedSequenceMutations
+    """
+    def __init__(self, seed, data_idx, data_info, line_idxs, lines, read_args):
+        """
+        @param seed: seed for imputing degenerate nucleotides
+        @param data_idx: index of the dataset
+        @param data_info: dictionary with the dataset info from get_partition_info
+        @param line_idxs: indices of the lines in the annotation file
+        @param lines: the raw lines of the annotation file, as dictionaries
+        @param read_args: dictionary with the other arguments to read_partis_data_from_annotations
+        """
+        self.seed = seed
+        self.data_idx = data_idx
+        self.data_info = data_info
+        self.line_idxs = line_idxs
+        self.lines = lines
+        self.read_args = read_args
+
+    def run_worker(self, shared_obj):
+        """
+        @return tuple with list of ObservedSequenceMutations and list of metadata dictionaries
+        """
+        # imputing degenerate nucleotides uses python's random number generator
+        random.seed(self.seed)
+        args = self.read_args
+        process_input_line, add_implicit_info, glutils = _import_partis_utils()
+        glfo_key = (self.data_info['germline_file'], self.data_info['locus'])
+        if glfo_key not in _PARTIS_GLFOS:
+            _PARTIS_GLFOS[glfo_key] = glutils.read_glfo(self.data_info['germline_file'], locus=self.data_info['locus'])
+        glfo = _PARTIS_GLFOS[glfo_key]
+
+        obs_data = []
+        metadata = []
+        for idx, line in zip(self.line_idxs, self.lines):
+            # add goodies from partis
+            process_input_line(line)
+            add_implicit_info(glfo, line)
+            family = _filter_partis_family(
+                line,
+                args['seq_filters'],
+                args['min_clonal_family_size'],
+                args['min_seq_len'],
+                args['max_mut_pct'],
+                args['min_mut_pct'],
+                args['region'],
+            )
+            if family is None:
+                continue
+            gl_seq, all_seqs, good_seq_idx = family
+
+            gl_name = 'clone{}-{}-{}'.format(*[self.data_idx, idx, args['clone_str']])
+            for good_idx in sorted(good_seq_idx):
+                start_seq, end_seq, collapse_list = process_degenerates_and_impute_nucleotides(
+                    gl_seq,
+                    all_seqs[good_idx],
+                    max(args['left_flank_len'], args['right_flank_len']),
+                )
+                obs_seq_mutation = ObservedSequenceMutations(
+                        start_seq=start_seq,
+                        end_seq=end_seq,
+                        motif_len=args['motif_len'],
+                        left_flank_len=args['left_flank_len'],
+                        right_flank_len=args['right_flank_len'],
+                        collapse_list=collapse_list,
+                )
+                if obs_seq_mutation.num_mutations > 0:
+                    # don't consider pairs where mutations occur in flanking regions
+                    seq_info = _get_partis_seq_info(line, gl_name, good_idx, all_seqs, self.data_info, args['region'], args['germline_family'])
+                    seq_info['germline_sequence'] = gl_seq
+                    obs_data.append(obs_seq_mutation)
+                    metadata.append(seq_info)
+        return obs_data, metadata
+
+    def __str__(self):
+        return "PartisChunkWorker %s lines %d-%d" % (self.data_info['annotations_file'], self.line_idxs[0], self.line_idxs[-1])
+
+def read_partis_data_chunks_from_annotations(
+    path_to_annotations,
+    metadata,
+    motif_len=3,
+    left_flank_len=None,
+    right_flank_len=None,
+    filters={},
+    seq_filters={},
+    min_clonal_family_size=0,
+    min_seq_len=0,
+    max_mut_pct=1.,
+    min_mut_pct=0.,
+    clone_str='',
+    region='v',
+    germline_family='v',
+    chunk_size=500,
+    seed=None,
+    pool=None,
+    num_threads=1,
+):
+    """
+    Reads partis annotations directly into ObservedSequenceMutations, without writing the intermediate
+    gene and sequence csv files (see write_partis_data_from_annotations and read_gene_seq_csv_data).
+    The annotation files are streamed in chunks of clonal families that are processed in parallel, so only
+    a few chunks of the raw annotations are in memory at a time. The processed chunks are yielded in order
+    as they are done, so they can be written out (see data_cache.read_obs_data_cached) without keeping them all.
+
+    The filtering parameters are the same as in write_partis_data_from_annotations.
+
+    @param motif_len: length of motif we're using; used to collapse series of "n"s
+    @param left_flank_len: maximum left flank length for this motif length
+    @param right_flank_len: maximum right flank length for this motif length
+    @param chunk_size: number of clonal families processed at once by a worker
+    @param seed: seed for imputing degenerate nucleotides; each chunk gets its own seed
+    @param pool: multiprocessing pool for processing the chunks; if None, the chunks are processed serially
+    @param num_threads: number of processes in the pool
+
+    @return generator of tuples with the ObservedSequenceMutations of a chunk and their metadata as a list of dictionaries
+    """
+    _check_partis_region(region, germline_family)
+
+    if left_flank_len is None or right_flank_len is None:
+        # default to central base mutating
+        left_flank_len = motif_len/2
+        right_flank_len = motif_len/2
 
-                        for key, value in data_info.iteritems():
-                            base_dict[key] = value
+    if seed is None:
+        seed = get_randint()
+
+    read_args = {
+        'motif_len': motif_len,
+        'left_flank_len': left_flank_len,
+        'right_flank_len': right_flank_len,
+        'seq_filters': seq_filters,
+        'min_clonal_family_size': min_clonal_family_size,
+        'min_seq_len': min_seq_len,
+        'max_mut_pct': max_mut_pct,
+        'min_mut_pct': min_mut_pct,
+        'clone_str': clone_str,
+        'region': region,
+        'germline_family': germline_family,
+    }
+    chunks = _get_partis_annotation_chunks(get_partition_info(path_to_annotations, metadata), filters, chunk_size)
+    worker_iter = (
+        PartisChunkWorker(seed + chunk_idx, data_idx, data_info, line_idxs, lines, read_args)
+        for chunk_idx, (data_idx, data_info, line_idxs, lines) in enumerate(chunks)
+    )
 
-                        seq_writer.writerow(base_dict)
+    # Only submit a few chunks per process at a time. The pool would otherwise read all the annotations
+    # into its task queue right away.
+    num_chunks_per_round = 2 * num_threads if pool is not None else 1
+    while True:
+        workers = list(itertools.islice(worker_iter, num_chunks_per_round))
+        if not workers:
+            break
+        batched_workers = [BatchParallelWorkers([worker], None) for worker in workers]
+        if pool is not None:
+            results = pool.imap(run_multiprocessing_worker, batched_workers)
+        else:
+            results = itertools.imap(run_multiprocessing_worker, batched_workers)
+        for worker, (result,) in itertools.izip(workers, results):
+            if result is None:
+                raise ValueError("Failed to process partis annotations: %s" % worker)
+            yield result
+
+def read_partis_data_from_annotations(path_to_annotations, metadata, **kwargs):
+    """
+    Same as read_partis_data_chunks_from_annotations, but returns all the chunks together
+
+    @return ObservedSequenceMutations from processed data, metadata as a list of dictionaries
+    """
+    obs_data = []
+    all_metadata = []
+    for chunk_obs_data, chunk_metadata in read_partis_data_chunks_from_annotations(path_to_annotations, metadata, **kwargs):
+        obs_data += chunk_obs_data
+        all_metadata += chunk_metadata
+    return obs_data, all_metadata
 
 def impute_ancestors_dnapars(seqs, gl_seq, scratch_dir, gl_name='germline', verbose=True):
     """
@@ -250,6 +524,9 @@ def impute_ancestors_dnapars(seqs, gl_seq, scratch_dir, gl_name='germline', verb
     @return seqs_line: information needed to output imputed sequence data
     """
     from gctree.bin.phylip_parse import parse_outfile
+    from Bio.Seq import Seq
+    from Bio.SeqIO import SeqRecord
+    from Bio.AlignIO import MultipleSeqAlignment
 
     assert(len(gl_name) < 10)
 
@@ -315,6 +592,48 @@ def impute_ancestors_dnapars(seqs, gl_seq, scratch_dir, gl_name='germline', verb
 
     return genes_line, seq_line
 
+class DnaparsWorker(ParallelWorker):
+    """
+    Imputes the ancestral sequences of one clonal family with dnapars.
+    Each family gets its own subdirectory in the scratch directory, since dnapars always uses the same file names.
+    """
+    def __init__(self, seed, cluster_idx, seqs, gl_seq, scratch_dir, gl_name, verbose=True):
+        """
+        @param seed: not used by dnapars, which has its own seed
+        @param cluster_idx: index of the clonal family, returned with the result so results can be put back in order
+        @param seqs: list of sequences
+        @param gl_seq: germline sequence
+        @param scratch_dir: the family's intermediate dnapars files are written to a subdirectory of this directory
+        @param gl_name: name of germline (must be less than 10 characters long); also the name of the subdirectory
+        """
+        self.seed = seed
+        self.cluster_idx = cluster_idx
+        self.seqs = seqs
+        self.gl_seq = gl_seq
+        self.scratch_dir = scratch_dir
+        self.gl_name = gl_name
+        self.verbose = verbose
+
+    def run_worker(self, shared_obj):
+        """
+        @return tuple with the index of the clonal family and the output of impute_ancestors_dnapars
+        """
+        cluster_scratch_dir = os.path.join(self.scratch_dir, self.gl_name)
+        if not os.path.exists(cluster_scratch_dir):
+            os.makedirs(cluster_scratch_dir)
+        pars_gene, pars_seq = impute_ancestors_dnapars(
+            self.seqs,
+            self.gl_seq,
+            cluster_scratch_dir,
+            gl_name=self.gl_name,
+            verbose=self.verbose,
+        )
+        shutil.rmtree(cluster_scratch_dir)
+        return self.cluster_idx, pars_gene, pars_seq
+
+    def __str__(self):
+        return "DnaparsWorker %s: %d sequences" % (self.gl_name, len(self.seqs))
+
 def disambiguate(seq):
     """
     @param seq: sequence
@@ -332,6 +651,7 @@ def write_data_after_sampling(output_genes, output_seqs, gene_file_name, seq_fil
     @param sample_highest_mutated: sample sequence from each clonal family with most mutations
     """
 
+    import pandas as pd
     genes = pd.read_csv(gene_file_name)
     seqs = pd.read_csv(seq_file_name)
 
@@ -400,23 +720,31 @@ def write_data_after_sampling(output_genes, output_seqs, gene_file_name, seq_fil
         seq_writer.writeheader()
         seq_writer.writerows(out_seqs)
 
-def write_data_after_imputing(output_genes, output_seqs, gene_file_name, seq_file_name, motif_len=1, scratch_dir='_output', verbose=True):
+def write_data_after_imputing(output_genes, output_seqs, gene_file_name, seq_file_name, motif_len=1, scratch_dir='_output', verbose=True, pool=None):
     """
     @param output_genes: where to write processed germline data, if wanted
     @param output_genes: where to write processed sequence data, if wanted
     @param gene_file_name: csv file with germline names and sequences
     @param seq_file_name: csv file with sequence names and sequences, with corresponding germline name
     @param motif_len: length of motif we're using; used to collapse series of "n"s
-    @param scratch_dir: where to write dnapars intermediate files
+    @param scratch_dir: where to write dnapars intermediate files; each clonal family gets its own subdirectory
+    @param pool: multiprocessing pool for running dnapars on many clonal families at once;
+                the largest families are started first. The output is the same as without a pool.
+
+    Raises a ValueError with the germline names of the clonal families where dnapars failed, with or without a pool
     """
 
+    import pandas as pd
     genes = pd.read_csv(gene_file_name)
     seqs = pd.read_csv(seq_file_name)
 
     full_data = pd.merge(genes, seqs, on='germline_name')
 
-    out_genes = []
-    out_seqs = []
+    # The output lines for each clonal family, in the order of the clonal families
+    cluster_lines = []
+    # The germline name and metadata of the clonal families that go through dnapars
+    dnapars_clusters = {}
+    dnapars_workers = []
     for gl_idx, (germline, cluster) in enumerate(full_data.groupby(['germline_name'])):
         seqs_line = []
         genes_line = []
@@ -466,25 +794,71 @@ def write_data_after_imputing(output_genes, output_seqs, gene_file_name, seq_fil
                 continue
         else:
             # otherwise, take it away dnapars
+            # the output lines are filled in after dnapars is done
             gl_name = 'gene'+str(gl_idx)
-            pars_gene, pars_seq = impute_ancestors_dnapars(
-                    seqs_in_cluster,
-                    proc_gl_seq,
-                    scratch_dir,
-                    gl_name=gl_name,
-                    verbose=verbose
-                )
-            for seq_line in pars_seq:
-                current_seq = meta_in_cluster.copy()
-                current_seq['germline_name'] = gl_name
-                current_seq['sequence_name'] = seq_line[1]
-                current_seq['sequence'] = seq_line[2]
-                seqs_line.append(current_seq)
+            dnapars_workers.append(DnaparsWorker(
+                None,
+                len(cluster_lines),
+                seqs_in_cluster,
+                proc_gl_seq,
+                scratch_dir,
+                gl_name,
+                verbose=verbose,
+            ))
+            dnapars_clusters[len(cluster_lines)] = (gl_name, meta_in_cluster)
+            cluster_lines.append(None)
+            continue
 
-            for gene_line in pars_gene:
-                genes_line.append({'germline_name': gene_line[0],
-                    'germline_sequence': gene_line[1]})
+        cluster_lines.append((genes_line, seqs_line))
+
+    if pool is not None:
+        # Run the largest clonal families first so they don't hold up the end of the run.
+        # Each family is its own batch so idle processes pick up the next family right away.
+        dnapars_workers = sorted(dnapars_workers, key=lambda worker: len(worker.seqs), reverse=True)
+        rand_seed = get_randint()
+        for i, worker in enumerate(dnapars_workers):
+            worker.seed = rand_seed + i
+        dnapars_results = MultiprocessingManager(
+            pool,
+            dnapars_workers,
+            num_approx_batches=len(dnapars_workers),
+            pool_chunksize=1,
+        ).run()
+    else:
+        dnapars_results = []
+        for worker in dnapars_workers:
+            try:
+                dnapars_results.append(worker.run_worker(None))
+            except Exception as e:
+                print "Exception caught in %s: %s" % (worker, e)
+    # Failed workers return None in the pool
+    dnapars_results = [result for result in dnapars_results if result is not None]
+
+    failed_cluster_idxs = set(dnapars_clusters.keys()) - set([result[0] for result in dnapars_results])
+    if failed_cluster_idxs:
+        raise ValueError("dnapars failed for clonal families with germlines: %s" % ", ".join(
+            [str(dnapars_clusters[cluster_idx][1]['germline_name']) for cluster_idx in sorted(failed_cluster_idxs)]
+        ))
+
+    for cluster_idx, pars_gene, pars_seq in dnapars_results:
+        gl_name, meta_in_cluster = dnapars_clusters[cluster_idx]
+        seqs_line = []
+        genes_line = []
+        for seq_line in pars_seq:
+            current_seq = meta_in_cluster.copy()
+            current_seq['germline_name'] = gl_name
+            current_seq['sequence_name'] = seq_line[1]
+            current_seq['sequence'] = seq_line[2]
+            seqs_line.append(current_seq)
+
+        for gene_line in pars_gene:
+            genes_line.append({'germline_name': gene_line[0],
+                'germline_sequence': gene_line[1]})
+        cluster_lines[cluster_idx] = (genes_line, seqs_line)
 
+    out_genes = []
+    out_seqs = []
+    for genes_line, seqs_line in cluster_lines:
         out_genes += genes_line
         out_seqs += seqs_line
 
@@ -550,6 +924,7 @@ def read_gene_seq_csv_data(
         left_flank_len = motif_len/2
         right_flank_len = motif_len/2
 
+    import pandas as pd
     genes = pd.read_csv(gene_file_name)
     seqs = pd.read_csv(seq_file_name)
 
@@ -582,6 +957,129 @@ def read_gene_seq_csv_data(
 
     return obs_data, metadata
 
+def _get_conserved_region_start(is_bad, flank_len):
+    """
+    Vectorized version of the forward scan in ObservedSequenceMutations that finds the start of the conserved region:
+    the conserved region starts right after the last bad position that comes before the first run of flank_len good positions.
+
+    @param is_bad: boolean matrix, one row per sequence; positions that are mutated or degenerate.
+                    Only the positions that are scanned (the first half of the sequence) should be passed in.
+    @param flank_len: number of conserved positions needed for the flank
+
+    @return numpy array with the start index of the conserved region for each row
+    """
+    num_rows, num_cols = is_bad.shape
+    if num_cols == 0:
+        return np.zeros(num_rows, dtype=int)
+    # start_idxs[:, i] is the start index after scanning position i
+    start_idxs = np.maximum.accumulate(is_bad * np.arange(1, num_cols + 1), axis=1)
+    # the start index before scanning position i
+    prev_start_idxs = np.hstack([np.zeros((num_rows, 1), dtype=int), start_idxs[:, :-1]])
+    is_stop = np.arange(num_cols) - prev_start_idxs == flank_len
+    return np.where(
+        is_stop.any(axis=1),
+        prev_start_idxs[np.arange(num_rows), np.argmax(is_stop, axis=1)],
+        start_idxs[:, -1],
+    )
+
+def read_gene_seq_csv_data_bulk(
+        gene_file_name,
+        seq_file_name,
+        motif_len=3,
+        left_flank_len=None,
+        right_flank_len=None,
+        ):
+    """
+    Same as read_gene_seq_csv_data but processes the sequences with array operations instead of row by row.
+    Sequences of the same length are encoded as one uint8 matrix, and the mutations and flanks are found
+    for all of them at once.
+    Rows with degenerate characters (or different germline and sequence lengths) are processed the same way
+    as read_gene_seq_csv_data. The observations are returned in the same order as read_gene_seq_csv_data.
+
+    @param gene_file_name: csv file with germline names and sequences
+    @param seq_file_name: csv file with sequence names and sequences, with corresponding germline name
+    @param motif_len: length of motif we're using; used to collapse series of "n"s
+    @param left_flank_len: maximum left flank length for this motif length
+    @param right_flank_len: maximum right flank length for this motif length
+
+    @return ObservedSequenceMutations from processed data, metadata as a list of dictionaries
+    """
+    if left_flank_len is None or right_flank_len is None:
+        # default to central base mutating
+        left_flank_len = motif_len/2
+        right_flank_len = motif_len/2
+
+    import pandas as pd
+    genes = pd.read_csv(gene_file_name)
+    seqs = pd.read_csv(seq_file_name)
+
+    full_data = pd.merge(genes, seqs, on='germline_name')
+    # groupby visits germlines in sorted order and keeps the order of the rows within each germline
+    full_data = full_data.sort_values('germline_name', kind='mergesort')
+    gl_seqs = full_data['germline_sequence'].str.lower().values
+    end_seqs = full_data['sequence'].str.lower().values
+    seq_lens = full_data['sequence'].str.len().values
+    is_same_len = full_data['germline_sequence'].str.len().values == seq_lens
+
+    is_nucleotide = np.zeros(256, dtype=bool)
+    for nucleotide in NUCLEOTIDES:
+        is_nucleotide[ord(nucleotide)] = True
+
+    # Each row is processed in bulk if it only contains ACGT characters
+    # Otherwise we fall back to the row by row processing
+    bulk_args = [None] * len(full_data)
+    for seq_len in np.unique(seq_lens[is_same_len]):
+        row_idxs = np.flatnonzero(is_same_len & (seq_lens == seq_len))
+        start_mat = np.frombuffer("".join(gl_seqs[row_idxs]), dtype=np.uint8).reshape((row_idxs.size, seq_len))
+        end_mat = np.frombuffer("".join(end_seqs[row_idxs]), dtype=np.uint8).reshape((row_idxs.size, seq_len))
+        is_clean = is_nucleotide[start_mat].all(axis=1) & is_nucleotide[end_mat].all(axis=1)
+        row_idxs = row_idxs[is_clean]
+        is_mutated = start_mat[is_clean] != end_mat[is_clean]
+
+        half_len = seq_len/2
+        start_idxs = _get_conserved_region_start(is_mutated[:, :half_len], left_flank_len)
+        end_idxs = seq_len - _get_conserved_region_start(is_mutated[:, half_len:][:, ::-1], right_flank_len)
+        for row_idx, row_is_mutated, start_idx, end_idx in zip(row_idxs, is_mutated, start_idxs.tolist(), end_idxs.tolist()):
+            bulk_args[row_idx] = (
+                (start_idx, end_idx),
+                np.flatnonzero(row_is_mutated[start_idx + left_flank_len:end_idx - right_flank_len]).tolist(),
+            )
+
+    obs_data = []
+    metadata = []
+    for row_idx, elt in enumerate(full_data.to_dict('records')):
+        if bulk_args[row_idx] is None:
+            start_seq, end_seq, collapse_list = process_degenerates_and_impute_nucleotides(gl_seqs[row_idx], end_seqs[row_idx], max(left_flank_len, right_flank_len))
+            obs_seq_mutation = ObservedSequenceMutations(
+                    start_seq=start_seq,
+                    end_seq=end_seq,
+                    motif_len=motif_len,
+                    left_flank_len=left_flank_len,
+                    right_flank_len=right_flank_len,
+                    collapse_list=collapse_list,
+            )
+        else:
+            flank_idxs, mutation_pos = bulk_args[row_idx]
+            if len(mutation_pos) == 0 and flank_idxs[1] - flank_idxs[0] > left_flank_len + right_flank_len:
+                # no mutations, so this observation is skipped anyways
+                continue
+            obs_seq_mutation = ObservedSequenceMutations(
+                    start_seq=gl_seqs[row_idx],
+                    end_seq=end_seqs[row_idx],
+                    motif_len=motif_len,
+                    left_flank_len=left_flank_len,
+                    right_flank_len=right_flank_len,
+                    flank_idxs=flank_idxs,
+                    mutation_pos=mutation_pos,
+            )
+
+        if obs_seq_mutation.num_mutations > 0:
+            # don't consider pairs where mutations occur in flanking regions
+            obs_data.append(obs_seq_mutation)
+            metadata.append(elt)
+
+    return obs_data, metadata
+
 def get_data_statistics_print_lines(obs_data, feat_generator):
     """
     Some interesting statistics we can output (some from Cui et al. 2016 for comparison)
@@ -631,9 +1129,13 @@ def load_true_model(file_name):
     return np.array(true_model_agg)
 
 def load_fitted_model(file_name, keep_col0=False, add_targets=True):
-    with open(file_name, "r") as f:
-        fitted_models = pickle.load(f)
-        best_model = pick_best_model(fitted_models)
+    """
+    @param file_name: result store directory from fit_samm (or a pickle file from an older fit)
+
+    @return the best MethodResults, with the aggregate thetas
+    """
+    fitted_models = load_method_results(file_name)
+    best_model = pick_best_model(fitted_models)
 
     if best_model is None:
         print "FAIL", file_name
@@ -668,6 +1170,8 @@ def read_germline_file(fasta):
     @return dataframe with column "gene" for the name of the germline gene and
     "base" for the nucleotide content
     """
+    import pandas as pd
+    from Bio import SeqIO
 
     with open(fasta) as fasta_file:
         genes = []
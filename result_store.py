@@ -0,0 +1,193 @@
+"""
+On-disk store of the MethodResults from fitting a model for a sequence of penalty parameters.
+
+The store is a directory. Each MethodResults gets its own subdirectory where every numpy array
+(thetas, masks, variance estimates) is a separate .npy file and every other large object
+(feature generator, model truncation, sampler results) is a separate pickle file.
+The small fields (penalty parameters, log likelihood ratios, flags) of all the MethodResults are kept
+in one index file. Loading the store only reads the index: the other fields are read from disk
+the first time they are accessed, and the arrays are memory-mapped.
+"""
+import os
+import re
+import shutil
+import cPickle
+import numpy as np
+
+from checkpoint import write_atomic
+from method_results import MethodResults
+
+INDEX_FILE = "index.pkl"
+# Names of the files and directories that a result store directory can contain:
+# the index, temporary files from writing it, and one directory per MethodResults
+STORE_FILE_REGEX = re.compile(r"^(%s(\.tmp\d+)?|param\d+_model\d+)$" % re.escape(INDEX_FILE))
+
+def _is_small_value(value):
+    """
+    @return whether the value is stored in the index instead of its own file
+    """
+    if value is None or isinstance(value, (bool, int, long, float, str, np.number, np.bool_)):
+        return True
+    if isinstance(value, tuple):
+        return all([_is_small_value(v) for v in value])
+    return False
+
+class StoredMethodResults(MethodResults):
+    """
+    A MethodResults whose large fields are read from the result store only when they are accessed
+    """
+    def __init__(self, entry_dir, fields, mmap_mode="c"):
+        """
+        @param entry_dir: directory with the fields of this MethodResults
+        @param fields: dictionary with the small fields of this MethodResults
+        @param mmap_mode: passed to np.load; by default arrays are copy-on-write, so they can be modified
+                        in memory without changing the store
+        """
+        self.__dict__.update(fields)
+        self._entry_dir = entry_dir
+        self._mmap_mode = mmap_mode
+
+    def __getattr__(self, name):
+        # Only called for fields that have not been loaded yet
+        if name.startswith("__") or "_entry_dir" not in self.__dict__:
+            raise AttributeError(name)
+        npy_file = os.path.join(self._entry_dir, "%s.npy" % name)
+        pkl_file = os.path.join(self._entry_dir, "%s.pkl" % name)
+        if os.path.exists(npy_file):
+            value = np.load(npy_file, mmap_mode=self._mmap_mode)
+        elif os.path.exists(pkl_file):
+            with open(pkl_file, "rb") as f:
+                value = cPickle.load(f)
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+    def load_all_fields(self):
+        """
+        Read every field into memory, e.g. before its files in the store are overwritten
+        """
+        for file_name in os.listdir(self._entry_dir):
+            name, ext = os.path.splitext(file_name)
+            if ext in (".npy", ".pkl") and name not in self.__dict__:
+                getattr(self, name)
+            if ext == ".npy":
+                setattr(self, name, np.array(getattr(self, name)))
+
+    def __str__(self):
+        pen_param_str = ",".join(map(str, self.penalty_params))
+        return "Pen params %s" % pen_param_str
+
+class ResultStore:
+    """
+    Writes and reads the list of lists of MethodResults that fit_samm creates: one list per penalty parameter,
+    with a MethodResults for each fold
+    """
+    def __init__(self, path):
+        """
+        @param path: directory of the result store
+        """
+        self.path = path
+        self.index = {}
+        index_file = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file, "rb") as f:
+                self.index = cPickle.load(f)
+
+    def clear(self):
+        """
+        Remove everything in the result store.
+        Raises a ValueError instead of removing anything if the path is a file or a directory with
+        files that do not belong to a result store, e.g. if --out-file points to the wrong place.
+        """
+        if os.path.isdir(self.path):
+            other_files = [name for name in os.listdir(self.path) if not STORE_FILE_REGEX.match(name)]
+            if other_files:
+                raise ValueError("%s is not a result store (it contains %s); not removing it" % (self.path, ", ".join(sorted(other_files)[:5])))
+            shutil.rmtree(self.path)
+        elif os.path.exists(self.path):
+            raise ValueError("%s is a file, not a result store; not removing it" % self.path)
+        self.index = {}
+
+    def _get_entry_dir(self, param_idx, model_idx):
+        return os.path.join(self.path, "param%d_model%d" % (param_idx, model_idx))
+
+    def save(self, param_idx, model_idx, method_res):
+        """
+        Writes one MethodResults; overwrites it if it was already in the store
+
+        @param param_idx: index of the penalty parameter
+        @param model_idx: index of the MethodResults among those for this penalty parameter (e.g. the fold index)
+        @param method_res: MethodResults
+        """
+        entry_dir = self._get_entry_dir(param_idx, model_idx)
+        if isinstance(method_res, StoredMethodResults):
+            method_res.load_all_fields()
+        if os.path.exists(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.makedirs(entry_dir)
+
+        fields = {}
+        for name, value in method_res.__dict__.iteritems():
+            if name.startswith("_"):
+                continue
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                np.save(os.path.join(entry_dir, "%s.npy" % name), value)
+            elif _is_small_value(value):
+                fields[name] = value
+            else:
+                with open(os.path.join(entry_dir, "%s.pkl" % name), "wb") as f:
+                    cPickle.dump(value, f, protocol=cPickle.HIGHEST_PROTOCOL)
+
+        self.index[(param_idx, model_idx)] = fields
+        write_atomic(
+            os.path.join(self.path, INDEX_FILE),
+            lambda f: cPickle.dump(self.index, f, protocol=cPickle.HIGHEST_PROTOCOL),
+        )
+
+    def remove(self, param_idx, model_idx):
+        """
+        Remove one MethodResults from the store, if it is there
+        """
+        if (param_idx, model_idx) not in self.index:
+            return
+        del self.index[(param_idx, model_idx)]
+        write_atomic(
+            os.path.join(self.path, INDEX_FILE),
+            lambda f: cPickle.dump(self.index, f, protocol=cPickle.HIGHEST_PROTOCOL),
+        )
+        shutil.rmtree(self._get_entry_dir(param_idx, model_idx))
+
+    def load_result(self, param_idx, model_idx):
+        """
+        @return the StoredMethodResults for this penalty parameter and model index, None if it is not in the store
+        """
+        if (param_idx, model_idx) not in self.index:
+            return None
+        return StoredMethodResults(
+            self._get_entry_dir(param_idx, model_idx),
+            self.index[(param_idx, model_idx)],
+        )
+
+    def load(self):
+        """
+        @return list of lists of StoredMethodResults, in the same layout as they were saved
+        """
+        if not self.index:
+            return []
+        num_params = max([param_idx for param_idx, _ in self.index]) + 1
+        results_list = [[] for _ in range(num_params)]
+        for param_idx, model_idx in sorted(self.index.keys()):
+            results_list[param_idx].append(self.load_result(param_idx, model_idx))
+        return results_list
+
+def load_method_results(file_name):
+    """
+    @param file_name: a result store directory, or a pickle file with the MethodResults from an older fit
+
+    @return list of lists of MethodResults
+    """
+    if os.path.isdir(file_name):
+        return ResultStore(file_name).load()
+    with open(file_name, "r") as f:
+        return cPickle.load(f)
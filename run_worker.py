@@ -32,9 +32,7 @@ def main(args=sys.argv[1:]):
     with open(args.input_file, "r") as input_file:
         batched_workers = cPickle.load(input_file)
 
-    results = []
-    for worker in batched_workers.workers:
-        results.append(worker.run(batched_workers.shared_obj))
+    results = batched_workers.run()
 
     with open(args.output_file, "w") as output_file:
         cPickle.dump(results, output_file, protocol=cPickle.HIGHEST_PROTOCOL)
@@ -6,7 +6,7 @@ from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from read_data import get_sequence_mutations_from_tree, get_shazam_theta
 from likelihood_evaluator import LogLikelihoodEvaluator
 
-def likelihood_of_tree_from_shazam(tree, mutability_file, substitution_file=None, num_jobs=1, scratch_dir='_output', num_samples=1000, burn_in=0, num_tries=5):
+def likelihood_of_tree_from_shazam(tree, mutability_file, substitution_file=None, num_jobs=1, scratch_dir='_output', num_samples=1000, burn_in=0, num_tries=5, pool=None, parallel_stages=True):
     """
     Given an ETE tree and theta vector, compute the likelihood of that tree
 
@@ -18,6 +18,8 @@ def likelihood_of_tree_from_shazam(tree, mutability_file, substitution_file=None
     @param num_samples: number of chibs samples
     @param burn_in: number of burn-in iterations
     @param num_tries: number of tries for Chibs sampler
+    @param pool: multiprocessing pool to run the gibbs samplers on (used if num_jobs <= 1)
+    @param parallel_stages: whether to run the conditional stages of Chibs for all the branches in parallel
 
     @return: log likelihood of a tree given a SHazaM fit
     """
@@ -40,12 +42,13 @@ def likelihood_of_tree_from_shazam(tree, mutability_file, substitution_file=None
     )
 
     feat_generator.add_base_features_for_list(obs_data)
-    log_like_evaluator = LogLikelihoodEvaluator(obs_data, feat_generator, num_jobs, scratch_dir)
+    log_like_evaluator = LogLikelihoodEvaluator(obs_data, feat_generator, num_jobs, scratch_dir, pool=pool)
 
     return log_like_evaluator.get_log_lik(
         theta_ref,
         num_samples=num_samples,
         burn_in=burn_in,
         num_tries=num_tries,
+        parallel_stages=parallel_stages,
     )
 
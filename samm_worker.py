@@ -18,7 +18,8 @@ class SammWorker(ParallelWorker):
             reference_pen_param,
             val_set,
             num_val_samples,
-            args):
+            args,
+            checkpoint=None):
         self.seed = seed
         self.context_model_algo = context_model_algo
         self.train_set = train_set
@@ -30,6 +31,7 @@ class SammWorker(ParallelWorker):
         self.val_set = val_set
         self.num_val_samples = num_val_samples
         self.args = args
+        self.checkpoint = checkpoint
 
     def run_worker(self, pool=None):
         """
@@ -47,7 +49,8 @@ class SammWorker(ParallelWorker):
                 val_set_evaluator=self.val_set_evaluator,
                 init_theta=self.init_theta,
                 reference_pen_param=self.reference_pen_param,
-                pool=pool)
+                pool=pool,
+                checkpoint=self.checkpoint)
 
         val_set_evaluator = LikelihoodComparer(
             self.val_set,
@@ -57,5 +60,6 @@ class SammWorker(ParallelWorker):
             burn_in=self.args.num_val_burnin,
             num_jobs=self.args.num_jobs,
             scratch_dir=self.context_model_algo.scratch_dir,
+            job_backend=self.args.job_backend,
         )
         return model_results, val_set_evaluator
@@ -2,20 +2,74 @@ import sys
 import numpy as np
 import traceback
 import os.path
+import shutil
+import uuid
 from combined_feature_generator import CombinedFeatureGenerator
 from models import ImputedSequenceMutations
 from parallel_worker import ParallelWorker
 from parallel_worker import BatchSubmissionManager
 from parallel_worker import MultiprocessingManager
+from parallel_worker import PickledObjectRef, write_pickled_object, evict_pickled_objects, split_into_batches
 from common import get_randint, NUM_NUCLEOTIDES
 import custom_utils
 
+class ObservedDataDump:
+    """
+    The observed data written to the scratch dir for the jobs submitted to slurm, so the workers only get
+    references to it and it is not pickled again for every E-step.
+    The data is split the same way as the workers are batched, so each job only reads its own observations.
+    One dump can be shared by all the sampler collections over the same observed data, e.g. for a whole fit.
+    """
+    def __init__(self, observed_data, num_jobs, scratch_dir):
+        """
+        @param observed_data: list of ObservedSequenceMutationsFeatures objects
+        @param num_jobs: number of jobs the workers are split into
+        @param scratch_dir: directory to write the dump in
+        """
+        self.observed_data = observed_data
+        self.num_jobs = num_jobs
+        # The name is fixed here so every copy of this object (e.g. after pickling) removes the same files
+        self.dump_dir = os.path.join(scratch_dir, "observed_data_%s" % uuid.uuid4().hex)
+        self.refs = None
+
+    def __getstate__(self):
+        # The references are cheap to recreate, and the files may have been removed by another copy
+        state = self.__dict__.copy()
+        state["refs"] = None
+        return state
+
+    def get_refs(self):
+        """
+        Writes the observed data the first time it is called
+
+        @return list with a PickledObjectRef for each observation
+        """
+        if self.refs is None:
+            if not os.path.exists(self.dump_dir):
+                os.makedirs(self.dump_dir)
+            self.refs = []
+            for batch_idx, obs_batch in enumerate(split_into_batches(self.observed_data, self.num_jobs)):
+                file_name = os.path.join(self.dump_dir, "batch_%d.pkl" % batch_idx)
+                write_pickled_object(file_name, obs_batch)
+                self.refs += [PickledObjectRef(file_name, i) for i in range(len(obs_batch))]
+        return self.refs
+
+    def remove(self):
+        """
+        Removes the files of the dump; they are written again if the references are needed later
+        """
+        if self.refs is not None:
+            evict_pickled_objects(set([ref.file_name for ref in self.refs]))
+            self.refs = None
+        if os.path.exists(self.dump_dir):
+            shutil.rmtree(self.dump_dir)
+
 class SamplerCollection:
     """
     A class that will run samplers in parallel.
     A sampler is created for each element in observed_data.
     """
-    def __init__(self, observed_data, theta, sampler_cls, feat_generator, num_jobs=None, scratch_dir=None, pool=None, num_tries=5, get_residuals=False):
+    def __init__(self, observed_data, theta, sampler_cls, feat_generator, num_jobs=None, scratch_dir=None, pool=None, num_tries=5, get_residuals=False, job_backend="slurm", observed_data_dump=None):
         """
         There are two choices for running a sampler collection: Batch submission and multithreading.
         If num_jobs and scratch_dir are specified, then we perform batch submission.
@@ -29,8 +83,12 @@ class SamplerCollection:
         @param scratch_dir: a tmp directory to write files in for the batch submission manager
         @param pool: multiprocessing pool previously initialized before model fitting
         @param num_tries: number of tries for Chibs sampler
+        @param job_backend: "slurm" to submit the jobs to slurm, "local" to run them on local worker processes
+        @param observed_data_dump: ObservedDataDump of observed_data to share with other sampler collections;
+                        if None, the collection makes its own and removes it in close
         """
         self.num_jobs = num_jobs
+        self.job_backend = job_backend
         self.scratch_dir = scratch_dir
         self.pool = pool
 
@@ -40,6 +98,30 @@ class SamplerCollection:
         self.observed_data = observed_data
         self.num_tries = num_tries
         self.get_residuals = get_residuals
+        # The observed data in the scratch dir, for the jobs submitted to slurm
+        self.owns_observed_data_dump = observed_data_dump is None
+        self.observed_data_dump = observed_data_dump
+
+    def _get_observed_data_for_workers(self):
+        """
+        When submitting jobs to slurm, the observed data is written to the scratch dir the first time
+        and the workers only get references to it (see ObservedDataDump)
+
+        @return list with the observed data or a reference to it for each observation
+        """
+        if self.num_jobs is None or self.num_jobs <= 1 or self.job_backend != "slurm":
+            return self.observed_data
+
+        if self.observed_data_dump is None:
+            self.observed_data_dump = ObservedDataDump(self.observed_data, self.num_jobs, self.scratch_dir)
+        return self.observed_data_dump.get_refs()
+
+    def close(self):
+        """
+        Removes the observed data that this collection wrote to the scratch dir, unless the dump is shared
+        """
+        if self.owns_observed_data_dump and self.observed_data_dump is not None:
+            self.observed_data_dump.remove()
 
     def get_samples(self, init_orders_for_iter, num_samples, burn_in_sweeps=0, sampling_rate=1):
         """
@@ -57,18 +139,43 @@ class SamplerCollection:
         shared_obj = SamplerPoolWorkerShared(self.sampler_cls, self.theta, self.feat_generator, num_samples, burn_in_sweeps, sampling_rate, self.num_tries, self.get_residuals)
         worker_list = [
             SamplerPoolWorker(rand_seed + i, obs_data, init_order)
-            for i, (obs_data, init_order) in enumerate(zip(self.observed_data, init_orders_for_iter))
+            for i, (obs_data, init_order) in enumerate(zip(self._get_observed_data_for_workers(), init_orders_for_iter))
         ]
+        return self.run_workers(worker_list, shared_obj)
+
+    def run_workers(self, worker_list, shared_obj, worker_folder_name="gibbs_workers"):
+        """
+        Run the workers using batch submission, the multiprocessing pool, or serially (in that order of preference)
+
+        @param worker_list: list of ParallelWorkers
+        @param shared_obj: the object shared among all the workers
+        @param worker_folder_name: name of the folder in the scratch dir for the batch submission manager
+
+        @return list of results from the workers (failed workers are dropped)
+        """
         if self.num_jobs is not None and self.num_jobs > 1:
-            batch_manager = BatchSubmissionManager(worker_list, shared_obj, self.num_jobs, os.path.join(self.scratch_dir, "gibbs_workers"))
-            sampled_orders_list = batch_manager.run()
+            batch_manager = BatchSubmissionManager(
+                worker_list,
+                shared_obj,
+                self.num_jobs,
+                os.path.join(self.scratch_dir, worker_folder_name),
+                backend=self.job_backend,
+            )
+            results = batch_manager.run()
         elif self.pool is not None:
-            proc_manager = MultiprocessingManager(self.pool, worker_list)
-            sampled_orders_list = proc_manager.run()
+            # The shared object is pickled with every batch, so only make a couple of batches per process
+            proc_manager = MultiprocessingManager(
+                self.pool,
+                worker_list,
+                shared_obj,
+                num_approx_batches=self.pool._processes * 2,
+                pool_chunksize=1,
+            )
+            results = proc_manager.run()
         else:
-            sampled_orders_list = [worker.run(shared_obj) for worker in worker_list]
+            results = [worker.run(shared_obj) for worker in worker_list]
 
-        return sampled_orders_list
+        return results
 
 class SamplerPoolWorkerShared:
     def __init__(self, sampler_cls, theta, feat_generator, num_samples, burn_in_sweeps, sampling_rate, num_tries, get_residuals):
@@ -86,15 +193,19 @@ class SamplerPoolWorker(ParallelWorker):
     Stores the information for running a sampler
     """
     def __init__(self, seed, obs_seq, init_order):
+        """
+        @param obs_seq: ObservedSequenceMutations, or a PickledObjectRef to it
+        """
         self.seed = seed
         self.obs_seq = obs_seq
         self.init_order = init_order
 
     def run_worker(self, shared_obj):
+        obs_seq = self.obs_seq.get() if isinstance(self.obs_seq, PickledObjectRef) else self.obs_seq
         sampler = shared_obj.sampler_cls(
             shared_obj.theta,
             shared_obj.feat_generator,
-            self.obs_seq,
+            obs_seq,
             shared_obj.num_tries,
             shared_obj.get_residuals,
         )
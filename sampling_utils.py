@@ -0,0 +1,213 @@
+import numpy as np
+
+class UniformBuffer:
+    """
+    Pre-draws uniform random numbers in batches from the numpy random number generator.
+
+    The buffer is off unless it is enabled, and then every uniform comes straight from numpy,
+    so seeding numpy with np.random.seed is enough to make the draws reproducible.
+    When it is on, the buffer must be cleared whenever the numpy random number generator is seeded.
+    Otherwise the buffered values from before the seeding will be used.
+    Use `set_random_seed` to seed the generator and clear the buffer at the same time.
+    ParallelWorkers turn the buffer on while they run, since they always set their seed first.
+    """
+    def __init__(self, buffer_size=4096):
+        """
+        @param buffer_size: number of uniforms to draw at once
+        """
+        self.buffer_size = buffer_size
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        self.unifs = np.zeros(0)
+        self.idx = 0
+
+    def disable(self):
+        """
+        Turn off the buffer and throw away the buffered uniforms
+        """
+        self.enabled = False
+        self.clear()
+
+    def draw(self):
+        """
+        @return one uniform random number in [0, 1)
+        """
+        if not self.enabled:
+            return np.random.random_sample()
+        if self.idx >= self.unifs.size:
+            self.unifs = np.random.random_sample(self.buffer_size)
+            self.idx = 0
+        unif = self.unifs[self.idx]
+        self.idx += 1
+        return unif
+
+    def draw_many(self, num_unifs):
+        """
+        @param num_unifs: number of uniforms to draw
+        @return numpy array of uniform random numbers in [0, 1)
+        """
+        if not self.enabled:
+            return np.random.random_sample(num_unifs)
+        if self.idx + num_unifs > self.unifs.size:
+            self.unifs = np.concatenate([
+                self.unifs[self.idx:],
+                np.random.random_sample(max(self.buffer_size, num_unifs)),
+            ])
+            self.idx = 0
+        unifs = self.unifs[self.idx:self.idx + num_unifs]
+        self.idx += num_unifs
+        return unifs
+
+    def get_state(self):
+        """
+        @return the buffered uniforms that have not been used yet
+        """
+        return self.unifs[self.idx:].copy()
+
+    def set_state(self, unifs):
+        """
+        @param unifs: buffered uniforms from `get_state`
+        """
+        self.unifs = np.array(unifs, dtype=float)
+        self.idx = 0
+
+# Every process has its own buffer. ParallelWorkers clear it when they set their seed.
+UNIFORM_BUFFER = UniformBuffer()
+
+def set_random_seed(seed, buffer_uniforms=False):
+    """
+    Seed the numpy random number generator and clear the uniform buffer
+
+    @param buffer_uniforms: whether to turn on the uniform buffer; it is turned off otherwise
+    """
+    np.random.seed(seed)
+    UNIFORM_BUFFER.clear()
+    UNIFORM_BUFFER.enabled = buffer_uniforms
+
+def get_random_state():
+    """
+    @return the state of the numpy random number generator and the uniform buffer
+    """
+    return np.random.get_state(), UNIFORM_BUFFER.get_state()
+
+def set_random_state(random_state):
+    """
+    @param random_state: the state from `get_random_state`
+    """
+    np_state, buffer_state = random_state
+    np.random.set_state(np_state)
+    UNIFORM_BUFFER.set_state(buffer_state)
+
+def sample_index(weights):
+    """
+    Sample an index with probability proportional to the weights using the inverse CDF
+
+    @param weights: non-negative weights, not necessarily normalized
+    @return the sampled index
+    """
+    cum_weights = np.cumsum(weights)
+    return min(
+        np.searchsorted(cum_weights, UNIFORM_BUFFER.draw() * cum_weights[-1], side="right"),
+        cum_weights.size - 1,
+    )
+
+def sample_index_from_log_probs(log_probs):
+    """
+    Sample an index with probability proportional to exp(log_probs) using the inverse CDF on the log scale.
+    There is no need to exponentiate and normalize the probabilities.
+
+    @param log_probs: unnormalized log probabilities
+    @return the sampled index
+    """
+    log_cum_probs = np.logaddexp.accumulate(log_probs)
+    return min(
+        np.searchsorted(log_cum_probs, np.log(UNIFORM_BUFFER.draw()) + log_cum_probs[-1], side="right"),
+        log_cum_probs.size - 1,
+    )
+
+def sample_indices(probs, size):
+    """
+    Sample many indices independently from the same distribution
+
+    @param probs: non-negative weights, not necessarily normalized
+    @param size: number of indices to sample
+    @return numpy array of sampled indices
+    """
+    cum_probs = np.cumsum(probs)
+    return np.minimum(
+        np.searchsorted(cum_probs, UNIFORM_BUFFER.draw_many(size) * cum_probs[-1], side="right"),
+        cum_probs.size - 1,
+    )
+
+class FenwickSampler:
+    """
+    Samples an index with probability proportional to a vector of weights.
+    The weights are stored in a Fenwick tree (binary indexed tree), so updating a weight
+    and sampling an index both take O(log n) time.
+    Useful when a few weights change between draws.
+    """
+    def __init__(self, weights):
+        """
+        @param weights: non-negative weights
+        """
+        self.weights = np.array(weights, dtype=float)
+        self.size = self.weights.size
+        # tree[i] is the sum of weights in (i - lowbit(i), i], with 1-indexing
+        self.tree = np.zeros(self.size + 1)
+        self.tree[1:] = self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.top_bit = 1 << (self.size.bit_length() - 1) if self.size else 0
+
+    def update(self, idx, weight):
+        """
+        Set the weight of an index
+
+        @param idx: the index to update
+        @param weight: the new non-negative weight
+        """
+        delta = weight - self.weights[idx]
+        self.weights[idx] = weight
+        i = idx + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def get_total(self):
+        """
+        @return sum of all the weights
+        """
+        total = 0.
+        i = self.size
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, value):
+        """
+        @param value: a number in [0, total weight)
+        @return the smallest index where the cumulative sum of weights is greater than value
+        """
+        pos = 0
+        bit = self.top_bit
+        while bit:
+            next_pos = pos + bit
+            if next_pos <= self.size and self.tree[next_pos] <= value:
+                pos = next_pos
+                value -= self.tree[next_pos]
+            bit >>= 1
+        if pos >= self.size:
+            # Only happens due to rounding errors: return the last index with positive weight
+            pos = np.flatnonzero(self.weights)[-1]
+        return pos
+
+    def sample(self):
+        """
+        @return an index sampled with probability proportional to its weight
+        """
+        return self.find(UNIFORM_BUFFER.draw() * self.get_total())
@@ -0,0 +1,111 @@
+"""
+Score the mutability of every position of many sequences with a fitted samm model.
+Outputs the relative mutation rate of each position and, for per-target models,
+the probability of mutating to each target nucleotide (see mutability_scorer.ScoreWriter for the format).
+"""
+
+import sys
+import argparse
+import csv
+import itertools
+import logging as log
+import time
+from multiprocessing import Pool
+
+from Bio import SeqIO
+
+from common import pick_best_model
+from result_store import load_method_results
+from mutability_scorer import MutabilityScorer, ScoreWriter, score_sequence_chunks
+
+def parse_args():
+    ''' parse command line arguments '''
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--input-model',
+        type=str,
+        help='Fitted model from fit_samm',
+        default='_output/context_model')
+    parser.add_argument('--input-seqs',
+        type=str,
+        help='FASTA or CSV file with the sequences to score',
+        default='_output/naive.csv')
+    parser.add_argument('--input-format',
+        type=str,
+        choices=('fasta', 'csv'),
+        help='Format of --input-seqs; guessed from the file extension by default',
+        default=None)
+    parser.add_argument('--seq-col',
+        type=str,
+        help='Column with the sequences in a CSV file',
+        default='germline_sequence')
+    parser.add_argument('--name-col',
+        type=str,
+        help='Column with the sequence names in a CSV file',
+        default='germline_name')
+    parser.add_argument('--output-dir',
+        type=str,
+        help='Directory to write the scores to',
+        default='_output/scores')
+    parser.add_argument('--chunk-size',
+        type=int,
+        help='Number of sequences scored at once by a process',
+        default=10000)
+    parser.add_argument('--num-cpu-threads',
+        type=int,
+        help='Number of processes for scoring',
+        default=1)
+    parser.add_argument('--log-file',
+        type=str,
+        help='Log file',
+        default='_output/score_log.txt')
+
+    args = parser.parse_args()
+
+    if args.input_format is None:
+        args.input_format = 'csv' if args.input_seqs.lower().endswith('.csv') else 'fasta'
+
+    return args
+
+def read_seq_chunks(args):
+    """
+    Reads the input sequences lazily
+
+    @return generator of tuples with a list of sequence names and a list of sequences
+    """
+    if args.input_format == 'fasta':
+        records = ((record.id, str(record.seq).lower()) for record in SeqIO.parse(args.input_seqs, 'fasta'))
+    else:
+        f = open(args.input_seqs, 'r')
+        records = ((row[args.name_col], row[args.seq_col].lower()) for row in csv.DictReader(f))
+
+    while True:
+        chunk = list(itertools.islice(records, args.chunk_size))
+        if not chunk:
+            break
+        yield [name for name, _ in chunk], [seq for _, seq in chunk]
+
+def main(args=sys.argv[1:]):
+    args = parse_args()
+    log.basicConfig(format="%(message)s", filename=args.log_file, level=log.DEBUG)
+    st_time = time.time()
+
+    method_res = pick_best_model(load_method_results(args.input_model))
+    scorer = MutabilityScorer.from_method_results(method_res)
+
+    pool = Pool(args.num_cpu_threads) if args.num_cpu_threads > 1 else None
+    writer = ScoreWriter(args.output_dir)
+    num_seqs = 0
+    for names, (rates, target_probs, offsets) in score_sequence_chunks(scorer, read_seq_chunks(args), pool, args.num_cpu_threads):
+        writer.write(names, rates, target_probs, offsets)
+        num_seqs += len(names)
+        log.info("Scored %d sequences" % num_seqs)
+    writer.close()
+
+    if pool is not None:
+        pool.close()
+    log.info("Completed! Time: %s" % str(time.time() - st_time))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
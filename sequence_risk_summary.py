@@ -0,0 +1,330 @@
+"""
+Per-sequence summaries of a fitted motif model, computed from the aggregate theta without simulating:
+    - the probability that each position is the first to mutate,
+    - the expected time until the first k mutations,
+    - the expected number of mutations in each region of the sequence by a censoring time.
+
+At time zero every position p mutates at rate lambda0 * r_p, where r_p is the relative mutation rate from
+MutabilityScorer. The first mutation is therefore exact: position p mutates first with probability r_p / sum(r)
+and the first mutation happens at an exponential time with mean 1/(lambda0 * sum(r)).
+After the first mutation, the motifs of the neighbouring positions change. The other summaries ignore this
+and treat the positions as independent exponential clocks with the rates at time zero, which makes them
+closed form (expected counts) or a one-dimensional integral (expected times of the k-th mutation).
+They are approximations of the full model.
+SequenceRiskSummarizer.simulate_summaries estimates the same quantities under the full model with
+the lockstep survival model simulator, for when the approximation is not good enough.
+"""
+import itertools
+import numpy as np
+
+from common import NUM_NUCLEOTIDES, NUCLEOTIDE_DICT, get_randint
+from mutability_scorer import MutabilityScorer
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from survival_model_simulator import SurvivalModelSimulatorSingleColumn, SurvivalModelSimulatorMultiColumn
+from parallel_worker import ParallelWorker, BatchParallelWorkers, run_multiprocessing_worker
+
+class SequenceRiskSummarizer:
+    """
+    Computes mutation summaries for many sequences at once
+    """
+    def __init__(self, agg_theta, motif_len, left_flank_len, lambda0=1., num_grid_points=400):
+        """
+        @param agg_theta: aggregate theta, see MutabilityScorer
+        @param motif_len: length of the motifs
+        @param left_flank_len: the position in the motif that mutates
+        @param lambda0: the baseline hazard; times are in units of 1/lambda0
+        @param num_grid_points: number of time points for integrating the expected times of the k-th mutation
+        """
+        self.agg_theta = agg_theta
+        self.motif_len = motif_len
+        self.left_flank_len = left_flank_len
+        self.lambda0 = lambda0
+        self.num_grid_points = num_grid_points
+        self.scorer = MutabilityScorer(agg_theta, motif_len, left_flank_len)
+
+    @staticmethod
+    def from_method_results(method_res, lambda0=1.):
+        """
+        @param method_res: MethodResults with a refit theta
+        @param lambda0: the baseline hazard
+
+        @return SequenceRiskSummarizer for the refit theta
+        """
+        feat_generator = method_res.refit_feature_generator
+        agg_theta = feat_generator.create_aggregate_theta(
+            method_res.refit_theta,
+            keep_col0=False,
+            add_targets=True,
+        )
+        return SequenceRiskSummarizer(agg_theta, feat_generator.motif_len, feat_generator.max_left_motif_flank_len, lambda0)
+
+    def get_position_hazards(self, seqs):
+        """
+        @param seqs: list of sequences
+
+        @return numpy array with the hazard at time zero of every position of every sequence, zero for positions
+                that cannot mutate; one row per sequence, padded with zeros to the length of the longest sequence
+        """
+        rates, _, offsets = self.scorer.score(seqs)
+        seq_lens = offsets[1:] - offsets[:-1]
+        hazards = np.zeros((len(seqs), max(seq_lens) if len(seqs) else 0))
+        is_position = np.arange(hazards.shape[1])[None, :] < seq_lens[:, None]
+        hazards[is_position] = np.nan_to_num(rates.astype(float)) * self.lambda0
+        return hazards
+
+    def get_first_mutation_probs(self, seqs):
+        """
+        @param seqs: list of sequences
+
+        @return numpy array with the probability that each position is the first one to mutate, one row per sequence
+                (padded with zeros to the length of the longest sequence)
+        """
+        hazards = self.get_position_hazards(seqs)
+        total_hazards = hazards.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(total_hazards[:, None] > 0, hazards / total_hazards[:, None], 0)
+
+    def get_expected_first_mutation_times(self, seqs):
+        """
+        @param seqs: list of sequences
+
+        @return numpy array with the expected time of the first mutation of each sequence
+                (infinite if the sequence cannot mutate)
+        """
+        total_hazards = self.get_position_hazards(seqs).sum(axis=1)
+        with np.errstate(divide="ignore"):
+            return 1. / total_hazards
+
+    def get_expected_mutation_counts(self, seqs, censoring_time, regions=None):
+        """
+        Assumes the positions mutate independently with their hazards at time zero
+
+        @param seqs: list of sequences
+        @param censoring_time: how long the sequences mutate for
+        @param regions: list of (start, end) positions of the regions to count mutations in; whole sequence if None
+
+        @return numpy array with the expected number of mutations in each region, one row per sequence
+        """
+        mutate_probs = -np.expm1(-self.get_position_hazards(seqs) * censoring_time)
+        if regions is None:
+            regions = [(0, mutate_probs.shape[1])]
+        return np.array([
+            mutate_probs[:, start:end].sum(axis=1) for start, end in regions
+        ]).reshape((len(regions), len(seqs))).T
+
+    def get_expected_kth_mutation_times(self, seqs, max_k):
+        """
+        Assumes the positions mutate independently with their hazards at time zero.
+        Uses E[T_k] = integral of P(fewer than k mutations by time t) over t; the number of mutations by time t
+        is a sum of independent Bernoullis, so its distribution is computed one position at a time.
+        The integral is over a log-spaced grid of times per sequence: it starts where the first mutation
+        has hardly any chance of having happened and stops where the max_k fastest positions have almost surely mutated.
+        The first column is exact.
+
+        @param seqs: list of sequences
+        @param max_k: the largest number of mutations
+
+        @return numpy array with the expected time of the k-th mutation for k = 1,...,max_k, one row per sequence
+                (infinite if the sequence has fewer than k positions that can mutate)
+        """
+        hazards = self.get_position_hazards(seqs)
+        num_seqs = hazards.shape[0]
+        kth_times = np.empty((num_seqs, max_k))
+        kth_times[:, 0] = self.get_expected_first_mutation_times(seqs)
+        num_mutable = (hazards > 0).sum(axis=1)
+        sorted_hazards = -np.sort(-hazards, axis=1)
+        todo_idxs = np.where(num_mutable > 0)[0]
+        kth_times[num_mutable == 0, :] = np.inf
+        if max_k == 1 or todo_idxs.size == 0:
+            return kth_times
+
+        hazards = hazards[todo_idxs]
+        # Hazard of the slowest of the fastest max_k positions that can mutate
+        slow_hazards = sorted_hazards[todo_idxs, np.minimum(num_mutable[todo_idxs], max_k) - 1]
+        min_times = 1e-6 / hazards.sum(axis=1)
+        max_times = (np.log(max_k) + 40.) / slow_hazards
+        log_times = np.linspace(0, 1, self.num_grid_points)[None, :] * np.log(max_times / min_times)[:, None] + np.log(min_times)[:, None]
+        times = np.exp(log_times)
+
+        # count_probs[i, g, m] = probability of m mutations by times[i, g], for m < max_k
+        count_probs = np.zeros((todo_idxs.size, self.num_grid_points, max_k))
+        count_probs[:, :, 0] = 1
+        for pos in np.where(hazards.any(axis=0))[0]:
+            mutate_probs = -np.expm1(-hazards[:, pos][:, None] * times)[:, :, None]
+            count_probs[:, :, 1:] = count_probs[:, :, 1:] * (1 - mutate_probs) + count_probs[:, :, :-1] * mutate_probs
+            count_probs[:, :, 0] *= 1 - mutate_probs[:, :, 0]
+        fewer_probs = np.cumsum(count_probs, axis=2)
+
+        # integrate over log time, and P(fewer than k mutations) is one before the first grid point
+        integrals = min_times[:, None] + np.trapz(fewer_probs * times[:, :, None], log_times[:, :, None], axis=1)
+        for k in range(1, max_k):
+            kth_times[todo_idxs, k] = np.where(num_mutable[todo_idxs] > k, integrals[:, k], np.inf)
+        return kth_times
+
+    def summarize(self, seqs, censoring_time, max_k=1, regions=None):
+        """
+        @param seqs: list of sequences
+        @param censoring_time: how long the sequences mutate for when counting mutations
+        @param max_k: the largest number of mutations to get expected times for
+        @param regions: list of (start, end) positions of the regions to count mutations in; whole sequence if None
+
+        @return dictionary with the total hazard of each sequence, the probability that each position mutates first,
+                the expected times of the first max_k mutations and the expected mutation counts in each region
+                (see get_first_mutation_probs, get_expected_kth_mutation_times and get_expected_mutation_counts);
+                only the first two and the expected time of the first mutation are exact
+        """
+        return {
+            "total_hazards": self.get_position_hazards(seqs).sum(axis=1),
+            "first_mutation_probs": self.get_first_mutation_probs(seqs),
+            "expected_kth_mutation_times": self.get_expected_kth_mutation_times(seqs, max_k),
+            "expected_mutation_counts": self.get_expected_mutation_counts(seqs, censoring_time, regions),
+        }
+
+    def get_simulator(self):
+        """
+        @return the survival model simulator for the aggregate theta, so it mutates motifs at the same rates
+        """
+        feat_generator = HierarchicalMotifFeatureGenerator(
+            motif_lens=[self.motif_len],
+            left_motif_flank_len_list=[[self.left_flank_len]],
+        )
+        if self.scorer.per_target_model:
+            return SurvivalModelSimulatorMultiColumn(self.agg_theta, feat_generator, self.lambda0)
+        # each motif mutates to the other nucleotides with equal probability
+        probability_matrix = np.ones((feat_generator.feature_vec_len, NUM_NUCLEOTIDES))
+        for motif_idx, motif in enumerate(feat_generator.motif_list):
+            probability_matrix[motif_idx, NUCLEOTIDE_DICT[motif[self.left_flank_len]]] = 0
+        return SurvivalModelSimulatorSingleColumn(self.agg_theta, probability_matrix / (NUM_NUCLEOTIDES - 1), feat_generator, self.lambda0)
+
+    def simulate_summaries(self, seqs, censoring_time, max_k=1, regions=None, num_samples=100, seed=None, pool=None, num_jobs=1):
+        """
+        Monte Carlo estimates of the summaries from summarize, under the full model where the hazards change after
+        each mutation
+
+        @param seqs: list of sequences
+        @param censoring_time: how long the sequences mutate for when counting mutations
+        @param max_k: the largest number of mutations to get expected times for
+        @param regions: list of (start, end) positions of the regions to count mutations in; whole sequence if None
+        @param num_samples: number of simulations per sequence
+        @param seed: seed for the simulations
+        @param pool, num_jobs: passed to SurvivalModelSimulator.simulate_many
+
+        @return dictionary with the same keys as summarize (the total hazards are not simulated)
+        """
+        simulator = self.get_simulator()
+        num_seqs = len(seqs)
+        start_seqs = [seq for seq in seqs for _ in range(num_samples)]
+        # simulate_many uses the seeds from seed up to seed + 2 * len(start_seqs) at most
+        count_seed = None if seed is None else seed + 2 * len(start_seqs)
+
+        # Mutate each sequence max_k times without censoring
+        flank_len = self.motif_len - 1
+        time_samples = simulator.simulate_many(
+            start_seqs,
+            percents_mutated=[max_k / float(len(seq) - flank_len) for seq in start_seqs],
+            seed=seed,
+            pool=pool,
+            num_jobs=num_jobs,
+            lockstep=True,
+        )
+        kth_times = np.array([
+            [s.mutations[k].time if k < len(s.mutations) else np.inf for k in range(max_k)]
+            for s in time_samples
+        ]).reshape((num_seqs, num_samples, max_k))
+        first_mutation_probs = np.zeros((num_seqs, max([len(seq) for seq in seqs]) if seqs else 0))
+        for sample_idx, s in enumerate(time_samples):
+            if s.mutations:
+                first_mutation_probs[sample_idx / num_samples, s.mutations[0].pos + self.left_flank_len] += 1. / num_samples
+
+        count_samples = simulator.simulate_many(
+            start_seqs,
+            censoring_time=censoring_time,
+            seed=count_seed,
+            pool=pool,
+            num_jobs=num_jobs,
+            lockstep=True,
+        )
+        if regions is None:
+            regions = [(0, max([len(seq) for seq in seqs]) if seqs else 0)]
+        counts = np.array([
+            [
+                np.sum([start <= m.pos + self.left_flank_len < end for m in s.mutations])
+                for start, end in regions
+            ]
+            for s in count_samples
+        ]).reshape((num_seqs, num_samples, len(regions)))
+
+        return {
+            "total_hazards": self.get_position_hazards(seqs).sum(axis=1),
+            "first_mutation_probs": first_mutation_probs,
+            "expected_kth_mutation_times": kth_times.mean(axis=1),
+            "expected_mutation_counts": counts.mean(axis=1),
+        }
+
+class SummaryWorker(ParallelWorker):
+    """
+    Summarizes a chunk of sequences
+    """
+    def __init__(self, seed, chunk_idx, seqs, summarize_kwargs, num_sim_samples=0):
+        """
+        @param seed: seed for the simulations; not used for the approximate summaries
+        @param chunk_idx: index of the chunk
+        @param seqs: list of sequences
+        @param summarize_kwargs: arguments for SequenceRiskSummarizer.summarize
+        @param num_sim_samples: if positive, estimate the summaries with this many simulations per sequence
+                        (see SequenceRiskSummarizer.simulate_summaries) instead of approximating them
+        """
+        self.seed = seed
+        self.chunk_idx = chunk_idx
+        self.seqs = seqs
+        self.summarize_kwargs = summarize_kwargs
+        self.num_sim_samples = num_sim_samples
+
+    def run_worker(self, summarizer):
+        """
+        @param summarizer: SequenceRiskSummarizer
+        @return the output of SequenceRiskSummarizer.summarize or SequenceRiskSummarizer.simulate_summaries
+        """
+        if self.num_sim_samples > 0:
+            return summarizer.simulate_summaries(self.seqs, num_samples=self.num_sim_samples, seed=self.seed, **self.summarize_kwargs)
+        return summarizer.summarize(self.seqs, **self.summarize_kwargs)
+
+    def __str__(self):
+        return "SummaryWorker %d: %d sequences" % (self.chunk_idx, len(self.seqs))
+
+def summarize_sequence_chunks(summarizer, chunks, summarize_kwargs, pool=None, num_threads=1, num_sim_samples=0):
+    """
+    Summarizes chunks of sequences, a few chunks per process at a time so the input can be streamed
+
+    @param summarizer: SequenceRiskSummarizer
+    @param chunks: iterable of tuples with a list of sequence names and a list of sequences
+    @param summarize_kwargs: arguments for SequenceRiskSummarizer.summarize
+    @param pool: multiprocessing pool; if None, the chunks are summarized serially
+    @param num_sim_samples: if positive, simulate the summaries instead (see SummaryWorker);
+                        the seeds of the chunks are drawn from the numpy random state
+
+    @return generator with the sequence names and the output of SequenceRiskSummarizer.summarize for each chunk,
+            in the same order as the chunks
+    """
+    num_chunks_per_round = 2 * num_threads if pool is not None else 1
+    # The simulations reseed the global random state, so the seeds of the chunks come from their own random state
+    seed_random_state = np.random.RandomState(get_randint())
+    chunk_iter = iter(chunks)
+    chunk_idx = 0
+    while True:
+        round_chunks = list(itertools.islice(chunk_iter, num_chunks_per_round))
+        if not round_chunks:
+            break
+        batched_workers = [
+            BatchParallelWorkers([SummaryWorker(seed_random_state.randint(2**31), chunk_idx + i, seqs, summarize_kwargs, num_sim_samples)], summarizer)
+            for i, (_, seqs) in enumerate(round_chunks)
+        ]
+        chunk_idx += len(round_chunks)
+        if pool is not None:
+            results = pool.imap(run_multiprocessing_worker, batched_workers)
+        else:
+            results = ([batched_worker.workers[0].run_worker(summarizer)] for batched_worker in batched_workers)
+        for (names, _), batched_worker, (result,) in itertools.izip(round_chunks, batched_workers, results):
+            if result is None:
+                raise ValueError("Failed to summarize sequences: %s" % batched_worker.workers[0])
+            yield names, result
@@ -19,6 +19,7 @@ import yaml
 
 from simulate_shm_star_tree import create_simulator
 from common import *
+from sampling_utils import set_random_seed
 
 def parse_args():
     ''' parse command line arguments '''
@@ -101,7 +102,7 @@ def run_survival(args, tree, naive_seq):
 
 def main(args=sys.argv[1:]):
     args = parse_args()
-    np.random.seed(args.seed)
+    set_random_seed(args.seed)
 
     naive_seq = simulate_naive_seq(args)
 
@@ -11,6 +11,7 @@ from scipy.stats import poisson
 from ete3 import TreeNode
 
 from gctree.bin.mutation_model import MutationModel
+from sampling_utils import set_random_seed
 
 def parse_args():
     ''' parse command line arguments '''
@@ -235,7 +236,7 @@ def main(args=sys.argv[1:]):
         os.makedirs(output_dir)
 
     # Randomly generate number of mutations or use default
-    np.random.seed(args.seed)
+    set_random_seed(args.seed)
 
     all_germline_dicts = _get_clonal_family_stats(
         args.path_to_annotations,
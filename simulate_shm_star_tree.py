@@ -12,12 +12,14 @@ import os
 import os.path
 import csv
 import subprocess
+from multiprocessing import Pool
 
 from survival_model_simulator import SurvivalModelSimulatorSingleColumn
 from survival_model_simulator import SurvivalModelSimulatorMultiColumn
 from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from simulate_germline import GermlineSimulatorPartis, GermlineMetadata
 from common import *
+from sampling_utils import set_random_seed
 
 def parse_args():
     ''' parse command line arguments '''
@@ -81,8 +83,15 @@ def parse_args():
     parser.add_argument('--with-replacement',
         action="store_true",
         help='Allow same position to mutate multiple times')
+    parser.add_argument('--num-cpu-threads',
+        type=int,
+        help='Number of threads to use for simulating sequences',
+        default=1)
+    parser.add_argument('--lockstep',
+        action="store_true",
+        help='Simulate sequences of the same length together (vectorized across sequences)')
 
-    parser.set_defaults(with_replacement=False, use_partis=False, use_shmulate=False)
+    parser.set_defaults(with_replacement=False, use_partis=False, use_shmulate=False, lockstep=False)
     args = parser.parse_args()
     args.output_naive_freqs = args.output_naive.replace(".csv", "_prevalence.csv")
     return args
@@ -142,37 +151,54 @@ def run_survival(args, germline_seqs):
     # For each germline gene, run survival model to obtain mutated sequences.
     # Write sequences to file with three columns: name of germline gene
     # used, name of simulated sequence and corresponding sequence.
-    tot_mutated = 0
-    tot_germline = len(germline_seqs)
+    germline_keys = germline_seqs.keys()
+    mult_sample = np.random.multinomial(
+        args.tot_mutated,
+        [germline_seqs[g_key].freq for g_key in germline_keys],
+    )
+    genes = []
+    start_seqs = []
+    percents_mutated = []
+    for idx, gene in enumerate(germline_keys):
+        # Decide amount to mutate -- just random uniform
+        percent_to_mutate = np.random.uniform(low=args.min_percent_mutated, high=args.max_percent_mutated)
+        # Decide number of taxa. Must be at least one.
+        n_germ_taxa = mult_sample[idx]
+        genes += [gene] * n_germ_taxa
+        start_seqs += [germline_seqs[gene].val.lower()] * n_germ_taxa
+        percents_mutated += [percent_to_mutate] * n_germ_taxa
+
+    pool = Pool(args.num_cpu_threads) if args.num_cpu_threads > 1 else None
+    full_data_samples = simulator.simulate_many(
+        start_seqs,
+        percents_mutated=percents_mutated,
+        with_replacement=args.with_replacement,
+        seed=get_randint(),
+        pool=pool,
+        num_jobs=args.num_cpu_threads,
+        lockstep=args.lockstep,
+    )
+    if pool is not None:
+        pool.close()
+
+    rows = []
+    num_mutations = {}
+    for gene, sample in zip(genes, full_data_samples):
+        num_mutations.setdefault(gene, []).append(len(sample.mutations))
+        rows.append([
+            gene,
+            "%s-sample-%d" % (gene, len(num_mutations[gene]) - 1),
+            sample.left_flank + sample.end_seq + sample.right_flank,
+        ])
+    for gene in germline_keys:
+        if gene in num_mutations:
+            print "Number of mutations: %f (%f)" % (np.mean(num_mutations[gene]), np.sqrt(np.var(num_mutations[gene])))
+
+    # Write sequences to file in csv format, all at once
     with open(args.output_mutated, 'w') as outseqs:
         seq_file = csv.writer(outseqs)
         seq_file.writerow(['germline_name', 'sequence_name', 'sequence'])
-        germline_keys = germline_seqs.keys()
-        mult_sample = np.random.multinomial(
-            args.tot_mutated,
-            [germline_seqs[g_key].freq for g_key in germline_keys],
-        )
-        for idx, gene in enumerate(germline_keys):
-            sequence = germline_seqs[gene].val
-            # Decide amount to mutate -- just random uniform
-            percent_to_mutate = np.random.uniform(low=args.min_percent_mutated, high=args.max_percent_mutated)
-            # Decide number of taxa. Must be at least one.
-            n_germ_taxa = mult_sample[idx]
-            if n_germ_taxa > 0:
-                full_data_samples = [
-                    simulator.simulate(
-                        start_seq=sequence.lower(),
-                        percent_mutated=percent_to_mutate,
-                        with_replacement=args.with_replacement,
-                    ) for i in range(n_germ_taxa)
-                ]
-
-                # write to file in csv format
-                num_mutations = []
-                for i, sample in enumerate(full_data_samples):
-                    num_mutations.append(len(sample.mutations))
-                    seq_file.writerow([gene, "%s-sample-%d" % (gene, i) , sample.left_flank + sample.end_seq + sample.right_flank])
-                print "Number of mutations: %f (%f)" % (np.mean(num_mutations), np.sqrt(np.var(num_mutations)))
+        seq_file.writerows(rows)
 
 def run_shmulate(args):
     # Call Rscript
@@ -199,7 +225,7 @@ def run_shmulate(args):
 
 def main(args=sys.argv[1:]):
     args = parse_args()
-    np.random.seed(args.seed)
+    set_random_seed(args.seed)
 
     germline_seqs = _get_germline_nucleotides(args)
     dump_germline_data(germline_seqs, args)
@@ -0,0 +1,168 @@
+"""
+Summarize the mutation risk of many sequences under a fitted samm model:
+the total hazard of each sequence, the probability that each position mutates first,
+the expected times of its first few mutations and the expected number of mutations in each region
+by a censoring time (see sequence_risk_summary).
+By default only the total hazard, the first mutation probabilities and the expected time of the first mutation
+are exact; the other columns are approximations that are prefixed with "approx_".
+With --num-sim-samples, all the summaries are estimated by simulating under the full model instead
+and the columns are prefixed with "sim_".
+Writes one CSV row per sequence, and the first mutation probabilities of the positions that can mutate
+to a separate CSV file.
+"""
+
+import sys
+import argparse
+import csv
+import logging as log
+import time
+import numpy as np
+from multiprocessing import Pool
+
+from common import pick_best_model
+from sampling_utils import set_random_seed
+from result_store import load_method_results
+from score_sequences import read_seq_chunks
+from sequence_risk_summary import SequenceRiskSummarizer, summarize_sequence_chunks
+
+def parse_args():
+    ''' parse command line arguments '''
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('--seed',
+        type=int,
+        help='Random number generator seed for replicability',
+        default=1)
+    parser.add_argument('--input-model',
+        type=str,
+        help='Fitted model from fit_samm',
+        default='_output/context_model')
+    parser.add_argument('--input-seqs',
+        type=str,
+        help='FASTA or CSV file with the sequences to summarize',
+        default='_output/naive.csv')
+    parser.add_argument('--input-format',
+        type=str,
+        choices=('fasta', 'csv'),
+        help='Format of --input-seqs; guessed from the file extension by default',
+        default=None)
+    parser.add_argument('--seq-col',
+        type=str,
+        help='Column with the sequences in a CSV file',
+        default='germline_sequence')
+    parser.add_argument('--name-col',
+        type=str,
+        help='Column with the sequence names in a CSV file',
+        default='germline_name')
+    parser.add_argument('--lambda0',
+        type=float,
+        help='Baseline hazard; times are in units of 1/lambda0',
+        default=1.)
+    parser.add_argument('--censoring-time',
+        type=float,
+        help='How long the sequences mutate for when counting the expected mutations',
+        default=1.)
+    parser.add_argument('--max-k',
+        type=int,
+        help='Get the expected times of the first max-k mutations',
+        default=1)
+    parser.add_argument('--regions',
+        type=str,
+        help='Comma-separated start:end positions of the regions to count mutations in, e.g. 0:78,78:114; whole sequence by default',
+        default=None)
+    parser.add_argument('--num-sim-samples',
+        type=int,
+        help='If positive, estimate the summaries with this many simulations of each sequence under the full model',
+        default=0)
+    parser.add_argument('--output-file',
+        type=str,
+        help='CSV file to write the summaries to',
+        default='_output/summaries.csv')
+    parser.add_argument('--output-first-mutation-file',
+        type=str,
+        help='CSV file to write the probability that each position mutates first to, for the positions that can mutate',
+        default='_output/first_mutation_probs.csv')
+    parser.add_argument('--chunk-size',
+        type=int,
+        help='Number of sequences summarized at once by a process',
+        default=1000)
+    parser.add_argument('--num-cpu-threads',
+        type=int,
+        help='Number of processes for summarizing',
+        default=1)
+    parser.add_argument('--log-file',
+        type=str,
+        help='Log file',
+        default='_output/summarize_log.txt')
+
+    args = parser.parse_args()
+
+    if args.input_format is None:
+        args.input_format = 'csv' if args.input_seqs.lower().endswith('.csv') else 'fasta'
+    if args.regions is not None:
+        args.regions = [tuple(map(int, region.split(':'))) for region in args.regions.split(',')]
+
+    return args
+
+def main(args=sys.argv[1:]):
+    args = parse_args()
+    log.basicConfig(format="%(message)s", filename=args.log_file, level=log.DEBUG)
+    set_random_seed(args.seed)
+    st_time = time.time()
+
+    method_res = pick_best_model(load_method_results(args.input_model))
+    summarizer = SequenceRiskSummarizer.from_method_results(method_res, args.lambda0)
+    summarize_kwargs = dict(censoring_time=args.censoring_time, max_k=args.max_k, regions=args.regions)
+
+    pool = Pool(args.num_cpu_threads) if args.num_cpu_threads > 1 else None
+    if args.regions is None:
+        region_names = ['all']
+    else:
+        region_names = ['%d_%d' % region for region in args.regions]
+    if args.num_sim_samples > 0:
+        time_names = ['sim_expected_time_%d' % (k + 1) for k in range(args.max_k)]
+        count_prefix = 'sim_'
+    else:
+        # Only the expected time of the first mutation is exact
+        time_names = ['expected_time_1'] + ['approx_expected_time_%d' % (k + 1) for k in range(1, args.max_k)]
+        count_prefix = 'approx_'
+    num_seqs = 0
+    with open(args.output_file, 'w') as f, open(args.output_first_mutation_file, 'w') as first_f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ['sequence_name', 'total_hazard']
+            + time_names
+            + ['%sexpected_mutations_%s' % (count_prefix, region_name) for region_name in region_names]
+        )
+        first_writer = csv.writer(first_f)
+        first_writer.writerow(['sequence_name', 'position', 'first_mutation_prob'])
+        chunk_summaries = summarize_sequence_chunks(
+            summarizer,
+            read_seq_chunks(args),
+            summarize_kwargs,
+            pool,
+            args.num_cpu_threads,
+            num_sim_samples=args.num_sim_samples,
+        )
+        for names, summaries in chunk_summaries:
+            for i, name in enumerate(names):
+                writer.writerow(
+                    [name, summaries["total_hazards"][i]]
+                    + summaries["expected_kth_mutation_times"][i].tolist()
+                    + summaries["expected_mutation_counts"][i].tolist()
+                )
+                first_mutation_probs = summaries["first_mutation_probs"][i]
+                first_writer.writerows([
+                    (name, pos, first_mutation_probs[pos])
+                    for pos in np.where(first_mutation_probs > 0)[0]
+                ])
+            num_seqs += len(names)
+            log.info("Summarized %d sequences" % num_seqs)
+
+    if pool is not None:
+        pool.close()
+    log.info("Completed! Time: %s" % str(time.time() - st_time))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
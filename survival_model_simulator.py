@@ -1,7 +1,11 @@
+import itertools
 import numpy as np
-from common import mutate_string
-from common import NUCLEOTIDES, NUM_NUCLEOTIDES
-from common import sample_multinomial, process_degenerates_and_impute_nucleotides
+from common import mutate_string, get_randint
+from common import NUCLEOTIDES, NUM_NUCLEOTIDES, NUCLEOTIDE_SET, NUCLEOTIDE_DICT
+from common import process_degenerates_and_impute_nucleotides
+from sampling_utils import FenwickSampler, UNIFORM_BUFFER, sample_index, set_random_seed
+from parallel_worker import ParallelWorker, MultiprocessingManager
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from models import *
 
 class SurvivalModelSimulator:
@@ -11,6 +15,11 @@ class SurvivalModelSimulator:
     """
     def simulate(self, start_seq, left_flank=None, right_flank=None, censoring_time=None, percent_mutated=None, with_replacement=False, obs_seq_mutation=None):
         """
+        Keeps the hazards of each position (and each target nucleotide) in a Fenwick tree.
+        After each mutation, only the hazards of the positions whose motifs overlap the mutated position are updated.
+        So sampling the next mutation and updating the hazards take O(log L) time (with respect to the sequence length L),
+        other than the feature generation for the neighboring positions.
+
         @param start_seq: string for the original sequence; includes flanks unless they are provided by left_flank/right_flank
         @param left_flank: the left flank
         @param right_flank: the right flank
@@ -23,40 +32,58 @@ class SurvivalModelSimulator:
         mutations = []
 
         if left_flank is None and right_flank is None:
-            left_flank = start_seq[:self.feature_generator.max_left_motif_flank_len]
-            right_flank = start_seq[len(start_seq) - self.feature_generator.max_right_motif_flank_len:]
-            start_seq = start_seq[self.feature_generator.max_left_motif_flank_len:len(start_seq) - self.feature_generator.max_right_motif_flank_len]
+            left_flank, start_seq, right_flank = self._split_flanks(start_seq)
+
+        seq_len = len(start_seq)
+        update_region = max(self.feature_generator.left_update_region, self.feature_generator.right_update_region)
+        feature_vec_dict = self.feature_generator.create_for_sequence(start_seq, left_flank, right_flank, obs_seq_mutation=obs_seq_mutation)
+        target_hazards = np.array([
+            self._get_target_hazards(feature_vec_dict[p], p, start_seq[p])
+            for p in range(seq_len)
+        ]).reshape((seq_len, NUM_NUCLEOTIDES))
+        pos_sampler = FenwickSampler(target_hazards.sum(axis=1))
 
-        pos_to_mutate = set(range(len(start_seq)))
+        is_mutated = np.zeros(seq_len, dtype=bool)
         intermediate_seq = start_seq
         last_mutate_time = 0
-        while len(pos_to_mutate) > 0:
-            # TODO: For speedup, we don't need to recalculate all the features.
-            if with_replacement:
-                feature_vec_dict = self.feature_generator.create_for_sequence(intermediate_seq, left_flank, right_flank, obs_seq_mutation=obs_seq_mutation)
-            else:
-                feature_vec_dict = self.feature_generator.create_for_sequence(intermediate_seq, left_flank, right_flank, do_feat_vec_pos=pos_to_mutate, obs_seq_mutation=obs_seq_mutation)
-
-            mutate_time_delta, mutate_pos, nucleotide_target = self._sample_mutation(feature_vec_dict, intermediate_seq, pos_to_mutate)
-            mutate_time = last_mutate_time + mutate_time_delta
+        while with_replacement or len(mutations) < seq_len:
+            # sample the time for the next mutation
+            # we do inverse transform sampling - sample from unif and then invert
+            denom = pos_sampler.get_total()
+            mutate_time = last_mutate_time - 1/self.lambda0 * np.log(1 - UNIFORM_BUFFER.draw()) / denom
 
             if censoring_time is not None and censoring_time < mutate_time:
                 break
-            elif percent_mutated is not None and len(mutations) >= percent_mutated * len(start_seq):
+            elif percent_mutated is not None and len(mutations) >= percent_mutated * seq_len:
                 break
 
-            last_mutate_time = mutate_time
-
-            if not with_replacement:
-                pos_to_mutate.remove(mutate_pos)
+            # sample mutation position and target nucleotide
+            mutate_pos = pos_sampler.sample()
+            nucleotide_target = NUCLEOTIDES[sample_index(target_hazards[mutate_pos])]
 
+            last_mutate_time = mutate_time
             mutations.append(MutationEvent(
                 mutate_time,
                 mutate_pos,
                 nucleotide_target,
             ))
-
             intermediate_seq = mutate_string(intermediate_seq, mutate_pos, nucleotide_target)
+
+            if not with_replacement:
+                is_mutated[mutate_pos] = True
+                target_hazards[mutate_pos] = 0
+                pos_sampler.update(mutate_pos, 0)
+
+            # Only the positions near the mutated position have new features
+            update_pos = [
+                p for p in range(max(mutate_pos - update_region, 0), min(mutate_pos + update_region + 1, seq_len))
+                if not is_mutated[p]
+            ]
+            feature_vec_dict = self.feature_generator.create_for_sequence(intermediate_seq, left_flank, right_flank, do_feat_vec_pos=update_pos, obs_seq_mutation=obs_seq_mutation)
+            for p in update_pos:
+                target_hazards[p] = self._get_target_hazards(feature_vec_dict[p], p, intermediate_seq[p])
+                pos_sampler.update(p, target_hazards[p].sum())
+
         return FullSequenceMutations(
             start_seq,
             intermediate_seq,
@@ -65,7 +92,262 @@ class SurvivalModelSimulator:
             mutations,
         )
 
-    def simulate_dataset_from_observed(self, obs_data, with_replacement=False, motif_len=5, left_flank_len=None, right_flank_len=None):
+    def simulate_many(self, start_seqs, left_flanks=None, right_flanks=None, censoring_time=None, percents_mutated=None, with_replacement=False, obs_seq_mutations=None, seed=None, pool=None, num_jobs=1, lockstep=False):
+        """
+        Simulates many sequences, possibly in parallel.
+        Each sequence is simulated by a SimulationWorker with its own seed, so the results do not depend on
+        whether or not a pool is used.
+
+        @param start_seqs: list of original sequences; includes flanks unless they are provided by left_flanks/right_flanks
+        @param left_flanks: list of left flanks
+        @param right_flanks: list of right flanks
+        @param censoring_time: how long to mutate the sequences for
+        @param percents_mutated: list of percents of each sequence to mutate
+        @param with_replacement: True = a position can mutate multiple times, False = a position can mutate at most once
+        @param obs_seq_mutations: list of ObservedSequenceMutations to pass to the feature generator
+        @param seed: seed for the first sequence; the i-th sequence uses seed + i
+        @param pool: multiprocessing pool
+        @param num_jobs: number of batches to split the sequences into when using the pool
+        @param lockstep: simulate sequences of the same length together, evaluating the hazards for all of them at once.
+                    Only for HierarchicalMotifFeatureGenerator models, whose features only depend on the motif window
+                    around each position. The random numbers are drawn differently than in the other mode.
+
+        @return list of FullSequenceMutations, in the same order as start_seqs
+        """
+        num_seqs = len(start_seqs)
+        if left_flanks is None and right_flanks is None:
+            split_seqs = [self._split_flanks(s) for s in start_seqs]
+            left_flanks = [s[0] for s in split_seqs]
+            start_seqs = [s[1] for s in split_seqs]
+            right_flanks = [s[2] for s in split_seqs]
+        if percents_mutated is None:
+            percents_mutated = [None] * num_seqs
+        if obs_seq_mutations is None:
+            obs_seq_mutations = [None] * num_seqs
+        if seed is None:
+            seed = get_randint()
+
+        samples = [None] * num_seqs
+        if lockstep:
+            if not isinstance(self.feature_generator, HierarchicalMotifFeatureGenerator):
+                raise ValueError("Lockstep simulation is only for hierarchical motif models, not %s" % type(self.feature_generator).__name__)
+            if any([obs_seq_mutation is not None for obs_seq_mutation in obs_seq_mutations]):
+                raise ValueError("Lockstep simulation does not use ObservedSequenceMutations")
+            # Group the sequences by length; sequences with non-ACGT characters are simulated one at a time
+            seq_len_groups = {}
+            for idx, (left_flank, start_seq, right_flank) in enumerate(zip(left_flanks, start_seqs, right_flanks)):
+                full_seq = left_flank + start_seq + right_flank
+                if set(full_seq) <= NUCLEOTIDE_SET:
+                    seq_len_groups.setdefault(len(full_seq), []).append(idx)
+            for group_idx, group_seq_len in enumerate(sorted(seq_len_groups.keys())):
+                idxs = seq_len_groups[group_seq_len]
+                set_random_seed(seed + num_seqs + group_idx)
+                group_samples = self._simulate_lockstep(
+                    [left_flanks[i] for i in idxs],
+                    [start_seqs[i] for i in idxs],
+                    [right_flanks[i] for i in idxs],
+                    censoring_time,
+                    [percents_mutated[i] for i in idxs],
+                    with_replacement,
+                )
+                for i, sample in zip(idxs, group_samples):
+                    samples[i] = sample
+
+        worker_list = [
+            SimulationWorker(
+                seed + idx,
+                idx,
+                start_seqs[idx],
+                dict(
+                    left_flank=left_flanks[idx],
+                    right_flank=right_flanks[idx],
+                    censoring_time=censoring_time,
+                    percent_mutated=percents_mutated[idx],
+                    with_replacement=with_replacement,
+                    obs_seq_mutation=obs_seq_mutations[idx],
+                ),
+            )
+            for idx in range(num_seqs) if samples[idx] is None
+        ]
+        if pool is not None and len(worker_list) > 1:
+            manager = MultiprocessingManager(pool, worker_list, shared_obj=self, num_approx_batches=num_jobs)
+            results = manager.run()
+        else:
+            results = [worker.run(self) for worker in worker_list]
+
+        for res in results:
+            if res is not None:
+                idx, sample = res
+                samples[idx] = sample
+        if any([sample is None for sample in samples]):
+            raise ValueError("Simulation failed for %d sequences" % np.sum([sample is None for sample in samples]))
+        return samples
+
+    def _simulate_lockstep(self, left_flanks, start_seqs, right_flanks, censoring_time, percents_mutated, with_replacement):
+        """
+        Simulates sequences of the same length together: at each step, every sequence that is still running
+        gets its next mutation. The hazards of all the positions in all the sequences are stored in one array and
+        are looked up from a table of hazards for every possible motif window.
+
+        @param left_flanks: list of left flanks, all of length max_left_motif_flank_len
+        @param start_seqs: list of sequences (without flanks) of the same length, only ACGT characters
+        @param right_flanks: list of right flanks, all of length max_right_motif_flank_len
+        @param censoring_time: how long to mutate the sequences for
+        @param percents_mutated: list of percents of each sequence to mutate (elements can be None)
+        @param with_replacement: True = a position can mutate multiple times, False = a position can mutate at most once
+
+        @return list of FullSequenceMutations
+        """
+        left_flank_len = self.feature_generator.max_left_motif_flank_len
+        right_flank_len = self.feature_generator.max_right_motif_flank_len
+        if any([len(f) != left_flank_len for f in left_flanks]) or any([len(f) != right_flank_len for f in right_flanks]):
+            raise ValueError("Lockstep simulation requires flanks of the maximum motif flank lengths")
+
+        window_len = left_flank_len + right_flank_len + 1
+        hazard_table = self._get_window_hazard_table()
+        window_powers = NUM_NUCLEOTIDES ** np.arange(window_len - 1, -1, -1)
+
+        num_seqs = len(start_seqs)
+        seq_len = len(start_seqs[0])
+        nucleotide_lookup = np.zeros(256, dtype=np.uint8)
+        for nucleotide, nucleotide_idx in NUCLEOTIDE_DICT.iteritems():
+            nucleotide_lookup[ord(nucleotide)] = nucleotide_idx
+        seqs = nucleotide_lookup[np.frombuffer(
+            "".join([lf + s + rf for lf, s, rf in zip(left_flanks, start_seqs, right_flanks)]),
+            dtype=np.uint8,
+        )].reshape((num_seqs, -1))
+
+        # hazards[i, p, t] is the hazard of position p in sequence i mutating to nucleotide t.
+        # The motif window for position p starts at position p of the flanked sequence.
+        pos_ratios = np.array([self._get_position_hazard_ratio(p) for p in range(seq_len)], dtype=float)
+        window_codes = np.zeros((num_seqs, seq_len), dtype=int)
+        for k in range(window_len):
+            window_codes += seqs[:, k:k + seq_len] * window_powers[k]
+        hazards = hazard_table[window_codes] * pos_ratios[None, :, None]
+
+        max_mutations = np.array([
+            np.inf if percent_mutated is None else percent_mutated * seq_len
+            for percent_mutated in percents_mutated
+        ])
+        if not with_replacement:
+            max_mutations = np.minimum(max_mutations, seq_len)
+        is_mutated = np.zeros((num_seqs, seq_len), dtype=bool)
+        num_mutations = np.zeros(num_seqs, dtype=int)
+        times = np.zeros(num_seqs)
+        mutations = [[] for i in range(num_seqs)]
+        active_idxs = np.arange(num_seqs)
+        while active_idxs.size:
+            cum_hazards = np.cumsum(hazards[active_idxs].reshape((active_idxs.size, -1)), axis=1)
+            denoms = cum_hazards[:, -1]
+
+            # sample the time for the next mutation
+            with np.errstate(divide="ignore"):
+                mutate_times = times[active_idxs] - 1/self.lambda0 * np.log(1 - UNIFORM_BUFFER.draw_many(active_idxs.size)) / denoms
+            is_done = (num_mutations[active_idxs] >= max_mutations[active_idxs]) | (denoms <= 0)
+            if censoring_time is not None:
+                is_done |= censoring_time < mutate_times
+            active_idxs = active_idxs[~is_done]
+            if active_idxs.size == 0:
+                break
+            times[active_idxs] = mutate_times[~is_done]
+            cum_hazards = cum_hazards[~is_done]
+
+            # sample mutation position and target nucleotide
+            unifs = UNIFORM_BUFFER.draw_many(active_idxs.size) * cum_hazards[:, -1]
+            sampled_cols = np.minimum((cum_hazards <= unifs[:, None]).sum(axis=1), cum_hazards.shape[1] - 1)
+            mutate_pos = sampled_cols / NUM_NUCLEOTIDES
+            targets = sampled_cols % NUM_NUCLEOTIDES
+            for i, p, t in zip(active_idxs, mutate_pos, targets):
+                mutations[i].append(MutationEvent(times[i], p, NUCLEOTIDES[t]))
+            num_mutations[active_idxs] += 1
+            seqs[active_idxs, left_flank_len + mutate_pos] = targets
+            if not with_replacement:
+                is_mutated[active_idxs, mutate_pos] = True
+
+            # Update the hazards of the positions whose motif windows contain the mutated position
+            update_pos = np.clip(mutate_pos[:, None] - np.arange(window_len)[None, :] + left_flank_len, 0, seq_len - 1)
+            rows = active_idxs[:, None]
+            update_codes = np.zeros(update_pos.shape, dtype=int)
+            for k in range(window_len):
+                update_codes += seqs[rows, update_pos + k] * window_powers[k]
+            hazards[rows, update_pos] = (
+                hazard_table[update_codes]
+                * pos_ratios[update_pos][:, :, None]
+                * ~is_mutated[rows, update_pos][:, :, None]
+            )
+
+        return [
+            FullSequenceMutations(
+                start_seq,
+                "".join([NUCLEOTIDES[c] for c in seq[left_flank_len:left_flank_len + seq_len]]),
+                left_flank,
+                right_flank,
+                seq_mutations,
+            )
+            for left_flank, start_seq, right_flank, seq, seq_mutations in zip(left_flanks, start_seqs, right_flanks, seqs, mutations)
+        ]
+
+    def _get_window_hazard_table(self):
+        """
+        Calculates the hazards for every possible motif window, ignoring position effects.
+        Only for motif models, where the features of a position only depend on the window of
+        max_left_motif_flank_len nucleotides to the left and max_right_motif_flank_len nucleotides to the right.
+
+        @return numpy array with one row per window (in the order of itertools.product over NUCLEOTIDES)
+                    and one column per target nucleotide
+        """
+        left_flank_len = self.feature_generator.max_left_motif_flank_len
+        window_len = left_flank_len + self.feature_generator.max_right_motif_flank_len + 1
+        hazard_table = np.zeros((NUM_NUCLEOTIDES ** window_len, NUM_NUCLEOTIDES))
+        for window_idx, window in enumerate(itertools.product(NUCLEOTIDES, repeat=window_len)):
+            window = "".join(window)
+            feat_idxs = self.feature_generator.create_for_sequence(
+                window[left_flank_len],
+                window[:left_flank_len],
+                window[left_flank_len + 1:],
+            )[0]
+            hazard_table[window_idx] = self._get_motif_target_hazards(feat_idxs, window[left_flank_len])
+        return hazard_table
+
+    def _split_flanks(self, start_seq):
+        """
+        @param start_seq: sequence including the flanks
+        @return tuple with left flank, sequence without flanks, right flank
+        """
+        left_flank_len = self.feature_generator.max_left_motif_flank_len
+        right_flank_len = self.feature_generator.max_right_motif_flank_len
+        return (
+            start_seq[:left_flank_len],
+            start_seq[left_flank_len:len(start_seq) - right_flank_len],
+            start_seq[len(start_seq) - right_flank_len:],
+        )
+
+    def _get_target_hazards(self, feat_idxs, pos, nucleotide):
+        """
+        @param feat_idxs: the features of the position
+        @param pos: the position
+        @param nucleotide: the current nucleotide at the position
+
+        @return numpy array with the hazard of the position mutating to each of the nucleotides in NUCLEOTIDES
+        """
+        return self._get_motif_target_hazards(feat_idxs, nucleotide) * self._get_position_hazard_ratio(pos)
+
+    def _get_motif_target_hazards(self, feat_idxs, nucleotide):
+        """
+        @param feat_idxs: the features of the position
+        @param nucleotide: the current nucleotide at the position
+
+        @return numpy array with the hazard of mutating to each of the nucleotides in NUCLEOTIDES, ignoring position effects
+        """
+        raise NotImplementedError()
+
+    def _get_position_hazard_ratio(self, pos):
+        """
+        @return how much more or less likely the position is to mutate; no position effects by default
+        """
+        return 1.
+
+    def simulate_dataset_from_observed(self, obs_data, with_replacement=False, motif_len=5, left_flank_len=None, right_flank_len=None, pool=None, num_jobs=1):
         """
         Simulates a dataset with similar germlines and mutation positions/rates as an observed dataset
 
@@ -74,6 +356,8 @@ class SurvivalModelSimulator:
         @param motif_len: length of motif, for data processing
         @param left_flank_len: maximum left flank length for this motif length
         @param right_flank_len: maximum right flank length for this motif length
+        @param pool: multiprocessing pool for simulating the sequences in parallel
+        @param num_jobs: number of batches to split the sequences into when using the pool
 
         @return list of ObservedSequenceMutations
         """
@@ -82,17 +366,19 @@ class SurvivalModelSimulator:
             left_flank_len = motif_len/2
             right_flank_len = motif_len/2
 
+        samples = self.simulate_many(
+            [obs_seq_mutation.start_seq for obs_seq_mutation in obs_data],
+            left_flanks=[obs_seq_mutation.left_flank for obs_seq_mutation in obs_data],
+            right_flanks=[obs_seq_mutation.right_flank for obs_seq_mutation in obs_data],
+            percents_mutated=[float(obs_seq_mutation.num_mutations)/obs_seq_mutation.seq_len for obs_seq_mutation in obs_data],
+            with_replacement=with_replacement,
+            obs_seq_mutations=obs_data,
+            pool=pool,
+            num_jobs=num_jobs,
+        )
+
         simulated_data = []
-        for idx, obs_seq_mutation in enumerate(obs_data):
-            pos_to_mutate = obs_seq_mutation.mutation_pos_dict.keys()
-            sample = self.simulate(
-                start_seq=obs_seq_mutation.start_seq,
-                left_flank=obs_seq_mutation.left_flank,
-                right_flank=obs_seq_mutation.right_flank,
-                with_replacement=with_replacement,
-                percent_mutated=float(obs_seq_mutation.num_mutations)/obs_seq_mutation.seq_len,
-                obs_seq_mutation=obs_seq_mutation
-            )
+        for sample in samples:
             raw_start_seq = sample.left_flank + sample.start_seq + sample.right_flank
             raw_end_seq = sample.left_flank + sample.end_seq + sample.right_flank
 
@@ -131,31 +417,9 @@ class SurvivalModelSimulatorSingleColumn(SurvivalModelSimulator):
         self.feature_generator = feature_generator
         self.lambda0 = lambda0
 
-    def _sample_mutation(self, feature_vec_dict, intermediate_seq, pos_to_mutate):
-        # Fill in all the hazard weights -- only fill in for the positions eligible for mutation
-        # Note: shmulate removes all stop codons too, which we will not be doing here.
-        hazard_weights = []
-        mutate_positions = []
-        for p in pos_to_mutate:
-            motif_idx = feature_vec_dict[p]
-            hazard_weights.append(np.exp(self.thetas[motif_idx,0].sum(axis=0)))
-            mutate_positions.append(p)
-
-        # sample the time for the next mutation
-        # we do inverse transform sampling - sample from unif and then invert
-        unif_sample = np.random.rand(1)
-        denom = np.sum(hazard_weights)
-        mutate_time_delta = - 1/self.lambda0 * np.log(1 - unif_sample) / denom
-
-        # sample mutation position and target nucleotide
-        # this is a multinomial
-        sampled_idx = sample_multinomial(hazard_weights)
-        mutate_pos = mutate_positions[sampled_idx]
-        mutate_feat_idx = feature_vec_dict[mutate_pos]
-        nucleotide_target_idx = sample_multinomial(
-            self.probability_matrix[mutate_feat_idx,:].sum(axis=0)
-        )
-        return mutate_time_delta, mutate_pos, NUCLEOTIDES[nucleotide_target_idx]
+    def _get_motif_target_hazards(self, feat_idxs, nucleotide):
+        target_probs = self.probability_matrix[feat_idxs,:].sum(axis=0)
+        return np.exp(self.thetas[feat_idxs,0].sum()) * target_probs/target_probs.sum()
 
 class SurvivalModelSimulatorMultiColumn(SurvivalModelSimulator):
     """
@@ -176,34 +440,10 @@ class SurvivalModelSimulatorMultiColumn(SurvivalModelSimulator):
         self.feature_generator = feature_generator
         self.lambda0 = lambda0
 
-    def _sample_mutation(self, feature_vec_dict, intermediate_seq, pos_to_mutate):
-        # Fill in all the hazard weights -- only fill in for the positions eligible for mutation
-        # Note: shmulate removes all stop codons too, which we will not be doing here.
-        hazard_weights = []
-        target_nucleotides = []
-        mutate_positions = []
-        for p in pos_to_mutate:
-            motif_idxs = feature_vec_dict[p]
-            nucleotide_to_mutate = intermediate_seq[p]
-            for theta_idx, target_nucleotide in enumerate(NUCLEOTIDES):
-                if target_nucleotide != nucleotide_to_mutate:
-                    exp_theta = np.exp(self.thetas[motif_idxs, theta_idx].sum())
-                    hazard_weights.append(exp_theta)
-                    target_nucleotides.append(target_nucleotide)
-                    mutate_positions.append(p)
-
-        # sample the time for the next mutation
-        # we do inverse transform sampling - sample from unif and then invert
-        unif_sample = np.random.rand(1)
-        denom = np.sum(hazard_weights)
-        mutate_time_delta = - 1/self.lambda0 * np.log(1 - unif_sample) / denom
-
-        # sample mutation position and target nucleotide
-        # this is a multinomial
-        sampled_idx = sample_multinomial(hazard_weights)
-        mutate_pos = mutate_positions[sampled_idx]
-        nucleotide_target = target_nucleotides[sampled_idx]
-        return mutate_time_delta, mutate_pos, nucleotide_target
+    def _get_motif_target_hazards(self, feat_idxs, nucleotide):
+        target_hazards = np.exp(self.thetas[feat_idxs,:].sum(axis=0))
+        target_hazards[NUCLEOTIDES.index(nucleotide)] = 0
+        return target_hazards
 
 class SurvivalModelSimulatorPositionDependent(SurvivalModelSimulator):
     """
@@ -228,22 +468,35 @@ class SurvivalModelSimulatorPositionDependent(SurvivalModelSimulator):
         self.lambda0 = lambda0
         self.pos_risk = pos_risk
 
-    def _sample_mutation(self, feature_vec_dict, intermediate_seq, pos_to_mutate):
-        hazard_weights = []
-        mutate_positions = []
-        for p in pos_to_mutate:
-            motif_idx = feature_vec_dict[p]
-            hazard_weights.append(np.exp(self.thetas[motif_idx,0].sum(axis=0) + self.pos_risk[p]))
-            mutate_positions.append(p)
-
-        unif_sample = np.random.rand(1)
-        denom = np.sum(hazard_weights)
-        mutate_time_delta = - 1/self.lambda0 * np.log(1 - unif_sample) / denom
-
-        sampled_idx = sample_multinomial(hazard_weights)
-        mutate_pos = mutate_positions[sampled_idx]
-        mutate_feat_idx = feature_vec_dict[mutate_pos]
-        nucleotide_target_idx = sample_multinomial(
-            self.probability_matrix[mutate_feat_idx,:].sum(axis=0)
-        )
-        return mutate_time_delta, mutate_pos, NUCLEOTIDES[nucleotide_target_idx]
+    def _get_motif_target_hazards(self, feat_idxs, nucleotide):
+        target_probs = self.probability_matrix[feat_idxs,:].sum(axis=0)
+        return np.exp(self.thetas[feat_idxs,0].sum()) * target_probs/target_probs.sum()
+
+    def _get_position_hazard_ratio(self, pos):
+        return np.exp(np.sum(self.pos_risk[pos]))
+
+class SimulationWorker(ParallelWorker):
+    """
+    Simulates mutations for one sequence
+    """
+    def __init__(self, seed, seq_idx, start_seq, simulate_kwargs):
+        """
+        @param seed: seed for this sequence
+        @param seq_idx: index of the sequence, returned with the result so results can be put back in order
+        @param start_seq: the original sequence
+        @param simulate_kwargs: dictionary with the other arguments to SurvivalModelSimulator.simulate
+        """
+        self.seed = seed
+        self.seq_idx = seq_idx
+        self.start_seq = start_seq
+        self.simulate_kwargs = simulate_kwargs
+
+    def run_worker(self, simulator):
+        """
+        @param simulator: SurvivalModelSimulator
+        @return tuple with the sequence index and FullSequenceMutations
+        """
+        return self.seq_idx, simulator.simulate(self.start_seq, **self.simulate_kwargs)
+
+    def __str__(self):
+        return "SimulationWorker %d: %s" % (self.seq_idx, self.start_seq)
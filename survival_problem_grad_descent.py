@@ -10,6 +10,7 @@ from survival_problem_grad_descent_workers import *
 from common import *
 from parallel_worker import MultiprocessingManager
 from profile_support import profile
+from perf_registry import perf_timed, perf_count
 
 class SurvivalProblemCustom(SurvivalProblem):
     """
@@ -17,13 +18,15 @@ class SurvivalProblemCustom(SurvivalProblem):
     """
     print_iter = 10 # print status every `print_iter` iterations
 
-    def __init__(self, feat_generator, samples, sample_labels=None, penalty_params=[0], per_target_model=False, possible_theta_mask=None, zero_theta_mask=None, fuse_windows=[], fuse_center_only=False, pool=None):
+    def __init__(self, feat_generator, samples, sample_labels=None, penalty_params=[0], per_target_model=False, possible_theta_mask=None, zero_theta_mask=None, fuse_windows=[], fuse_center_only=False, pool=None, sample_weights=None):
         """
         @param feat_generator: CombinedFeatureGenerator
         @param samples: observations to compute gradient descent problem
         @param sample_labels: only used for calculating the Hessian
         @param possible_theta_mask: these theta values are some finite number
         @param zero_theta_mask: these theta values are forced to be zero
+        @param sample_weights: importance weights of the samples. The weights of the samples for the same observation
+                            should sum to the number of samples for that observation. If None, all weights are one.
         """
         assert(isinstance(feat_generator, CombinedFeatureGenerator))
         self.feature_generator = feat_generator
@@ -34,6 +37,7 @@ class SurvivalProblemCustom(SurvivalProblem):
             self.theta_mask_flat = (possible_theta_mask & ~zero_theta_mask).reshape((zero_theta_mask.size,), order="F")
 
         self.num_samples = len(self.samples)
+        self.set_sample_weights(sample_weights)
         self.sample_labels = sample_labels
         if self.sample_labels is not None:
             assert(len(self.sample_labels) == self.num_samples)
@@ -58,6 +62,7 @@ class SurvivalProblemCustom(SurvivalProblem):
         """
         raise NotImplementedError()
 
+    @perf_timed("precalc_time")
     def _create_precalc_data_parallel(self, samples):
         """
         calculate the precalculated data for each sample in parallel
@@ -81,7 +86,27 @@ class SurvivalProblemCustom(SurvivalProblem):
         """
         raise NotImplementedError()
 
+    def set_sample_weights(self, sample_weights):
+        """
+        @param sample_weights: importance weights of the samples (see __init__), None if unweighted
+        """
+        self.sample_weights = None
+        if sample_weights is not None:
+            assert(len(sample_weights) == self.num_samples)
+            self.sample_weights = np.array(sample_weights, dtype=float)
+
+    def _get_weighted_sum(self, vals):
+        """
+        @param vals: vector of values for each sample
+        @return the (importance-weighted) sum of the values
+        """
+        if self.sample_weights is None:
+            return vals.sum()
+        return vals.dot(self.sample_weights)
+
     def _group_log_lik_ratio_vec(self, ll_ratio_vec):
+        if self.sample_weights is not None:
+            ll_ratio_vec = ll_ratio_vec * self.sample_weights
         num_unique_samples = len(set(self.sample_labels))
         # Reshape the log likelihood ratio vector
         ll_ratio_dict = [[] for _ in range(num_unique_samples)]
@@ -105,6 +130,37 @@ class SurvivalProblemCustom(SurvivalProblem):
         else:
             return ll_ratio_vec
 
+    def get_log_lik_vec(self, theta):
+        """
+        @param theta: the theta to calculate the likelihood for
+        @return vector of log likelihood values for each e-step sample
+        """
+        return self._get_log_lik_parallel(theta)
+
+    def get_log_lik_vecs(self, thetas):
+        """
+        Evaluates all the thetas together, which costs about the same as evaluating one of them
+
+        @param thetas: list of thetas, all with the same shape
+        @return list with the vector of log likelihood values of each theta
+        """
+        ll_matrix = self._get_log_lik_parallel(np.dstack(thetas))
+        return [ll_matrix[:,i] for i in range(len(thetas))]
+
+    def calculate_log_lik_ratio_vecs(self, thetas, ref_log_lik_vec, group_by_sample=False):
+        """
+        @param thetas: list of thetas in the numerator, all with the same shape
+        @param ref_log_lik_vec: the log likelihoods of the theta in the denominator, from get_log_lik_vec
+        @return list with the log likelihood ratios between each theta and the reference theta for each e-step sample
+        """
+        ll_ratio_vecs = []
+        for ll_vec in self.get_log_lik_vecs(thetas):
+            ll_ratio_vec = ll_vec - ref_log_lik_vec
+            if group_by_sample:
+                ll_ratio_vec = self._group_log_lik_ratio_vec(ll_ratio_vec)
+            ll_ratio_vecs.append(ll_ratio_vec)
+        return ll_ratio_vecs
+
     def _run_processes(self, worker_list, shared_obj=None, pool=None):
         """
         Run parallel workers
@@ -125,9 +181,10 @@ class SurvivalProblemCustom(SurvivalProblem):
         """
         NOTE: parallel not faster if not a lot of a data
 
-        @param theta: the theta to calculate the likelihood for
-        @return vector of log likelihood values
+        @param theta: the theta to calculate the likelihood for, or a stack of thetas along a third axis
+        @return vector of log likelihood values, or a matrix with a column for each theta in the stack
         """
+        perf_count("num_log_lik_evals")
         worker_list = [
             LogLikelihoodWorker(s, self.per_target_model) for s in self.precalc_data
         ]
@@ -138,12 +195,15 @@ class SurvivalProblemCustom(SurvivalProblem):
 
         return np.array(log_liks)
 
+    @perf_timed("hessian_time")
     def get_hessian(self, theta):
         """
         Uses Louis's method to calculate the information matrix of the observed data
 
         @return fishers information matrix of the observed data, hessian of the log likelihood of the complete data
         """
+        assert(self.sample_weights is None)
+
         def _get_parallel_sum(worker_list, shared_obj=None):
             res_list = self._run_processes(worker_list, shared_obj, pool=self.pool)
             assert not any([r is None for r in res_list])
@@ -221,13 +281,18 @@ class SurvivalProblemCustom(SurvivalProblem):
 
         Calculate the gradient of the negative log likelihood
         """
+        perf_count("num_grad_evals")
         if self.pool is not None:
-            batched_data = get_batched_list(self.precalc_data, self.pool._processes * 2)
+            batched_idxs = get_batched_list(range(self.num_samples), self.pool._processes * 2)
         else:
-            batched_data = [self.precalc_data]
+            batched_idxs = [range(self.num_samples)]
         worker_list = [
-            GradientWorker(batch, self.per_target_model)
-            for batch in batched_data
+            GradientWorker(
+                [self.precalc_data[j] for j in idxs],
+                self.per_target_model,
+                None if self.sample_weights is None else self.sample_weights[idxs],
+            )
+            for idxs in batched_idxs
         ]
         grad_ll_raw = self._run_processes(
                 worker_list,
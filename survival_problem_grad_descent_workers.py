@@ -1,6 +1,7 @@
 import time
 import numpy as np
 import scipy as sp
+import scipy.linalg
 from scipy.sparse import csr_matrix, dok_matrix
 
 from parallel_worker import ParallelWorker
@@ -117,13 +118,15 @@ class GradientWorker(ParallelWorker):
     """
     Stores the information for calculating gradient
     """
-    def __init__(self, sample_data, per_target_model):
+    def __init__(self, sample_data, per_target_model, sample_weights=None):
         """
         @param sample_data: list of SamplePrecalcData
+        @param sample_weights: importance weights for each sample in sample_data, None if unweighted
         """
         self.seed = 0
         self.sample_data = sample_data
         self.per_target_model = per_target_model
+        self.sample_weights = sample_weights
 
     def run_worker(self, theta):
         """
@@ -134,8 +137,11 @@ class GradientWorker(ParallelWorker):
         @param theta: the theta to evaluate the gradient at
         """
         grad = 0
-        for s in self.sample_data:
-            grad += self._get_gradient(s, theta)
+        for i, s in enumerate(self.sample_data):
+            if self.sample_weights is None:
+                grad += self._get_gradient(s, theta)
+            else:
+                grad += self.sample_weights[i] * self._get_gradient(s, theta)
         return grad
 
     def _get_gradient(self, sample_dat, theta):
@@ -178,25 +184,43 @@ class LogLikelihoodWorker(ParallelWorker):
     def run_worker(self, theta):
         """
         Calculate the log likelihood of this sample
+
+        @param theta: the theta to evaluate the log likelihood at, or a stack of K thetas along a third axis
+                    (see np.dstack) to evaluate them all at once
+        @return the log likelihood, or a vector with the log likelihood for each theta in the stack
         """
-        merged_thetas = theta[:,0, None]
+        if theta.ndim == 2:
+            return self._get_log_liks(theta[:,:,None])[0]
+        return self._get_log_liks(theta)
+
+    def _get_log_liks(self, theta_stack):
+        """
+        The thetas in the stack are merged into one matrix with a column per theta (and target nucleotide),
+        so each mutation step is a single sparse-by-dense product for all the thetas.
+        """
+        num_thetas = theta_stack.shape[2]
+        merged_thetas = theta_stack[:,0,:]
         if self.per_target_model:
-            merged_thetas = merged_thetas + theta[:,1:]
-        prev_denom = (np.exp(self.sample_data.obs_seq_mutation.feat_matrix_start.dot(merged_thetas))).sum()
+            merged_thetas = (theta_stack[:,0:1,:] + theta_stack[:,1:,:]).reshape((theta_stack.shape[0], -1))
+        # Sums the columns of exp(psi * theta) for each theta
+        def _sum_per_theta(exp_thetas):
+            return exp_thetas.sum(axis=0).reshape((-1, num_thetas)).sum(axis=0)
+
+        prev_denom = _sum_per_theta(np.exp(self.sample_data.obs_seq_mutation.feat_matrix_start.dot(merged_thetas)))
         denominators = [prev_denom]
         for pos_feat_matrix, features_sign_update in zip(self.sample_data.features_per_step_matrices, self.sample_data.features_sign_updates):
             exp_thetas = np.exp(pos_feat_matrix.dot(merged_thetas))
             signed_exp_thetas = np.multiply(exp_thetas, features_sign_update)
-            new_denom = prev_denom + signed_exp_thetas.sum()
+            new_denom = prev_denom + _sum_per_theta(signed_exp_thetas)
             denominators.append(new_denom)
             prev_denom = new_denom
 
-        numerators = theta[self.sample_data.mutating_pos_feat_vals_rows, 0]
+        numerators = theta_stack[self.sample_data.mutating_pos_feat_vals_rows, 0, :]
         if self.per_target_model:
-            numerators = numerators + theta[self.sample_data.mutating_pos_feat_vals_rows, self.sample_data.mutating_pos_feat_vals_cols]
+            numerators = numerators + theta_stack[self.sample_data.mutating_pos_feat_vals_rows, self.sample_data.mutating_pos_feat_vals_cols, :]
 
-        log_lik = numerators.sum() - np.log(denominators).sum()
-        return log_lik
+        log_liks = numerators.sum(axis=0) - np.log(denominators).sum(axis=0)
+        return log_liks
 
 class HessianWorker(ParallelWorker):
     """
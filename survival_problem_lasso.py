@@ -27,7 +27,7 @@ class SurvivalProblemLasso(SurvivalProblemProximal):
         @return tuple: negative penalized log likelihood and array of log likelihoods
         """
         log_lik_vec = self._get_log_lik_parallel(theta)
-        neg_log_lik = -1.0/self.num_samples * log_lik_vec.sum()
+        neg_log_lik = -1.0/self.num_samples * self._get_weighted_sum(log_lik_vec)
         if self.possible_theta_mask is None:
             return neg_log_lik, log_lik_vec
         else:
@@ -3,6 +3,7 @@ import numpy as np
 import scipy as sp
 import logging as log
 from profile_support import profile
+from perf_registry import perf_count
 
 from common import *
 from survival_problem_grad_descent import SurvivalProblemCustom
@@ -58,6 +59,7 @@ class SurvivalProblemProximal(SurvivalProblemCustom):
         current_value = init_value
 
         for i in range(max_iters):
+            perf_count("num_m_iters")
             if i % self.print_iter == 0:
                 log.info("PROX iter %d, val %f, time %f" % (i, current_value, time.time() - st))
                 if ase is not None and ess is not None:
@@ -79,6 +81,7 @@ class SurvivalProblemProximal(SurvivalProblemCustom):
                 elif step_size * expected_decrease < self.min_diff_thres:
                     break
                 step_size *= step_size_shrink
+                perf_count("num_line_search_shrinks")
                 log.info("PROX step size shrink %f" % step_size)
                 potential_theta = theta - step_size * grad
                 # Do proximal gradient step
@@ -1,2 +1,4 @@
 INPUT_GENES = "test/data/genes.csv"
 INPUT_SEQS = "test/data/seqs.csv"
+PARTIS_ANNOTATIONS = "test/data/partis"
+PARTIS_METADATA = "test/data/partis/meta.csv"
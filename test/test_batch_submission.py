@@ -0,0 +1,145 @@
+import unittest
+import os
+import shutil
+import numpy as np
+from multiprocessing import Pool
+
+import custom_utils
+import parallel_worker
+import sampler_collection
+from parallel_worker import BatchSubmissionManager, BatchParallelWorkers, PickledObjectRef, MultiprocessingManager
+from sampler_collection import SamplerCollection, SamplerPoolWorker, SamplerPoolWorkerShared, ObservedDataDump
+from mutation_order_gibbs import MutationOrderGibbsSampler
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from read_data import read_gene_seq_csv_data
+from constants import *
+from sampling_utils import set_random_seed
+
+class BatchSubmission_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = 'test/_output/batch_submission'
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+        os.makedirs(cls.scratch_dir)
+
+        cls.feat_generator = HierarchicalMotifFeatureGenerator(motif_lens=[3])
+        obs_data, _ = read_gene_seq_csv_data(INPUT_GENES, INPUT_SEQS, motif_len=3)
+        cls.obs_data = obs_data[:5]
+        for obs_seq_mutation in cls.obs_data:
+            cls.feat_generator.add_base_features(obs_seq_mutation)
+
+    def test_job_files(self):
+        set_random_seed(0)
+        theta = np.random.randn(self.feat_generator.feature_vec_len, 1) * 0.1
+        sampler_collection = SamplerCollection(
+            self.obs_data,
+            theta,
+            MutationOrderGibbsSampler,
+            self.feat_generator,
+            num_jobs=2,
+            scratch_dir=self.scratch_dir,
+        )
+        # The observed data is written once, split like the batches of workers
+        obs_data_refs = sampler_collection._get_observed_data_for_workers()
+        self.assertTrue(sampler_collection._get_observed_data_for_workers() is obs_data_refs)
+        self.assertEqual(len(set([ref.file_name for ref in obs_data_refs])), 2)
+        for obs_seq_mutation, ref in zip(self.obs_data, obs_data_refs):
+            self.assertTrue(isinstance(ref, PickledObjectRef))
+            self.assertEqual(ref.get().start_seq, obs_seq_mutation.start_seq)
+
+        # Run the jobs of the sampler workers without a batch system
+        shared_obj = SamplerPoolWorkerShared(MutationOrderGibbsSampler, theta, self.feat_generator, 2, 0, 1, 5, False)
+        worker_list = [
+            SamplerPoolWorker(i, obs_data_ref, obs_seq.mutation_pos_dict.keys())
+            for i, (obs_data_ref, obs_seq) in enumerate(zip(obs_data_refs, self.obs_data))
+        ]
+        worker_folder = os.path.join(self.scratch_dir, "gibbs_workers")
+        manager = BatchSubmissionManager(worker_list, shared_obj, 2, worker_folder)
+        # The shared object is written once for all the jobs
+        self.assertTrue(os.path.exists(os.path.join(worker_folder, "shared.pkl")))
+        custom_utils.run_cmds(manager.batch_worker_cmds, batch_system=None)
+        sampler_results = manager.read_batch_worker_results()
+
+        self.assertEqual(len(sampler_results), len(self.obs_data))
+        for obs_seq_mutation, res in zip(self.obs_data, sampler_results):
+            self.assertEqual(len(res.samples), 2)
+            self.assertEqual(res.samples[0].obs_seq_mutation.start_seq, obs_seq_mutation.start_seq)
+
+    def test_observed_data_dump(self):
+        theta = np.zeros((self.feat_generator.feature_vec_len, 1))
+        def _make_collection(observed_data_dump=None):
+            return SamplerCollection(
+                self.obs_data,
+                theta,
+                MutationOrderGibbsSampler,
+                self.feat_generator,
+                num_jobs=2,
+                scratch_dir=self.scratch_dir,
+                observed_data_dump=observed_data_dump,
+            )
+
+        # A collection removes its own copy of the observed data when it is closed
+        sampler_collection = _make_collection()
+        obs_data_refs = sampler_collection._get_observed_data_for_workers()
+        dump_dir = os.path.dirname(obs_data_refs[0].file_name)
+        self.assertTrue(os.path.exists(dump_dir))
+        sampler_collection.close()
+        self.assertFalse(os.path.exists(dump_dir))
+
+        # Collections that share a dump use the same files, and do not remove them when they are closed
+        observed_data_dump = ObservedDataDump(self.obs_data, 2, self.scratch_dir)
+        first_collection = _make_collection(observed_data_dump)
+        first_refs = first_collection._get_observed_data_for_workers()
+        first_collection.close()
+        second_refs = _make_collection(observed_data_dump)._get_observed_data_for_workers()
+        self.assertEqual([ref.file_name for ref in first_refs], [ref.file_name for ref in second_refs])
+        self.assertEqual(second_refs[0].get().start_seq, self.obs_data[0].start_seq)
+        observed_data_dump.remove()
+        self.assertFalse(os.path.exists(observed_data_dump.dump_dir))
+        self.assertFalse(second_refs[0].file_name in parallel_worker._LOADED_PICKLES)
+
+    def test_evict_loaded_pickles(self):
+        theta = np.zeros((self.feat_generator.feature_vec_len, 1))
+        observed_data_dump = ObservedDataDump(self.obs_data, 2, self.scratch_dir)
+        obs_data_refs = observed_data_dump.get_refs()
+        shared_obj = SamplerPoolWorkerShared(MutationOrderGibbsSampler, theta, self.feat_generator, 1, 0, 1, 5, False)
+        worker_list = [
+            SamplerPoolWorker(i, obs_data_ref, obs_seq.mutation_pos_dict.keys())
+            for i, (obs_data_ref, obs_seq) in enumerate(zip(obs_data_refs, self.obs_data))
+        ]
+        # The observed data that a batch loads is not kept in memory after the batch is done
+        results = BatchParallelWorkers(worker_list, shared_obj).run()
+        self.assertEqual(len(results), len(self.obs_data))
+        for ref in obs_data_refs:
+            self.assertFalse(ref.file_name in parallel_worker._LOADED_PICKLES)
+        observed_data_dump.remove()
+
+    def test_pool_batches(self):
+        """
+        With a pool, the workers are split into a couple of batches per process, since the shared object
+        is pickled with every batch
+        """
+        theta = np.random.randn(self.feat_generator.feature_vec_len, 1) * 0.1
+        init_orders = [obs_seq.mutation_pos_dict.keys() for obs_seq in self.obs_data]
+        num_batches = []
+        class _CountingManager(MultiprocessingManager):
+            def run(self):
+                num_batches.append(len(self.batched_workers_list))
+                return MultiprocessingManager.run(self)
+
+        pool = Pool(1)
+        sampler_collection.MultiprocessingManager = _CountingManager
+        try:
+            collection = SamplerCollection(self.obs_data, theta, MutationOrderGibbsSampler, self.feat_generator, pool=pool)
+            results = collection.get_samples(init_orders, num_samples=2)
+        finally:
+            sampler_collection.MultiprocessingManager = MultiprocessingManager
+            pool.close()
+        # about two batches for the one process, rather than one per observation
+        self.assertEqual(len(num_batches), 1)
+        self.assertTrue(num_batches[0] < len(self.obs_data))
+        self.assertEqual(len(results), len(self.obs_data))
+        for obs_seq_mutation, res in zip(self.obs_data, results):
+            self.assertEqual(len(res.samples), 2)
+            self.assertEqual(sorted(res.samples[0].mutation_order), sorted(obs_seq_mutation.mutation_pos_dict.keys()))
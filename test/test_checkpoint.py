@@ -0,0 +1,88 @@
+import unittest
+import os
+import shutil
+import numpy as np
+
+from checkpoint import EMCheckpoint
+from mcmc_em import MCMC_EM
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from mutation_order_gibbs import MutationOrderGibbsSampler
+from survival_problem_lasso import SurvivalProblemLasso
+from read_data import read_gene_seq_csv_data
+from sampling_utils import set_random_seed, UNIFORM_BUFFER
+from constants import *
+
+class Checkpoint_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = 'test/_output/checkpoint'
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+        os.makedirs(cls.scratch_dir)
+
+    def test_em_checkpoint(self):
+        checkpoint = EMCheckpoint(os.path.join(self.scratch_dir, 'em'))
+        set_random_seed(0, buffer_uniforms=True)
+        UNIFORM_BUFFER.draw()
+        theta = np.random.randn(5, 1)
+        init_orders = [[2, 0, 1], [], [4]]
+        checkpoint.save(3, theta, init_orders, [["trace0"], ["trace1"]])
+        checkpoint.save(4, theta, init_orders, [["trace0"], ["trace1"], ["trace2"]])
+        draws = UNIFORM_BUFFER.draw_many(3).tolist() + np.random.rand(2).tolist()
+
+        # Loading restores the random number generator
+        em_iter, loaded_theta, loaded_orders, traces = EMCheckpoint(os.path.join(self.scratch_dir, 'em')).load()
+        self.assertEqual(em_iter, 4)
+        self.assertTrue(np.array_equal(loaded_theta, theta))
+        self.assertEqual(loaded_orders, init_orders)
+        self.assertEqual(traces, [["trace0"], ["trace1"], ["trace2"]])
+        self.assertEqual(UNIFORM_BUFFER.draw_many(3).tolist() + np.random.rand(2).tolist(), draws)
+        UNIFORM_BUFFER.disable()
+
+    def test_resume_mcmc_em(self):
+        """
+        An interrupted MCMC-EM that resumes from its checkpoint ends at the same theta as one that was not interrupted
+        """
+        feat_generator = HierarchicalMotifFeatureGenerator(motif_lens=[3])
+        obs_data, _ = read_gene_seq_csv_data(INPUT_GENES, INPUT_SEQS, motif_len=3)
+        obs_data = obs_data[:20]
+        for obs_seq_mutation in obs_data:
+            feat_generator.add_base_features(obs_seq_mutation)
+        theta_shape = (feat_generator.feature_vec_len, 1)
+        possible_theta_mask = np.ones(theta_shape, dtype=bool)
+        zero_theta_mask = np.zeros(theta_shape, dtype=bool)
+
+        def _run_em(max_em_iters, checkpoint):
+            em_algo = MCMC_EM(
+                MutationOrderGibbsSampler,
+                SurvivalProblemLasso,
+                base_num_e_samples=4,
+                max_m_iters=20,
+                scratch_dir=self.scratch_dir,
+            )
+            set_random_seed(1)
+            theta, _, _, traces = em_algo.run(
+                obs_data,
+                feat_generator,
+                np.zeros(theta_shape),
+                penalty_params=(0.01, 0),
+                possible_theta_mask=possible_theta_mask,
+                zero_theta_mask=zero_theta_mask,
+                max_em_iters=max_em_iters,
+                diff_thres=-np.inf,
+                max_e_samples=4,
+                checkpoint=checkpoint,
+            )
+            return theta, traces
+
+        theta, traces = _run_em(3, None)
+
+        checkpoint = EMCheckpoint(os.path.join(self.scratch_dir, 'em_resume'))
+        checkpoint.clear()
+        interrupted_theta, _ = _run_em(2, checkpoint)
+        self.assertFalse(np.array_equal(theta, interrupted_theta))
+        # The checkpoint is at the start of the last iteration; resume from there
+        resumed_theta, resumed_traces = _run_em(3, EMCheckpoint(checkpoint.checkpoint_dir))
+        self.assertTrue(np.array_equal(theta, resumed_theta))
+        self.assertEqual(len(traces), 3)
+        self.assertEqual(len(traces), len(resumed_traces))
@@ -6,11 +6,13 @@ from models import ObservedSequenceMutations
 from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from likelihood_evaluator import LogLikelihoodEvaluator
 from mutation_order_gibbs import MutationOrderGibbsSampler
+from mutation_order_chibs import MutationOrderChibsSampler
+from sampling_utils import set_random_seed
 
 class Chibs_TestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        np.random.seed(1)
+        set_random_seed(1)
         cls.motif_len = 3
         cls.burn_in = 10
 
@@ -34,6 +36,42 @@ class Chibs_TestCase(unittest.TestCase):
             ObservedSequenceMutations("attcgta", "attagta", self.motif_len)
         )
 
+    def test_chibs_parallel_stages(self):
+        """
+        Check that running the conditional stages of all observations together gives the same estimate
+        """
+        obs_seq_m = ObservedSequenceMutations("attacacgta", "attgggggta", self.motif_len)
+        self.feat_gen.add_base_features(obs_seq_m)
+        val_set_evaluator = LogLikelihoodEvaluator([obs_seq_m], self.feat_gen)
+        sequential_ll = val_set_evaluator.get_log_lik(self.theta, num_samples=4000, burn_in=self.burn_in)
+        parallel_ll = val_set_evaluator.get_log_lik(self.theta, num_samples=4000, burn_in=self.burn_in, parallel_stages=True)
+        self.assertTrue(np.abs(sequential_ll - parallel_ll) < 0.1)
+
+        # Raises if the conditional stages are never estimated
+        with self.assertRaises(ValueError):
+            val_set_evaluator.get_log_lik(self.theta, num_samples=10, burn_in=self.burn_in, num_tries=0, parallel_stages=True)
+
+    def test_proportion_agrees(self):
+        """
+        Check the vectorized proportion of agreements against a direct count
+        """
+        obs_seq_m = ObservedSequenceMutations("attacacgta", "attgggggta", self.motif_len)
+        self.feat_gen.add_base_features(obs_seq_m)
+        gibbs_sampler = MutationOrderGibbsSampler(self.theta, self.feat_gen, obs_seq_m)
+        samples = gibbs_sampler.run(obs_seq_m.mutation_pos_dict.keys(), self.burn_in, 100).samples
+        for pos1 in obs_seq_m.mutation_pos_dict.keys():
+            for pos2 in obs_seq_m.mutation_pos_dict.keys():
+                if pos1 == pos2:
+                    continue
+                num_agrees = [
+                    s.mutation_order.index(pos1) < s.mutation_order.index(pos2)
+                    for s in samples
+                ]
+                self.assertEqual(
+                    MutationOrderChibsSampler._get_proportion_agrees(samples, [pos1, pos2]),
+                    np.mean(num_agrees),
+                )
+
     def _test_chibs_for_obs_seq_mut(self, obs_seq_mut):
         obs_seq_m = obs_seq_mut
         self.feat_gen.add_base_features(obs_seq_m)
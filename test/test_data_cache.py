@@ -0,0 +1,91 @@
+import unittest
+import os
+import shutil
+import glob
+import numpy as np
+
+from data_cache import read_obs_data_cached
+from read_data import read_gene_seq_csv_data_bulk
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from test.constants import INPUT_GENES, INPUT_SEQS
+from sampling_utils import set_random_seed
+
+class DataCache_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        set_random_seed(1)
+        cls.cache_dir = 'test/_output/data_cache'
+        cls.feat_gen = HierarchicalMotifFeatureGenerator(motif_lens=[3,5], left_motif_flank_len_list=[[1],[2,3]])
+
+    def setUp(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def _read_data(self, motif_len=5, left_flank_len=3, right_flank_len=2, feat_gen=None, read_func=None):
+        if read_func is None:
+            read_func = lambda: [read_gene_seq_csv_data_bulk(INPUT_GENES, INPUT_SEQS, motif_len, left_flank_len, right_flank_len)]
+        return read_obs_data_cached(
+            self.cache_dir,
+            [INPUT_GENES, INPUT_SEQS],
+            read_func,
+            motif_len,
+            left_flank_len,
+            right_flank_len,
+            feat_generator=feat_gen,
+        )
+
+    def _check_same_data(self, obs_data, metadata, cached_obs_data, cached_metadata):
+        theta = np.random.rand(self.feat_gen.feature_vec_len, 1)
+        self.assertEqual(metadata, cached_metadata)
+        self.assertEqual(len(obs_data), len(cached_obs_data))
+        for obs, cached_obs in zip(obs_data, cached_obs_data):
+            for attr in ["start_seq_with_flanks", "end_seq_with_flanks", "mutation_pos_dict", "mutated_indicator", "skipped_mutations", "left_position_offset", "right_position_offset", "raw_pos", "collapse_list", "motif_len"]:
+                self.assertEqual(getattr(obs, attr), getattr(cached_obs, attr))
+            self.assertEqual((obs.feat_matrix_start != cached_obs.feat_matrix_start).nnz, 0)
+            self.assertTrue(np.allclose(obs.feat_matrix_start.dot(theta), cached_obs.feat_matrix_start.dot(theta)))
+
+    def test_cache(self):
+        obs_data, metadata = self._read_data(feat_gen=self.feat_gen)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        cached_obs_data, cached_metadata = self._read_data(feat_gen=self.feat_gen)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self._check_same_data(obs_data, metadata, cached_obs_data, cached_metadata)
+
+        # Different settings should not use the same cache entry
+        self._read_data(feat_gen=None)
+        self._read_data(motif_len=3, left_flank_len=1, right_flank_len=1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_cache_chunks(self):
+        """
+        The chunks are written to the cache as they are read, and give the same cache as reading everything at once
+        """
+        obs_data, metadata = read_gene_seq_csv_data_bulk(INPUT_GENES, INPUT_SEQS, 5, 3, 2)
+        self.feat_gen.add_base_features_for_list(obs_data)
+        chunk_size = 7
+        def read_chunks():
+            for start_idx in range(0, len(obs_data), chunk_size):
+                yield obs_data[start_idx:start_idx + chunk_size], metadata[start_idx:start_idx + chunk_size]
+                # The chunk is already in the temporary cache directory
+                tmp_path, = glob.glob(os.path.join(self.cache_dir, "*.tmp*"))
+                self.assertEqual(
+                    os.path.getsize(os.path.join(tmp_path, "start_seqs.raw")),
+                    sum([len(obs.start_seq_with_flanks) for obs in obs_data[:start_idx + chunk_size]]),
+                )
+            # An empty chunk does not change anything
+            yield [], []
+
+        cached_obs_data, cached_metadata = self._read_data(feat_gen=self.feat_gen, read_func=read_chunks)
+        cache_entries = os.listdir(self.cache_dir)
+        self.assertEqual(len(cache_entries), 1)
+        self.assertNotIn(".tmp", cache_entries[0])
+        self._check_same_data(obs_data, metadata, cached_obs_data, cached_metadata)
+
+        # A failed read leaves no cache entry behind
+        shutil.rmtree(self.cache_dir)
+        def read_failed_chunks():
+            yield obs_data[:chunk_size], metadata[:chunk_size]
+            raise ValueError("Failed to read")
+        with self.assertRaises(ValueError):
+            self._read_data(feat_gen=self.feat_gen, read_func=read_failed_chunks)
+        self.assertEqual(os.listdir(self.cache_dir), [])
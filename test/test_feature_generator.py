@@ -4,13 +4,14 @@ import time
 from motif_feature_generator import MotifFeatureGenerator
 from models import *
 from common import *
+from sampling_utils import set_random_seed
 
 class FeatureGeneratorTestCase(unittest.TestCase):
     def test_time(self):
         """
         Just a test to see how fast things are running
         """
-        np.random.seed(0)
+        set_random_seed(0)
 
         motif_len = 3
         seq_length = 400
@@ -0,0 +1,101 @@
+import unittest
+import os
+import shutil
+
+from fold_penalty_scheduler import FoldPenaltyScheduler
+from parallel_worker import ParallelWorker
+
+class ChainWorker(ParallelWorker):
+    """
+    Adds one to the value of the previous task in its fold
+    """
+    def __init__(self, seed, param_idx, prev_value, fail=False, crash=False):
+        self.seed = seed
+        self.param_idx = param_idx
+        self.prev_value = prev_value
+        self.fail = fail
+        self.crash = crash
+
+    def run_worker(self, pool=None):
+        if self.fail:
+            raise ValueError("failed on purpose")
+        if self.crash:
+            # Exit without reporting back, like a process that is killed
+            os._exit(1)
+        num_threads = pool._processes if pool is not None else 1
+        return self.prev_value + 1, num_threads, os.getpid()
+
+    def __str__(self):
+        return "ChainWorker %d" % self.seed
+
+class FoldPenaltyScheduler_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = 'test/_output/fold_penalty_scheduler'
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+
+    def _run(self, scheduler, start_param_idxs=None, prune_after=None, fail_task=None, crash_task=None, prev_results={}):
+        results = dict(prev_results)
+        def _make_worker(param_idx, fold_idx):
+            prev_value = results[(param_idx - 1, fold_idx)][0] if param_idx else 0
+            return ChainWorker(
+                fold_idx,
+                param_idx,
+                prev_value,
+                fail=(param_idx, fold_idx) == fail_task,
+                crash=(param_idx, fold_idx) == crash_task,
+            )
+        for param_idx, fold_idx, result in scheduler.run(_make_worker, start_param_idxs):
+            results[(param_idx, fold_idx)] = result
+            if prune_after is not None:
+                scheduler.prune(prune_after)
+        return results
+
+    def test_run(self):
+        scheduler = FoldPenaltyScheduler(3, 3, 4, self.scratch_dir)
+        results = self._run(scheduler)
+        self.assertEqual(sorted(results.keys()), [(p, f) for p in range(3) for f in range(3)])
+        for (param_idx, fold_idx), (value, num_threads, pid) in results.iteritems():
+            # Each task starts from the result of the previous penalty parameter
+            self.assertEqual(value, param_idx + 1)
+            self.assertTrue(num_threads >= 1)
+            self.assertNotEqual(pid, os.getpid())
+        # The first tasks of the folds share all the cores
+        self.assertEqual(sum([results[(0, f)][1] for f in range(3)]), 4)
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+    def test_prune(self):
+        # The folds still run concurrently with one core: after the first task, only the first penalty parameter is fit
+        scheduler = FoldPenaltyScheduler(2, 3, 1, self.scratch_dir)
+        results = self._run(scheduler, prune_after=0)
+        self.assertEqual(sorted(results.keys()), [(0, 0), (0, 1)])
+        self.assertNotEqual(results[(0, 0)][2], results[(0, 1)][2])
+        self.assertNotEqual(results[(0, 1)][2], os.getpid())
+
+        # One fold, so the tasks run one at a time in this process
+        scheduler = FoldPenaltyScheduler(1, 3, 2, self.scratch_dir)
+        results = self._run(scheduler, prune_after=1)
+        self.assertEqual(sorted(results.keys()), [(0, 0), (1, 0)])
+        self.assertEqual(results[(1, 0)][1:], (2, os.getpid()))
+
+        # Resume the second fold from the last penalty parameter
+        scheduler = FoldPenaltyScheduler(2, 3, 2, self.scratch_dir)
+        results = self._run(scheduler, start_param_idxs=[3, 2], prev_results={(1, 1): (2, 1, None)})
+        self.assertEqual(sorted(results.keys()), [(1, 1), (2, 1)])
+        self.assertEqual(results[(2, 1)][:2], (3, 2))
+
+    def test_failure(self):
+        scheduler = FoldPenaltyScheduler(2, 2, 2, self.scratch_dir)
+        with self.assertRaises(ValueError):
+            self._run(scheduler, fail_task=(1, 0))
+
+        # A task whose process dies is marked as failed instead of waiting for it forever
+        scheduler = FoldPenaltyScheduler(2, 2, 2, self.scratch_dir, poll_interval=0.1)
+        with self.assertRaises(ValueError):
+            self._run(scheduler, crash_task=(0, 1))
+
+        # Failures are also raised when the tasks run in this process
+        scheduler = FoldPenaltyScheduler(1, 2, 4, self.scratch_dir)
+        with self.assertRaises(ValueError):
+            self._run(scheduler, fail_task=(1, 0))
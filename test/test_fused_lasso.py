@@ -8,11 +8,12 @@ from common import *
 
 from motif_feature_generator import MotifFeatureGenerator
 import solver_wrappers
+from sampling_utils import set_random_seed
 
 class Fused_LassoC_TestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        np.random.seed(10)
+        set_random_seed(10)
         cls.motif_len = 5
         feat_gen = MotifFeatureGenerator(motif_len=cls.motif_len)
         cls.feature_vec_len = feat_gen.feature_vec_len
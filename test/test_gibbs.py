@@ -188,6 +188,7 @@ class Gibbs_TestCase(unittest.TestCase):
         """
         Test the joint distributions match for a single column theta (not a per-target-nucleotide model)
         """
+        np.random.seed(2)
         theta = np.random.rand(self.feat_gen.feature_vec_len, 1) * 2
         rho, pval = self._test_joint_distribution(self.feat_gen, theta)
         self.assertTrue(rho > 0.95)
@@ -209,6 +210,7 @@ class Gibbs_TestCase(unittest.TestCase):
             multi_theta[~theta_mask] = -np.inf
             return multi_theta
 
+        np.random.seed(1)
         multi_theta = _make_multi_theta(self.feat_gen)/2
         rho, pval = self._test_joint_distribution(self.feat_gen, multi_theta)
         self.assertTrue(rho > 0.90)
@@ -8,11 +8,12 @@ from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from mutation_order_gibbs import MutationOrderGibbsSampler
 from survival_problem_grad_descent import SurvivalProblemCustom
 from common import *
+from sampling_utils import set_random_seed
 
 class Hessian_TestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        np.random.seed(1)
+        set_random_seed(1)
         cls.motif_len = 3
         cls.feat_gen = HierarchicalMotifFeatureGenerator(motif_lens=[3])
         cls.feat_gen_hier = HierarchicalMotifFeatureGenerator(motif_lens=[2,3], left_motif_flank_len_list=[[0,1], [1]])
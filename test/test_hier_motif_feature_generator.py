@@ -0,0 +1,103 @@
+import unittest
+import itertools
+import cPickle
+import numpy as np
+
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from motif_feature_generator import MotifFeatureGenerator
+from model_truncation import ModelTruncation
+from common import NUCLEOTIDES, ZSCORE_95, create_theta_idx_mask
+from sampling_utils import set_random_seed
+
+class HierarchicalMotifFeatureGenerator_TestCase(unittest.TestCase):
+    def _brute_force_combine(self, feat_gen, theta, variance_est, col_idx, add_targets):
+        """
+        Combine the thetas by looping over every sub-motif and every flank of it,
+        and get the confidence intervals from the full covariance of the full theta
+        """
+        full_feat_gen = MotifFeatureGenerator(
+            motif_len=feat_gen.motif_len,
+            distance_to_start_of_motif=-feat_gen.max_left_motif_flank_len,
+        )
+        theta_idx_counter = create_theta_idx_mask(
+            feat_gen.model_truncation.zero_theta_mask_refit,
+            feat_gen.get_possible_motifs_to_targets(theta.shape),
+        )
+        full_theta = np.zeros(full_feat_gen.feature_vec_len)
+        agg_matrix = np.zeros((full_feat_gen.feature_vec_len, np.max(theta_idx_counter) + 1))
+        for offset, sub_feat_gen in zip(feat_gen.feat_offsets, feat_gen.feat_gens):
+            for m_idx, m in enumerate(sub_feat_gen.motif_list):
+                raw_theta_idx = offset + m_idx
+                m_theta = theta[raw_theta_idx, col_idx]
+                if col_idx != 0 and add_targets:
+                    m_theta += theta[raw_theta_idx, 0]
+                flanks = itertools.product(NUCLEOTIDES, repeat=feat_gen.motif_len - sub_feat_gen.motif_len)
+                for f in flanks:
+                    full_m = "".join(f[:sub_feat_gen.flank_len_offset]) + m + "".join(f[sub_feat_gen.flank_len_offset:])
+                    full_m_idx = full_feat_gen.motif_dict[full_m]
+                    full_theta[full_m_idx] += m_theta
+                    for c in set([0, col_idx]):
+                        if theta_idx_counter[raw_theta_idx, c] != -1:
+                            agg_matrix[full_m_idx, theta_idx_counter[raw_theta_idx, c]] = 1
+        full_std_err = np.sqrt(np.diag(np.dot(np.dot(agg_matrix, variance_est), agg_matrix.T)))
+        return full_theta, full_theta - ZSCORE_95 * full_std_err, full_theta + ZSCORE_95 * full_std_err
+
+    def test_combine_thetas(self):
+        set_random_seed(0)
+        motif_lens = [3, 5]
+        left_motif_flank_len_list = [[1], [2]]
+        feat_gen = HierarchicalMotifFeatureGenerator(motif_lens=motif_lens, left_motif_flank_len_list=left_motif_flank_len_list)
+
+        # Remove some features and zero out some theta values, like after fitting a penalized model
+        theta = np.random.randn(feat_gen.feature_vec_len, len(NUCLEOTIDES) + 1)
+        theta[np.random.rand(*theta.shape) < 0.3] = 0
+        theta[np.random.choice(feat_gen.feature_vec_len, size=20, replace=False)] = 0
+        theta[~feat_gen.get_possible_motifs_to_targets(theta.shape)] = -np.inf
+        model_truncation = ModelTruncation(theta, feat_gen)
+        feat_gen = HierarchicalMotifFeatureGenerator(
+            motif_lens=motif_lens,
+            model_truncation=model_truncation,
+            left_motif_flank_len_list=left_motif_flank_len_list,
+        )
+        theta = theta[~model_truncation.feats_to_remove_mask]
+        theta[~feat_gen.get_possible_motifs_to_targets(theta.shape)] = 0
+
+        num_est = np.max(create_theta_idx_mask(model_truncation.zero_theta_mask_refit, feat_gen.get_possible_motifs_to_targets(theta.shape))) + 1
+        variance_sqrt = np.random.randn(num_est, num_est)
+        variance_est = np.dot(variance_sqrt, variance_sqrt.T)
+
+        for col_idx in range(theta.shape[1]):
+            for add_targets in [True, False]:
+                full_theta, theta_lower, theta_upper = feat_gen.combine_thetas_and_get_conf_int(
+                    theta,
+                    variance_est=variance_est,
+                    col_idx=col_idx,
+                    add_targets=add_targets,
+                )
+                brute_theta, brute_lower, brute_upper = self._brute_force_combine(feat_gen, theta, variance_est, col_idx, add_targets)
+                self.assertTrue(np.allclose(full_theta, brute_theta))
+                self.assertTrue(np.allclose(theta_lower, brute_lower))
+                self.assertTrue(np.allclose(theta_upper, brute_upper))
+
+        # All the columns are aggregated at once
+        agg_theta = feat_gen.create_aggregate_theta(theta, keep_col0=False)
+        self.assertEqual(agg_theta.shape, (4 ** max(motif_lens), len(NUCLEOTIDES)))
+        for col_idx in range(1, theta.shape[1]):
+            brute_theta, _, _ = self._brute_force_combine(feat_gen, theta, variance_est, col_idx, True)
+            self.assertTrue(np.allclose(agg_theta[:, col_idx - 1], brute_theta))
+
+    def test_pickle_aggregate_theta(self):
+        feat_gen = HierarchicalMotifFeatureGenerator(motif_lens=[3, 5], left_motif_flank_len_list=[[1], [2]])
+        theta = np.random.randn(feat_gen.feature_vec_len, 1)
+        agg_theta = feat_gen.create_aggregate_theta(theta)
+
+        # The aggregation matrix is not pickled, and is rebuilt after unpickling
+        pickled_feat_gen = cPickle.dumps(feat_gen, protocol=cPickle.HIGHEST_PROTOCOL)
+        self.assertTrue(feat_gen.motif_agg_matrix is not None)
+        self.assertTrue(cPickle.loads(pickled_feat_gen).motif_agg_matrix is None)
+        self.assertTrue(np.allclose(cPickle.loads(pickled_feat_gen).create_aggregate_theta(theta), agg_theta))
+
+        # Feature generators pickled before the aggregation matrix was kept do not have the attribute
+        old_feat_gen = cPickle.loads(pickled_feat_gen)
+        del old_feat_gen.motif_agg_matrix
+        self.assertTrue(np.allclose(old_feat_gen.create_aggregate_theta(theta), agg_theta))
@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+
+from likelihood_evaluator import LikelihoodComparer
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from read_data import read_gene_seq_csv_data
+from constants import *
+from sampling_utils import set_random_seed
+
+class LikelihoodComparer_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        set_random_seed(1)
+        cls.feat_generator = HierarchicalMotifFeatureGenerator(motif_lens=[3])
+        obs_data, _ = read_gene_seq_csv_data(INPUT_GENES, INPUT_SEQS, motif_len=3)
+        cls.obs_data = obs_data[:10]
+        for obs_seq_mutation in cls.obs_data:
+            cls.feat_generator.add_base_features(obs_seq_mutation)
+        cls.theta_shape = (cls.feat_generator.feature_vec_len, 1)
+
+    def test_set_reference(self):
+        theta_ref = np.random.randn(*self.theta_shape) * 0.1
+        comparer = LikelihoodComparer(self.obs_data, self.feat_generator, theta_ref, num_samples=4)
+        self.assertEqual(comparer.ess_ratio, 1)
+        self.assertIsNone(comparer.prob.sample_weights)
+
+        # A nearby reference reuses the samples with importance weights
+        new_theta_ref = theta_ref + np.random.randn(*self.theta_shape) * 0.01
+        self.assertTrue(comparer.set_reference(new_theta_ref))
+        self.assertTrue(comparer.sampling_theta is theta_ref)
+        self.assertTrue(comparer.ess_ratio > 0.5 and comparer.ess_ratio <= 1)
+        sample_weights = comparer.prob.sample_weights
+        for label in range(len(self.obs_data)):
+            label_weights = sample_weights[np.array(comparer.sample_labels) == label]
+            self.assertTrue(np.isclose(label_weights.sum(), label_weights.size))
+        ll_ratio, lower_bound, upper_bound = comparer.get_log_likelihood_ratio(new_theta_ref, max_iters=1)
+        self.assertAlmostEqual(ll_ratio, 0)
+
+        # Draws new samples if the weights are degenerate
+        comparer.min_ess_ratio = 1
+        far_theta_ref = np.random.randn(*self.theta_shape) * 2
+        self.assertFalse(comparer.set_reference(far_theta_ref))
+        self.assertTrue(comparer.sampling_theta is far_theta_ref)
+        self.assertIsNone(comparer.prob.sample_weights)
+        self.assertEqual(len(comparer.samples), 4 * len(self.obs_data))
@@ -0,0 +1,69 @@
+import unittest
+import os
+import shutil
+
+from local_worker_fleet import get_local_worker_fleet, shutdown_local_worker_fleet
+from parallel_worker import ParallelWorker, BatchSubmissionManager
+from perf_registry import PerfRegistry
+
+class OffsetWorker(ParallelWorker):
+    """
+    Adds the shared offset to its value. Kills its process the first time if given a crash file.
+    """
+    def __init__(self, seed, value, crash_file=None):
+        self.seed = seed
+        self.value = value
+        self.crash_file = crash_file
+
+    def run_worker(self, offset):
+        if self.crash_file is not None and not os.path.exists(self.crash_file):
+            open(self.crash_file, "w").close()
+            os._exit(1)
+        return self.value + offset
+
+    def __str__(self):
+        return "OffsetWorker %d" % self.value
+
+class LocalWorkerFleet_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = 'test/_output/local_worker_fleet'
+        if os.path.exists(cls.scratch_dir):
+            shutil.rmtree(cls.scratch_dir)
+        os.makedirs(cls.scratch_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_local_worker_fleet()
+
+    def _run(self, worker_list, offset):
+        manager = BatchSubmissionManager(worker_list, offset, 3, self.scratch_dir, backend="local")
+        return manager.run()
+
+    def test_run(self):
+        registry = PerfRegistry()
+        with registry.activate():
+            results = self._run([OffsetWorker(i, i) for i in range(10)], 100)
+        self.assertEqual(results, [i + 100 for i in range(10)])
+        # The shared object and the three batches are sent once each
+        record = registry.records[0]
+        self.assertTrue(record["num_job_bytes_sent"] > 0)
+        self.assertTrue(record["num_job_bytes_received"] > 0)
+        # Nothing is written to the scratch directory
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+        # The worker processes are reused, and get the new shared object
+        fleet = get_local_worker_fleet(3)
+        pids = [proc.pid for proc in fleet.procs]
+        results = self._run([OffsetWorker(i, i) for i in range(5)], -1)
+        self.assertEqual(results, [i - 1 for i in range(5)])
+        self.assertEqual([proc.pid for proc in fleet.procs], pids)
+
+    def test_retry(self):
+        crash_file = os.path.join(self.scratch_dir, "crashed")
+        worker_list = [OffsetWorker(i, i) for i in range(6)]
+        worker_list[4].crash_file = crash_file
+        results = self._run(worker_list, 10)
+        self.assertTrue(os.path.exists(crash_file))
+        self.assertEqual(results, [i + 10 for i in range(6)])
+        os.remove(crash_file)
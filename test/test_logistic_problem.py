@@ -0,0 +1,180 @@
+import unittest
+import numpy as np
+import scipy.sparse
+from multiprocessing import Pool
+
+from logistic_problem_workers import LogisticFoldWorker
+from parallel_worker import MultiprocessingManager
+from logistic_problem_prox import LogisticRegressionMotifProximal, LogisticSufficientStats
+from common import NUM_NUCLEOTIDES
+from sampling_utils import set_random_seed
+
+class LogisticProblem_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        set_random_seed(1)
+        cls.num_feats = 20
+        cls.num_obs = 2000
+        # Each position has one feature from each of two groups, like a hierarchical motif model
+        feat_idxs = np.vstack([
+            np.random.randint(0, cls.num_feats / 2, size=cls.num_obs),
+            np.random.randint(cls.num_feats / 2, cls.num_feats, size=cls.num_obs),
+        ]).T
+        cls.X = scipy.sparse.csr_matrix(
+            (np.ones(feat_idxs.size), (np.repeat(np.arange(cls.num_obs), 2), feat_idxs.ravel())),
+            shape=(cls.num_obs, cls.num_feats),
+        )
+        true_theta = np.random.randn(cls.num_feats) * 0.5 - 1
+        mutate_probs = 1/(1 + np.exp(-cls.X.dot(true_theta)))
+        cls.y_mutated = np.random.rand(cls.num_obs) < mutate_probs
+        cls.y_orig = np.where(cls.y_mutated, np.random.randint(1, NUM_NUCLEOTIDES + 1, size=cls.num_obs), 0)
+        targets = (cls.y_orig - 1 + np.random.randint(1, NUM_NUCLEOTIDES, size=cls.num_obs)) % NUM_NUCLEOTIDES + 1
+        cls.y_target = np.where(cls.y_mutated, targets, 0)
+
+    def _get_dense_log_lik(self, theta, theta_intercept, per_target_model, X=None, y_target=None):
+        """
+        The log likelihood computed one position at a time, with the intercept added to every feature
+        like in logistic_problem_cvxpy: the logits are X * (theta + theta_intercept)
+        """
+        X = (self.X if X is None else X).toarray()
+        y_target = self.y_target if y_target is None else y_target
+        log_lik = 0
+        for i in range(X.shape[0]):
+            mutate_prob = 1/(1 + np.exp(-X[i].dot(theta[:, 0] + theta_intercept)))
+            if y_target[i] != 0:
+                log_lik += np.log(mutate_prob)
+                if per_target_model:
+                    logits = np.array([-X[i].dot(theta[:, j + 1] + theta_intercept) for j in range(NUM_NUCLEOTIDES)])
+                    logits[self.y_orig[i] - 1] = -np.inf
+                    log_lik += logits[y_target[i] - 1] - np.log(np.sum(np.exp(logits)))
+            else:
+                log_lik += np.log(1 - mutate_prob)
+        return log_lik
+
+    def _check_optimal(self, problem, theta, lam):
+        """
+        Check the KKT conditions of the penalized problem
+        """
+        _, grad, grad_intercept = problem._get_log_lik(problem.data, theta, problem.theta_intercept, get_grad=True)
+        self.assertTrue(np.abs(grad_intercept) < 1e-3)
+        nonzero = theta != 0
+        self.assertTrue(np.allclose(grad[nonzero], lam * np.sign(theta[nonzero]), atol=1e-3))
+        self.assertTrue(np.all(np.abs(grad[~nonzero]) <= lam + 1e-3))
+
+    def test_solve(self):
+        for per_target_model in [False, True]:
+            y = self.y_target if per_target_model else self.y_mutated.astype(int)
+            theta_shape = (self.num_feats, NUM_NUCLEOTIDES + 1 if per_target_model else 1)
+            problem = LogisticRegressionMotifProximal(theta_shape, self.X, y, self.y_orig, per_target_model=per_target_model)
+
+            # The log likelihood agrees with computing it position by position
+            theta = np.random.randn(*theta_shape) * 0.1
+            self.assertTrue(np.isclose(
+                problem._get_log_lik(problem.data, theta, -0.5),
+                self._get_dense_log_lik(theta, -0.5, per_target_model),
+            ))
+
+            # Warm starts along the penalty path give the same solution as a cold start
+            for lam in [20., 5.]:
+                theta, _, value = problem.solve(lam, max_iters=10000, diff_thres=1e-12)
+                self._check_optimal(problem, theta, lam)
+            cold_problem = LogisticRegressionMotifProximal(theta_shape, self.X, y, self.y_orig, per_target_model=per_target_model)
+            cold_theta, _, cold_value = cold_problem.solve(5., max_iters=10000, diff_thres=1e-12)
+            self.assertTrue(np.allclose(theta, cold_theta, atol=1e-3))
+            self.assertTrue(np.isclose(value, cold_value))
+            self.assertTrue(np.sum(theta == 0) > 0)
+
+            self.assertTrue(np.isclose(
+                problem.score(self.X, y, self.y_orig),
+                self._get_dense_log_lik(theta, problem.theta_intercept, per_target_model),
+            ))
+
+    def test_intercept_per_feature(self):
+        """
+        The intercept is added to every feature like in logistic_problem_cvxpy, so it is counted once per motif level.
+        Drop the second feature of some positions so that they have different numbers of levels.
+        """
+        X = self.X.tolil()
+        for i in np.where(np.random.rand(self.num_obs) < 0.3)[0]:
+            X[i, X.rows[i][1]] = 0
+        X = X.tocsr()
+        X.eliminate_zeros()
+        lam = 5.
+        for per_target_model in [False, True]:
+            y = self.y_target if per_target_model else self.y_mutated.astype(int)
+            theta_shape = (self.num_feats, NUM_NUCLEOTIDES + 1 if per_target_model else 1)
+            problem = LogisticRegressionMotifProximal(theta_shape, X, y, self.y_orig, per_target_model=per_target_model)
+
+            theta = np.random.randn(*theta_shape) * 0.1
+            self.assertTrue(np.isclose(
+                problem._get_log_lik(problem.data, theta, -0.5),
+                self._get_dense_log_lik(theta, -0.5, per_target_model, X=X),
+            ))
+
+            theta, theta_with_intercept, value = problem.solve(lam, max_iters=10000, diff_thres=1e-12)
+            self._check_optimal(problem, theta, lam)
+            self.assertTrue(np.isclose(
+                value,
+                self._get_dense_log_lik(theta, problem.theta_intercept, per_target_model, X=X) - lam * np.sum(np.abs(theta)),
+            ))
+            # The intercept is optimal for the cvxpy objective
+            eps = 1e-5
+            intercept_deriv = (
+                self._get_dense_log_lik(theta, problem.theta_intercept + eps, per_target_model, X=X)
+                - self._get_dense_log_lik(theta, problem.theta_intercept - eps, per_target_model, X=X)
+            ) / (2 * eps)
+            self.assertTrue(np.abs(intercept_deriv) < 1e-3)
+            # The returned theta already includes the intercept for each level
+            self.assertTrue(np.isclose(
+                self._get_dense_log_lik(theta_with_intercept, 0., per_target_model, X=X),
+                self._get_dense_log_lik(theta, problem.theta_intercept, per_target_model, X=X),
+            ))
+
+    def test_sufficient_stats(self):
+        y = self.y_target
+        all_stats = LogisticSufficientStats.from_X_y(self.X, y, self.y_orig)
+        X, stats_y, stats_y_orig, counts = all_stats.get_X_y_counts()
+        self.assertEqual(np.sum(counts), self.num_obs)
+        self.assertTrue(X.shape[0] < self.num_obs)
+
+        # Fold counts by subtraction match counting the fold directly
+        val_idx = np.arange(0, self.num_obs, 3)
+        train_idx = np.setdiff1d(np.arange(self.num_obs), val_idx)
+        val_stats = LogisticSufficientStats.from_X_y(self.X[val_idx], y[val_idx], self.y_orig[val_idx])
+        train_stats = LogisticSufficientStats.from_X_y(self.X[train_idx], y[train_idx], self.y_orig[train_idx])
+        self.assertEqual(all_stats.subtract(val_stats).row_counts, train_stats.row_counts)
+
+        # The collapsed data has the same log likelihood and solution as the full data
+        theta_shape = (self.num_feats, NUM_NUCLEOTIDES + 1)
+        problem = LogisticRegressionMotifProximal(theta_shape, self.X, y, self.y_orig, per_target_model=True)
+        stats_problem = LogisticRegressionMotifProximal(theta_shape, X, stats_y, stats_y_orig, per_target_model=True, counts=counts)
+        theta, _, value = problem.solve(5., max_iters=10000, diff_thres=1e-12)
+        stats_theta, _, stats_value = stats_problem.solve(5., max_iters=10000, diff_thres=1e-12)
+        self.assertTrue(np.isclose(value, stats_value))
+        self.assertTrue(np.allclose(theta, stats_theta, atol=1e-3))
+        self.assertTrue(np.isclose(
+            problem.score(self.X[val_idx], y[val_idx], self.y_orig[val_idx]),
+            problem.score(*val_stats.get_X_y_counts()),
+        ))
+
+    def test_fold_workers(self):
+        y = self.y_mutated.astype(int)
+        penalty_params = [20., 10., 5.]
+        worker_list = []
+        for fold_idx in range(3):
+            val_idx = np.arange(fold_idx, self.num_obs, 3)
+            train_idx = np.setdiff1d(np.arange(self.num_obs), val_idx)
+            problem = LogisticRegressionMotifProximal((self.num_feats, 1), self.X[train_idx], y[train_idx], self.y_orig[train_idx])
+            val_data = (self.X[val_idx], y[val_idx], self.y_orig[val_idx])
+            worker_list.append(LogisticFoldWorker(fold_idx, fold_idx, problem, val_data, penalty_params, 10000))
+
+        pool = Pool(3)
+        pool_results = MultiprocessingManager(pool, worker_list, num_approx_batches=len(worker_list), pool_chunksize=1).run()
+        pool.close()
+        serial_results = [worker.run_worker(None) for worker in worker_list]
+        self.assertEqual(len(pool_results), len(worker_list))
+        for pool_res, serial_res in zip(pool_results, serial_results):
+            self.assertEqual([r.penalty_param for r in pool_res], penalty_params)
+            for pool_param_res, serial_param_res in zip(pool_res, serial_res):
+                self.assertTrue(np.allclose(pool_param_res.theta, serial_param_res.theta))
+                self.assertTrue(np.isclose(pool_param_res.validation_value, serial_param_res.validation_value))
@@ -17,6 +17,7 @@ from survival_model_simulator import SurvivalModelSimulatorSingleColumn, Surviva
 from models import ObservedSequenceMutations
 from common import get_random_dna_seq, NUM_NUCLEOTIDES, process_degenerates_and_impute_nucleotides, NUCLEOTIDE_DICT
 from plot_helpers import plot_martingale_residuals_on_axis
+from sampling_utils import set_random_seed
 
 POSITION_BIAS = 1
 
@@ -26,7 +27,7 @@ class Residuals_TestCase(unittest.TestCase):
         """
         Set up state
         """
-        np.random.seed(1)
+        set_random_seed(1)
         cls.motif_len = 3
         cls.flank_len = 1
         cls.mut_pos_list = [[cls.flank_len]]
@@ -0,0 +1,78 @@
+import unittest
+import os
+import numpy as np
+from multiprocessing import Pool
+
+from mutability_scorer import MutabilityScorer, ScoreWriter, score_sequence_chunks, read_scores
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from common import get_random_dna_seq, NUM_NUCLEOTIDES, NUCLEOTIDES
+from sampling_utils import set_random_seed
+
+class MutabilityScorer_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        set_random_seed(1)
+        cls.feat_gen = HierarchicalMotifFeatureGenerator(motif_lens=[3,5], left_motif_flank_len_list=[[1],[2]])
+        cls.seqs = [get_random_dna_seq(np.random.randint(1, 30)) for i in range(20)]
+        cls.seqs[3] = cls.seqs[3][:10] + "n" + cls.seqs[3][11:]
+        cls.output_dir = 'test/_output/scores'
+
+    def _get_theta(self, per_target_model):
+        if per_target_model:
+            theta = np.random.randn(self.feat_gen.feature_vec_len, NUM_NUCLEOTIDES + 1)
+            theta[~self.feat_gen.get_possible_motifs_to_targets(theta.shape)] = -np.inf
+        else:
+            theta = np.random.randn(self.feat_gen.feature_vec_len, 1)
+        return theta
+
+    def _check_scores(self, theta, rates, target_probs, offsets):
+        left_flank_len = self.feat_gen.max_left_motif_flank_len
+        right_flank_len = self.feat_gen.max_right_motif_flank_len
+        for seq_idx, seq in enumerate(self.seqs):
+            seq_rates = rates[offsets[seq_idx]:offsets[seq_idx + 1]]
+            self.assertEqual(seq_rates.size, len(seq))
+            for pos in range(len(seq)):
+                window = seq[pos - left_flank_len:pos + right_flank_len + 1] if pos >= left_flank_len else ""
+                if len(window) < left_flank_len + right_flank_len + 1 or "n" in window:
+                    self.assertTrue(np.isnan(seq_rates[pos]))
+                    continue
+                feat_idxs = self.feat_gen.create_for_sequence(
+                    window[left_flank_len],
+                    window[:left_flank_len],
+                    window[left_flank_len + 1:],
+                )[0]
+                if theta.shape[1] == 1:
+                    true_hazards = np.exp(theta[feat_idxs, 0].sum(keepdims=True))
+                else:
+                    true_hazards = np.exp(theta[feat_idxs, 0].sum() + theta[feat_idxs, 1:].sum(axis=0))
+                    true_hazards[NUCLEOTIDES.index(window[left_flank_len])] = 0
+                    self.assertTrue(np.allclose(target_probs[offsets[seq_idx] + pos], true_hazards/true_hazards.sum(), rtol=1e-5))
+                self.assertTrue(np.isclose(seq_rates[pos], true_hazards.sum(), rtol=1e-5))
+
+    def test_score(self):
+        for per_target_model in [False, True]:
+            theta = self._get_theta(per_target_model)
+            agg_theta = self.feat_gen.create_aggregate_theta(theta, keep_col0=False, add_targets=True)
+            scorer = MutabilityScorer(agg_theta, self.feat_gen.motif_len, self.feat_gen.max_left_motif_flank_len)
+            rates, target_probs, offsets = scorer.score(self.seqs)
+            self.assertEqual(target_probs is None, not per_target_model)
+            self._check_scores(theta, rates, target_probs, offsets)
+
+    def test_score_chunks(self):
+        theta = self._get_theta(True)
+        agg_theta = self.feat_gen.create_aggregate_theta(theta, keep_col0=False, add_targets=True)
+        scorer = MutabilityScorer(agg_theta, self.feat_gen.motif_len, self.feat_gen.max_left_motif_flank_len)
+        names = ["seq%d" % i for i in range(len(self.seqs))]
+        chunks = [(names[i:i + 3], self.seqs[i:i + 3]) for i in range(0, len(self.seqs), 3)]
+
+        pool = Pool(2)
+        writer = ScoreWriter(self.output_dir)
+        for chunk_names, (rates, target_probs, offsets) in score_sequence_chunks(scorer, chunks, pool=pool, num_threads=2):
+            writer.write(chunk_names, rates, target_probs, offsets)
+        writer.close()
+        pool.close()
+
+        index, stored_rates, stored_target_probs = read_scores(self.output_dir)
+        self.assertEqual([name for name, _, _ in index], names)
+        offsets = [start for _, start, _ in index] + [stored_rates.size]
+        self._check_scores(theta, stored_rates, stored_target_probs, offsets)
@@ -0,0 +1,106 @@
+import unittest
+import os
+import json
+import numpy as np
+from multiprocessing import Pool
+
+from perf_registry import PerfRegistry, perf_count, perf_timer, write_perf_json
+from parallel_worker import ParallelWorker, MultiprocessingManager
+from mcmc_em import MCMC_EM
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from mutation_order_gibbs import MutationOrderGibbsSampler
+from survival_problem_lasso import SurvivalProblemLasso
+from read_data import read_gene_seq_csv_data
+from sampling_utils import set_random_seed
+from constants import *
+
+class SquareWorker(ParallelWorker):
+    def __init__(self, seed, value):
+        self.seed = seed
+        self.value = value
+
+    def run_worker(self, shared_obj):
+        return self.value ** 2
+
+    def __str__(self):
+        return "SquareWorker %d" % self.value
+
+class PerfRegistry_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch_dir = 'test/_output/'
+        if not os.path.exists(cls.scratch_dir):
+            os.makedirs(cls.scratch_dir)
+
+    def test_registry(self):
+        # Nothing is recorded without an active registry
+        perf_count("num_ignored")
+        registry = PerfRegistry()
+        with registry.activate():
+            perf_count("num_before_record", 2)
+            registry.start_record(em_iter=0)
+            with perf_timer("e_step_time"):
+                perf_count("num_samples_drawn", 3)
+            perf_count("num_samples_drawn", 4)
+
+            pool = Pool(2)
+            results = MultiprocessingManager(pool, [SquareWorker(i, i) for i in range(5)], num_approx_batches=2).run()
+            pool.close()
+            pool.join()
+        perf_count("num_ignored")
+
+        self.assertEqual(results, [i ** 2 for i in range(5)])
+        self.assertEqual(len(registry.records), 2)
+        self.assertEqual(registry.records[0], {"num_before_record": 2})
+        record = registry.records[1]
+        self.assertEqual(record["em_iter"], 0)
+        self.assertEqual(record["num_samples_drawn"], 7)
+        self.assertTrue(record["e_step_time"] >= 0)
+        self.assertTrue(record["num_pool_bytes_sent"] > 0)
+        self.assertTrue(record["num_pool_bytes_received"] > 0)
+
+        perf_file = os.path.join(self.scratch_dir, 'perf.json')
+        write_perf_json(perf_file, [dict(stage="penalized", records=registry.records)], info=dict(k_folds=1))
+        with open(perf_file, "r") as f:
+            perf_dict = json.load(f)
+        self.assertEqual(perf_dict["k_folds"], 1)
+        self.assertEqual(perf_dict["fits"][0]["totals"]["num_samples_drawn"], 7)
+        self.assertEqual(perf_dict["fits"][0]["totals"]["num_before_record"], 2)
+        self.assertFalse("em_iter" in perf_dict["fits"][0]["totals"])
+
+    def test_mcmc_em_records(self):
+        feat_generator = HierarchicalMotifFeatureGenerator(motif_lens=[3])
+        obs_data, _ = read_gene_seq_csv_data(INPUT_GENES, INPUT_SEQS, motif_len=3)
+        obs_data = obs_data[:10]
+        for obs_seq_mutation in obs_data:
+            feat_generator.add_base_features(obs_seq_mutation)
+        theta_shape = (feat_generator.feature_vec_len, 1)
+        em_algo = MCMC_EM(
+            MutationOrderGibbsSampler,
+            SurvivalProblemLasso,
+            base_num_e_samples=2,
+            max_m_iters=5,
+            scratch_dir=self.scratch_dir,
+        )
+        set_random_seed(1)
+        registry = PerfRegistry()
+        with registry.activate():
+            em_algo.run(
+                obs_data,
+                feat_generator,
+                np.zeros(theta_shape),
+                penalty_params=(0.01, 0),
+                possible_theta_mask=np.ones(theta_shape, dtype=bool),
+                zero_theta_mask=np.zeros(theta_shape, dtype=bool),
+                max_em_iters=2,
+                diff_thres=-np.inf,
+                max_e_samples=2,
+            )
+
+        # One record per EM iteration
+        self.assertTrue(len(registry.records) > 0)
+        self.assertEqual([r["em_iter"] for r in registry.records], range(len(registry.records)))
+        for record in registry.records:
+            self.assertEqual(record["num_samples_drawn"], 2 * len(obs_data))
+            for name in ["e_step_time", "m_step_time", "precalc_time", "num_m_iters", "num_log_lik_evals", "num_grad_evals"]:
+                self.assertTrue(record[name] > 0)
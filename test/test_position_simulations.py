@@ -7,6 +7,7 @@ from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from survival_model_simulator import SurvivalModelSimulatorPositionDependent
 from models import ObservedSequenceMutations
 from common import get_random_dna_seq, NUM_NUCLEOTIDES
+from sampling_utils import set_random_seed
 
 class Position_Simulation_TestCase(unittest.TestCase):
     @classmethod
@@ -14,7 +15,7 @@ class Position_Simulation_TestCase(unittest.TestCase):
         """
         Set up state
         """
-        np.random.seed(1)
+        set_random_seed(1)
         cls.motif_len = 3
         cls.mut_pos_list = [[1]]
         cls.feat_gen = HierarchicalMotifFeatureGenerator(
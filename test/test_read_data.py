@@ -0,0 +1,229 @@
+import unittest
+import csv
+import os
+import random
+import numpy as np
+from multiprocessing import Pool
+
+import read_data
+from read_data import read_gene_seq_csv_data, read_gene_seq_csv_data_bulk, write_data_after_imputing
+from read_data import write_partis_data_from_annotations, read_partis_data_chunks_from_annotations, read_partis_data_from_annotations
+from common import get_random_dna_seq, mutate_string, NUCLEOTIDES
+from test.constants import INPUT_GENES, INPUT_SEQS, PARTIS_ANNOTATIONS, PARTIS_METADATA
+from sampling_utils import set_random_seed
+
+# Germline sequences where _impute_ancestors_fake fails
+_FAILING_GERMLINES = set()
+
+def _impute_ancestors_fake(seqs, gl_seq, scratch_dir, gl_name='germline', verbose=True):
+    """
+    Stands in for impute_ancestors_dnapars: a star tree with the same output format, so that the parallel imputation
+    can be checked without dnapars installed
+    """
+    if gl_seq in _FAILING_GERMLINES:
+        raise ValueError("dnapars failed")
+    genes_line = [[gl_name, gl_seq]]
+    seq_line = [[gl_name, "%s-%d" % (gl_name, idx), seq] for idx, seq in enumerate(seqs)]
+    return genes_line, seq_line
+
+def _process_input_line_fake(line):
+    """
+    Stands in for partis' process_input_line on the synthetic annotations in test/data/partis
+    """
+    for key in ['unique_ids', 'input_seqs']:
+        line[key] = line[key].split(':')
+    line['v_end'] = int(line['v_end'])
+
+def _add_implicit_info_fake(glfo, line):
+    """
+    Stands in for partis' add_implicit_info: the V region is the start of the sequences, up to v_end
+    """
+    line['seqs'] = line['input_seqs']
+    line['v_gl_seq'] = line['naive_seq'][:line['v_end']]
+    line['v_qr_seqs'] = [seq[:line['v_end']] for seq in line['seqs']]
+    line['mut_freqs'] = [np.mean([a != b for a, b in zip(line['naive_seq'], seq)]) for seq in line['seqs']]
+
+class _GlutilsFake:
+    @staticmethod
+    def read_glfo(germline_file, locus):
+        return {'locus': locus}
+
+def _import_partis_utils_fake():
+    return _process_input_line_fake, _add_implicit_info_fake, _GlutilsFake
+
+class ReadData_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        set_random_seed(1)
+        cls.scratch_dir = 'test/_output/'
+        if not os.path.exists(cls.scratch_dir):
+            os.makedirs(cls.scratch_dir)
+
+    def _write_random_data(self, gene_file_name, seq_file_name, num_genes=6, num_seqs=200):
+        """
+        Write germlines of different lengths and mutated sequences, some with degenerate characters
+        and mutations in the flanks
+        """
+        gene_seqs = {"GENE_%d" % i: get_random_dna_seq(np.random.randint(15, 30)) for i in range(num_genes)}
+        with open(gene_file_name, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['germline_name', 'germline_sequence'])
+            for gene in sorted(gene_seqs.keys(), reverse=True):
+                writer.writerow([gene, gene_seqs[gene].upper()])
+
+        with open(seq_file_name, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['germline_name', 'sequence_name', 'sequence'])
+            for i in range(num_seqs):
+                gene = "GENE_%d" % np.random.randint(num_genes)
+                seq = gene_seqs[gene]
+                for pos in np.random.choice(len(seq), size=np.random.randint(0, 5), replace=False):
+                    seq = mutate_string(seq, pos, np.random.choice(list(NUCLEOTIDES + "n")))
+                if np.random.rand() < 0.1:
+                    seq = "nnn" + seq[3:]
+                writer.writerow([gene, "seq%d" % i, seq])
+
+    def _check_same_data(self, gene_file_name, seq_file_name, motif_len, left_flank_len=None, right_flank_len=None):
+        random.seed(0)
+        obs_data, metadata = read_gene_seq_csv_data(gene_file_name, seq_file_name, motif_len, left_flank_len, right_flank_len)
+        random.seed(0)
+        bulk_obs_data, bulk_metadata = read_gene_seq_csv_data_bulk(gene_file_name, seq_file_name, motif_len, left_flank_len, right_flank_len)
+        self.assertEqual(len(obs_data), len(bulk_obs_data))
+        for obs, bulk_obs, elt, bulk_elt in zip(obs_data, bulk_obs_data, metadata, bulk_metadata):
+            self.assertEqual(obs.start_seq_with_flanks, bulk_obs.start_seq_with_flanks)
+            self.assertEqual(obs.end_seq_with_flanks, bulk_obs.end_seq_with_flanks)
+            self.assertEqual(obs.mutation_pos_dict, bulk_obs.mutation_pos_dict)
+            self.assertEqual(obs.mutated_indicator, bulk_obs.mutated_indicator)
+            self.assertEqual(obs.skipped_mutations, bulk_obs.skipped_mutations)
+            self.assertEqual(obs.left_position_offset, bulk_obs.left_position_offset)
+            self.assertEqual(obs.right_position_offset, bulk_obs.right_position_offset)
+            self.assertEqual(obs.raw_pos, bulk_obs.raw_pos)
+            self.assertEqual(obs.collapse_list, bulk_obs.collapse_list)
+            self.assertEqual(elt['sequence_name'], bulk_elt['sequence_name'])
+
+    def test_bulk_read(self):
+        self._check_same_data(INPUT_GENES, INPUT_SEQS, motif_len=3)
+        self._check_same_data(INPUT_GENES, INPUT_SEQS, motif_len=5)
+
+        gene_file_name = os.path.join(self.scratch_dir, 'bulk_genes.csv')
+        seq_file_name = os.path.join(self.scratch_dir, 'bulk_seqs.csv')
+        self._write_random_data(gene_file_name, seq_file_name)
+        self._check_same_data(gene_file_name, seq_file_name, motif_len=3)
+        self._check_same_data(gene_file_name, seq_file_name, motif_len=5)
+        self._check_same_data(gene_file_name, seq_file_name, motif_len=5, left_flank_len=4, right_flank_len=0)
+
+    def _impute(self, gene_file_name, seq_file_name, pool=None):
+        """
+        @return the output files of write_data_after_imputing with the fake imputation
+        """
+        out_gene_file_name = os.path.join(self.scratch_dir, 'imputed_genes_%s.csv' % (pool is not None))
+        out_seq_file_name = os.path.join(self.scratch_dir, 'imputed_seqs_%s.csv' % (pool is not None))
+        write_data_after_imputing(
+            out_gene_file_name,
+            out_seq_file_name,
+            gene_file_name,
+            seq_file_name,
+            motif_len=3,
+            scratch_dir=self.scratch_dir,
+            verbose=False,
+            pool=pool,
+        )
+        with open(out_gene_file_name, 'r') as genes_file, open(out_seq_file_name, 'r') as seqs_file:
+            return genes_file.read(), seqs_file.read()
+
+    def test_parallel_imputation(self):
+        """
+        Imputing with a pool gives the same output as imputing serially,
+        and a failed clonal family raises an error either way
+        """
+        gene_file_name = os.path.join(self.scratch_dir, 'impute_genes.csv')
+        seq_file_name = os.path.join(self.scratch_dir, 'impute_seqs.csv')
+        self._write_random_data(gene_file_name, seq_file_name, num_genes=8, num_seqs=100)
+        with open(gene_file_name, 'r') as f:
+            gl_seqs = {row['germline_name']: row['germline_sequence'].lower() for row in csv.DictReader(f)}
+
+        orig_impute_ancestors = read_data.impute_ancestors_dnapars
+        read_data.impute_ancestors_dnapars = _impute_ancestors_fake
+        try:
+            # The pool processes must be started after patching in the fake imputation
+            pool = Pool(2)
+            serial_output = self._impute(gene_file_name, seq_file_name)
+            self.assertEqual(serial_output, self._impute(gene_file_name, seq_file_name, pool=pool))
+            self.assertTrue(len(serial_output[1].splitlines()) > len(gl_seqs))
+
+            _FAILING_GERMLINES.add(gl_seqs["GENE_3"])
+            pool.close()
+            pool = Pool(2)
+            for p in [None, pool]:
+                with self.assertRaises(ValueError) as cm:
+                    self._impute(gene_file_name, seq_file_name, pool=p)
+                self.assertIn("GENE_3", str(cm.exception))
+        finally:
+            pool.close()
+            _FAILING_GERMLINES.clear()
+            read_data.impute_ancestors_dnapars = orig_impute_ancestors
+
+    def _check_same_partis_data(self, obs_data, metadata, stream_obs_data, stream_metadata):
+        """
+        Check that the sequences are the same, regardless of the order they were read in
+        """
+        self.assertEqual(len(obs_data), len(stream_obs_data))
+        stream_data = {elt['sequence_name']: (obs, elt) for obs, elt in zip(stream_obs_data, stream_metadata)}
+        for obs, elt in zip(obs_data, metadata):
+            stream_obs, stream_elt = stream_data[elt['sequence_name']]
+            self.assertEqual(obs.start_seq_with_flanks, stream_obs.start_seq_with_flanks)
+            self.assertEqual(obs.end_seq_with_flanks, stream_obs.end_seq_with_flanks)
+            self.assertEqual(obs.mutation_pos_dict, stream_obs.mutation_pos_dict)
+            self.assertEqual(elt['germline_sequence'], stream_elt['germline_sequence'])
+            self.assertEqual(elt['locus'], stream_elt['locus'])
+
+    def test_partis_streaming(self):
+        """
+        Reading the partis annotations directly gives the same sequences as writing them to csv files first,
+        with and without a pool
+        """
+        gene_file_name = os.path.join(self.scratch_dir, 'partis_genes.csv')
+        seq_file_name = os.path.join(self.scratch_dir, 'partis_seqs.csv')
+        orig_import_partis_utils = read_data._import_partis_utils
+        read_data._import_partis_utils = _import_partis_utils_fake
+        pool = None
+        try:
+            # The pool processes must be started after patching in the fake partis functions
+            pool = Pool(2)
+            for filter_args in [{}, {'filters': {'locus': ['igk']}, 'min_clonal_family_size': 2, 'max_mut_pct': 0.1}]:
+                write_partis_data_from_annotations(gene_file_name, seq_file_name, PARTIS_ANNOTATIONS, PARTIS_METADATA, **filter_args)
+                obs_data, metadata = read_gene_seq_csv_data(gene_file_name, seq_file_name, motif_len=3)
+                self.assertTrue(len(obs_data) > 0)
+                for p in [None, pool]:
+                    chunks = list(read_partis_data_chunks_from_annotations(
+                        PARTIS_ANNOTATIONS,
+                        PARTIS_METADATA,
+                        motif_len=3,
+                        chunk_size=4,
+                        pool=p,
+                        num_threads=2,
+                        **filter_args
+                    ))
+                    self.assertTrue(len(chunks) > 1)
+                    self._check_same_partis_data(
+                        obs_data,
+                        metadata,
+                        [obs for chunk_obs_data, _ in chunks for obs in chunk_obs_data],
+                        [elt for _, chunk_metadata in chunks for elt in chunk_metadata],
+                    )
+
+                    stream_obs_data, stream_metadata = read_partis_data_from_annotations(
+                        PARTIS_ANNOTATIONS,
+                        PARTIS_METADATA,
+                        motif_len=3,
+                        chunk_size=4,
+                        pool=p,
+                        num_threads=2,
+                        **filter_args
+                    )
+                    self._check_same_partis_data(obs_data, metadata, stream_obs_data, stream_metadata)
+        finally:
+            if pool is not None:
+                pool.close()
+            read_data._import_partis_utils = orig_import_partis_utils
+            read_data._PARTIS_GLFOS.clear()
@@ -0,0 +1,93 @@
+import unittest
+import os
+import pickle
+import numpy as np
+
+from result_store import ResultStore, load_method_results
+from method_results import MethodResults
+from model_truncation import ModelTruncation
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from common import pick_best_model
+from sampling_utils import set_random_seed
+
+class ResultStore_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        set_random_seed(1)
+        cls.scratch_dir = 'test/_output/'
+        if not os.path.exists(cls.scratch_dir):
+            os.makedirs(cls.scratch_dir)
+        cls.feat_gen = HierarchicalMotifFeatureGenerator(motif_lens=[3])
+
+    def _make_results(self, penalty_param, log_lik_ratio_lower_bound, refit=True):
+        theta = np.random.randn(self.feat_gen.feature_vec_len, 1)
+        theta[np.abs(theta) < 0.5] = 0
+        model_masks = ModelTruncation(theta, self.feat_gen)
+        method_res = MethodResults((penalty_param, penalty_param))
+        method_res.set_penalized_theta(theta, log_lik_ratio_lower_bound, 0.5, model_masks, reference_penalty_param=(1.0, 1.0))
+        if refit:
+            refit_theta = theta[~model_masks.feats_to_remove_mask, :]
+            method_res.set_refit_theta(self.feat_gen, refit_theta, None, None, np.ones(refit_theta.shape, dtype=bool))
+        return method_res
+
+    def test_store(self):
+        results_list = [
+            [self._make_results(0.5, 1., refit=False), self._make_results(0.5, 1.)],
+            [self._make_results(0.1, 1.), self._make_results(0.1, -1.)],
+        ]
+        store_dir = os.path.join(self.scratch_dir, 'result_store')
+        store = ResultStore(store_dir)
+        store.clear()
+        for param_idx, param_results in enumerate(results_list):
+            for model_idx, res in enumerate(param_results):
+                store.save(param_idx, model_idx, res)
+
+        stored_results_list = load_method_results(store_dir)
+        self.assertEqual(len(stored_results_list), len(results_list))
+        for param_results, stored_param_results in zip(results_list, stored_results_list):
+            self.assertEqual(len(param_results), len(stored_param_results))
+            for res, stored_res in zip(param_results, stored_param_results):
+                # Large fields are only read when accessed
+                self.assertFalse('penalized_theta' in stored_res.__dict__)
+                self.assertEqual(res.penalty_params, stored_res.penalty_params)
+                self.assertEqual(res.has_refit_data, stored_res.has_refit_data)
+                self.assertEqual(res.log_lik_ratio_lower_bound, stored_res.log_lik_ratio_lower_bound)
+                self.assertTrue(np.array_equal(res.penalized_theta, stored_res.penalized_theta))
+                self.assertTrue(np.array_equal(res.model_masks.zero_theta_mask_refit, stored_res.model_masks.zero_theta_mask_refit))
+                if res.has_refit_data:
+                    self.assertTrue(np.array_equal(res.refit_theta, stored_res.refit_theta))
+                    self.assertEqual(res.num_p, stored_res.num_p)
+                    self.assertEqual(stored_res.variance_est, None)
+                    self.assertEqual(stored_res.refit_feature_generator.feature_vec_len, self.feat_gen.feature_vec_len)
+                else:
+                    self.assertRaises(AttributeError, getattr, stored_res, 'refit_theta')
+
+        best_model = pick_best_model(stored_results_list)
+        self.assertTrue(np.array_equal(best_model.refit_theta, pick_best_model(results_list).refit_theta))
+
+        # Overwriting an entry, e.g. after refitting
+        results_list[0][0] = self._make_results(0.5, 2.)
+        store.save(0, 0, results_list[0][0])
+        stored_res = ResultStore(store_dir).load()[0][0]
+        self.assertTrue(stored_res.has_refit_data)
+        self.assertTrue(np.array_equal(results_list[0][0].refit_theta, stored_res.refit_theta))
+
+        # Older pickled results can still be loaded
+        pickle_file = os.path.join(self.scratch_dir, 'results.pkl')
+        with open(pickle_file, 'w') as f:
+            pickle.dump(results_list, f)
+        pickled_results_list = load_method_results(pickle_file)
+        self.assertTrue(np.array_equal(pickled_results_list[1][0].penalized_theta, results_list[1][0].penalized_theta))
+
+        # Clearing refuses to remove anything that is not a result store
+        self.assertRaises(ValueError, ResultStore(pickle_file).clear)
+        self.assertTrue(os.path.exists(pickle_file))
+        other_dir = os.path.join(self.scratch_dir, 'not_a_store')
+        if not os.path.exists(other_dir):
+            os.makedirs(other_dir)
+        other_file = os.path.join(other_dir, 'data.csv')
+        open(other_file, 'w').close()
+        self.assertRaises(ValueError, ResultStore(other_dir).clear)
+        self.assertTrue(os.path.exists(other_file))
+        store.clear()
+        self.assertFalse(os.path.exists(store_dir))
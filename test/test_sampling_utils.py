@@ -0,0 +1,109 @@
+import unittest
+import numpy as np
+import scipy.stats
+
+from sampling_utils import *
+from parallel_worker import ParallelWorker
+
+class DrawUniformsWorker(ParallelWorker):
+    def __init__(self, seed):
+        self.seed = seed
+
+    def run_worker(self, shared_obj):
+        return [sample_index([1, 2, 3, 4]) for i in range(20)]
+
+    def __str__(self):
+        return "DrawUniformsWorker %d" % self.seed
+
+class SamplingUtils_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Test the buffered draws, like the ones in the parallel workers
+        set_random_seed(1, buffer_uniforms=True)
+        cls.num_draws = 20000
+
+    @classmethod
+    def tearDownClass(cls):
+        UNIFORM_BUFFER.disable()
+
+    def _check_frequencies(self, sampled_idxs, probs):
+        freqs = np.bincount(sampled_idxs, minlength=len(probs))/float(len(sampled_idxs))
+        norm_probs = np.array(probs)/np.sum(probs)
+        self.assertTrue(np.all(np.abs(freqs - norm_probs) < 0.015))
+
+    def _check_goodness_of_fit(self, sampled_idxs, probs):
+        """
+        Pearson chi-square test of the sampled indices against the given probabilities
+        (indices with zero probability must never be drawn)
+        """
+        counts = np.bincount(sampled_idxs, minlength=len(probs))
+        norm_probs = np.array(probs)/np.sum(probs)
+        self.assertEqual(np.sum(counts[norm_probs == 0]), 0)
+        nonzero = norm_probs > 0
+        _, pval = scipy.stats.chisquare(counts[nonzero], len(sampled_idxs) * norm_probs[nonzero])
+        self.assertTrue(pval > 0.001)
+
+    def test_sample_index(self):
+        probs = [0.1, 0, 0.5, 0.2, 0.2]
+        self._check_frequencies([sample_index(probs) for i in range(self.num_draws)], probs)
+        self._check_frequencies(sample_indices(probs, self.num_draws), probs)
+
+    def test_sample_index_from_log_probs(self):
+        probs = [0.1, 0, 0.5, 0.2, 0.2]
+        with np.errstate(divide="ignore"):
+            log_probs = np.log(probs) - 1000
+        self._check_frequencies([sample_index_from_log_probs(log_probs) for i in range(self.num_draws)], probs)
+
+    def test_sample_index_from_log_probs_unbiased(self):
+        """
+        The buffered draws must follow the target distribution, including for many
+        categories, tiny probabilities and log probabilities far from zero
+        """
+        for probs in [[0.1, 0, 0.5, 0.2, 0.2], np.random.dirichlet(np.ones(40) * 0.3), [1e-3, 1 - 2e-3, 1e-3]]:
+            with np.errstate(divide="ignore"):
+                log_probs = np.log(probs) + 500
+            sampled_idxs = [sample_index_from_log_probs(log_probs) for i in range(self.num_draws)]
+            self._check_goodness_of_fit(sampled_idxs, probs)
+            self._check_goodness_of_fit(sample_indices(probs, self.num_draws), probs)
+
+        # Consecutive draws from the shared uniform buffer must be independent
+        probs = [0.3, 0.7]
+        sampled_idxs = np.array([sample_index_from_log_probs(np.log(probs)) for i in range(self.num_draws)])
+        pair_idxs = 2 * sampled_idxs[:-1:2] + sampled_idxs[1::2]
+        self._check_goodness_of_fit(pair_idxs, np.outer(probs, probs).flatten())
+
+    def test_fenwick_sampler(self):
+        weights = np.random.rand(13)
+        fenwick_sampler = FenwickSampler(weights)
+        # Update a few of the weights, including setting some to zero
+        for idx, w in [(0, 0), (5, 3.), (12, 0), (7, 0.5), (5, 1.)]:
+            fenwick_sampler.update(idx, w)
+            weights[idx] = w
+        self.assertTrue(np.isclose(fenwick_sampler.get_total(), weights.sum()))
+        cum_weights = np.cumsum(weights)
+        for value in np.linspace(0, weights.sum(), 50, endpoint=False):
+            self.assertEqual(fenwick_sampler.find(value), np.searchsorted(cum_weights, value, side="right"))
+        self._check_frequencies([fenwick_sampler.sample() for i in range(self.num_draws)], weights)
+        self._check_goodness_of_fit([fenwick_sampler.sample() for i in range(self.num_draws)], weights)
+
+    def test_seeding(self):
+        """
+        Parallel workers must draw the same numbers given the same seed, regardless of the state of the uniform buffer
+        """
+        first_draws = DrawUniformsWorker(10).run(None)
+        UNIFORM_BUFFER.draw_many(5)
+        second_draws = DrawUniformsWorker(10).run(None)
+        self.assertEqual(first_draws, second_draws)
+
+        # Outside of the workers, the buffer is off so np.random.seed makes the draws reproducible
+        self.assertFalse(UNIFORM_BUFFER.enabled)
+        np.random.seed(10)
+        draws = [sample_index([1, 1]) for i in range(10)]
+        np.random.seed(10)
+        self.assertEqual(draws, [sample_index([1, 1]) for i in range(10)])
+        set_random_seed(10, buffer_uniforms=True)
+
+        random_state = get_random_state()
+        draws = [sample_index([1, 1]) for i in range(10)]
+        set_random_state(random_state)
+        self.assertEqual(draws, [sample_index([1, 1]) for i in range(10)])
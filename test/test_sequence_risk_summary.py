@@ -0,0 +1,109 @@
+import unittest
+import numpy as np
+from multiprocessing import Pool
+
+from sequence_risk_summary import SequenceRiskSummarizer, summarize_sequence_chunks
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from common import get_random_dna_seq, NUM_NUCLEOTIDES
+from sampling_utils import set_random_seed
+
+class SequenceRiskSummary_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        set_random_seed(1)
+        cls.feat_gen = HierarchicalMotifFeatureGenerator(motif_lens=[3])
+        cls.seqs = [get_random_dna_seq(30) for i in range(3)] + [get_random_dna_seq(20)]
+
+    def _get_summarizer(self, theta):
+        agg_theta = self.feat_gen.create_aggregate_theta(theta, keep_col0=False, add_targets=True)
+        return SequenceRiskSummarizer(agg_theta, self.feat_gen.motif_len, self.feat_gen.max_left_motif_flank_len, lambda0=2.)
+
+    def test_constant_hazards(self):
+        """
+        Without context effects the positions really are independent, so the summaries are exact
+        """
+        summarizer = self._get_summarizer(np.zeros((self.feat_gen.feature_vec_len, 1)))
+        seq = get_random_dna_seq(12)
+        num_positions = len(seq) - self.feat_gen.motif_len + 1
+        kth_times = summarizer.get_expected_kth_mutation_times([seq], 5)
+        true_kth_times = np.cumsum([1. / (2. * (num_positions - j)) for j in range(5)])
+        self.assertTrue(np.allclose(kth_times[0], true_kth_times, rtol=1e-3))
+
+        first_probs = summarizer.get_first_mutation_probs([seq])[0]
+        self.assertTrue(np.allclose(first_probs[1:-1], 1. / num_positions))
+        self.assertEqual(first_probs[0], 0)
+        self.assertEqual(first_probs[-1], 0)
+
+        counts = summarizer.get_expected_mutation_counts([seq], 0.1, regions=[(0, 4), (4, 12)])
+        self.assertTrue(np.allclose(counts[0], np.array([3, 7]) * (1 - np.exp(-0.2))))
+
+        # Not enough positions to mutate
+        kth_times = summarizer.get_expected_kth_mutation_times([seq[:4], "nnnn"], 3)
+        self.assertTrue(np.all(np.isfinite(kth_times[0, :2])))
+        self.assertTrue(np.isinf(kth_times[0, 2]))
+        self.assertTrue(np.all(np.isinf(kth_times[1])))
+
+    def test_against_simulation(self):
+        for per_target_model in [False, True]:
+            if per_target_model:
+                theta = np.random.randn(self.feat_gen.feature_vec_len, NUM_NUCLEOTIDES + 1) * 0.5
+                theta[~self.feat_gen.get_possible_motifs_to_targets(theta.shape)] = -np.inf
+            else:
+                theta = np.random.randn(self.feat_gen.feature_vec_len, 1) * 0.5
+            summarizer = self._get_summarizer(theta)
+            regions = [(0, 15), (15, 30)]
+            summaries = summarizer.summarize(self.seqs, 0.03, max_k=3, regions=regions)
+            sim_summaries = summarizer.simulate_summaries(self.seqs, 0.03, max_k=3, regions=regions, num_samples=2000, seed=1)
+
+            # The first mutation is exact
+            self.assertTrue(np.allclose(
+                summaries["expected_kth_mutation_times"][:, 0],
+                sim_summaries["expected_kth_mutation_times"][:, 0],
+                rtol=0.1,
+            ))
+            self.assertTrue(np.allclose(summaries["first_mutation_probs"].sum(axis=1), 1))
+            self.assertTrue(np.allclose(
+                summaries["first_mutation_probs"],
+                sim_summaries["first_mutation_probs"],
+                atol=0.05,
+            ))
+            # The rest ignore the change in the motifs after a mutation, so they are only close
+            self.assertTrue(np.allclose(
+                summaries["expected_kth_mutation_times"],
+                sim_summaries["expected_kth_mutation_times"],
+                rtol=0.15,
+            ))
+            self.assertTrue(np.allclose(
+                summaries["expected_mutation_counts"],
+                sim_summaries["expected_mutation_counts"],
+                rtol=0.15,
+                atol=0.1,
+            ))
+
+    def test_summarize_chunks(self):
+        theta = np.random.randn(self.feat_gen.feature_vec_len, 1)
+        summarizer = self._get_summarizer(theta)
+        chunks = [(["seq%d" % i], [seq]) for i, seq in enumerate(self.seqs)]
+        summarize_kwargs = dict(censoring_time=0.1, max_k=2)
+        all_summaries = summarizer.summarize(self.seqs, **summarize_kwargs)
+        pool = Pool(2)
+        for chunk_pool in [None, pool]:
+            results = list(summarize_sequence_chunks(summarizer, chunks, summarize_kwargs, chunk_pool, 2))
+            self.assertEqual([names for names, _ in results], [names for names, _ in chunks])
+            for i, (_, summaries) in enumerate(results):
+                for key, value in summaries.iteritems():
+                    all_value = all_summaries[key][i]
+                    if key == "first_mutation_probs":
+                        # padded to the longest sequence of the chunk
+                        all_value = all_value[:value.shape[1]]
+                    self.assertTrue(np.allclose(value[0], all_value))
+
+        # Simulated summaries do not depend on how the chunks are run
+        set_random_seed(2)
+        sim_results = list(summarize_sequence_chunks(summarizer, chunks, summarize_kwargs, None, 2, num_sim_samples=20))
+        set_random_seed(2)
+        pool_sim_results = list(summarize_sequence_chunks(summarizer, chunks, summarize_kwargs, pool, 2, num_sim_samples=20))
+        for (_, summaries), (_, pool_summaries) in zip(sim_results, pool_sim_results):
+            for key, value in summaries.iteritems():
+                self.assertTrue(np.allclose(value, pool_summaries[key]))
+        pool.close()
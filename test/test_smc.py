@@ -0,0 +1,85 @@
+import unittest
+import itertools
+import numpy as np
+import scipy.misc
+
+from common import *
+from models import ObservedSequenceMutations, ImputedSequenceMutations
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from mutation_order_gibbs import MutationOrderGibbsSampler
+from mutation_order_smc import MutationOrderSMCSampler
+from survival_problem_lasso import SurvivalProblemLasso
+from sampling_utils import set_random_seed
+
+class SMC_TestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        set_random_seed(1)
+        cls.feat_gen = HierarchicalMotifFeatureGenerator(motif_lens=[3,5], left_motif_flank_len_list=[[1],[2]])
+        cls.obs = ObservedSequenceMutations("aattacacgtaa", "aattgggggtaa", motif_len=5)
+        cls.feat_gen.add_base_features(cls.obs)
+
+    def _get_exact_log_probs(self, theta):
+        """
+        @return dictionary mapping each possible mutation order to its log probability (not conditional on the ending sequence)
+        """
+        sampler = MutationOrderGibbsSampler(theta, self.feat_gen, self.obs)
+        return {
+            order: sampler.get_log_probs(list(order))
+            for order in itertools.permutations(self.obs.mutation_pos_dict.keys())
+        }
+
+    def _test_marginal_likelihood(self, per_target_model):
+        if per_target_model:
+            theta = np.random.rand(self.feat_gen.feature_vec_len, NUM_NUCLEOTIDES + 1)
+            possible_motif_mask = self.feat_gen.get_possible_motifs_to_targets(theta.shape)
+            theta[~possible_motif_mask] = -np.inf
+        else:
+            theta = np.random.rand(self.feat_gen.feature_vec_len, 1) * 2
+        exact_log_probs = self._get_exact_log_probs(theta)
+        exact_log_marginal = scipy.misc.logsumexp(exact_log_probs.values())
+
+        res = MutationOrderSMCSampler(theta, self.feat_gen, self.obs).run(None, 0, 4000)
+        self.assertTrue(np.abs(res.log_marginal_estimate - exact_log_marginal) < 0.05)
+        self.assertTrue(np.isclose(np.sum(res.sample_weights), 1))
+
+        # Check the weighted samples approximate the distribution of the most likely order given the ending sequence
+        best_order = max(exact_log_probs, key=exact_log_probs.get)
+        exact_prob_best = np.exp(exact_log_probs[best_order] - exact_log_marginal)
+        smc_prob_best = np.sum([
+            w for s, w in zip(res.samples, res.sample_weights) if tuple(s.mutation_order) == best_order
+        ])
+        self.assertTrue(np.abs(exact_prob_best - smc_prob_best) < 0.05)
+
+    def test_marginal_likelihood(self):
+        self._test_marginal_likelihood(per_target_model=False)
+
+    def test_marginal_likelihood_per_target(self):
+        self._test_marginal_likelihood(per_target_model=True)
+
+    def test_zero_hazards(self):
+        """
+        If the observed mutations can never happen, the marginal likelihood estimate is zero and the weights are still valid
+        """
+        theta = np.random.rand(self.feat_gen.feature_vec_len, NUM_NUCLEOTIDES + 1)
+        theta[:, NUCLEOTIDE_DICT["g"] + 1] = -np.inf
+        res = MutationOrderSMCSampler(theta, self.feat_gen, self.obs).run(None, 0, 100)
+        self.assertEqual(res.log_marginal_estimate, -np.inf)
+        self.assertTrue(np.isclose(np.sum(res.sample_weights), 1))
+        for sample in res.samples:
+            self.assertEqual(sorted(sample.mutation_order), sorted(self.obs.mutation_pos_dict.keys()))
+
+    def test_uniform_weights(self):
+        """
+        Uniform sample weights should not change the M-step objective or its gradient
+        """
+        theta = np.random.rand(self.feat_gen.feature_vec_len, 1)
+        samples = [
+            ImputedSequenceMutations(self.obs, list(order))
+            for order in itertools.permutations(self.obs.mutation_pos_dict.keys())
+        ]
+        labels = [0] * len(samples)
+        prob = SurvivalProblemLasso(self.feat_gen, samples, labels, penalty_params=[0.1])
+        weighted_prob = SurvivalProblemLasso(self.feat_gen, samples, labels, penalty_params=[0.1], sample_weights=np.ones(len(samples)))
+        self.assertTrue(np.isclose(prob._get_value_parallel(theta)[0], weighted_prob._get_value_parallel(theta)[0]))
+        self.assertTrue(np.allclose(prob._get_gradient_log_lik(theta), weighted_prob._get_gradient_log_lik(theta)))
@@ -0,0 +1,154 @@
+import unittest
+import numpy as np
+from multiprocessing import Pool
+
+from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
+from motif_feature_generator import MotifFeatureGenerator
+from position_feature_generator import PositionFeatureGenerator
+from combined_feature_generator import CombinedFeatureGenerator
+from survival_model_simulator import SurvivalModelSimulatorSingleColumn
+from survival_model_simulator import SurvivalModelSimulatorMultiColumn
+from survival_model_simulator import SurvivalModelSimulatorPositionDependent
+from models import MutationEvent, FullSequenceMutations
+from common import NUM_NUCLEOTIDES, NUCLEOTIDES, mutate_string
+from sampling_utils import set_random_seed
+
+class SurvivalModelSimulator_TestCase(unittest.TestCase):
+    """
+    The incremental simulator should have the same distribution as the reference simulator that
+    recalculates all the hazards after every mutation
+    """
+    @classmethod
+    def setUpClass(cls):
+        set_random_seed(1)
+        cls.feat_gen = HierarchicalMotifFeatureGenerator(motif_lens=[3,5], left_motif_flank_len_list=[[1],[2]])
+        cls.start_seq = "ggacgtatcgatgacc"
+        cls.seq_len = len(cls.start_seq) - 4
+        cls.num_sims = 2000
+
+    def _simulate_from_scratch(self, simulator, start_seq, censoring_time=None, percent_mutated=None, with_replacement=False):
+        """
+        Reference simulator that recalculates the features and the hazards of all the positions after each mutation
+
+        @return FullSequenceMutations
+        """
+        left_flank, start_seq, right_flank = simulator._split_flanks(start_seq)
+        seq_len = len(start_seq)
+        is_mutated = np.zeros(seq_len, dtype=bool)
+        intermediate_seq = start_seq
+        mutate_time = 0
+        mutations = []
+        while with_replacement or not np.all(is_mutated):
+            feature_vec_dict = simulator.feature_generator.create_for_sequence(intermediate_seq, left_flank, right_flank)
+            hazards = np.array([
+                simulator._get_target_hazards(feature_vec_dict[p], p, intermediate_seq[p])
+                for p in range(seq_len)
+            ])
+            hazards[is_mutated] = 0
+            mutate_time += np.random.exponential(1. / (simulator.lambda0 * hazards.sum()))
+            if censoring_time is not None and censoring_time < mutate_time:
+                break
+            elif percent_mutated is not None and len(mutations) >= percent_mutated * seq_len:
+                break
+
+            sampled_idx = np.random.choice(hazards.size, p=hazards.ravel() / hazards.sum())
+            mutate_pos = sampled_idx / NUM_NUCLEOTIDES
+            nucleotide_target = NUCLEOTIDES[sampled_idx % NUM_NUCLEOTIDES]
+            mutations.append(MutationEvent(mutate_time, mutate_pos, nucleotide_target))
+            intermediate_seq = mutate_string(intermediate_seq, mutate_pos, nucleotide_target)
+            if not with_replacement:
+                is_mutated[mutate_pos] = True
+        return FullSequenceMutations(start_seq, intermediate_seq, left_flank, right_flank, mutations)
+
+    def _get_summaries(self, simulate_func, **kwargs):
+        """
+        @return the average number of mutations and the frequency of each position/target nucleotide mutation
+        """
+        return self._get_sample_summaries([simulate_func(self.start_seq, **kwargs) for i in range(self.num_sims)])
+
+    def _get_sample_summaries(self, samples):
+        num_mutations = []
+        mutation_freqs = np.zeros((self.seq_len, NUM_NUCLEOTIDES))
+        for sample in samples:
+            num_mutations.append(len(sample.mutations))
+            for mut in sample.mutations:
+                mutation_freqs[mut.pos, NUCLEOTIDES.index(mut.target_nucleotide)] += 1
+        return np.mean(num_mutations), mutation_freqs/self.num_sims
+
+    def _check_simulators_agree(self, simulator, **kwargs):
+        mean_muts, mutation_freqs = self._get_summaries(simulator.simulate, **kwargs)
+        ref_mean_muts, ref_mutation_freqs = self._get_summaries(
+            lambda start_seq, **kwargs: self._simulate_from_scratch(simulator, start_seq, **kwargs),
+            **kwargs
+        )
+        self.assertTrue(np.abs(mean_muts - ref_mean_muts) < 0.15)
+        self.assertTrue(np.all(np.abs(mutation_freqs - ref_mutation_freqs) < 0.05))
+
+    def test_single_column(self):
+        theta = np.random.normal(size=(self.feat_gen.feature_vec_len, 1))
+        target_shape = (self.feat_gen.feature_vec_len, NUM_NUCLEOTIDES)
+        probability_matrix = np.random.rand(*target_shape)
+        probability_matrix[~self.feat_gen.get_possible_motifs_to_targets(target_shape)] = 0
+        simulator = SurvivalModelSimulatorSingleColumn(theta, probability_matrix, self.feat_gen, lambda0=0.1)
+        self._check_simulators_agree(simulator, censoring_time=2.)
+        self._check_simulators_agree(simulator, percent_mutated=0.3)
+
+    def test_multi_column(self):
+        theta = np.random.normal(size=(self.feat_gen.feature_vec_len, NUM_NUCLEOTIDES))
+        simulator = SurvivalModelSimulatorMultiColumn(theta, self.feat_gen, lambda0=0.1)
+        self._check_simulators_agree(simulator, censoring_time=2.)
+        self._check_simulators_agree(simulator, censoring_time=0.5, with_replacement=True)
+
+    def test_position_dependent(self):
+        theta = np.random.normal(size=(self.feat_gen.feature_vec_len, 1))
+        target_shape = (self.feat_gen.feature_vec_len, NUM_NUCLEOTIDES)
+        probability_matrix = np.ones(target_shape)
+        probability_matrix[~self.feat_gen.get_possible_motifs_to_targets(target_shape)] = 0
+        pos_risk = np.random.normal(size=self.seq_len)
+        simulator = SurvivalModelSimulatorPositionDependent(theta, probability_matrix, self.feat_gen, lambda0=0.1, pos_risk=pos_risk)
+        self._check_simulators_agree(simulator, censoring_time=2.)
+
+    def test_simulate_many(self):
+        # The distribution checks below are only tested at one seed, so do not depend on which tests ran before
+        set_random_seed(0)
+        theta = np.random.normal(size=(self.feat_gen.feature_vec_len, NUM_NUCLEOTIDES))
+        simulator = SurvivalModelSimulatorMultiColumn(theta, self.feat_gen, lambda0=0.1)
+        start_seqs = [self.start_seq, self.start_seq[:-1], self.start_seq]
+
+        # Results should not depend on whether or not a pool is used
+        samples = simulator.simulate_many(start_seqs, censoring_time=2., seed=10)
+        pool = Pool(2)
+        pool_samples = simulator.simulate_many(start_seqs, censoring_time=2., seed=10, pool=pool, num_jobs=2)
+        pool.close()
+        self.assertEqual([s.end_seq for s in samples], [s.end_seq for s in pool_samples])
+        self.assertEqual([len(s.start_seq) for s in samples], [12, 11, 12])
+
+        # Lockstep simulation should have the same distribution as the regular simulation
+        for kwargs in [dict(censoring_time=2.), dict(percents_mutated=[0.3] * self.num_sims), dict(censoring_time=0.5, with_replacement=True)]:
+            lockstep_samples = simulator.simulate_many([self.start_seq] * self.num_sims, lockstep=True, **kwargs)
+            samples = simulator.simulate_many([self.start_seq] * self.num_sims, **kwargs)
+            mean_muts, mutation_freqs = self._get_sample_summaries(lockstep_samples)
+            ref_mean_muts, ref_mutation_freqs = self._get_sample_summaries(samples)
+            self.assertTrue(np.abs(mean_muts - ref_mean_muts) < 0.15)
+            self.assertTrue(np.all(np.abs(mutation_freqs - ref_mutation_freqs) < 0.05))
+            for s in lockstep_samples[:10]:
+                # the ending sequence must match the mutation history
+                end_seq = s.start_seq
+                for m in s.mutations:
+                    end_seq = end_seq[:m.pos] + m.target_nucleotide + end_seq[m.pos + 1:]
+                self.assertEqual(end_seq, s.end_seq)
+
+    def test_lockstep_requires_motif_model(self):
+        # Position features are not a function of the motif window, so lockstep simulation must refuse them
+        feat_gen = CombinedFeatureGenerator(
+            feat_gen_list=[
+                MotifFeatureGenerator(motif_len=3, distance_to_start_of_motif=-1),
+                PositionFeatureGenerator(breaks=[0, self.seq_len / 2, len(self.start_seq)]),
+            ],
+            left_update_region=1,
+            right_update_region=1,
+        )
+        theta = np.random.normal(size=(feat_gen.feature_vec_len, NUM_NUCLEOTIDES))
+        simulator = SurvivalModelSimulatorMultiColumn(theta, feat_gen, lambda0=0.1)
+        with self.assertRaises(ValueError):
+            simulator.simulate_many([self.start_seq[2:-2]], left_flanks=["g"], right_flanks=["c"], censoring_time=2., lockstep=True)
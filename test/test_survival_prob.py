@@ -6,13 +6,14 @@ from hier_motif_feature_generator import HierarchicalMotifFeatureGenerator
 from survival_problem_cvxpy import SurvivalProblemLassoCVXPY
 from survival_problem_lasso import SurvivalProblemLasso
 from common import *
+from sampling_utils import set_random_seed
 
 class Survival_Problem_TestCase(unittest.TestCase):
     """
     Show that the values from CVXPY and our own impelmentation is the same
     """
     def _test_value_calculation_size(self, theta_num_col):
-        np.random.seed(10)
+        set_random_seed(10)
         motif_len = 3
         penalty_param = 0.5
 
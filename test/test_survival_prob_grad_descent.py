@@ -9,11 +9,12 @@ from mutation_order_gibbs import MutationOrderGibbsSampler
 from survival_problem_grad_descent import SurvivalProblemCustom
 from survival_problem_grad_descent_workers import *
 from common import *
+from sampling_utils import set_random_seed
 
 class Survival_Problem_Gradient_Descent_TestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        np.random.seed(10)
+        set_random_seed(10)
         cls.motif_len = 5
 
         cls.feat_gen_hier = HierarchicalMotifFeatureGenerator(motif_lens=[3,5], left_motif_flank_len_list=[[0,1], [2]])
@@ -74,6 +75,19 @@ class Survival_Problem_Gradient_Descent_TestCase(unittest.TestCase):
         fast_ll = LogLikelihoodWorker(sample_data, per_target).run_worker(theta)
         self.assertTrue(np.allclose(fast_ll, old_ll))
 
+        # Evaluate a stack of thetas at once
+        thetas = [theta, theta * 0.5, np.random.rand(feat_gen.feature_vec_len, theta_num_col)]
+        thetas[2][~theta_mask] = -np.inf
+        stacked_lls = LogLikelihoodWorker(sample_data, per_target).run_worker(np.dstack(thetas))
+        self.assertEqual(stacked_lls.shape, (len(thetas),))
+        for t, stacked_ll in zip(thetas, stacked_lls):
+            self.assertTrue(np.allclose(stacked_ll, self.calculate_log_likelihood_slow(t, feat_gen, sample)))
+
+        ref_ll_vec = prob_solver.get_log_lik_vec(thetas[0])
+        ll_ratio_vecs = prob_solver.calculate_log_lik_ratio_vecs(thetas[1:], ref_ll_vec)
+        for t, ll_ratio_vec in zip(thetas[1:], ll_ratio_vecs):
+            self.assertTrue(np.allclose(ll_ratio_vec, prob_solver.calculate_log_lik_ratio_vec(t, thetas[0])))
+
     def test_log_likelihood_calculation(self):
         self._compare_log_likelihood_calculation(self.feat_gen_hier, self.sample_hier, False)
         self._compare_log_likelihood_calculation(self.feat_gen_hier, self.sample_hier, True)